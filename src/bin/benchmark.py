@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""Benchmark CLI
+
+   Measures the throughput of the disk processing building blocks on this host."""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from util.compression import DEFAULT_LEVEL, gzip_stream
+from util.io_policy import POLICIES, PolicyReader, drop_cached_range
+from util.logger import LOGGER
+from util.zero_blocks import ZeroBlockScanner
+
+MIB = 1024 * 1024
+
+
+def _throughput(size, elapsed):
+    """Format a throughput in MiB/s."""
+    return '{:.1f} MiB/s'.format(size / MIB / max(elapsed, 1e-9))
+
+
+@contextmanager
+def sample_disk(args):
+    """Yield the path of the disk to benchmark, generating a temporary sample if needed.
+
+    The generated sample mixes holes, zero-filled blocks and random data in the proportions
+    given on the command line, roughly like an installed BIG-IP raw disk."""
+    if args.file:
+        yield args.file
+        return
+
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        path = os.path.join(work_dir, 'sample.raw')
+        chunk = 4 * MIB
+        rng = random.Random(0)
+        with open(path, 'wb') as sample:
+            sample.truncate(args.size * MIB)
+            for offset in range(0, args.size * MIB, chunk):
+                draw = rng.random()
+                if draw < args.data_ratio:
+                    sample.seek(offset)
+                    sample.write(os.urandom(chunk))
+                elif draw < args.data_ratio + args.zero_ratio:
+                    sample.seek(offset)
+                    sample.write(bytes(chunk))
+        yield path
+
+
+def benchmark_zero_blocks(args):
+    """Zero block scan throughput for each block size."""
+    with sample_disk(args) as path:
+        size = os.path.getsize(path)
+        for block_kb in args.block_sizes:
+            scanner = ZeroBlockScanner(path, block_kb * 1024)
+            start = time.monotonic()
+            nonzero = sum(length for _, length in scanner.iter_nonzero_ranges())
+            elapsed = time.monotonic() - start
+            LOGGER.info('zero-blocks block=%dKiB: %s of disk, %s of scanned data '
+                        '(%d MiB non-zero, %d MiB zero, %d MiB holes)',
+                        block_kb, _throughput(size, elapsed),
+                        _throughput(scanner.scanned_bytes, elapsed), nonzero // MIB,
+                        scanner.zero_bytes // MIB, scanner.hole_bytes // MIB)
+
+
+def _cached_bytes():
+    """Size of the host page cache according to /proc/meminfo."""
+    with open('/proc/meminfo') as meminfo:
+        for line in meminfo:
+            if line.startswith('Cached:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _hash_with_policy(path, policy):
+    """Hash a file through a PolicyReader, like the hash and upload stages do."""
+    digest = hashlib.md5()
+    reader = PolicyReader(path, policy)
+    try:
+        buffer = bytearray(reader.chunk_size)
+        view = memoryview(buffer)
+        while True:
+            length = reader.readinto(view)
+            if not length:
+                return reader.policy
+            digest.update(view[:length])
+    finally:
+        reader.close()
+
+
+def benchmark_io_policy(args):
+    """Aggregate read throughput and page cache growth of concurrent readers per I/O policy."""
+    with sample_disk(args) as path:
+        size = os.path.getsize(path)
+        for policy in args.policies:
+            # Start every policy from a cold cache for the sample.
+            with open(path, 'rb') as disk_file:
+                drop_cached_range(disk_file.fileno(), 0, 0)
+            cached_before = _cached_bytes()
+            start = time.monotonic()
+            with ThreadPoolExecutor(args.readers) as executor:
+                used = set(executor.map(_hash_with_policy, [path] * args.readers,
+                                        [policy] * args.readers))
+            elapsed = time.monotonic() - start
+            cache_growth = max(_cached_bytes() - cached_before, 0)
+            LOGGER.info('io-policy %s (%s), %d readers: %s aggregate, page cache +%d MiB',
+                        policy, '/'.join(sorted(used)), args.readers,
+                        _throughput(size * args.readers, elapsed), cache_growth // MIB)
+
+
+def _log_compression(name, level, size, compressed_size, elapsed):
+    LOGGER.info('compression %s level=%d: %s, %d MiB -> %d MiB (%.1f%%)', name, level,
+                _throughput(size, elapsed), size // MIB, compressed_size // MIB,
+                100.0 * compressed_size / max(size, 1))
+
+
+def benchmark_compression(args):
+    """Parallel deflate throughput and ratio per thread count, against gzip, pigz and zip."""
+    with sample_disk(args) as path:
+        size = os.path.getsize(path)
+        for threads in args.threads:
+            with open(path, 'rb') as input_file, \
+                    tempfile.TemporaryFile(dir=args.work_dir) as output_file:
+                start = time.monotonic()
+                _, compressed_size = gzip_stream(input_file, output_file, level=args.level,
+                                                 threads=threads)
+                output_file.flush()
+                elapsed = time.monotonic() - start
+            _log_compression('parallel-deflate threads={}'.format(threads), args.level, size,
+                             compressed_size, elapsed)
+
+        level_option = '-{}'.format(args.level)
+        for command in (['gzip', level_option, '-c', path], ['pigz', level_option, '-c', path],
+                        ['zip', '-q', level_option, '-j', '-', path]):
+            if not shutil.which(command[0]):
+                LOGGER.info('compression %s: not installed', command[0])
+                continue
+            with tempfile.TemporaryFile(dir=args.work_dir) as output_file:
+                start = time.monotonic()
+                subprocess.run(command, stdout=output_file, check=True)
+                elapsed = time.monotonic() - start
+                compressed_size = os.fstat(output_file.fileno()).st_size
+            _log_compression(command[0], args.level, size, compressed_size, elapsed)
+
+
+def _same_data(path, snapshot_path, size):
+    """Whether the first size bytes of two files are identical."""
+    with open(path, 'rb') as disk_file, open(snapshot_path, 'rb') as snapshot_file:
+        for _ in range(0, size, 4 * MIB):
+            if disk_file.read(4 * MIB) != snapshot_file.read(4 * MIB):
+                return False
+    return True
+
+
+def _change_blocks(path, changed_path, ratio):
+    """Copy a disk, overwriting the given fraction of its EBS blocks with random data or
+    zeroes, like a rebuild with a few changed files."""
+    # pylint: disable=import-outside-toplevel
+    from image.aws_ebs_snapshot import EBS_BLOCK_SIZE
+    shutil.copyfile(path, changed_path)
+    rng = random.Random(1)
+    with open(changed_path, 'r+b') as changed_file:
+        for offset in range(0, os.path.getsize(path), EBS_BLOCK_SIZE):
+            if rng.random() < ratio:
+                changed_file.seek(offset)
+                changed_file.write(os.urandom(EBS_BLOCK_SIZE) if rng.random() < 0.8 else
+                                   bytes(EBS_BLOCK_SIZE))
+
+
+def _write_snapshot(args, stub, writer, path, parent_snapshot_id=None, parent_blocks=None):
+    """Write a disk with an EbsSnapshotWriter and log the throughput."""
+    # pylint: disable=import-outside-toplevel
+    from image.aws_ebs_snapshot import EBS_BLOCK_SIZE
+    size = os.path.getsize(path)
+    scanner = ZeroBlockScanner(path, EBS_BLOCK_SIZE)
+    start = time.monotonic()
+    writer.write(size, scanner.iter_nonzero_chunks(), 'benchmark', parent_snapshot_id,
+                 parent_blocks)
+    elapsed = time.monotonic() - start
+    verified = ''
+    if args.verify:
+        verified = ', verified' if _same_data(path, stub.get_image_path(writer.snapshot_id),
+                                              size) else ', MISMATCH'
+    LOGGER.info('ebs-direct%s concurrency=%d latency=%dms: %s of disk, %s sent '
+                '(%d blocks, %d MiB)%s', ' incremental' if parent_snapshot_id else '',
+                writer.concurrency, args.latency, _throughput(size, elapsed),
+                _throughput(writer.sent_bytes, elapsed), len(writer.block_checksums),
+                writer.sent_bytes // MIB, verified)
+
+
+def benchmark_ebs_direct(args):
+    """EBS direct API snapshot write throughput per concurrency, against a local stub. With
+    --changed-ratio, also writes a changed copy of the disk incrementally over the snapshot."""
+    # The EBS modules need botocore, which is only installed on AWS build hosts.
+    # pylint: disable=import-outside-toplevel
+    from image.aws_ebs_snapshot import EbsSnapshotWriter
+    from image.aws_ebs_stub import EbsDirectStub
+    with sample_disk(args) as path:
+        for concurrency in args.concurrency:
+            with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+                stub = EbsDirectStub(work_dir if args.verify else None, args.latency / 1000.0)
+                writer = EbsSnapshotWriter(stub, concurrency)
+                _write_snapshot(args, stub, writer, path)
+                if args.changed_ratio:
+                    changed_path = os.path.join(work_dir, 'changed.raw')
+                    _change_blocks(path, changed_path, args.changed_ratio)
+                    parent_snapshot_id, parent_blocks = writer.snapshot_id, writer.blocks
+                    writer = EbsSnapshotWriter(stub, concurrency)
+                    _write_snapshot(args, stub, writer, changed_path, parent_snapshot_id,
+                                    parent_blocks)
+
+
+def main():
+    """Main benchmark helper"""
+    parser = argparse.ArgumentParser(description='Benchmark disk processing building blocks')
+    parser.add_argument('-f', '--file',
+                        help='Existing disk to benchmark with instead of a generated sample')
+    parser.add_argument('-s', '--size', type=int, default=1024,
+                        help='Size of the generated sample disk in MiB')
+    parser.add_argument('--data-ratio', type=float, default=0.3,
+                        help='Fraction of the generated sample filled with random data')
+    parser.add_argument('--zero-ratio', type=float, default=0.3,
+                        help='Fraction of the generated sample filled with allocated zeroes')
+    parser.add_argument('-w', '--work-dir',
+                        help='Directory for the generated sample and temporary outputs')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    zero_blocks = subparsers.add_parser('zero-blocks', help=benchmark_zero_blocks.__doc__)
+    zero_blocks.add_argument('-b', '--block-sizes', type=int, nargs='+',
+                             default=[4, 64, 512, 4096], help='Block sizes in KiB')
+    zero_blocks.set_defaults(func=benchmark_zero_blocks)
+
+    io_policy = subparsers.add_parser('io-policy', help=benchmark_io_policy.__doc__)
+    io_policy.add_argument('-p', '--policies', nargs='+', choices=POLICIES, default=POLICIES,
+                           help='I/O policies to compare')
+    io_policy.add_argument('-r', '--readers', type=int, default=4,
+                           help='Number of concurrent readers, as in concurrent builds')
+    io_policy.set_defaults(func=benchmark_io_policy)
+
+    compression = subparsers.add_parser('compression', help=benchmark_compression.__doc__)
+    compression.add_argument('-l', '--level', type=int, default=DEFAULT_LEVEL,
+                             choices=range(1, 10), metavar='1-9', help='Compression level')
+    compression.add_argument('-t', '--threads', type=int, nargs='+',
+                             default=sorted({1, os.cpu_count() or 1}),
+                             help='Thread counts of the parallel deflate engine')
+    compression.set_defaults(func=benchmark_compression)
+
+    ebs_direct = subparsers.add_parser('ebs-direct', help=benchmark_ebs_direct.__doc__)
+    ebs_direct.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 4, 16, 64],
+                            help='Numbers of blocks written at the same time')
+    ebs_direct.add_argument('-l', '--latency', type=int, default=20,
+                            help='Simulated latency of every EBS call in milliseconds')
+    ebs_direct.add_argument('--changed-ratio', type=float, default=0.0,
+                            help='Fraction of blocks changed in a copy of the disk written '
+                                 'incrementally over the first snapshot')
+    ebs_direct.add_argument('--verify', action='store_true',
+                            help='Write the snapshots to raw files and compare them to the disks')
+    ebs_direct.set_defaults(func=benchmark_ebs_direct)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
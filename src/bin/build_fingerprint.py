@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Build fingerprint CLI
+
+   Computes the fingerprint of a build from its inputs, records it next to the bundles the build
+   produces, and checks whether a published bundle was produced by a build."""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import json
+import sys
+from util.build_fingerprint import (compute_build_fingerprint, get_build_inputs,
+                                    is_built_bundle, write_build_record)
+from util.logger import LOGGER
+from util.misc import create_log_handler
+
+def main():
+    """ Wrapper to compute, record and check build fingerprints """
+    parser = argparse.ArgumentParser(description='Compute, record or check build fingerprints')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compute_parser = subparsers.add_parser(
+        'compute', help='Print the fingerprint of a build, saving it with its inputs to a file')
+    compute_parser.add_argument('-p', '--platform', required=True, help='Target platform')
+    compute_parser.add_argument('-m', '--modules', required=True, help='BIG-IP modules')
+    compute_parser.add_argument('-b', '--boot-locations', required=True,
+                                help='Number of boot locations')
+    compute_parser.add_argument('-i', '--iso', required=True, help='BIG-IP ISO')
+    compute_parser.add_argument('-e', '--ehf-iso', default='', help='Engineering hotfix ISO')
+    compute_parser.add_argument('output', help='File to save the fingerprint and inputs to')
+
+    record_parser = subparsers.add_parser(
+        'record', help='Record the fingerprint of a build next to the bundles it produced')
+    record_parser.add_argument('build', help='File saved by the compute command')
+    record_parser.add_argument('bundles', nargs='+', help='Bundles produced by the build')
+
+    check_parser = subparsers.add_parser(
+        'check', help='Print the bundle if it was produced by a build with this fingerprint, '
+                      'else an empty line')
+    check_parser.add_argument('fingerprint', help='Build fingerprint')
+    check_parser.add_argument('bundle', help='Published bundle')
+    args = parser.parse_args()
+
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    try:
+        if args.command == 'compute':
+            inputs = get_build_inputs(args.platform, args.modules, args.boot_locations,
+                                      args.iso, args.ehf_iso)
+            build_fingerprint = compute_build_fingerprint(inputs)
+            with open(args.output, 'w') as output_file:
+                json.dump({'build_fingerprint': build_fingerprint, 'inputs': inputs},
+                          output_file, indent=4, sort_keys=True)
+            LOGGER.info('Build fingerprint: %s', build_fingerprint)
+            print(build_fingerprint)
+        elif args.command == 'record':
+            with open(args.build) as build_file:
+                build = json.load(build_file)
+            for bundle in args.bundles:
+                write_build_record(bundle, build['build_fingerprint'], build['inputs'])
+        else:
+            print(args.bundle if is_built_bundle(args.bundle, args.fingerprint) else '')
+    except (RuntimeError, ValueError, OSError, KeyError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Compression CLI
+
+   Compresses files into gzip or zip archives on all CPUs, like pigz, and raw disks into
+   sparse tar.gz archives."""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import sys
+from disk.sparse_tar import create_tar_gz
+from util.compression import DEFAULT_LEVEL, gzip_file, zip_files
+from util.digests import store_file
+from util.logger import LOGGER
+from util.misc import create_log_handler
+
+def main():
+    """ Wrapper to compress files with the parallel deflate engine """
+    parser = argparse.ArgumentParser(
+        description='Compress files into gzip or zip archives, deflating blocks in parallel')
+    parser.add_argument('-l', '--level', type=int, default=DEFAULT_LEVEL,
+                        choices=range(1, 10), metavar='1-9', help='Compression level')
+    parser.add_argument('-j', '--threads', type=int,
+                        help='Compression threads, COMPRESSION_THREADS or all CPUs by default')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    gzip_parser = subparsers.add_parser('gzip', help='Compress a file or stdin with gzip')
+    gzip_parser.add_argument('input', help='File to compress, - for stdin')
+    gzip_parser.add_argument('output', help='gzip file to write, - for stdout')
+
+    zip_parser = subparsers.add_parser('zip', help='Create a zip archive of files, like zip -j')
+    zip_parser.add_argument('zip', help='Zip archive to create')
+    zip_parser.add_argument('inputs', nargs='+', help='Files to add under their base name')
+
+    tar_parser = subparsers.add_parser(
+        'tar', help='Archive a disk as the sparse member of a tar.gz archive, like '
+        'tar --format=oldgnu -Sczf')
+    tar_parser.add_argument('tar', help='tar.gz archive to create')
+    tar_parser.add_argument('raw_disk', help='Disk to archive, a regular file')
+    tar_parser.add_argument('-n', '--name', help='Member name, the disk base name by default')
+    tar_parser.add_argument('--no-sparse', dest='sparse', action='store_false',
+                            help='Archive holes as zeroes, like tar -czf')
+
+    store_parser = subparsers.add_parser(
+        'store', help='Write stdin, for example the output of zstd, to a file and record its '
+        'digests')
+    store_parser.add_argument('output', help='File to write')
+    store_parser.add_argument('-m', '--member', help='File held by the output, for its listing')
+    args = parser.parse_args()
+
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    try:
+        if args.command == 'gzip':
+            gzip_file(args.input, args.output, args.level, args.threads)
+        elif args.command == 'tar':
+            create_tar_gz(args.raw_disk, args.tar, args.name, args.sparse, args.level,
+                          args.threads)
+        elif args.command == 'store':
+            store_file(args.output, args.member)
+        else:
+            zip_files(args.zip, args.inputs, args.level, args.threads)
+    except (RuntimeError, ValueError, OSError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
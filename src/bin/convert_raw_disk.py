@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+""" Convert a raw disk into one or more virtual disk formats with a single read """
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import sys
+from disk.converter import ConversionTarget, convert_raw_disk, get_layout_data_ranges
+from util.config import get_list_from_config_yaml
+from util.logger import LOGGER
+from util.misc import create_log_handler
+
+def main():
+    """ Wrapper to convert a raw disk into several formats at once """
+    parser = argparse.ArgumentParser(
+        description='Convert a raw disk into vpc, qcow2 and vmdk images with one read')
+    parser.add_argument('raw_disk', help='Raw disk to convert')
+    parser.add_argument('-t', '--target', nargs=3, action='append', required=True,
+                        metavar=('FORMAT', 'PATH', 'OPTIONS'),
+                        help='Output in qemu-img format FORMAT (vpc, qcow2 or vmdk) with '
+                             'qemu-img style OPTIONS (may be empty), repeatable')
+    parser.add_argument('-l', '--layout', action='store_true',
+                        help='Skip free LVM extents and empty LVs of the raw disk')
+    args = parser.parse_args()
+
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    try:
+        ranges = None
+        if args.layout:
+            ranges = get_layout_data_ranges(args.raw_disk,
+                                            get_list_from_config_yaml('RAW_DISK_EMPTY_LVS'))
+        convert_raw_disk(args.raw_disk, [ConversionTarget(*target) for target in args.target],
+                         ranges)
+    except (RuntimeError, ValueError, OSError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Create OVAs from a raw disk in one pass without qemu-img or ovftool, or customize the OVA
+created by ovftool without extracting it. Several variants of the OVA, differing in their
+descriptor and archive format, can be packaged from a single VMDK"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import os
+import sys
+from disk.converter import get_layout_data_ranges
+from disk.ova import OvaVariant, create_ova, rewrite_ova
+from disk.ovf import build_ovf, customize_ovf, ovf_to_bytes, parse_ovf, read_vmx, write_ovf
+from exceptions import ReturnCodeError
+from util.config import get_config_value, get_list_from_config_yaml
+from util.logger import LOGGER
+from util.misc import call_subprocess, create_log_handler, get_disk_size
+
+
+def sign_manifest(manifest_path):
+    """Sign the manifest with IMAGE_SIG_PRIVATE_KEY and IMAGE_SIG_ENCRYPTION_TYPE.
+    Returns the signature and public key files to add to the OVA."""
+    private_key = get_config_value('IMAGE_SIG_PRIVATE_KEY')
+    public_key = get_config_value('IMAGE_SIG_PUBLIC_KEY')
+    if not private_key or not public_key:
+        LOGGER.warning('No signing keys were provided.  Skipping OVA signing process!')
+        return []
+    encryption_type = get_config_value('IMAGE_SIG_ENCRYPTION_TYPE')
+    base_path = os.path.splitext(manifest_path)[0]
+    sig_file = base_path + '.sig'
+    pub_file = base_path + '.pub'
+    LOGGER.info('Signing manifest %s using encryption type %s with private key %s',
+                manifest_path, encryption_type, private_key)
+    try:
+        call_subprocess(['openssl', 'dgst', '-' + encryption_type, '-sign', private_key,
+                         '-out', sig_file, manifest_path])
+    except ReturnCodeError:
+        LOGGER.error('Unable to sign manifest %s using private key %s!', manifest_path,
+                     private_key)
+        if os.path.exists(sig_file):
+            os.unlink(sig_file)
+        return []
+    with open(public_key, 'rb') as public_key_file, open(pub_file, 'wb') as pub:
+        pub.write(public_key_file.read())
+    return [sig_file, pub_file]
+
+
+# Customizations of the OVF descriptor, see customize_ovf().
+VARIANT_KINDS = ['vmware', 'vcloud']
+
+
+def customize(envelope, args, vcloud):
+    """Apply the BIG-IP customization of the OVF descriptor."""
+    net_properties_version = None
+    if get_config_value('OVA_PROP_NET_USER'):
+        if not args.version_number:
+            raise ValueError('OVA_PROP_NET_USER requires the BIG-IP version number')
+        net_properties_version = args.version_number
+    return customize_ovf(envelope, args.product_version, args.product_build,
+                         net_properties_version, vcloud)
+
+
+def get_variants(args):
+    """OvaVariant list of the --variant arguments."""
+    def get_transform(vcloud):
+        return lambda ovf_data: ovf_to_bytes(customize(parse_ovf(ovf_data), args, vcloud))
+
+    for kind, path in args.variant:
+        if kind not in VARIANT_KINDS:
+            raise ValueError('Unknown OVA variant {} for {}, expected one of {}'.format(
+                kind, path, ', '.join(VARIANT_KINDS)))
+    return [OvaVariant(path, get_transform(kind == 'vcloud')) for kind, path in args.variant]
+
+
+def add_variant_arguments(parser):
+    """Arguments of the archives to create and of the BIG-IP customization of their OVF
+    descriptor."""
+    parser.add_argument('-V', '--variant', nargs=2, action='append', required=True,
+                        metavar=('KIND', 'ARCHIVE'),
+                        help='Archive to create, a zip archive if it ends in .zip, with the '
+                             'OVF customization KIND: vmware, or vcloud to leave out what '
+                             'vCloud Director cannot handle, like deployment options. '
+                             'Can be repeated to package the same VMDK into several archives')
+    parser.add_argument('--product-version', required=True, help='BIG-IP version, e.g. 16.1.2')
+    parser.add_argument('--product-build', required=True, help='BIG-IP build, e.g. 0.0.18')
+    parser.add_argument('--version-number', type=int,
+                        help='BIG-IP version number (e.g. 16010200), required for '
+                             'OVA_PROP_NET_USER')
+
+
+def main():
+    """ Wrapper to generate an OVF descriptor, package it with a raw disk or rewrite an OVA """
+    parser = argparse.ArgumentParser(
+        description='Generate the OVF descriptor of a VMX, package customized variants of an OVF '
+                    'descriptor and a streamOptimized VMDK of a raw disk into OVAs, or customize '
+                    'the OVF descriptor of an OVA created by ovftool')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ovf_parser = subparsers.add_parser('ovf', help='Generate an OVF descriptor')
+    ovf_parser.add_argument('vmx', help='VMX file describing the virtual machine')
+    ovf_parser.add_argument('raw_disk', help='Raw disk of the virtual machine')
+    ovf_parser.add_argument('vmdk_name', help='Name of the VMDK in the OVA')
+    ovf_parser.add_argument('ovf', help='OVF descriptor to write')
+    ovf_parser.add_argument('--eula', help='Text file with an end-user license agreement')
+
+    ova_parser = subparsers.add_parser('ova', help='Create OVA (tar) or zip archives')
+    ova_parser.add_argument('raw_disk', help='Raw disk to package')
+    ova_parser.add_argument('vmdk_name', help='Name of the VMDK in the OVA')
+    ova_parser.add_argument('ovf', help='OVF descriptor generated by the ovf command')
+    ova_parser.add_argument('-a', '--adapter-type', default='lsilogic',
+                            help='Adapter type recorded in the VMDK')
+    ova_parser.add_argument('-j', '--threads', type=int,
+                            help='Threads compressing the VMDK, all CPUs by default')
+    ova_parser.add_argument('-l', '--layout', action='store_true',
+                            help='Skip free LVM extents and empty LVs of the raw disk')
+    add_variant_arguments(ova_parser)
+
+    rewrite_parser = subparsers.add_parser(
+        'rewrite', help='Customize the OVF descriptor of an OVA created by ovftool')
+    rewrite_parser.add_argument('source_ova', help='OVA created by ovftool')
+    add_variant_arguments(rewrite_parser)
+    args = parser.parse_args()
+
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    try:
+        if args.command == 'ovf':
+            eula_text = None
+            if args.eula:
+                with open(args.eula, 'r') as eula_file:
+                    eula_text = eula_file.read()
+            write_ovf(build_ovf(read_vmx(args.vmx), args.vmdk_name, get_disk_size(args.raw_disk),
+                                eula_text), args.ovf)
+            LOGGER.info('Generated OVF descriptor %s from %s.', args.ovf, args.vmx)
+        elif args.command == 'rewrite':
+            rewrite_ova(args.source_ova, get_variants(args), sign_manifest)
+        else:
+            ranges = None
+            if args.layout:
+                ranges = get_layout_data_ranges(args.raw_disk,
+                                                get_list_from_config_yaml('RAW_DISK_EMPTY_LVS'))
+            create_ova(args.raw_disk, args.ovf, get_variants(args), args.vmdk_name, ranges,
+                       args.adapter_type, compress_threads=args.threads,
+                       sign_manifest=sign_manifest)
+    except (RuntimeError, ValueError, OSError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
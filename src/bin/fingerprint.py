@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Fingerprint CLI
+
+   Prints the fingerprint of build artifacts, computing and caching it if needed."""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import sys
+from util.fingerprint import get_fingerprint
+from util.logger import LOGGER
+from util.misc import create_log_handler
+
+def main():
+    """ Wrapper to print the cached BLAKE2b tree hash fingerprint of a file """
+    parser = argparse.ArgumentParser(
+        description='Print the fingerprint of a file or block device')
+    parser.add_argument('file', help='File to fingerprint')
+    parser.add_argument('-r', '--refresh', action='store_true',
+                        help='Recompute the fingerprint even if it is cached')
+    args = parser.parse_args()
+
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    try:
+        print(get_fingerprint(args.file, args.refresh) or '')
+    except (RuntimeError, ValueError, OSError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Fixed VHD CLI
+
+   Creates a fixed VHD from a raw disk by reflinking it and appending a footer."""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import json
+import sys
+from os.path import basename
+from disk.vhd import append_fixed_vhd_footer, read_footer
+from util.logger import LOGGER
+from util.materialize import materialize_file
+from util.misc import create_log_handler
+
+def main():
+    """ Wrapper to turn a reflinked copy of a raw disk into a fixed VHD """
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    if len(sys.argv) != 3:
+        LOGGER.error('%s received %s arguments, expected 2', basename(__file__), len(sys.argv) - 1)
+        sys.exit(1)
+
+    raw_disk, vhd = sys.argv[1:]
+    try:
+        # Never hardlink: the footer is appended to the new file in place.
+        result = materialize_file(raw_disk, vhd)
+        size = append_fixed_vhd_footer(vhd)
+        footer = read_footer(vhd)
+        LOGGER.info('Created %d byte fixed VHD %s from %s using %s (%d bytes copied).',
+                    size, vhd, raw_disk, result.strategy, result.bytes_copied)
+        LOGGER.debug('VHD footer: %s', json.dumps(footer))
+    except (RuntimeError, OSError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
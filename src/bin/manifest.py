@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Manifest CLI
+
+   Records the digests and chunk manifest of bundles, and verifies bundles against theirs."""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import sys
+from util.digests import record_digests
+from util.logger import LOGGER
+from util.manifest import verify_file
+from util.misc import create_log_handler
+
+def main():
+    """ Wrapper to record and verify chunk manifests """
+    parser = argparse.ArgumentParser(description='Record or verify the chunk manifest of files')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser(
+        'record', help='Read a file once to record its digests, fingerprint and manifest')
+    record_parser.add_argument('file', help='File to record')
+
+    verify_parser = subparsers.add_parser(
+        'verify', help='Check the chunks of a file in parallel, printing the mismatching ones')
+    verify_parser.add_argument('file', help='File to verify')
+    verify_parser.add_argument('-m', '--manifest',
+                               help='Manifest of the file, <file>.manifest.json by default')
+    verify_parser.add_argument('-j', '--threads', type=int,
+                               help='Hashing threads, all CPUs by default')
+    args = parser.parse_args()
+
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    try:
+        if args.command == 'record':
+            record_digests(args.file)
+        else:
+            mismatching = verify_file(args.file, args.manifest, args.threads)
+            for index in mismatching:
+                print(index)
+            if mismatching:
+                LOGGER.error('%d chunks of %s do not match its manifest.', len(mismatching),
+                             args.file)
+                sys.exit(1)
+    except (RuntimeError, ValueError, OSError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Materialize file CLI
+
+   Makes a large file available at a new path using reflinks, hardlinks or sparse copies."""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import argparse
+import sys
+
+from util.logger import LOGGER
+from util.materialize import materialize_file
+from util.misc import create_log_handler
+
+def main():
+    """Main materialize file helper"""
+    parser = argparse.ArgumentParser(description='Materialize a file at a new path')
+    parser.add_argument('-i', '--immutable', action='store_true',
+                        help='The source is never modified in place, allow hardlinks')
+    parser.add_argument('-m', '--move', action='store_true',
+                        help='Remove the source once it is materialized')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='Copy the chunks listed by the manifest of the source that an '
+                        'interrupted or earlier copy does not hold')
+    parser.add_argument('source', help='Source file')
+    parser.add_argument('destination', help='Destination file or directory')
+
+    args = parser.parse_args()
+
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    try:
+        materialize_file(args.source, args.destination, args.immutable, args.move, args.resume)
+    except (RuntimeError, ValueError, OSError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
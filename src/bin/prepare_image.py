@@ -20,7 +20,7 @@ import sys
 from image.image_controller import ImageController
 from util.config import get_config_value
 from util.logger import LOGGER
-from util.misc import create_log_handler
+from util.misc import create_log_handler, save_image_id
 
 def main():
     """main command handler"""
@@ -30,8 +30,15 @@ def main():
                         help='Absolute path to the artifacts directory')
     parser.add_argument('-c', '--check-name', action="store_true",
                         help='Check cloud image name')
+    parser.add_argument('-f', '--find-build', default='',
+                        help='Look up an existing cloud image built with this build fingerprint, '
+                             'saving its id to image_id.json if there is one')
     parser.add_argument('-i', '--input', required=True,
                         help='Absolute path to the input virtual disk')
+    parser.add_argument('-o', '--uploaded-disk', default='',
+                        help='Create the image from this disk object, uploaded earlier from the '
+                             'same input (S3 key, GCS blob, Azure page blob URL or OSS object), '
+                             'instead of uploading the input disk')
     parser.add_argument('-p', '--platform', required=True,
                         help='The cloud type (i.e. aws, gce, azure, alibaba)')
     parser.add_argument('-s', '--seed-image-name', default='',
@@ -42,14 +49,29 @@ def main():
     args = parser.parse_args()
 
     # Check either seed or user cloud image name was provided
-    if (args.seed_image_name == '' and args.user_image_name == '') or \
-       (args.seed_image_name != '' and args.user_image_name != ''):
+    if args.find_build == '' and \
+       ((args.seed_image_name == '' and args.user_image_name == '') or
+        (args.seed_image_name != '' and args.user_image_name != '')):
         raise Exception('You must provide either --seed-image-name or --user-image-name')
 
     # create log handler for the global LOGGER
     create_log_handler()
 
-    if args.check_name:
+    if args.find_build:
+        # Look up the image of a previous build with the same inputs
+        try:
+            image_id = ImageController.find_tagged_image(args.platform, 'build_fingerprint',
+                                                         args.find_build)
+        except (RuntimeError, ValueError) as runtime_exce:
+            LOGGER.exception(runtime_exce)
+            sys.exit(1)
+        if image_id is None:
+            LOGGER.info("No image was built with build fingerprint '%s'.", args.find_build)
+        else:
+            LOGGER.info("Image '%s' was built with build fingerprint '%s'.", image_id,
+                        args.find_build)
+            save_image_id(image_id)
+    elif args.check_name:
         # Check name
         if args.user_image_name == '':
             raise Exception('--check-name can only be used with --user-image-name')
@@ -61,7 +83,8 @@ def main():
             # Prepare image
             image_controller = ImageController(args.artifacts_dir, args.platform,
                                                args.input)
-            image_controller.prepare(args.seed_image_name, args.user_image_name)
+            image_controller.prepare(args.seed_image_name, args.user_image_name,
+                                     args.uploaded_disk)
             # If execution came so far, all is well.
             result = True
         except RuntimeError as runtime_exce:
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+""" Map the partitions, LVs and free extents of a raw disk """
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import json
+import sys
+from os.path import basename
+from disk.raw_disk_layout import RawDiskLayout
+from util.config import get_list_from_config_yaml
+from util.logger import LOGGER
+from util.misc import create_log_handler
+
+def main():
+    """ Wrapper to write the layout report of a raw disk """
+    # create log handler for the global LOGGER
+    create_log_handler()
+
+    if len(sys.argv) != 3:
+        LOGGER.error('%s received %s arguments, expected 2', basename(__file__), len(sys.argv) - 1)
+        sys.exit(1)
+
+    try:
+        layout = RawDiskLayout(sys.argv[1], get_list_from_config_yaml('RAW_DISK_EMPTY_LVS'))
+        layout.load()
+        layout.log_report()
+        with open(sys.argv[2], 'w') as layout_json:
+            json.dump(layout.get_report(), layout_json, indent=4)
+    except (RuntimeError, ValueError) as runtime_exception:
+        LOGGER.exception(runtime_exception)
+        sys.exit(1)
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
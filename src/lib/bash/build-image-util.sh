@@ -17,6 +17,8 @@
 
 # shellcheck source=src/lib/bash/common.sh
 source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/common.sh"
+# shellcheck source=src/lib/bash/lvm_thin.sh
+source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/lvm_thin.sh"
 # shellcheck source=src/lib/bash/util/config.sh
 source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/util/config.sh"
 # shellcheck source=src/lib/bash/util/logger.sh
@@ -317,7 +319,7 @@ function check_iso_src {
                 "$PRODUCT_VERSION" "$PRODUCT_BUILD" "$PROJECT_NAME")"
         iso_name="$store_dir/$iso_name".iso
 
-        if ! mv -fv "$tmp_iso_path" "$iso_name"; then
+        if ! materialize_file --move --immutable "$tmp_iso_path" "$iso_name"; then
             echo "Error: Unable to move iso from $tmp_iso_path to $iso_name" > "$out_file"
             return 1
         fi
@@ -482,9 +484,12 @@ function get_disk_extension {
         alibaba|gce)
             extension='tar.gz'
             ;;
-        aws|qcow2|vhd)
+        aws)
             extension='zip'
             ;;
+        qcow2|vhd)
+            extension="$(get_bundle_compression_extension)" || return 1
+            ;;
         azure)
             extension='vhd.tar.gz'
             ;;
@@ -1014,7 +1019,7 @@ function create_disk_name {
             if [[ "$image_name" != *$plat ]]; then
                 image_name="${image_name}.$plat"
             fi
-                echo "$image_name.$format"
+                echo "$image_name${format:+.$format}"
             return
         fi
     fi
@@ -1057,8 +1062,8 @@ function create_disk_name {
     local sizing_type
     sizing_type="$(get_modules_production_name "$modules" "$boot_loc")"
 
-    # -- fixed suffix
-    output="$ehf_marker$output-$version-$build.$sizing_type.$platform.$format"
+    # -- fixed suffix, without an extension for uncompressed qcow2 and vhd bundles
+    output="$ehf_marker$output-$version-$build.$sizing_type.$platform${format:+.$format}"
     echo "$output"
 }
 
@@ -1147,6 +1152,218 @@ function produce_virtual_disk {
     if [[ $? -ne 0 ]]; then
         error_and_exit "Packaging virtual disk failed."
     fi
+
+    # Record the qemu-img convert profiles used for the disk.
+    local convert_profile_json="$artifacts_dir/convert_profile.json"
+    if [[ -s "$convert_profile_json" ]] && [[ -s "$prepare_vdisk_json" ]]; then
+        local vdisk_info
+        if vdisk_info="$(jq --slurpfile profile "$convert_profile_json" \
+                '.convert_profile = $profile[0]' "$prepare_vdisk_json")"; then
+            echo "$vdisk_info" > "$prepare_vdisk_json"
+        else
+            log_warning "Failed to add the convert profile to '$prepare_vdisk_json'."
+        fi
+    fi
+}
+
+
+# Check that a JSON document records the expected values, logging the ones that differ.
+# Usage: check_recorded_values <json_file> <jq_path> <expected_value> [<jq_path> <value>]...
+# return 0 if all values match; otherwise 1.
+function check_recorded_values {
+    local json_file="$1"
+    shift
+    if [[ $(($# % 2)) -ne 0 ]]; then
+        error_and_exit "${FUNCNAME[0]} received an odd number of path and value parameters: $*"
+    fi
+
+    local result=0
+    local recorded
+    while [[ $# -gt 0 ]]; do
+        if ! recorded="$(jq -r "$1 // empty" "$json_file" 2>&1)"; then
+            log_error "jq error while reading $1 from $json_file: $recorded"
+            return 1
+        elif [[ "$recorded" != "$2" ]]; then
+            log_error "$json_file records $1 '$recorded' instead of '$2'."
+            result=1
+        fi
+        shift 2
+    done
+    return $result
+}
+
+
+# Make a raw disk installed by a previous build the raw disk of this build, skipping the
+# installation. The prepare_raw_disk.json next to the installed disk (in the artifacts directory
+# of the previous build) must record a successful installation of the same ISOs for the same
+# platform, modules and boot locations, and the disk must not have changed since.
+# return 0 if successful; otherwise 1.
+function use_installed_raw_disk {
+    local installed_disk="$1"
+    local raw_disk="$2"
+    local platform="$3"
+    local modules="$4"
+    local boot_locations="$5"
+    local iso="$6"
+    local ehf_iso="$7"
+    if [[ $# -ne 7 ]]; then
+        error_and_exit "Received a wrong number ($#) of parameters: $*"
+    fi
+
+    local installed_dir
+    installed_dir="$(dirname "$installed_disk")"
+    if ! is_disk_file "$installed_disk"; then
+        log_error "Installed raw disk '$installed_disk' doesn't exist."
+        return 1
+    elif [[ ! -f "${installed_dir}/prepare_raw_disk.json" ]]; then
+        log_error "'$installed_disk' has no prepare_raw_disk.json record of its installation."
+        return 1
+    fi
+
+    # An empty fingerprint would match an empty record, so it rules the disk out.
+    local input_fingerprint installed_fingerprint
+    input_fingerprint="$(get_fingerprint "$iso" "$ehf_iso")"
+    installed_fingerprint="$(get_fingerprint "$installed_disk")"
+    if [[ -z "$input_fingerprint" ]] || [[ -z "$installed_fingerprint" ]]; then
+        log_error "'$installed_disk' or the ISOs can't be fingerprinted."
+        return 1
+    elif ! check_recorded_values "${installed_dir}/prepare_raw_disk.json" \
+            .status "success" \
+            .output "$(basename "$installed_disk")" \
+            .platform "$platform" \
+            .modules "$modules" \
+            .boot_locations "$boot_locations" \
+            .input_fingerprint "$input_fingerprint" \
+            .output_fingerprint "$installed_fingerprint"; then
+        log_error "'$installed_disk' wasn't installed by a build compatible with this one."
+        return 1
+    fi
+
+    local info_file="${installed_dir}/generator-info.json"
+    local installed_version current_version
+    current_version="$(get_config_value "VERSION_NUMBER")"
+    if [[ -f "$info_file" ]] && installed_version="$(jq -r '.VERSION // empty' "$info_file")" \
+            && [[ "$installed_version" != "$current_version" ]]; then
+        log_warning "'$installed_disk' was installed by generator version $installed_version," \
+                "packaging it with version $current_version."
+    fi
+
+    if [[ "$(realpath "$installed_disk")" == "$(realpath -m "$raw_disk")" ]]; then
+        log_info "'$installed_disk' is already the raw disk of this build."
+    elif [[ -b "$installed_disk" ]]; then
+        # An instant thin snapshot, owned by this build, rather than a link to the LV of the
+        # previous build, which its own clean-up or REUSE run could remove or change.
+        if ! snapshot_thin_disk "$installed_disk" "$raw_disk"; then
+            log_error "Failed to clone '$installed_disk' to '$raw_disk'."
+            return 1
+        fi
+    elif ! materialize_file "$installed_disk" "$raw_disk"; then
+        log_error "Failed to copy '$installed_disk' to '$raw_disk'."
+        return 1
+    fi
+}
+
+
+# Check that a bundle published by a previous build can be uploaded by this one: its build record
+# (<bundle>.build.json) must record the same ISOs, platform, modules and boot locations, and the
+# bundle must not have changed since.
+# return 0 if it can; otherwise 1.
+function check_bundle_compatibility {
+    local bundle="$1"
+    local platform="$2"
+    local modules="$3"
+    local boot_locations="$4"
+    local iso="$5"
+    local ehf_iso="$6"
+    if [[ $# -ne 6 ]]; then
+        error_and_exit "Received a wrong number ($#) of parameters: $*"
+    fi
+
+    if [[ ! -f "$bundle" ]]; then
+        log_error "Bundle '$bundle' doesn't exist."
+        return 1
+    elif [[ ! -f "${bundle}.build.json" ]]; then
+        log_error "'$bundle' has no ${bundle}.build.json record of the build that produced it."
+        return 1
+    fi
+
+    # An empty fingerprint would match an empty record, so it rules the bundle out. Only the
+    # optional EHF ISO has an empty fingerprint when it isn't given.
+    local iso_fingerprint ehf_iso_fingerprint bundle_fingerprint
+    iso_fingerprint="$(get_fingerprint "$iso")"
+    ehf_iso_fingerprint="$(get_fingerprint "$ehf_iso")"
+    bundle_fingerprint="$(get_fingerprint "$bundle")"
+    if [[ -z "$iso_fingerprint" ]] || [[ -z "$bundle_fingerprint" ]] || \
+            [[ -n "$ehf_iso" && -z "$ehf_iso_fingerprint" ]]; then
+        log_error "'$bundle' or the ISOs can't be fingerprinted."
+        return 1
+    elif ! check_recorded_values "${bundle}.build.json" \
+            .inputs.platform "$platform" \
+            .inputs.modules "$modules" \
+            .inputs.boot_locations "$boot_locations" \
+            .inputs.iso "$iso_fingerprint" \
+            .inputs.ehf_iso "$ehf_iso_fingerprint" \
+            .bundle_fingerprint "$bundle_fingerprint"; then
+        log_error "'$bundle' wasn't produced by a build compatible with this one."
+        return 1
+    fi
+
+    local bundle_version current_version
+    bundle_version="$(jq -r '.inputs.version // empty' "${bundle}.build.json")"
+    current_version="$(get_config_value "VERSION_NUMBER")"
+    if [[ "$bundle_version" != "$current_version" ]]; then
+        log_warning "'$bundle' was produced by generator version $bundle_version," \
+                "uploading it with version $current_version."
+    fi
+}
+
+
+# Create the cloud image of a bundle with prepare_image.py, named CLOUD_IMAGE_NAME when the user
+# supplied one, else with a name composed from the build properties.
+# return the status of prepare_image.py.
+function create_cloud_image {
+    local platform="$1"
+    local modules="$2"
+    local boot_locations="$3"
+    local ehf_iso="$4"
+    local bundle="$5"
+    local artifacts_dir="$6"
+    if [[ $# -ne 6 ]]; then
+        error_and_exit "Received a wrong number ($#) of parameters: $*"
+    fi
+
+    local cloud_image_opt="--user-image-name"
+    local cloud_image_name
+    cloud_image_name="$(get_config_value "CLOUD_IMAGE_NAME")"
+    if [[ -z "$cloud_image_name" ]]; then
+        cloud_image_opt="--seed-image-name"
+        cloud_image_name="$(compose_cloud_image_name "$PRODUCT_NAME" "$PRODUCT_VERSION" \
+                            "$PRODUCT_BUILD" "$modules" "$boot_locations" "$PROJECT_NAME" \
+                            "$ehf_iso")"
+    fi
+    set_config_value "CLOUD_IMAGE_NAME" "$cloud_image_name"
+
+    # Create the image from a disk object uploaded by an earlier run if one is given.
+    local uploaded_disk_opts=()
+    local uploaded_disk
+    uploaded_disk="$(get_config_value "UPLOADED_DISK")"
+    if [[ -n "$uploaded_disk" ]]; then
+        uploaded_disk_opts=("--uploaded-disk" "$uploaded_disk")
+    fi
+
+    "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/prepare_image.py \
+        --artifacts-dir "$artifacts_dir" --platform "$platform" --input "$bundle" \
+        "$cloud_image_opt" "$cloud_image_name" "${uploaded_disk_opts[@]}"
+}
+
+
+# Mark the build as successful in its start file.
+function mark_build_successful {
+    local start_file="$1"
+    local updated_start_file
+    updated_start_file="$(jq '.result = 0' "$start_file")"
+    rm "$start_file"
+    echo "$updated_start_file" > "$start_file"
 }
 
 
@@ -1239,6 +1456,9 @@ and encryption_type [${encryption_type}]"
 
 # Copy image and its md5 to the publishing location
 # md5 file must be alongside the image and have matching path: <iso_path>.md5
+# The chunk manifest of the image (<iso_path>.manifest.json) is published too
+# when there is one, and lets an interrupted copy resume where it stopped.
+# So is the record of the build that produced the image (<iso_path>.build.json).
 # signature_file_path can be empty
 # publishing location must exist
 function publish_image {
@@ -1256,10 +1476,18 @@ function publish_image {
     fi
 
     log_info "Copying $image_description [${image_path}] and its MD5 to [${publish_dir}]"
-    if ! execute_cmd cp -f "$image_path" "$publish_dir"; then
+    if ! materialize_file --resume "$image_path" "$publish_dir"; then
         error_and_exit "Failed to copy $image_description [${image_path}] to [${publish_dir}]!"
     elif ! cp -f "$image_path".md5 "$publish_dir"; then
         error_and_exit "Failed to copy $image_description MD5 [${image_path}] to [${publish_dir}]!"
+    elif [[ -f "$image_path".manifest.json ]] && \
+            ! cp -f "$image_path".manifest.json "$publish_dir"; then
+        error_and_exit "Failed to copy $image_description manifest [${image_path}] to" \
+                "[${publish_dir}]!"
+    elif [[ -f "$image_path".build.json ]] && \
+            ! cp -f "$image_path".build.json "$publish_dir"; then
+        error_and_exit "Failed to copy $image_description build record [${image_path}] to" \
+                "[${publish_dir}]!"
     fi
 
     if [[ -n "$sig_file_path" ]]; then
@@ -151,26 +151,34 @@ function is_supported_boot_locations {
 # For example, prepare_raw_disk can call this function with the prepare_raw_disk.json
 # and the output disk to check if the given object was successfully built.
 #
-# The function re-calculates partial md5sum of the given "disk" and checks it against
-# the output_partial_md5 (partial md5sum of "output") value, if one exists. In case of match, it
-# returns success.
+# The function compares the fingerprint of the given "disk" with the output_fingerprint
+# value, and the fingerprint of the given inputs with the input_fingerprint value, so a stage
+# is re-run when its output or any of its inputs changed. An empty recorded fingerprint never
+# matches. Status files written before fingerprints were recorded fall back to comparing the
+# partial md5sum of the given "disk" with the output_partial_md5 (partial md5sum of "output")
+# value, if one exists. In case of match, it returns success.
 # For example, consider this json file:
 # {
 #  "description": "Prepared Virtual disk status",
 #  "build_source": "prepare_ova.sh",
 #  "platform": "aws",
+#  "input": "BIGIP-15.0.0.LTM_1SLOT-aws.raw",
+#  "input_fingerprint": "0b6562f0612e942cf046fc21762769d9221a362dd66cebf52e4b9f39e50639e7",
 #  "output": "BIGIP-15.0.0.LTM_1SLOT-aws.zip",
+#  "output_fingerprint": "5d0e4c6e3bd2bd1d7c33f8c9a46d1ad8ba1e5b27dcd2f93c85c2f9fd6d3a8c1e",
 #  "output_partial_md5": "d41d2cd98f00b204e9700998ecf8427f",
 #  "output_size": "2192284",
 #  "status": "success"
 #}
 #
 # PARAMETERS:
-#   <json> <object_name>
+#   <json> <object_name> [input ...]
 #   where,
 #       json:        Resultant JSON file.
 #       object_name: Object whose status is being checked. (object_name in
 #                    above example)
+#       input:       Files the object was built from, as passed to get_fingerprint
+#                    when the json was written.
 #
 # RETURN:
 #       0 for success, 1 otherwise.
@@ -178,16 +186,17 @@ function is_supported_boot_locations {
 function check_previous_run_status {
     local json="$1"
     local object_name="$2"
+    local inputs=("${@:3}")
 
-    if [[ $# != 2 ]]; then
-        log_error "Usage: ${FUNCNAME[0]} <json> <object_name>"
+    if [[ $# -lt 2 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <json> <object_name> [input ...]"
         return 1
     fi
 
     if [[ ! -f "$json" ]]; then
         log_info "Skipping checksum verification for earlier runs as json '$json' doesn't exist."
         return 1
-    elif [[ ! -f "$object_name" ]]; then
+    elif ! is_disk_file "$object_name"; then
         log_info "Skipping checksum verification for earlier runs as file '$object_name' doesn't exist."
         return 1
     fi
@@ -211,7 +220,31 @@ function check_previous_run_status {
 
     # Check if the "object_name" in the json is same as the passed in object_name
     # and the "status" matches the passed-in status.
-    if [[ "${info[output]}" == "$(basename "$object_name")" ]]; then
+    if [[ "${info[output]}" == "$(basename "$object_name")" ]] && \
+            [[ "${info[status]}" == "success" ]] && [[ -n "${info[output_fingerprint]}" ]]; then
+        if [[ ${#inputs[@]} -gt 0 ]] && [[ -n "${info[input_fingerprint]+set}" ]]; then
+            local input_fingerprint
+            input_fingerprint="$(get_fingerprint "${inputs[@]}")"
+            if [[ -z "${info[input_fingerprint]}" ]] || [[ -z "$input_fingerprint" ]]; then
+                log_info "Inputs of '$object_name' can't be compared with '$json'," \
+                        "their fingerprint is empty."
+                return 1
+            elif [[ "${info[input_fingerprint]}" != "$input_fingerprint" ]]; then
+                log_info "Inputs of '$object_name' changed since '$json' was written:" \
+                        "'$input_fingerprint' != '${info[input_fingerprint]}'."
+                return 1
+            fi
+        fi
+        local object_fingerprint
+        object_fingerprint="$(get_fingerprint "$object_name")"
+        if [[ -n "$object_fingerprint" ]] && \
+                [[ "${info[output_fingerprint]}" == "$object_fingerprint" ]]; then
+            return 0
+        fi
+        log_info "Fingerprint of '$object_name' does not match the 'output_fingerprint' value" \
+                "from '$json': '$object_fingerprint' != '${info[output_fingerprint]}'."
+    elif [[ "${info[output]}" == "$(basename "$object_name")" ]] && \
+            [[ -z "${info[output_fingerprint]+set}" ]]; then
         if [[ "${info[status]}" == "success" ]] && [[ -n "${info[output_partial_md5]}" ]] && \
                 [[ -n "${info[output_size]}" ]]; then
             local object_md5
@@ -232,6 +265,55 @@ function check_previous_run_status {
     return 1
 }
 
+#####################################################################
+# Print the fingerprints (BLAKE2b tree hashes) of the given files on one
+# line. They are cached with the identity of each file, so files that didn't
+# change since they were last fingerprinted aren't read again, unlike block
+# devices (lvm-thin raw disks), which are hashed every time. Empty file
+# arguments (optional inputs) are skipped. Prints an empty line when any file
+# can't be fingerprinted.
+#
+# RETURN:
+#       0 for success, 1 otherwise.
+#
+function get_fingerprint {
+    if [[ $# == 0 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <file> [file ...]"
+        return 1
+    fi
+
+    local fingerprint_tool
+    fingerprint_tool="$(realpath "$(dirname "${BASH_SOURCE[0]}")")/../../bin/fingerprint.py"
+    local file_path
+    local fingerprint
+    local fingerprints=()
+    for file_path in "$@"; do
+        if [[ -z "$file_path" ]]; then
+            continue
+        fi
+        if ! fingerprint="$("$fingerprint_tool" "$file_path")"; then
+            log_error "Fingerprinting '$file_path' failed."
+            return 1
+        elif [[ -z "$fingerprint" ]]; then
+            echo
+            return 0
+        fi
+        fingerprints+=("$fingerprint")
+    done
+    echo "${fingerprints[*]}"
+}
+#####################################################################
+
+
+#####################################################################
+# Returns 0 if the path is a disk: a regular file or, with the lvm-thin
+# raw disk backend, a (link to a) block device.
+#
+function is_disk_file {
+    [[ -f "$1" ]] || [[ -b "$1" ]]
+}
+#####################################################################
+
 #####################################################################
 # Utility function that returns the value of a provided key.
 # Currently, this function works only for objects that are at top level
@@ -305,7 +387,7 @@ function print_qemu_disk_info {
         return 1
     fi
 
-    if [[ ! -f "$image_file" ]]; then
+    if ! is_disk_file "$image_file"; then
         log_error "<$image_file> doesn't exist."
         return 1
     fi
@@ -379,9 +461,43 @@ function vadc_hypervisor_name {
 #####################################################################
 
 
+#####################################################################
+# Print a digest recorded in <file>.digests.json while the file was written
+# (see util/digests.py), provided that the file didn't change since then.
+#
+# PARAMETERS:
+#   file_path - file whose digest is looked up
+#   key       - jq path of the digest, for example .digests.md5 or .partial_md5
+#
+# RETURN:
+#       0 and the digest, or 1 if no valid digest was recorded
+#
+function get_recorded_digest {
+    local file_path="$1"
+    local key="$2"
+    local digests_file="${file_path}.digests.json"
+    if [[ ! -f "$digests_file" ]] || [[ ! -f "$file_path" ]]; then
+        return 1
+    fi
+
+    local digest
+    digest="$(jq -r --argjson size "$(stat -c %s "$file_path")" \
+            --argjson mtime "$(stat -c %Y "$file_path")" \
+            "if .size == \$size and .mtime == \$mtime then $key // empty else empty end" \
+            "$digests_file" 2> /dev/null)"
+    if [[ -z "$digest" ]]; then
+        return 1
+    fi
+    echo "$digest"
+}
+#####################################################################
+
+
 #####################################################################
 # Generate MD5 sum for a given filepath in the same directory with the
-# name file.md5
+# name file.md5. The digest recorded while the file was written is used
+# when there is one, instead of reading the file again. Otherwise the file is
+# read once to record its digests and chunk manifest along with the md5.
 #
 function gen_md5 {
     local file_name
@@ -418,11 +534,26 @@ function gen_md5 {
         return 1
     fi
 
+    local recorded_md5
+    if ! get_recorded_digest "$file_path" .digests.md5 > /dev/null; then
+        log_info "Recording the digests and manifest of ${file_path}"
+        "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/manifest.py record \
+                "$file_path" || log_warning "Failed to record the digests of ${file_path}"
+    fi
+    if recorded_md5="$(get_recorded_digest "$file_path" .digests.md5)"; then
+        log_info "Generating ${file_path}.md5 from the digest recorded while writing it"
+        echo "$recorded_md5  $file_name" > "${file_path}.md5"
+        return
+    fi
+
     log_info "Generating ${file_path}.md5"
 
     # Temporary change to the output directory and generate MD5 there:
     pushd "$out_dir" >/dev/null || exit
-    md5sum "$file_name" > "${file_name}".md5
+    # md5sum reads stdin, name the file in the output as md5sum "$file_name" would.
+    local md5
+    md5="$(set -o pipefail; read_with_io_policy hash "$file_name" | md5sum)" && \
+        echo "${md5%% *}  $file_name" > "${file_name}".md5
     # shellcheck disable=SC2181
     if [[ $? -ne 0 ]]; then
         log_error "Generating MD5 for $file_path failed."
@@ -437,7 +568,8 @@ function gen_md5 {
 #####################################################################
 # Calculate and return MD5 sum for a fixed (small) portion of the file.
 # This is faster than checking the whole file and
-# should be enough for internal verifications.
+# should be enough for internal verifications. The digest recorded while the
+# file was written is used when there is one.
 #
 function calculate_partial_md5 {
     local file_path
@@ -448,12 +580,13 @@ function calculate_partial_md5 {
         return 1
     fi
 
-    if [[ ! -f "$file_path" ]]; then
+    if ! is_disk_file "$file_path"; then
         log_error "$file_path is not a file."
         return 1
     fi
 
-    dd count=1024 if="$file_path" 2>/dev/null | md5sum | awk '{print $1;}'
+    get_recorded_digest "$file_path" .partial_md5 || \
+        dd count=1024 if="$file_path" 2>/dev/null | md5sum | awk '{print $1;}'
 }
 #####################################################################
 
@@ -470,16 +603,308 @@ function get_file_size {
         return 1
     fi
 
-    if [[ ! -f "$file_path" ]]; then
+    if ! is_disk_file "$file_path"; then
         log_error "$file_path is not a file."
         return 1
     fi
 
+    if [[ -b "$file_path" ]]; then
+        # du reports nothing for devices, use the same 1K units for the device size.
+        echo $(( $(blockdev --getsize64 "$file_path") / 1024 ))
+        return 0
+    fi
     du "$file_path" | awk '{print $1;}'
 }
 #####################################################################
 
 
+#####################################################################
+# Make a (large) file available at a new path without copying its data when
+# the filesystem allows it: reflink, hardlink (--immutable only), sparse
+# copy_file_range, and a plain copy as the last resort. The strategy used and
+# the bytes saved are recorded in \$ARTIFACTS_DIR/materialize.json.
+#
+# PARAMETERS:
+#   [--immutable] - the source is never modified in place afterwards
+#   [--move]      - remove the source once it is materialized
+#   src           - source file
+#   dest          - destination file or directory
+#
+function materialize_file {
+    if [[ $# -lt 2 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} [--immutable] [--move] <src> <dest>"
+        return 1
+    fi
+
+    "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/materialize_file.py "$@"
+}
+#####################################################################
+
+
+#####################################################################
+# Print the I/O policy (default, fadvise or direct) of a large-file stage:
+# the IO_POLICY_STAGES entry for the stage if there is one, else IO_POLICY.
+#
+function get_io_policy {
+    local stage="$1"
+    if [[ $# != 1 ]] || [[ -z "$stage" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <stage>"
+        return 1
+    fi
+
+    local policy=""
+    local stages_json
+    stages_json="$(get_config_value "IO_POLICY_STAGES")"
+    if [[ -n "$stages_json" ]]; then
+        policy="$(jq -r --arg stage "$stage" '.[$stage] // empty' <<< "$stages_json")"
+    fi
+    if [[ -z "$policy" ]]; then
+        policy="$(get_config_value "IO_POLICY")"
+    fi
+    echo "${policy:-default}"
+}
+#####################################################################
+
+
+#####################################################################
+# Stream a file to stdout following the I/O policy of the given stage, so
+# that hashing multi-GB disks doesn't evict the page cache of other builds.
+#
+function read_with_io_policy {
+    local stage="$1"
+    local file="$2"
+    if [[ $# != 2 ]] || [[ ! -f "$file" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <stage> <file>"
+        return 1
+    fi
+
+    local policy
+    policy="$(get_io_policy "$stage")"
+    # Probe O_DIRECT with a single block read before streaming, so that a filesystem refusing
+    # it falls back to fadvise up front. A failure of the one dd below then propagates instead
+    # of a second pass appending the whole file to the output again.
+    if [[ "$policy" == "direct" ]] && ! dd if="$file" of=/dev/null bs=4096 count=1 iflag=direct \
+            status=none 2> /dev/null; then
+        log_debug "O_DIRECT isn't supported for '$file', reading it with fadvise."
+        policy="fadvise"
+    fi
+
+    case "$policy" in
+        direct)
+            dd if="$file" bs=8M iflag=direct status=none
+            ;;
+        fadvise)
+            dd if="$file" bs=8M iflag=nocache status=none
+            ;;
+        *)
+            cat "$file"
+            ;;
+    esac
+}
+#####################################################################
+
+
+#####################################################################
+# Create a zip archive of files stored under their base names, like zip -j,
+# deflating them in parallel on COMPRESSION_THREADS threads (all CPUs by
+# default). Files of 4 GiB or more get ZIP64 entries.
+#
+# PARAMETERS:
+#   archive - zip archive to create
+#   level   - compression level, from 1 (fastest) to 9 (best)
+#   file    - files to add
+#
+function create_zip {
+    local archive="$1"
+    local level="$2"
+    if [[ $# -lt 3 ]] || [[ -z "$archive" ]] || [[ -z "$level" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <archive> <level> <file>..."
+        return 1
+    fi
+    shift 2
+
+    "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/compress.py --level "$level" \
+            zip "$archive" "$@"
+}
+#####################################################################
+
+
+#####################################################################
+# Create a gzip compressed tar archive holding a single disk, like
+# tar --format=oldgnu -Sczf, with the deflate blocks compressed in parallel on
+# COMPRESSION_THREADS threads (all CPUs by default). Holes of the disk are only
+# recorded in the sparse map of the member, unless --no-sparse is given.
+#
+# PARAMETERS:
+#   archive     - tar.gz archive to create
+#   disk        - disk to archive under its base name
+#   --no-sparse - archive holes as zeroes, like tar -czf
+#
+function create_tar_gz {
+    local archive="$1"
+    local disk="$2"
+    if [[ $# -lt 2 ]] || [[ $# -gt 3 ]] || [[ -z "$archive" ]] || [[ -z "$disk" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <archive> <disk> [--no-sparse]"
+        return 1
+    fi
+
+    "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/compress.py tar "${@:3}" \
+            "$archive" "$disk"
+}
+#####################################################################
+
+
+#####################################################################
+# Print the extension of the qcow2 and vhd bundles for BUNDLE_COMPRESSION:
+# zip, zst or xz, and nothing for uncompressed bundles.
+#
+function get_bundle_compression_extension {
+    local compression
+    compression="$(get_config_value "BUNDLE_COMPRESSION")"
+    case "${compression:-zip}" in
+        zip)
+            echo "zip"
+            ;;
+        zstd)
+            echo "zst"
+            ;;
+        xz)
+            echo "xz"
+            ;;
+        none)
+            echo ""
+            ;;
+        *)
+            log_error "Unsupported BUNDLE_COMPRESSION '$compression'"
+            return 1
+            ;;
+    esac
+}
+#####################################################################
+
+
+#####################################################################
+# Compress a disk into a bundle according to the bundle extension: a zip
+# archive holding the disk under its base name (.zip), or the disk compressed
+# with zstd (.zst) or xz (.xz). All of them use COMPRESSION_THREADS threads,
+# all CPUs by default, and the digests of the bundle are recorded while it is
+# written.
+#
+# PARAMETERS:
+#   bundle - bundle to create
+#   disk   - disk to compress
+#
+function compress_bundle {
+    local bundle="$1"
+    local disk="$2"
+    if [[ $# != 2 ]] || [[ -z "$bundle" ]] || [[ ! -f "$disk" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <bundle> <disk>"
+        return 1
+    fi
+
+    local threads
+    threads="$(get_config_value "COMPRESSION_THREADS")"
+    local compressor
+    case "$bundle" in
+        *.zip)
+            create_zip "$bundle" 1 "$disk"
+            return
+            ;;
+        *.zst)
+            # The default 128 MiB long window keeps the bundle readable by zstd -d
+            # without --long or --memory options.
+            compressor=(zstd -q -c --long -T"${threads:-0}")
+            ;;
+        *.xz)
+            # Single-threaded xz writes different blocks. Reproducible builds force the
+            # multi-threaded mode, whose output doesn't depend on the number of threads.
+            if [[ -n "$(get_config_value "SOURCE_DATE_EPOCH")" ]]; then
+                if [[ "${threads:-0}" == 0 ]]; then
+                    threads="$(nproc)"
+                fi
+                if [[ "$threads" == 1 ]]; then
+                    threads="+1"
+                fi
+            fi
+            compressor=(xz -c -T"${threads:-0}")
+            ;;
+        *)
+            log_error "Unsupported bundle extension of '$bundle'"
+            return 1
+            ;;
+    esac
+
+    "${compressor[@]}" "$disk" | \
+            "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/compress.py store \
+            --member "$disk" "$bundle"
+    local statuses=("${PIPESTATUS[@]}")
+    if [[ ${statuses[0]} -ne 0 ]] || [[ ${statuses[1]} -ne 0 ]]; then
+        log_error "Unable to create $bundle: ${compressor[0]} exited with ${statuses[0]}," \
+                "compress.py with ${statuses[1]}"
+        return 1
+    fi
+}
+#####################################################################
+
+
+#####################################################################
+# Print the qemu-img options of the qcow2 bundle disk: its QCOW2_COMPAT level
+# and QCOW2_CLUSTER_SIZE.
+#
+function get_qcow2_disk_options {
+    local compat
+    compat="$(get_config_value "QCOW2_COMPAT")"
+    local cluster_size
+    cluster_size="$(get_config_value "QCOW2_CLUSTER_SIZE")"
+    echo "compat=${compat:-0.10},cluster_size=${cluster_size:-64k}"
+}
+#####################################################################
+
+
+#####################################################################
+# List the contents of a bundle created by compress_bundle or create_tar_gz,
+# or describe an uncompressed qcow2 or vhd bundle. Members recorded while the
+# bundle was written are listed without reading it.
+#
+function list_bundle {
+    local bundle="$1"
+    if [[ $# != 1 ]] || [[ ! -f "$bundle" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <bundle>"
+        return 1
+    fi
+
+    local members
+    if members="$(get_recorded_digest "$bundle" \
+            '(.members | map("\(.size)\t\(.name)") | join("\n"))')"; then
+        echo "$members"
+        return
+    fi
+
+    case "$bundle" in
+        *.zip)
+            unzip -l "$bundle"
+            ;;
+        *.zst)
+            zstd -l "$bundle"
+            ;;
+        *.xz)
+            xz -l "$bundle"
+            ;;
+        *.tar.gz)
+            tar -tzvf "$bundle"
+            ;;
+        *.qcow2|*.vhd)
+            qemu-img info "$bundle"
+            ;;
+        *)
+            log_error "Unsupported bundle extension of '$bundle'"
+            return 1
+            ;;
+    esac
+}
+#####################################################################
+
+
 #####################################################################
 # Print how much free disk space we have on build server.
 #
@@ -617,7 +1042,9 @@ function print_json {
 }
 
 #####################################################################
-# Sign a virtual disk file using openssl with -sha384 encryption type
+# Sign a virtual disk file using openssl with the IMAGE_SIG_ENCRYPTION_TYPE
+# digest. When that digest was recorded while the file was written, it is
+# signed as is instead of reading the file again: the signature is the same.
 #
 function sign_file {
     local src_disk="$1"
@@ -650,7 +1077,19 @@ function sign_file {
 
     if [[ -n "$private_key" ]]; then
         log_info "Signing ${src_disk} using encryption type ${encryption_type} with private key ${private_key}"
-        if openssl dgst -"$encryption_type" -sign "$private_key" "$src_disk" > "$out_sig_file"; then
+        local digest
+        local status
+        if digest="$(get_recorded_digest "$src_disk" ".digests[\"$encryption_type\"]")"; then
+            log_info "Signing the $encryption_type digest recorded while writing ${src_disk}"
+            # Hex digest to binary.
+            printf '%b' "$(sed 's/../\\x&/g' <<< "$digest")" | openssl pkeyutl -sign \
+                    -inkey "$private_key" -pkeyopt digest:"$encryption_type" > "$out_sig_file"
+            status=$?
+        else
+            openssl dgst -"$encryption_type" -sign "$private_key" "$src_disk" > "$out_sig_file"
+            status=$?
+        fi
+        if [[ $status -eq 0 ]]; then
             log_info "$out_sig_file was generated"
         else
             log_error "Unable to sign ${src_disk} using private key ${private_key}!"
@@ -20,6 +20,219 @@ source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/../bash/common.sh"
 # shellcheck source=src/lib/bash/util/logger.sh
 source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/../bash/util/logger.sh"
 
+# Built-in "qemu-img convert" profiles. Keys map to qemu-img options:
+#   coroutines: -m, parallel coroutines
+#   out_of_order: -W, out-of-order writes
+#   sparse_size: -S, minimum run of zeroes left unallocated in the target
+#   src_cache / dest_cache: -T / -t cache modes
+#   target_is_zero: pre-create the target and convert with -n --target-is-zero
+#   compressed: -c, compressed clusters (qcow2 targets with QCOW2_COMPRESS)
+declare -gA QEMU_IMG_CONVERT_PROFILES=(
+    [default]='{}'
+    [parallel]='{"coroutines": 8, "out_of_order": true}'
+    [direct]='{"coroutines": 8, "out_of_order": true, "src_cache": "none", "dest_cache": "none"}'
+    [sparse]='{"coroutines": 8, "out_of_order": true, "sparse_size": "64k", "target_is_zero": true}'
+)
+# Profiles tried by the auto profile, in order.
+QEMU_IMG_CONVERT_AUTO_CANDIDATES=(default parallel direct sparse)
+# Set by select_qemu_img_convert_profile.
+declare -g QEMU_IMG_CONVERT_SELECTION
+
+
+# Print the name of the convert profile for the current platform:
+# QEMU_IMG_CONVERT_PLATFORM_PROFILES[platform] if set, else QEMU_IMG_CONVERT_PROFILE.
+function get_qemu_img_convert_profile {
+    local profile=""
+    local platform_profiles
+    platform_profiles="$(get_config_value "QEMU_IMG_CONVERT_PLATFORM_PROFILES")"
+    if [[ -n "$platform_profiles" ]]; then
+        profile="$(jq -r --arg platform "$(get_config_value "PLATFORM")" '.[$platform] // empty' \
+                <<< "$platform_profiles")"
+    fi
+    if [[ -z "$profile" ]]; then
+        profile="$(get_config_value "QEMU_IMG_CONVERT_PROFILE")"
+    fi
+    echo "${profile:-default}"
+}
+
+
+# Print the options (JSON) of a built-in profile with the QEMU_IMG_CONVERT_OPTIONS
+# overrides and the convert I/O policy applied.
+# Usage: <profile> <dest_format> [disk_options]
+function get_qemu_img_convert_options {
+    local profile="$1"
+    local dest_format="$2"
+    local disk_options="$3"
+    if [[ -z "${QEMU_IMG_CONVERT_PROFILES[$profile]}" ]]; then
+        log_error "Unknown qemu-img convert profile '$profile'."
+        return 1
+    fi
+
+    local overrides
+    overrides="$(get_config_value "QEMU_IMG_CONVERT_OPTIONS")"
+    local bypass_cache="false"
+    if [[ "$(get_io_policy convert)" != "default" ]]; then
+        bypass_cache="true"
+    fi
+    # streamOptimized VMDKs are written strictly sequentially into fresh targets.
+    local sequential="false"
+    if [[ "$dest_format" == "vmdk" ]] && [[ "$disk_options" == *streamOptimized* ]]; then
+        sequential="true"
+    fi
+    # Compressed clusters are written into fresh targets too, qemu-img doesn't combine -c with
+    # out-of-order writes. Coroutines compress clusters in parallel.
+    local compressed="false"
+    if [[ "$dest_format" == "qcow2" ]] && [[ -n "$(get_config_value "QCOW2_COMPRESS")" ]]; then
+        compressed="true"
+    fi
+
+    jq -c --argjson overrides "${overrides:-"{}"}" --argjson bypass_cache "$bypass_cache" \
+            --argjson sequential "$sequential" --argjson compressed "$compressed" '
+        . + $overrides
+        | if $bypass_cache then {src_cache: "none", dest_cache: "none"} + . else . end
+        | if $sequential then del(.out_of_order, .target_is_zero) else . end
+        | if $compressed then {coroutines: 8} + . + {compressed: true}
+              | del(.out_of_order, .target_is_zero) else . end' \
+        <<< "${QEMU_IMG_CONVERT_PROFILES[$profile]}"
+}
+
+
+# Print the qemu-img convert command line options for the given options JSON.
+function get_qemu_img_convert_flags {
+    jq -r '[
+        (if .coroutines then "-m \(.coroutines)" else empty end),
+        (if .out_of_order then "-W" else empty end),
+        (if .sparse_size then "-S \(.sparse_size)" else empty end),
+        (if .src_cache then "-T \(.src_cache)" else empty end),
+        (if .dest_cache then "-t \(.dest_cache)" else empty end),
+        (if .compressed then "-c" else empty end)
+    ] | join(" ")' <<< "$1"
+}
+
+
+# Run a single conversion with the given options JSON, creating the target
+# first when target_is_zero is requested.
+# Usage: <options> <dest_format> <src_format> <src_disk> <dest_disk> <virtual_size> [disk_options]
+function run_qemu_img_convert {
+    local options="$1"
+    local dest_format="$2"
+    local src_format="$3"
+    local src_disk="$4"
+    local dest_disk="$5"
+    local virtual_size="$6"
+    local disk_options="$7"
+    if [[ -n "$disk_options" ]]; then
+        disk_options="-o $disk_options"
+    fi
+
+    local flags
+    flags="$(get_qemu_img_convert_flags "$options")" || return 1
+    if [[ "$(jq -r '.target_is_zero // false' <<< "$options")" == "true" ]]; then
+        # shellcheck disable=SC2086
+        qemu-img create -q -f "$dest_format" $disk_options "$dest_disk" "$virtual_size" || return 1
+        flags="$flags -n --target-is-zero"
+        disk_options=""
+    fi
+
+    # qemu_img might want receive argument separately, hence shellcheck exception
+    # shellcheck disable=SC2086
+    execute_cmd qemu-img convert -p -f "$src_format" $flags -O "$dest_format" $disk_options \
+            "$src_disk" "$dest_disk"
+}
+
+
+# Benchmark the auto candidates on a sample of the (raw) source disk and select
+# the fastest. The sample is converted next to dest_disk so the target storage
+# is measured too. Sets QEMU_IMG_CONVERT_SELECTION to a JSON object with the
+# selected profile, its options and the benchmark results.
+# Usage: <dest_format> <src_disk> <dest_disk> <virtual_size> [disk_options]
+function select_qemu_img_convert_profile {
+    local dest_format="$1"
+    local src_disk="$2"
+    local dest_disk="$3"
+    local virtual_size="$4"
+    local disk_options="$5"
+
+    local sample_size
+    sample_size=$(( $(get_config_value "QEMU_IMG_CONVERT_BENCHMARK_MB") * 1024 * 1024 ))
+    if [[ "$sample_size" -gt "$virtual_size" ]]; then
+        sample_size="$virtual_size"
+    fi
+    local driver="file"
+    if [[ -b "$src_disk" ]]; then
+        driver="host_device"
+    fi
+    local sample
+    sample="$(jq -cn --arg driver "$driver" --arg filename "$(realpath "$src_disk")" \
+            --argjson size "$sample_size" \
+            '{driver: "raw", offset: 0, size: $size, file: {driver: $driver, filename: $filename}}')"
+
+    local results="[]"
+    local best_profile="default"
+    local best_seconds=""
+    local profile
+    for profile in "${QEMU_IMG_CONVERT_AUTO_CANDIDATES[@]}"; do
+        local options
+        options="$(get_qemu_img_convert_options "$profile" "$dest_format" "$disk_options")" || return 1
+        local sample_disk
+        sample_disk="$(dirname "$dest_disk")/.convert_benchmark.$profile.$$"
+        rm -f "$sample_disk"
+
+        # Every candidate starts with a cold page cache for the source.
+        dd if="$src_disk" iflag=nocache count=0 status=none 2> /dev/null
+
+        local start end
+        start="$(date '+%s.%N')"
+        if ! run_qemu_img_convert "$options" "$dest_format" raw "json:$sample" "$sample_disk" \
+                "$sample_size" "$disk_options" > /dev/null; then
+            log_warning "qemu-img convert profile '$profile' failed on this host, skipping it."
+            rm -f "$sample_disk"
+            continue
+        fi
+        end="$(date '+%s.%N')"
+        rm -f "$sample_disk"
+
+        local seconds
+        seconds="$(awk -v start="$start" -v end="$end" 'BEGIN { printf "%.3f", end - start }')"
+        log_info "qemu-img convert profile '$profile': ${seconds}s for $((sample_size / 1048576)) MiB"
+        results="$(jq -c --arg profile "$profile" --argjson options "$options" \
+                --argjson seconds "$seconds" --argjson size "$sample_size" \
+                '. + [{profile: $profile, options: $options, seconds: $seconds,
+                       mib_per_second: (if $seconds > 0 then ($size / 1048576 / $seconds * 10
+                           | round / 10) else null end)}]' <<< "$results")"
+        if [[ -z "$best_seconds" ]] || awk -v a="$seconds" -v b="$best_seconds" 'BEGIN { exit !(a < b) }'; then
+            best_profile="$profile"
+            best_seconds="$seconds"
+        fi
+    done
+
+    log_info "Selected qemu-img convert profile '$best_profile' for $dest_format."
+    QEMU_IMG_CONVERT_SELECTION="$(jq -c --arg profile "$best_profile" \
+            --argjson options "$(get_qemu_img_convert_options "$best_profile" "$dest_format" "$disk_options")" \
+            --argjson sample_size "$sample_size" \
+            '{profile: $profile, options: $options, benchmark_sample_size: $sample_size,
+              benchmark: .}' <<< "$results")"
+}
+
+
+# Record the convert profile used for a target format in
+# $ARTIFACTS_DIR/convert_profile.json, which is merged into prepare_virtual_disk.json.
+# Usage: <dest_format> <selection>
+function record_qemu_img_convert_profile {
+    local dest_format="$1"
+    local selection="$2"
+    local profile_json
+    profile_json="$(get_config_value "ARTIFACTS_DIR")/convert_profile.json"
+
+    local profiles="{}"
+    if [[ -s "$profile_json" ]]; then
+        profiles="$(cat "$profile_json")"
+    fi
+    jq --arg format "$dest_format" --argjson selection "$selection" '.[$format] = $selection' \
+            <<< "$profiles" > "$profile_json"
+}
+
+
 # Convert the src_disk into the given format using "qemu-img convert"
 # Usage: <dest_format> <src_disk> <dest_disk> [options]
 # where
@@ -28,6 +241,7 @@ source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/../bash/util/logger.sh"
 #   dest_disk: new disk
 #   options: optional argument specifying the comma separated key=value pairs
 #       as supported by qemu-img
+# The qemu-img tuning options come from the QEMU_IMG_CONVERT_PROFILE of the platform.
 # return 0 if passed; otherwise return 1
 function convert_qemu_img() {
     if [[ "$#" -lt 3 ]]; then
@@ -39,20 +253,72 @@ function convert_qemu_img() {
     local src_disk="$2"
     local dest_disk="$3"
     local disk_options="$4"
-    if [[ -n "$disk_options" ]]; then
-        # Append qemu-img cmdline option '-o' to the comma-separated key=value
-        # options pairs.
-        disk_options="-o $disk_options"
-    fi
 
     log_info "Conversion to $dest_format -- start time: $(date +%T)"
     local start_task
     start_task=$(timer)
 
+    # Block devices (lvm-thin raw disk backend) hold raw disks, skip format probing.
+    local src_format
+    if [[ -b "$src_disk" ]]; then
+        src_format="raw"
+    else
+        src_format="$(qemu-img info --output json "$src_disk" | jq -r '.format')"
+    fi
+    local virtual_size
+    virtual_size="$(qemu-img info --output json -f "$src_format" "$src_disk" | jq -r '.["virtual-size"]')"
+    if ! is_number "$virtual_size"; then
+        log_error "Failed to read the virtual size of '$src_disk'."
+        return 1
+    fi
+
+    # The native converter reads the raw disk once, skipping holes, zero blocks and unused LVM
+    # extents. It falls back to qemu-img for anything it doesn't support, and doesn't write
+    # compressed clusters. Reproducible builds use it as qemu-img stamps VHDs with the time and
+    # random IDs, and VMDKs with a random CID.
+    local converter
+    converter="$(get_config_value "DISK_CONVERTER")"
+    if [[ -n "$(get_config_value "SOURCE_DATE_EPOCH")" ]]; then
+        converter="native"
+    fi
+    if [[ "$converter" == "native" ]] && [[ "$src_format" == "raw" ]] \
+            && [[ "$dest_format" =~ ^(qcow2|vmdk|vpc)$ ]] && ! [[ "$dest_format" == "qcow2" && \
+            -n "$(get_config_value "QCOW2_COMPRESS")" ]]; then
+        log_info "Converting '$src_disk' to $dest_format with the native converter."
+        if "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/convert_raw_disk.py --layout \
+                --target "$dest_format" "$dest_disk" "$disk_options" "$src_disk"; then
+            record_qemu_img_convert_profile "$dest_format" '{"converter": "native"}'
+            log_info "Conversion to $dest_format -- elapsed time: $(timer "$start_task")"
+            return 0
+        fi
+        log_warning "Native conversion of '$src_disk' to $dest_format failed, using qemu-img."
+    fi
+
+    local profile
+    profile="$(get_qemu_img_convert_profile)"
+    local selection
+    if [[ "$profile" == "auto" ]] && [[ "$src_format" == "raw" ]]; then
+        if ! select_qemu_img_convert_profile "$dest_format" "$src_disk" "$dest_disk" \
+                "$virtual_size" "$disk_options"; then
+            log_error "Failed to benchmark the qemu-img convert profiles."
+            return 1
+        fi
+        selection="$QEMU_IMG_CONVERT_SELECTION"
+    else
+        if [[ "$profile" == "auto" ]]; then
+            log_info "Source '$src_disk' is not raw, using the default qemu-img convert profile."
+            profile="default"
+        fi
+        local options
+        options="$(get_qemu_img_convert_options "$profile" "$dest_format" "$disk_options")" || return 1
+        selection="$(jq -cn --arg profile "$profile" --argjson options "$options" \
+                '{profile: $profile, options: $options}')"
+    fi
+    record_qemu_img_convert_profile "$dest_format" "$selection"
+
     local result
-    # qemu_img might want receive argument separately, hence shellcheck exception
-    # shellcheck disable=SC2086
-    execute_cmd qemu-img convert -p -O "$dest_format" $disk_options "$src_disk" "$dest_disk"
+    run_qemu_img_convert "$(jq -c '.options' <<< "$selection")" "$dest_format" "$src_format" \
+            "$src_disk" "$dest_disk" "$virtual_size" "$disk_options"
     result=$?
 
     local elapsed_time
@@ -65,4 +331,3 @@ function convert_qemu_img() {
         return 1
     fi
 }
-
@@ -17,6 +17,8 @@
 
 # shellcheck source=src/lib/bash/common.sh
 source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/common.sh"
+# shellcheck source=src/lib/bash/lvm_thin.sh
+source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/lvm_thin.sh"
 # shellcheck source=src/lib/bash/util/logger.sh
 source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/util/logger.sh"
 
@@ -37,8 +39,14 @@ function create_qemu_disk {
     local elapsed_time
     start_task=$(timer)
 
-    qemu-img create -f "$format" -o size="$size" "$disk"
-    local result=$?
+    local result
+    if [[ "$format" == "raw" ]] && is_lvm_thin_backend; then
+        create_thin_disk "$size" "$disk"
+        result=$?
+    else
+        qemu-img create -f "$format" -o size="$size" "$disk"
+        result=$?
+    fi
 
     elapsed_time=$(timer "$start_task")
 
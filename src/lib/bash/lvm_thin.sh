@@ -0,0 +1,220 @@
+#!/bin/bash
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+# LVM thin-pool backend for raw disks. With RAW_DISK_BACKEND=lvm-thin the raw
+# disk in the artifacts directory is a symlink to a thin LV carved out of
+# LVM_THIN_POOL (<vg>/<pool>). All LVs of one artifacts directory carry the
+# same LVM tag, so they can be removed together when the build is cleaned up.
+
+
+# shellcheck source=src/lib/bash/common.sh
+source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/common.sh"
+# shellcheck source=src/lib/bash/util/logger.sh
+source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/util/logger.sh"
+
+
+#####################################################################
+# Returns 0 if raw disks are kept on an LVM thin pool.
+#
+function is_lvm_thin_backend {
+    [[ "$(get_config_value "RAW_DISK_BACKEND")" == "lvm-thin" ]]
+}
+#####################################################################
+
+
+#####################################################################
+# Print the LVM tag shared by all thin LVs of the current artifacts directory.
+#
+function get_thin_volume_tag {
+    local artifacts_dir
+    artifacts_dir="$(realpath -m "$(get_config_value "ARTIFACTS_DIR")")"
+    echo "f5_image_generator_$(echo -n "$artifacts_dir" | md5sum | cut -c1-12)"
+}
+#####################################################################
+
+
+#####################################################################
+# Print the thin LV name backing the given disk path. The name is derived from
+# the full disk path so that REUSE runs find the same LV again.
+#
+function get_thin_volume_name {
+    local disk="$1"
+    if [[ $# != 1 ]] || [[ -z "$disk" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <disk>"
+        return 1
+    fi
+
+    local name
+    name="$(basename "$disk" | tr -c 'A-Za-z0-9+_.\n-' '_')"
+    echo "igen_$(echo -n "$(realpath -m "$disk")" | md5sum | cut -c1-8)_${name:0:100}"
+}
+#####################################################################
+
+
+#####################################################################
+# Allocate a thin LV of the given size and link it at the disk path.
+#
+# PARAMETERS:
+#   size - virtual size understood by lvcreate (e.g. 82G)
+#   disk - path of the disk in the artifacts directory
+#
+function create_thin_disk {
+    local size="$1"
+    local disk="$2"
+    if [[ $# != 2 ]] || [[ -z "$size" ]] || [[ -z "$disk" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <size> <disk>"
+        return 1
+    fi
+
+    local pool
+    pool="$(get_config_value "LVM_THIN_POOL")"
+    if [[ -z "$pool" ]]; then
+        log_error "LVM_THIN_POOL must be set to <vg>/<pool> for the lvm-thin raw disk backend."
+        return 1
+    fi
+    local vg="${pool%%/*}"
+    local lv
+    lv="$(get_thin_volume_name "$disk")"
+
+    # A previous run may have left the LV behind.
+    if lvs "$vg/$lv" > /dev/null 2>&1; then
+        log_info "Removing stale thin LV $vg/$lv"
+        if ! lvremove -y "$vg/$lv" > /dev/null; then
+            log_error "Failed to remove stale thin LV $vg/$lv"
+            return 1
+        fi
+    fi
+    rm -f "$disk"
+
+    log_info "Creating $size thin LV $vg/$lv in pool $pool for '$disk'"
+    if ! lvcreate -y -V "$size" -T "$pool" -n "$lv" --addtag "$(get_thin_volume_tag)" > /dev/null; then
+        log_error "Failed to create thin LV $vg/$lv in pool $pool"
+        return 1
+    fi
+    ln -s "/dev/$vg/$lv" "$disk"
+}
+#####################################################################
+
+
+#####################################################################
+# Take an instant thin snapshot of a thin disk and link it at a new path.
+#
+function snapshot_thin_disk {
+    local src_disk="$1"
+    local snapshot_disk="$2"
+    if [[ $# != 2 ]] || [[ ! -b "$src_disk" ]] || [[ -z "$snapshot_disk" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <thin disk> <snapshot disk>"
+        return 1
+    fi
+
+    local src_lv_path
+    src_lv_path="$(readlink "$src_disk")"
+    local src_lv="${src_lv_path##*/}"
+    local vg
+    vg="$(basename "$(dirname "$src_lv_path")")"
+    local lv
+    lv="$(get_thin_volume_name "$snapshot_disk")"
+
+    if lvs "$vg/$lv" > /dev/null 2>&1 && ! lvremove -y "$vg/$lv" > /dev/null; then
+        log_error "Failed to remove stale thin snapshot $vg/$lv"
+        return 1
+    fi
+    rm -f "$snapshot_disk"
+
+    log_info "Snapshotting thin LV $vg/$src_lv as $vg/$lv for '$snapshot_disk'"
+    if ! lvcreate -y -s -kn -ay -n "$lv" --addtag "$(get_thin_volume_tag)" "$vg/$src_lv" > /dev/null; then
+        log_error "Failed to snapshot thin LV $vg/$src_lv"
+        return 1
+    fi
+    ln -s "/dev/$vg/$lv" "$snapshot_disk"
+}
+#####################################################################
+
+
+#####################################################################
+# Remove every thin LV created for the current artifacts directory.
+#
+function remove_thin_disks {
+    local pool
+    pool="$(get_config_value "LVM_THIN_POOL")"
+    local vg="${pool%%/*}"
+    local tag
+    tag="$(get_thin_volume_tag)"
+
+    if [[ -z "$vg" ]] || [[ -z "$(lvs --noheadings -o lv_name "@$tag" 2> /dev/null)" ]]; then
+        return 0
+    fi
+    log_info "Removing thin LVs tagged $tag from $vg"
+    lvremove -y "@$tag" > /dev/null
+}
+#####################################################################
+
+
+#####################################################################
+# Create a loopback backed VG with a thin pool, for development and testing
+# of the lvm-thin backend on hosts without a dedicated volume.
+#
+# PARAMETERS:
+#   image - backing file to create
+#   size  - size of the backing file (e.g. 200G, sparse)
+#   pool  - <vg>/<pool> to create
+#
+function create_loop_thin_pool {
+    local image="$1"
+    local size="$2"
+    local pool="$3"
+    if [[ $# != 3 ]] || [[ "$pool" != */* ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <image> <size> <vg>/<pool>"
+        return 1
+    fi
+    local vg="${pool%%/*}"
+
+    truncate -s "$size" "$image" || return 1
+    local loop_device
+    if ! loop_device="$(losetup -f --show "$image")"; then
+        log_error "Failed to attach '$image' to a loop device"
+        return 1
+    fi
+    if ! pvcreate -y "$loop_device" > /dev/null || ! vgcreate -y "$vg" "$loop_device" > /dev/null \
+            || ! lvcreate -y -l 95%FREE -T "$pool" > /dev/null; then
+        log_error "Failed to create thin pool $pool on $loop_device"
+        return 1
+    fi
+    log_info "Created thin pool $pool on $loop_device backed by '$image'"
+}
+#####################################################################
+
+
+#####################################################################
+# Tear down a VG created by create_loop_thin_pool and its loop device.
+#
+function remove_loop_thin_pool {
+    local image="$1"
+    local vg="$2"
+    if [[ $# != 2 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <image> <vg>"
+        return 1
+    fi
+
+    vgremove -y -f "$vg" > /dev/null || return 1
+    local loop_device
+    for loop_device in $(losetup -j "$image" -O NAME --noheadings); do
+        pvremove -y "$loop_device" > /dev/null
+        losetup -d "$loop_device"
+    done
+    log_info "Removed thin pool VG $vg backed by '$image'"
+}
+#####################################################################
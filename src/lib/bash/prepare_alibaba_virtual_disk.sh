@@ -53,7 +53,7 @@ function alibaba_disk_package {
          || [[ -z "$prepare_vdisk_json" ]]; then
         log_error "raw_disk_name, artifacts_dir, bundle_name and prepare_vdisk_json must not be empty!"
         return 1
-    elif [[ ! -f "$artifacts_dir/$raw_disk_name" ]]; then
+    elif ! is_disk_file "$artifacts_dir/$raw_disk_name"; then
         log_error "Raw disk '$raw_disk_name' doesn't exist in '$artifacts_dir'."
         print_json "$failure_token" "$prepare_vdisk_json" "qcow2 generation failed: no input raw disk" \
                    "$(basename "${BASH_SOURCE[0]}")"
@@ -61,7 +61,8 @@ function alibaba_disk_package {
     fi
 
     # Check if the current execution is a re-run of previously successful execution.
-    if check_previous_run_status "$prepare_vdisk_json" "$bundle_name" ; then
+    if check_previous_run_status "$prepare_vdisk_json" "$bundle_name" \
+            "$artifacts_dir/$raw_disk_name"; then
         log_info "Skipping alibaba disk generation as the output virtual disk '$bundle_name'" \
                 "was generated successfully earlier."
         return 0
@@ -97,8 +98,7 @@ function alibaba_disk_package {
 
     # Compress the qcow2 into a tar archive.  Display the available disk space after the operation.
     log_info "Packaging Alibaba qcow2 [${qcow2_disk_path}] into archive [${bundle_name}]"
-    pushd "$temp_dir" >/dev/null || exit
-    if ! execute_cmd tar -vczf "$bundle_name" "$qcow2_name" ; then
+    if ! execute_cmd create_tar_gz "$bundle_name" "$qcow2_disk_path" --no-sparse ; then
         log_error "Failed to compress - $qcow2_disk_path"
         print_json "$failure_token" "$prepare_vdisk_json"  "QCOW2 generation failed: could not zip" \
                    "$(basename "${BASH_SOURCE[0]}")"
@@ -108,12 +108,9 @@ function alibaba_disk_package {
     else
         log_info "SUCCESS - $response"
     fi
-    popd >/dev/null || exit
 
     # Save an md5sum alongside the packaged disk
-    local md5_path="${bundle_name}.md5"
-    log_info "Generating md5sum for [${bundle_name}] at [${md5_path}]"
-    if md5sum "$bundle_name" > "$md5_path"; then
+    if gen_md5 "$bundle_name"; then
         log_info "SUCCESS - generated md5sum"
     else
         log_error "Unable to generate md5sum!"
@@ -151,6 +148,8 @@ function alibaba_disk_package {
             --arg input "$raw_disk_name" \
             --arg output "$(basename "$bundle_name")" \
             --arg sig_file "$(basename "$sig_file")" \
+            --arg input_fingerprint "$(get_fingerprint "$artifacts_dir/$raw_disk_name")" \
+            --arg output_fingerprint "$(get_fingerprint "$bundle_name")" \
             --arg output_partial_md5 "$(calculate_partial_md5 "$bundle_name")" \
             --arg output_size "$(get_file_size "$bundle_name")" \
             --arg status "$success_token" \
@@ -162,6 +161,8 @@ function alibaba_disk_package {
             input: $input,
             output: $output,
             sig_file: $sig_file,
+            input_fingerprint: $input_fingerprint,
+            output_fingerprint: $output_fingerprint,
             output_partial_md5: $output_partial_md5,
             output_size: $output_size,
             status: $status }' > "$prepare_vdisk_json")"
@@ -71,7 +71,8 @@ log_file]!"
     local log_file="$5"
 
     # Check if the current execution is a re-run of previously successful execution.
-    if check_previous_run_status "$prepare_vdisk_json" "$bundle_name" ; then
+    if check_previous_run_status "$prepare_vdisk_json" "$bundle_name" \
+            "${artifacts_dir}${raw_disk_name}"; then
         log_info "Skipping gce disk generation as the output virtual disk '$bundle_name'" \
                 "was generated successfully earlier."
         return 0
@@ -82,8 +83,29 @@ log_file]!"
     local packaged_disk_dir
     packaged_disk_dir="$(realpath "$(dirname "$bundle_name")")"
     mkdir -p "$packaged_disk_dir"
-    log_debug "Compressing raw GCE disk [${artifacts_dir}${raw_disk_name}] into archive [${bundle_name}]"
-    if ! execute_cmd tar -C "$artifacts_dir" -vczf "$bundle_name" "$raw_disk_name" ; then
+    # The archive is written from the extent map of the raw disk, so a raw disk on the lvm-thin
+    # backend is first copied into a sparse regular file.
+    local tar_dir="$artifacts_dir"
+    if [[ -b "${artifacts_dir}${raw_disk_name}" ]]; then
+        tar_dir="$(mktemp -d -p "$artifacts_dir")/"
+        if ! "$(dirname "${BASH_SOURCE[0]}")"/../../bin/convert raw "${artifacts_dir}${raw_disk_name}" \
+                "${tar_dir}${raw_disk_name}"; then
+            rm -rf "$tar_dir"
+            print_json "failure" "$prepare_vdisk_json" "GCE disk generation failed: during qemu img conversion" \
+                       "$(basename "${BASH_SOURCE[0]}")"
+            return 1
+        fi
+    fi
+
+    # Holes of the raw disk are recorded in the sparse map of an 'oldgnu' tar member, the format
+    # GCE documents for rawDisk imports, instead of being read and compressed.
+    log_debug "Compressing raw GCE disk [${tar_dir}${raw_disk_name}] into archive [${bundle_name}]"
+    local tar_status=0
+    execute_cmd create_tar_gz "$bundle_name" "${tar_dir}${raw_disk_name}" || tar_status=$?
+    if [[ "$tar_dir" != "$artifacts_dir" ]]; then
+        rm -rf "$tar_dir"
+    fi
+    if [[ "$tar_status" -ne 0 ]]; then
         log_error "$response"
         print_json "failure" "$prepare_vdisk_json" "GCE disk generation failed: during qemu img conversion" \
                    "$(basename "${BASH_SOURCE[0]}")"
@@ -122,6 +144,8 @@ log_file]!"
             --arg input "$raw_disk_name" \
             --arg output "$(basename "$bundle_name")" \
             --arg sig_file "$(basename "$sig_file")" \
+            --arg input_fingerprint "$(get_fingerprint "${artifacts_dir}${raw_disk_name}")" \
+            --arg output_fingerprint "$(get_fingerprint "$bundle_name")" \
             --arg output_partial_md5 "$(calculate_partial_md5 "$bundle_name")" \
             --arg output_size "$(get_file_size "$bundle_name")" \
             --arg log_file "$log_file" \
@@ -134,6 +158,8 @@ log_file]!"
             input: $input,
             output: $output,
             sig_file: $sig_file,
+            input_fingerprint: $input_fingerprint,
+            output_fingerprint: $output_fingerprint,
             output_partial_md5: $output_partial_md5,
 	    output_size: $output_size,
             log_file: $log_file,
@@ -56,286 +56,6 @@ function print_fail_status_json {
         return 1
     fi
 }
-
-#####################################################################
-function recreate_ova {
-    if [[ $# != 4 ]] || [[ -z "$1" ]] || [[ -z "$2" ]] || [[ -z "$3" ]] || [[ -z "$4" ]]; then
-        log_error "Received: $*"
-        error_and_exit "Usage: <general_bundle_name> <bundle_file_name> <repack_dir> <out_dir>"
-    fi
-    local general_bundle_name="$1"
-    local bundle_file_name="$2"
-    local repack_dir="$3"
-    local out_dir="$4"
-    log_debug "Updating unpacked OVA contents at ${repack_dir}"
-    pushd "$repack_dir" > /dev/null || exit
-
-    # Since the OVA contents have been modified we need to update the signatures in the manifest file
-    local manifest_file encryption_type_prefix
-    files_to_pack=("${general_bundle_name}.ovf")
-    files_to_pack+=("$(ls -- *.vmdk)")
-    manifest_file="${general_bundle_name}.mf"
-    :> "$manifest_file"
-    for file in "${files_to_pack[@]}"; do
-        log_debug "Regenerating hash for file ${file}"
-        # Unfortunately the VMWare VSphere client does not support modern encryption, so we're stuck
-        # using SHA1 hashes here.  Signing of the manifest file itself doesn't affect deployment
-        # within the client so we're free to use stronger encryption in the next step.
-        encryption_type_prefix="SHA1($file)= "
-        openssl SHA1 < "$file" | sed "s/(stdin)= /${encryption_type_prefix}/" >> "$manifest_file"
-        if [[ ${PIPESTATUS[0]} -ne 0 ]]; then
-            log_error "Unable to determine hash for file ${file}!"
-        fi
-    done
-    files_to_pack+=("$manifest_file")
-
-    # Sign the manifest file if private/public signing keys were provided.  This will create a
-    # digest of the manifest file using the provided private key.  This digest will be written to a
-    # .sig file with the public key packaged alongside it in a .pub file.  This will enable users to
-    # check the validity of the files in their OVAs as follows:
-    #  * Extract the OVA to a temporary directory
-    #  * Generate hashes of the extracted .vmdk and .ovf files
-    #  * View the manifest file and confirm that the listed hashes match the generated ones.  This
-    #    gives the user confidence that the file contents have not been changed since they were
-    #    published.
-    #  * Take the public key (.pub file) and digest (.sig file) and use them to verify the manifest
-    #    file.  This provides an additional layer of security in case the manifest file itself has
-    #    been tampered with.
-    local private_key public_key sig_file pub_file
-    private_key="$(get_config_value "IMAGE_SIG_PRIVATE_KEY")"
-    public_key="$(get_config_value "IMAGE_SIG_PUBLIC_KEY")"
-    if [[ -n "$private_key" ]] && [[ -n "$public_key" ]]; then
-        encryption_type="$(get_config_value "IMAGE_SIG_ENCRYPTION_TYPE")"
-        log_info "Signing manifest ${manifest_file} using encryption type ${encryption_type} with private key ${private_key}"
-        sig_file="${general_bundle_name}.sig"
-        if openssl dgst -"$encryption_type" -sign "$private_key" "$manifest_file" > "$sig_file"; then
-            pub_file="${general_bundle_name}.pub"
-            cat "$public_key" >> "$pub_file"
-            files_to_pack+=("$sig_file")
-            files_to_pack+=("$pub_file")
-        else
-            log_error "Unable to sign manifest ${manifest_file} using private key ${private_key}!"
-            rm "$sig_file"
-        fi
-    else
-        log_warning "No signing keys were provided.  Skipping OVA signing process!"
-        log_warning "Please provide IMAGE_SIG_PRIVATE_KEY and IMAGE_SIG_PUBLIC_KEY if you wish to sign OVA files!"
-    fi
-
-    # Create new OVA file based on updated contents
-    mkdir -p "$out_dir"
-    local out_file=${out_dir}/${bundle_file_name}
-    extension="${out_file##*.}"
-    case "$extension" in
-        ova|tar)
-            if ! execute_cmd tar -cvf "$out_file" "${files_to_pack[@]}"; then
-                error_and_exit "Unable to create OVA archive at ${out_file}"
-            fi
-            log_debug "OVA TAR file contents:"
-            log_debug "------------------"
-            log_cmd_output "$DEFAULT_LOG_LEVEL" tar -tvf "$out_file"
-            ;;
-        zip)
-            if ! execute_cmd zip -1 "$out_file" "${files_to_pack[@]}"; then
-                error_and_exit "Unable to create ZIP archive at ${out_file}"
-            fi
-            log_debug "OVA ZIP file contents:"
-            log_debug "------------------"
-            log_cmd_output "$DEFAULT_LOG_LEVEL" unzip -l "$out_file"
-            ;;
-        *)
-            error_and_exit "Extension ${extension} is not supported for packing OVA files!"
-            ;;
-    esac
-
-    # Save an md5 hash of the recreated OVA for use as a simple checksum
-    gen_md5 "$out_file"
-    popd > /dev/null || exit
-}
-#####################################################################
-
-#####################################################################
-function add_deployment_options_in_ovf {
-    local ovf_file="$1"
-
-    # shellcheck disable=SC2181
-    if [[ $# != 1 ]]; then
-        log_error "Usage: ${FUNCNAME[0]} <OVF filename>"
-        return 1
-    fi
-
-    if [[ -z "$ovf_file" ]]; then
-        log_error "Missing OVF filename parameter"
-        return 1
-    fi
-
-    log_debug "Adding DeploymentOptions"
-    sed -i "/<VirtualSystem ovf:id/ i\
-        <DeploymentOptionSection>\n\
-          <Info>DeploymentOption Info</Info>\n\
-          <Configuration ovf:id=\"singlecpu\">\n\
-            <Label>1 CPU/2048 MB RAM</Label>\n\
-            <Description>1 CPU and 2048 MB RAM.</Description>\n\
-          </Configuration>\n\
-          <Configuration ovf:id=\"dualcpu\">\n\
-            <Label>2 CPUs/4096 MB RAM</Label>\n\
-            <Description>2 CPUs and 4096 MB RAM.</Description>\n\
-          </Configuration>\n\
-          <Configuration ovf:id=\"quadcpu\">\n\
-            <Label>4 CPUs/8192 MB RAM</Label>\n\
-            <Description>4 CPUs and 8192 MB RAM.</Description>\n\
-          </Configuration>\n\
-          <Configuration ovf:id=\"octalcpu\">\n\
-            <Label>8 CPUs/16384 MB RAM</Label>\n\
-            <Description>8 CPUs and 16384 MB RAM.  High-performance configuration.</Description>\n\
-          </Configuration>\n\
-        </DeploymentOptionSection>
-        " "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]]; then
-        log_error "Error while adding DeploymentOptions in $ovf_file"
-        return 1
-    fi
-
-    #check if DeploymentOptionSection was properly added to ovf_file
-    p1=$(grep -n "</DeploymentOptionSection>" "$ovf_file" | awk -F ":" '{print $1;}')
-    p2=$(grep -n "<VirtualSystem" "$ovf_file" | awk -F ":" '{print $1;}')
-
-    if [[ ! $p1 -lt $p2 ]]; then
-        log_error "The DeploymentOptions were not added correctly in $ovf_file"
-        return 1
-    fi
-}
-
-function set_default_deployment_config {
-    local ovf_file="$1"
-
-    if [[ $# != 1 ]]; then
-        log_error "Usage: ${FUNCNAME[0]} <OVF filename>"
-        return 1
-    fi
-
-    if [[ -z "$ovf_file" ]]; then
-        log_error "Missing OVF filename parameter"
-        return 1
-    fi
-
-    log_debug "Set the default deployment."
-    sed -i 's/<Configuration ovf:id="dualcpu">/<Configuration ovf:id="dualcpu" ovf:default="true">/g' "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while setting default deployment in $ovf_file"
-        return 1
-    fi
-}
-
-function set_ovf_property_retrieval_method {
-    local ovf_file="$1"
-
-    if [[ $# != 1 ]]; then
-        log_error "Usage: ${FUNCNAME[0]} <OVF filename>"
-        return 1
-    fi
-
-    if [[ -z "$ovf_file" ]]; then
-        log_error "Missing OVF filename parameter"
-        return 1
-    fi
-
-    # Set the OVF property retrieval method to VMWare tools. With these
-    # options, vmtoolsd can be used to query the OVF properties using
-    # "info-get guestinfo.ovfEnv" as the --cmd.
-    sed -i "/<\/VirtualHardwareSection>/ i \
-      <vmw:Config ovf:required=\"true\" vmw:key=\"tools.afterPowerOn\" vmw:value=\"true\" />\n\
-      <vmw:Config ovf:required=\"true\" vmw:key=\"tools.afterResume\" vmw:value=\"true\" />\n\
-      <vmw:Config ovf:required=\"true\" vmw:key=\"tools.beforeGuestShutdown\" vmw:value=\"true\" />\n\
-      <vmw:Config ovf:required=\"true\" vmw:key=\"tools.beforeGuestStandby\" vmw:value=\"true\" />
-        "  "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while inserting VirtualHardwareSection in $ovf_file"
-        return 1
-    fi
-}
-#####################################################################
-
-
-#####################################################################
-function add_cpu_choices_in_ovf {
-    # and right after that, append singlecpu, quadcpu and octalcpu.
-    local ovf_file="$1"
-    if [[ $# != 1 ]]; then
-        log_error "Usage: ${FUNCNAME[0]} <OVF file name>"
-        return 1
-    fi
-
-    if [[ -z "$ovf_file" ]]; then
-        log_error "Missing variable file_name"
-        return 1
-    fi
-
-    sed -i "1,/<Item>/{ /<\/Item>/a\
-          <Item ovf:configuration=\"singlecpu\">\n\
-          <rasd:AllocationUnits>hertz * 10^6</rasd:AllocationUnits>\n\
-          <rasd:Description>Number of Virtual CPUs</rasd:Description>\n\
-          <rasd:ElementName>1 virtual CPU</rasd:ElementName>\n\
-          <rasd:InstanceID>1</rasd:InstanceID>\n\
-          <rasd:Reservation>2000</rasd:Reservation>\n\
-          <rasd:ResourceType>CPUTYPE</rasd:ResourceType>\n\
-          <rasd:VirtualQuantity>1</rasd:VirtualQuantity>\n\
-        </Item> \n\
-        <Item ovf:configuration=\"singlecpu\">\n\
-          <rasd:AllocationUnits>byte * 2^20</rasd:AllocationUnits>\n\
-          <rasd:Description>Memory Size</rasd:Description>\n\
-          <rasd:ElementName>2048MB of memory</rasd:ElementName>\n\
-          <rasd:InstanceID>2</rasd:InstanceID>\n\
-          <rasd:Reservation>2048</rasd:Reservation>\n\
-          <rasd:ResourceType>MEMTYPE</rasd:ResourceType>\n\
-          <rasd:VirtualQuantity>2048</rasd:VirtualQuantity>\n\
-        </Item> \n\
-        <Item ovf:configuration=\"quadcpu\">\n\
-        <rasd:AllocationUnits>hertz * 10^6</rasd:AllocationUnits>\n\
-          <rasd:Description>Number of Virtual CPUs</rasd:Description>\n\
-          <rasd:ElementName>4 virtual CPU(s)</rasd:ElementName>\n\
-          <rasd:InstanceID>1</rasd:InstanceID>\n\
-          <rasd:Reservation>8000</rasd:Reservation>\n\
-          <rasd:ResourceType>CPUTYPE</rasd:ResourceType>\n\
-          <rasd:VirtualQuantity>4</rasd:VirtualQuantity>\n\
-        </Item> \n\
-        <Item ovf:configuration=\"quadcpu\">\n\
-          <rasd:AllocationUnits>byte * 2^20</rasd:AllocationUnits>\n\
-          <rasd:Description>Memory Size</rasd:Description>\n\
-          <rasd:ElementName>8192MB of memory</rasd:ElementName>\n\
-          <rasd:InstanceID>2</rasd:InstanceID>\n\
-          <rasd:Reservation>8192</rasd:Reservation>\n\
-          <rasd:ResourceType>MEMTYPE</rasd:ResourceType>\n\
-          <rasd:VirtualQuantity>8192</rasd:VirtualQuantity>\n\
-        </Item> \n\
-        <Item ovf:configuration=\"octalcpu\">\n\
-          <rasd:AllocationUnits>hertz * 10^6</rasd:AllocationUnits>\n\
-          <rasd:Description>Number of Virtual CPUs</rasd:Description>\n\
-          <rasd:ElementName>8 virtual CPU(s)</rasd:ElementName>\n\
-          <rasd:InstanceID>1</rasd:InstanceID>\n\
-          <rasd:Reservation>16000</rasd:Reservation>\n\
-          <rasd:ResourceType>CPUTYPE</rasd:ResourceType>\n\
-          <rasd:VirtualQuantity>8</rasd:VirtualQuantity>\n\
-        </Item> \n\
-        <Item ovf:configuration=\"octalcpu\">\n\
-          <rasd:AllocationUnits>byte * 2^20</rasd:AllocationUnits>\n\
-          <rasd:Description>Memory Size</rasd:Description>\n\
-          <rasd:ElementName>16384MB of memory</rasd:ElementName>\n\
-          <rasd:InstanceID>2</rasd:InstanceID>\n\
-          <rasd:Reservation>16384</rasd:Reservation>\n\
-          <rasd:ResourceType>MEMTYPE</rasd:ResourceType>\n\
-          <rasd:VirtualQuantity>16384</rasd:VirtualQuantity>\n\
-        </Item>
-        }" "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "${FUNCNAME[0]} - Error while inserting CPU choices in $ovf_file"
-        return 1
-    fi
-}
 #####################################################################
 
 #####################################################################
@@ -407,192 +127,185 @@ function modify_template_vmx_file {
 }
 #####################################################################
 
-
-# BUG:https://bugzilla.olympus.f5net.com/show_bug.cgi?id=904845
-# not supported versions:
-# inclusive      exclusive
-# 14.1.3.1  ->   14.1.4.1
-# 15.1.1    ->   15.1.3
-# 16.0.1    ->   16.0.1.2
-function check_for_bug_ova {
-    if [[ $BIGIP_VERSION_NUMBER -ge 14010301 ]] && [[ $BIGIP_VERSION_NUMBER -lt 14010401 ]]; then
-        echo " 14.1.3.1  ->   14.1.4.1"
-        return
-    fi
-    if [[ $BIGIP_VERSION_NUMBER -ge 15010100 ]] && [[ $BIGIP_VERSION_NUMBER -lt 15010300 ]]; then
-        echo " 15.1.1  ->   15.1.3"
-        return
-    fi
-    if [[ $BIGIP_VERSION_NUMBER -ge 16000100 ]] && [[ $BIGIP_VERSION_NUMBER -lt 16000102 ]]; then
-        echo " 16.0.1  ->   16.0.2"
-        return
-    fi
-    echo "0"
-
+#####################################################################
+# Print the create_ova.py options that add the BIG-IP specific sections, deployment options
+# and reservations to the OVF.
+function get_ovf_customize_options {
+    local options="--product-version $PRODUCT_VERSION --product-build $PRODUCT_BUILD"
+    if [[ -n "$BIGIP_VERSION_NUMBER" ]]; then
+        options+=" --version-number $BIGIP_VERSION_NUMBER"
+    fi
+    echo "$options"
 }
 #####################################################################
 
+#####################################################################
+# Print the platform and bundle name of every OVA variant, one per line: the bundle of the
+# platform being built, then those of the OVA_VARIANTS platforms, which are named after it.
+function get_ova_variants {
+    local platform="$1"
+    local bundle_name="$2"
 
-# Called if user specifies ova_prop_net_user parameter. Adds properties to ovffile to allow customization of
-# mgmt IP's, gateways, and passwords.
-function add_ova_net_prop {
-    net_text="<Category>Network properties</Category>\n\
-                <Property ovf:key=\"net.mgmt.addr\" ovf:type=\"string\" ovf:value=\"\" ovf:userConfigurable=\"true\">\n\
-                <Label>mgmt-addr</Label>\n\
-                <Description>F5 BIG-IP VE\'s management address in the format of \"IP/prefix\"</Description>\n\
-                </Property>\n\ "
-    
-    local major_version="${BIGIP_VERSION_NUMBER:0:2}"
-    local add_ipv6=false 
-
-    # For support of ipv6 in ova configuration
-    # 14.1.x  =  14.1.4.1+
-    # 15.1.x  =  15.1.3+
-    # 16.x    =  16.0.1.2+
-    if [[ $BIGIP_VERSION_NUMBER -ge 14010401 ]]; then
-        if [[ $major_version -eq 14 ]]; then
-            add_ipv6=true
-        fi
-        if [[ $major_version -eq 15 ]] && [[ $BIGIP_VERSION_NUMBER -ge 15010300 ]]; then
-            add_ipv6=true
-        fi
-        if [[ $major_version -eq 16 ]] && [[ $BIGIP_VERSION_NUMBER -ge 16000102 ]]; then
-            add_ipv6=true
-            
-        fi
-    fi 
-    if [[ $add_ipv6 == "true" ]]; then
-        net_text="${net_text}<Property ovf:key=\"net.mgmt.addr6\" ovf:type=\"string\" ovf:value=\"\" ovf:userConfigurable=\"true\">\n\
-            <Label>mgmt-addr6</Label>\n\
-            <Description>F5 BIG-IP VE\'s management IPv6 address in the format of \"IP/prefix\"</Description>\n\
-            </Property>\n\
-            <Property ovf:key=\"net.mgmt.gw6\" ovf:type=\"string\" ovf:value=\"\" ovf:userConfigurable=\"true\">\n\
-            <Label>mgmt-gw6</Label>\n\
-            <Description>F5 BIG-IP VE\'s management default IPv6 gateway</Description>\n\
-            </Property>\n\ "
-    fi
-
-    net_text="${net_text}<Property ovf:key=\"net.mgmt.gw\" ovf:type=\"string\" ovf:value=\"\" ovf:userConfigurable=\"true\">\n\
-                <Label>mgmt-gw</Label>\n\
-                <Description>F5 BIG-IP VE\'s management default gateway</Description>\n\
-                </Property>\n\
-                <Category>User properties</Category>\n\
-                <Property ovf:key=\"user.root.pwd\" ovf:type=\"string\" ovf:value=\"\" ovf:userConfigurable=\"true\">\n\
-                <Label>root-pwd</Label>\n\
-                <Description>F5 BIG-IP VE\'s SHA-512 shadow or plain-text password for \"root\" user</Description>\n\
-                </Property>\n\
-                <Property ovf:key=\"user.admin.pwd\" ovf:type=\"string\" ovf:value=\"\" ovf:userConfigurable=\"true\">\n\
-                <Label>admin-pwd</Label>\n\
-                <Description>F5 BIG-IP VE\'s SHA-512 shadow or plain-text password for \"admin\" user</Description>\n\
-                </Property>\n\ "
-     echo "$net_text"
-}
+    if [[ $# != 2 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <platform> <bundle_name>"
+        return 1
+    fi
 
+    echo "$platform $bundle_name"
 
+    local variant_platforms variant_platform base_name
+    variant_platforms="$(get_config_value "OVA_VARIANTS")"
+    if [[ -z "$variant_platforms" ]]; then
+        return 0
+    fi
+    if ! variant_platforms="$(jq -r '.[]' <<< "$variant_platforms")"; then
+        log_error "OVA_VARIANTS must be a JSON list of platforms, e.g. [\"aws\"]"
+        return 1
+    fi
+    base_name="${bundle_name%.*}"
+    base_name="${base_name%-"$platform"}"
+    for variant_platform in $variant_platforms; do
+        case "$variant_platform" in
+            "$platform")
+                ;;
+            aws)
+                echo "aws ${base_name}-aws.zip"
+                ;;
+            vmware)
+                echo "vmware ${base_name}-vmware.ova"
+                ;;
+            *)
+                log_error "Unsupported OVA variant platform '$variant_platform'"
+                return 1
+                ;;
+        esac
+    done
+}
 #####################################################################
-# Modify several sections of the ovf file to contain BIGIP specific info
-function update_ovf_file_fields {
-    local ovf_file="$1"
-    local product_build="$2"
-    local product_version="$3"
 
-    local ve_product_name="BIG-IP"
-    local ve_product_descr="BIG-IP Local Traffic Manager Virtual Edition"
-    local check_for_bug="0"
+#####################################################################
+# Convert the raw disk to a VMDK with qemu-img and have ovftool turn it into an OVA with a
+# streamOptimized disk, then rewrite that OVA into every variant with a customized OVF. The
+# VMDK is copied from the ovftool OVA as is, without extracting it, and read at most once.
+function create_ovftool_ova {
+    local platform="$1"
+    local raw_disk="$2"
+    local general_bundle_name="$3"
+    local prod_vmx_file="$4"
+    local add_ova_eula="$5"
+    local temp_dir="$6"
+    local variant_options=("${@:7}")
 
-    if [[ $# != 3 ]]; then
-        log_error "Usage: ${FUNCNAME[0]} <OVF file name> <product build> <product version>"
+    if [[ $# -lt 9 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <platform> <raw_disk> <general_bundle_name>" \
+                "<vmx_file> <add_ova_eula> <temp_dir> --variant <kind> <bundle_name>..."
         return 1
     fi
 
-    if [[ -z "$ovf_file" ]]; then
-        log_error "Missing variable ovf_file"
-        return 1
-    fi
+    local create_ova vmdk_disk_name
+    create_ova="$(realpath "$(dirname "${BASH_SOURCE[0]}")")/../../bin/create_ova.py"
+    # The VMX template refers to the disk by this name.
+    vmdk_disk_name="$(dirname "$prod_vmx_file")/$general_bundle_name.vmdk"
 
-    if [[ -z "$product_build" ]]; then
-        log_error "Missing variable product_build"
-        return 1
+    # VMWare and AWS VMDKs need lsilogic adapter.
+    if [[ "$platform" == "vmware" ]] || [[ "$platform" == "aws" ]]; then
+        local qemu_vmware_disk_opt="adapter_type=lsilogic"
     fi
 
-    if [[ -z "$product_version" ]]; then
-        log_error "Missing variable product_version"
+    # Convert raw disk to vmdk format
+    "$( dirname "${BASH_SOURCE[0]}" )"/../../bin/convert vmdk "$raw_disk" \
+            "$vmdk_disk_name" $qemu_vmware_disk_opt
+    # shellcheck disable=SC2181
+    if [[ $? -ne 0 ]] ; then
+        log_error "Conversion of raw disk image did not work"
         return 1
     fi
 
-    log_debug "Check for OperatingSystemSection:"
-    grep "OperatingSystemSection" "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]]; then
-         log_error "$ovf_file does not contain OperatingSystemSection"
-         return 1
-    fi
-
-    # if user would like to configure password and managment IP in deployment
-    # we add in the needed section to the ovf file
-    ova_prop_net_user="$(get_config_value "OVA_PROP_NET_USER")"
-
-    prop_text="/<OperatingSystemSection/ i\
-        <AnnotationSection>\n\
-          <Info>F5 $ve_product_name Virtual Edition</Info>\n\
-          <Annotation>$ve_product_descr\n\
-    Copyright 2009-2022 F5 Inc (http://www.f5.com)\n\
-    \n\
-    For support please visit http://support.f5.com\n\
-          </Annotation>\n\
-        </AnnotationSection>\n\
-        <ProductSection>\n\
-          <Info>F5 $ve_product_name</Info>\n\
-          <Product>$ve_product_descr VE $product_version.$product_build</Product>\n\
-          <Vendor>F5 Networks</Vendor>\n\
-          <Version>$product_version</Version>\n\
-          <FullVersion>$product_version-$product_build</FullVersion>\n\
-          <VendorUrl>http://www.f5.com</VendorUrl>\n\ "
-
-    if [[ -n "$ova_prop_net_user" ]]; then
-	check_for_bug=$(check_for_bug_ova)
-	if [[ "$check_for_bug" != "0" ]]; then
-	    log_info "ERROR: $check_for_bug not supported for ova properties config"
-	    return 1
-	fi
-	net_text=$(add_ova_net_prop)
-        prop_text="$prop_text $net_text"
-    fi
-
-    prop_text="${prop_text}</ProductSection>"
-    log_info "Property text to add to ovf file:"
-    log_info "$prop_text"
-    sed -i "$prop_text" "$ovf_file"
+    echo "ddb tags in $vmdk_disk_name:"
+    grep --binary-files=text "^ddb." "$vmdk_disk_name"
 
+    local out_ova_file="$temp_dir/$general_bundle_name.ova"
+    local customize_options
+    read -r -a customize_options <<< "$(get_ovf_customize_options)"
+
+    # Bundle into OVA
+    start_task=$(timer)
+    log_info "Initial OVA generation -- start time: $(date +%T)"
+    if [[ -n "$add_ova_eula" ]]; then
+        log_info "Include user-defined EULA: $add_ova_eula"
+        ovftool --diskMode=streamOptimized --shaAlgorithm=SHA1 --eula@="$add_ova_eula" \
+                "$prod_vmx_file" "$out_ova_file"
+    else
+        ovftool --diskMode=streamOptimized --shaAlgorithm=SHA1 "$prod_vmx_file" "$out_ova_file"
+    fi
     # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ;then
-        log_error "Error while modifying $ovf_file with product info"
+    if [[ $? -ne 0 ]] ; then
+        log_error "Error while running ovftool on $prod_vmx_file"
+        return 1
+    fi
+    log_info "Initial OVA generation -- elapsed time: $(timer "$start_task")"
+
+    if [[ ! -f "$out_ova_file" ]]; then
+        log_error "The $out_ova_file is not present"
         return 1
     fi
 
-    if ! grep -q "<AnnotationSection" "$ovf_file"; then
-        log_error "$ovf_file does not contain AnnotationSection"
+    start_task=$(timer)
+    log_info "OVA customization -- start time: $(date +%T)"
+    if ! "$create_ova" rewrite "${customize_options[@]}" "${variant_options[@]}" \
+            "$out_ova_file"; then
+        log_error "Error while customizing $out_ova_file"
         return 1
     fi
+    log_info "OVA customization -- elapsed time: $(timer "$start_task")"
+}
+#####################################################################
 
-    if ! grep -q "<ProductSection" "$ovf_file"; then
-        log_error "$ovf_file does not contain ProductSection"
+#####################################################################
+# Build the OVA variants in a single pass over the raw disk, without qemu-img and ovftool:
+# generate the OVF from the VMX, then stream a streamOptimized VMDK of the raw disk into every
+# variant, next to its customized OVF.
+function create_native_ova {
+    local raw_disk="$1"
+    local general_bundle_name="$2"
+    local prod_vmx_file="$3"
+    local add_ova_eula="$4"
+    local temp_dir="$5"
+    local variant_options=("${@:6}")
+
+    if [[ $# -lt 8 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <raw_disk> <general_bundle_name>" \
+                "<vmx_file> <add_ova_eula> <temp_dir> --variant <kind> <bundle_name>..."
         return 1
     fi
 
-    #check if DeploymentOptionSection was properly added to ovf_file
-    p1=$(grep -n "</ProductSection>" "$ovf_file" | awk -F ":" '{print $1;}')
-    p2=$(grep -n "<OperatingSystemSection" "$ovf_file" | awk -F ":" '{print $1;}')
-    if [[ ! $p1 -lt $p2 ]]; then
-        log_error "AnnotationSection and productSection was not added correctly in the $ovf_file"
+    local create_ova ovf_file vmdk_name
+    create_ova="$(realpath "$(dirname "${BASH_SOURCE[0]}")")/../../bin/create_ova.py"
+    ovf_file="$temp_dir/${general_bundle_name}.ovf"
+    # Same disk name as ovftool.
+    vmdk_name="${general_bundle_name}-disk1.vmdk"
+
+    local eula_option=()
+    if [[ -n "$add_ova_eula" ]]; then
+        log_info "Include user-defined EULA: $add_ova_eula"
+        eula_option=(--eula "$add_ova_eula")
+    fi
+    if ! "$create_ova" ovf "${eula_option[@]}" "$prod_vmx_file" "$raw_disk" "$vmdk_name" \
+            "$ovf_file"; then
+        log_error "Error while generating $ovf_file from $prod_vmx_file"
         return 1
     fi
 
-    # Changing the default network adapter names to more friendly ones.
-    sed -i 's/ethernet0/Management/' "$ovf_file"
-    sed -i 's/ethernet1/Internal/' "$ovf_file"
-    sed -i 's/ethernet2/External/' "$ovf_file"
-    sed -i 's/ethernet3/HA/' "$ovf_file"
+    local customize_options
+    read -r -a customize_options <<< "$(get_ovf_customize_options)"
+    start_task=$(timer)
+    log_info "Native OVA generation -- start time: $(date +%T)"
+    if ! "$create_ova" ova --layout "${customize_options[@]}" "${variant_options[@]}" \
+            "$raw_disk" "$vmdk_name" "$ovf_file"; then
+        log_error "Error while packaging $raw_disk"
+        return 1
+    fi
+    log_info "Native OVA generation -- elapsed time: $(timer "$start_task")"
 }
 #####################################################################
 
@@ -657,23 +370,17 @@ function prepare_ova {
     fi
 
     # Check if the current execution is a re-run of previously successful execution.
-    if check_previous_run_status "$output_json" "$bundle_name" ; then
+    if check_previous_run_status "$output_json" "$bundle_name" "$artifacts_dir/$raw_disk"; then
         log_info "Skipping OVA generation as the output virtual disk '$bundle_name'" \
                 "was generated successfully earlier."
         return 0
     fi
 
-    local out_dir=""
     local temp_dir=""
-    local bundle_file_name=""
 
-    # Get the output directory from the bundle_name path.
-    out_dir="$(realpath "$(dirname "$bundle_name")")"
-    bundle_file_name="$(basename "$bundle_name")"
     output_json="$(realpath "$output_json")"
     temp_dir=$(mktemp -d -p "$artifacts_dir")
     
-    local vmdk_disk_name="$artifacts_dir/$general_bundle_name.vmdk"
     local machine_class="production"
 
     local template_dir=""
@@ -697,24 +404,6 @@ function prepare_ova {
     local mem_size=0
     mem_size=$((num_cpus * 2048))
 
-    # VMWare and AWS VMDKs need lsilogic adapter.
-    if [[ "$platform" == "vmware" ]] || [[ "$platform" == "aws" ]]; then
-        local qemu_vmware_disk_opt="adapter_type=lsilogic"
-    fi
-
-    # Convert raw disk to vmdk format
-    "$( dirname "${BASH_SOURCE[0]}" )"/../../bin/convert vmdk "$artifacts_dir/$raw_disk" \
-            "$vmdk_disk_name" $qemu_vmware_disk_opt
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Conversion of raw disk image did not work"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    echo "ddb tags in $vmdk_disk_name:"
-    grep --binary-files=text "^ddb." "$vmdk_disk_name"
-
     local prod_vmx_file="$artifacts_dir/$machine_class.vmx"
     modify_template_vmx_file "$platform" "$general_bundle_name" "$mem_size" "$num_cpus" "$template_vmx" "$prod_vmx_file"
     # shellcheck disable=SC2181
@@ -735,186 +424,73 @@ function prepare_ova {
     log_debug "Check OS in $prod_vmx_file"
     log_cmd_output "$DEFAULT_LOG_LEVEL" grep OS "$prod_vmx_file"
 
-    local out_ova_file="$temp_dir/$general_bundle_name.ova"
-
-    # Bundle into OVA
-    start_task=$(timer)
-    log_info "Initial OVA generation -- start time: $(date +%T)"
-    if [[ -n "$add_ova_eula" ]]; then
-        log_info "Include user-defined EULA: $add_ova_eula"
-        ovftool --diskMode=streamOptimized --eula@="$add_ova_eula" "$prod_vmx_file" "$out_ova_file"
-    else
-        ovftool --diskMode=streamOptimized "$prod_vmx_file" "$out_ova_file"
-    fi
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while running ovftool on $prod_vmx_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-    log_info "Initial OVA generation -- elapsed time: $(timer "$start_task")"
-
-    if [[ ! -f "$out_ova_file" ]]; then
-        log_error "The $out_ova_file is not present"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    local repack_dir="$temp_dir/repackage"
-    mkdir "$repack_dir"
-    cd "$repack_dir" || return
-    log_info "Extract OVA to fix up OVF translation. Files from OVA:"
-
-    tar fxv "$out_ova_file"
-
-    local ovf_file="${general_bundle_name}.ovf"
-
-    if [[ ! -f "$ovf_file" ]]; then
-        log_error "The $ovf_file is not present"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    # shellcheck disable=SC2153
-    update_ovf_file_fields "$ovf_file" "$PRODUCT_BUILD" "$PRODUCT_VERSION"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]]; then
-        log_error "Error while updating fields in $ovf_file"
+    # Every variant shares the VMDK, vCloud Director (aws) variants get an OVF without
+    # deployment options.
+    local variants variant_platform variant_bundle
+    local variant_bundles=() variant_options=()
+    if ! variants="$(get_ova_variants "$platform" "$bundle_name")"; then
         print_fail_status_json "$output_json" "$log_file"
         return 1
     fi
-
-    # Copy that OVF file to one that we'll use for vCloud ver 1.5
-    # It must be done prior adding deployment options as vCloud Director
-    # cannot handle them.
-    local my_ovf
-    if [[ "$platform" == "aws" ]]; then
-        my_ovf="$bundle_file_name.ovf"
-        cp "$ovf_file" "$my_ovf"
-    fi
-
-    # The old ovftool cannot handle it if set in VMX template
-    log_debug "Replacing osType to 'other3xlinux-64'"
-    sed -i "s/<OperatingSystemSection.*>/<OperatingSystemSection ovf:id=\"100\" vmw:osType=\"other3xLinux64Guest\">/" \
-            "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]]; then
-        log_error "Error while replacing osType in $ovf_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    add_deployment_options_in_ovf "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]]; then
-        log_error "add_deployment_options_in_ovf during OVA generation failed"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    set_default_deployment_config "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]]; then
-        log_error "Error setting default deployment configuration in OVF file; OVA cannot be generated"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-    log_debug "Modifying the memory and cpu deployment options."
-    # replace the first Item (the dual CPU) with a configured item
-    sed -i '1,/<Item>/s/<Item>/<Item ovf:configuration="dualcpu">/' "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while replacing configuration in $ovf_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    add_cpu_choices_in_ovf "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while inserting cpu choices info in $ovf_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    set_ovf_property_retrieval_method "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while setting property for retrieval method in $ovf_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    sed -i 's/<VirtualHardwareSection>/<VirtualHardwareSection ovf:transport="com.vmware.guestInfo">/' "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while inserting guest OS info in $ovf_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    echo "Making a Deployment item"
-    sed -i '1,/<Item>/s/<Item>/<Item ovf:configuration="dualcpu">/' "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while inseting a dualCPU item in $ovf_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    local f_ovf
-    log_debug "Adding CPU/Memory resource reservation info"
-    for f_ovf in $ovf_file $my_ovf; do
-        if [[ ! -f "$f_ovf" ]]; then
-            log_error "The $f_ovf is not present"
-            print_fail_status_json "$output_json" "$log_file"
-            return 1
+    while read -r variant_platform variant_bundle; do
+        variant_bundles+=("$variant_bundle")
+        if [[ "$variant_platform" == "aws" ]]; then
+            variant_options+=(--variant vcloud "$variant_bundle")
+        else
+            variant_options+=(--variant vmware "$variant_bundle")
         fi
-
-        sed -i 's%<rasd:ResourceType>3%<rasd:Reservation>4000</rasd:Reservation>\n        <rasd:ResourceType>3%' \
-                "$f_ovf"
-        # shellcheck disable=SC2181
-        if [[ $? -ne 0 ]] ; then
-            log_error "Error while inserting CPU Reservation info in $f_ovf"
+        mkdir -p "$(dirname "$variant_bundle")"
+    done <<< "$variants"
+
+    # ovftool OVAs hold a VMDK with a random CID, reproducible builds use the native builder.
+    if [[ "$(get_config_value "OVA_BUILDER")" == "native" ]] || \
+            [[ -n "$(get_config_value "SOURCE_DATE_EPOCH")" ]]; then
+        if ! create_native_ova "$artifacts_dir/$raw_disk" "$general_bundle_name" \
+                "$prod_vmx_file" "$add_ova_eula" "$temp_dir" "${variant_options[@]}"; then
             print_fail_status_json "$output_json" "$log_file"
             return 1
         fi
-
-        sed -i 's%<rasd:ResourceType>4%<rasd:Reservation>4096</rasd:Reservation>\n        <rasd:ResourceType>4%' \
-                "$f_ovf"
-        # shellcheck disable=SC2181
-        if [[ $? -ne 0 ]] ; then
-            log_error "Error while inserting Memory Reservation info in $f_ovf"
+    else
+        if ! create_ovftool_ova "$platform" "$artifacts_dir/$raw_disk" "$general_bundle_name" \
+                "$prod_vmx_file" "$add_ova_eula" "$temp_dir" "${variant_options[@]}"; then
             print_fail_status_json "$output_json" "$log_file"
             return 1
         fi
-    done
-    sed -i -e 's/CPUTYPE/3/' -e 's/MEMTYPE/4/' "$ovf_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]] ; then
-        log_error "Error while modifying CPUTYPE and MEMTYPE in $ovf_file"
-        print_fail_status_json "$output_json" "$log_file"
-        return 1
-    fi
-
-    if [[ "$platform" == "aws" ]]; then
-        # Put back the vCloud director file and build a zip file
-        cp "$my_ovf" "$ovf_file"
     fi
-    recreate_ova "$general_bundle_name" "$bundle_file_name" "$repack_dir" "$out_dir"
 
+    local sig_ext sig_file variants_json="[]"
     sig_ext="$(get_sig_file_extension "$(get_config_value "IMAGE_SIG_ENCRYPTION_TYPE")")"
-    sig_file="${bundle_name}${sig_ext}"
+    for variant_bundle in "${variant_bundles[@]}"; do
+        if [[ "$variant_bundle" == *.zip ]]; then
+            log_cmd_output "$DEFAULT_LOG_LEVEL" unzip -l "$variant_bundle"
+        else
+            log_cmd_output "$DEFAULT_LOG_LEVEL" tar -tvf "$variant_bundle"
+        fi
 
-    sign_file "$bundle_name" "$sig_file"
-    # shellcheck disable=SC2181
-    if [[ $? -ne 0 ]]; then
-        log_error "Error occured during signing the ${bundle_name}"
-        return 1
-    fi
+        # Save an md5 hash of the OVA for use as a simple checksum
+        gen_md5 "$variant_bundle"
 
-    # Check if signature file was generated, if not, then mark sig_file_path to
-    # be empty indicating it was not generated
+        sig_file="${variant_bundle}${sig_ext}"
+        sign_file "$variant_bundle" "$sig_file"
+        # shellcheck disable=SC2181
+        if [[ $? -ne 0 ]]; then
+            log_error "Error occured during signing the ${variant_bundle}"
+            return 1
+        fi
+
+        # Check if signature file was generated, if not, then mark sig_file_path to
+        # be empty indicating it was not generated
+        if [[ ! -f "$sig_file" ]]; then
+            sig_file=""
+        fi
+        if [[ "$variant_bundle" != "$bundle_name" ]]; then
+            variants_json="$(jq -c --arg output "$(basename "$variant_bundle")" \
+                    --arg sig_file "$(basename "$sig_file")" \
+                    '. + [{ output: $output, sig_file: $sig_file }]' <<< "$variants_json")"
+        fi
+    done
+    # The sig file of the bundle of the platform being built.
+    sig_file="${bundle_name}${sig_ext}"
     if [[ ! -f "$sig_file" ]]; then
         sig_file=""
     fi
@@ -930,8 +506,11 @@ function prepare_ova {
             --arg input "$raw_disk" \
             --arg output "$(basename "$bundle_name")" \
             --arg sig_file "$(basename "$sig_file")" \
+            --arg input_fingerprint "$(get_fingerprint "$artifacts_dir/$raw_disk")" \
+            --arg output_fingerprint "$(get_fingerprint "$bundle_name")" \
             --arg output_partial_md5 "$(calculate_partial_md5 "$bundle_name")" \
             --arg output_size "$(get_file_size "$bundle_name")" \
+            --argjson variants "$variants_json" \
             --arg log_file "$log_file" \
             --arg status "$status" \
             '{ description: $description,
@@ -942,8 +521,11 @@ function prepare_ova {
             input: $input,
             output: $output,
             sig_file: $sig_file,
+            input_fingerprint: $input_fingerprint,
+            output_fingerprint: $output_fingerprint,
             output_partial_md5: $output_partial_md5,
             output_size: $output_size,
+            variants: $variants,
             log_file: $log_file,
             status: $status }' \
             > "$output_json"
@@ -33,7 +33,7 @@ function prepare_qcow2 {
             [[ -z "$artifacts_dir" ]] || [[ -z "$output_json" ]]; then
         log_error "Usage: ${FUNCNAME[0]} <raw_disk> <bundle_name> <artifacts_dir> <output_json>"
         return 1
-    elif [[ ! -f "$artifacts_dir/$raw_disk" ]]; then
+    elif ! is_disk_file "$artifacts_dir/$raw_disk"; then
         log_error "Raw disk '$raw_disk' doesn't exist in '$artifacts_dir'."
         print_json "$failure_token" "$output_json" "qcow2 generation failed: no input raw disk" \
                    "$(basename "${BASH_SOURCE[0]}")"
@@ -41,7 +41,7 @@ function prepare_qcow2 {
     fi
 
     # Check if the current execution is a re-run of previously successful execution.
-    if check_previous_run_status "$output_json" "$bundle_name" ; then
+    if check_previous_run_status "$output_json" "$bundle_name" "$artifacts_dir/$raw_disk"; then
         log_info "Skipping qcow2 generation as the output virtual disk '$bundle_name'" \
                 "was generated successfully earlier."
         return 0
@@ -54,13 +54,17 @@ function prepare_qcow2 {
     local temp_dir
     temp_dir=$(mktemp -d -p "$artifacts_dir")
 
-    local qcow2_disk_file
-    qcow2_disk_file="$temp_dir/$(basename "$bundle_name")"
-    qcow2_disk_file="${qcow2_disk_file/%.zip}"
+    # Uncompressed bundles are the qcow2 disk itself, which is converted in place.
+    local qcow2_disk_file="$bundle_name"
+    if [[ "$bundle_name" != *.qcow2 ]]; then
+        qcow2_disk_file="$temp_dir/$(basename "$bundle_name")"
+        # Strip the bundle compression extension (zip, zst or xz).
+        qcow2_disk_file="${qcow2_disk_file%.*}"
+    fi
 
     # Convert the raw disk to qcow2.
     if ! "$(realpath "$( dirname "${BASH_SOURCE[0]}" )")/../../bin/convert" \
-            "qcow2" "$raw_disk" "$qcow2_disk_file" "compat=0.10" ; then
+            "qcow2" "$raw_disk" "$qcow2_disk_file" "$(get_qcow2_disk_options)" ; then
         log_error "Conversion of $raw_disk to 'qcow2' failed."
         print_json "$failure_token" "$output_json" "qemu image conversion failed" \
                    "$(basename "${BASH_SOURCE[0]}")"
@@ -73,11 +77,12 @@ function prepare_qcow2 {
     start_task=$(timer)
 
     # remove the old zip file
-    if [[ -n "$bundle_name" ]] && [[ -f "$bundle_name" ]]; then
+    if [[ "$qcow2_disk_file" != "$bundle_name" ]] && [[ -f "$bundle_name" ]]; then
         rm -rf "$bundle_name"
     fi
 
-    if ! execute_cmd zip -1 -j "$bundle_name" "$qcow2_disk_file" ; then
+    if [[ "$qcow2_disk_file" != "$bundle_name" ]] && \
+            ! execute_cmd compress_bundle "$bundle_name" "$qcow2_disk_file" ; then
         log_error "Failed to compress '$qcow2_disk_file'."
         print_json "$failure_token" "$output_json"  "QCOW2 generation failed: could not zip" \
                    "$(basename "${BASH_SOURCE[0]}")"
@@ -112,9 +117,9 @@ function prepare_qcow2 {
         sig_file=""
     fi
 
-    log_debug "Contents of zip file '$bundle_name':"
+    log_debug "Contents of bundle '$bundle_name':"
     log_debug "--------------------------------------"
-    log_cmd_output "$DEFAULT_LOG_LEVEL" unzip -l "$bundle_name"
+    log_cmd_output "$DEFAULT_LOG_LEVEL" list_bundle "$bundle_name"
 
     # cleanup and produce the stage output file
     remove_dir "$temp_dir"
@@ -127,6 +132,8 @@ function prepare_qcow2 {
             --arg input "$raw_disk" \
             --arg output "$(basename "$bundle_name")" \
             --arg sig_file "$(basename "$sig_file")" \
+            --arg input_fingerprint "$(get_fingerprint "$raw_disk")" \
+            --arg output_fingerprint "$(get_fingerprint "$bundle_name")" \
             --arg output_partial_md5 "$(calculate_partial_md5 "$bundle_name")" \
             --arg output_size "$(get_file_size "$bundle_name")" \
             --arg status "$success_token" \
@@ -137,6 +144,8 @@ function prepare_qcow2 {
             input: $input,
             output: $output,
             sig_file: $sig_file,
+            input_fingerprint: $input_fingerprint,
+            output_fingerprint: $output_fingerprint,
             output_partial_md5: $output_partial_md5,
             output_size: $output_size,
             status: $status }' \
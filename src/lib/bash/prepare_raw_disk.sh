@@ -213,7 +213,7 @@ function install_iso_on_disk {
     if [[ $# -lt 3 ]]; then
         log_error "Usage: ${FUNCNAME[0]} <raw_disk> <raw_disk_json> <iso> [hotfix_iso]"
         return 1
-    elif [[ ! -f "$disk" ]]; then
+    elif ! is_disk_file "$disk"; then
         log_error "RAW disk '$disk' doesn't exist."
         return 1
     elif [[ ! -s "$disk_json" ]]; then
@@ -480,7 +480,8 @@ function update_initrd_image {
     find . | cpio -o -H newc -A -F "$unzipped_boot_initrd"
 
     # Step 4) Zip the appended initrd.
-    gzip -c --best "$unzipped_boot_initrd" > "$boot_initrd_base"
+    "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/compress.py --level 9 gzip \
+            "$unzipped_boot_initrd" "$boot_initrd_base"
     popd > /dev/null || exit
 
     # Clean-up.
@@ -533,7 +534,7 @@ function exec_qemu_system {
         log_error "Usage: ${FUNCNAME[0]} <disk> <cd_disk> <pidfile> <kernel>" \
                 "<initrd> <append> <logfile>"
         return 1
-    elif [[ "$disk" == "0" ]] || [[ ! -f "$disk" ]]; then
+    elif [[ "$disk" == "0" ]] || ! is_disk_file "$disk"; then
         # disk is a required argument.
         log_error "disk = '$disk', invalid or missing disk."
         return 1
@@ -631,3 +632,31 @@ function exec_qemu_system {
     log_info "qemu-system $tag -- elapsed time: $(timer "$start_task")"
 }
 #####################################################################
+
+
+#####################################################################
+# Write the partition/LV/free extent map and per-LV size report of the
+# installed raw disk. The report is informational for consumers that can
+# skip unallocated extents, so a failure here doesn't fail the build.
+#
+function write_raw_disk_layout {
+    local disk="$1"
+    local layout_json="$2"
+    if [[ $# != 2 ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <raw disk> <layout json>"
+        return 1
+    elif ! is_disk_file "$disk"; then
+        log_error "$disk is missing or not a file."
+        return 1
+    fi
+
+    if "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/read_raw_disk_layout.py "$disk" "$layout_json"; then
+        log_info "Wrote raw disk layout report to '$layout_json'."
+        return 0
+    else
+        log_warning "Failed to read the raw disk layout of '$disk', sparse-aware steps will process the whole disk."
+        rm -f "$layout_json"
+        return 1
+    fi
+}
+#####################################################################
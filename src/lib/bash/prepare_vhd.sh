@@ -20,6 +20,44 @@ source "$( dirname "${BASH_SOURCE[0]}" )/common.sh"
 # shellcheck source=src/lib/bash/util/logger.sh
 source "$(realpath "$(dirname "${BASH_SOURCE[0]}")")/util/logger.sh"
 
+#####################################################################
+# Create a fixed VHD from a raw disk file by reflinking (or sparse copying) it
+# and appending a VHD footer, with the size padded to a whole MiB as Azure
+# requires. The result is checked with "qemu-img info" before it is used.
+#
+function create_fixed_vhd {
+    local raw_disk="$1"
+    local vhd="$2"
+    if [[ $# != 2 ]] || [[ -z "$raw_disk" ]] || [[ -z "$vhd" ]]; then
+        log_error "Usage: ${FUNCNAME[0]} <raw_disk> <vhd>"
+        return 1
+    fi
+    if [[ ! -f "$raw_disk" ]]; then
+        log_info "'$raw_disk' is not a regular file, a fixed VHD can't be created in place."
+        return 1
+    fi
+
+    if ! "$(realpath "$(dirname "${BASH_SOURCE[0]}")")"/../../bin/make_fixed_vhd.py \
+            "$raw_disk" "$vhd"; then
+        log_warning "Failed to create a fixed VHD from '$raw_disk'."
+        rm -f "$vhd"
+        return 1
+    fi
+
+    local info
+    local expected_size=$(( $(stat -c %s "$vhd") - 512 ))
+    if ! info="$(qemu-img info --output json -f vpc "$vhd")" || \
+            [[ "$(jq -r '.["virtual-size"]' <<< "$info")" != "$expected_size" ]] || \
+            (( expected_size % 1048576 != 0 )); then
+        log_warning "qemu-img doesn't read '$vhd' as a ${expected_size} byte VHD: $info"
+        rm -f "$vhd"
+        return 1
+    fi
+    log_cmd_output "$DEFAULT_LOG_LEVEL" qemu-img info -f vpc "$vhd"
+}
+#####################################################################
+
+
 #####################################################################
 function prepare_vhd { 
     local platform="$1"
@@ -42,7 +80,7 @@ function prepare_vhd {
     fi
 
     # Check if the current execution is a re-run of previously successful execution.
-    if check_previous_run_status "$output_json" "$bundle_name" ; then
+    if check_previous_run_status "$output_json" "$bundle_name" "$artifacts_dir/$raw_disk"; then
         log_info "Skipping ${FUNCNAME[0]} as the virtual disk '$bundle_name' was already generated successfully."
         return 0
     fi
@@ -51,15 +89,26 @@ function prepare_vhd {
     temp_dir=$(mktemp -d -p "$artifacts_dir")
 
     local virtual_disk_name="$temp_dir/$general_bundle_name.vhd"
+    # Uncompressed bundles are the VHD itself, which is converted in place.
+    if [[ "$platform" != "azure" ]] && [[ "$bundle_name" == *.vhd ]]; then
+        virtual_disk_name="$bundle_name"
+    fi
  
     if [[ "$platform" == "azure" ]]; then
         # Azure requires FIXED/STATIC VHDs:
         local vhd_options="subformat=fixed,force_size"
     fi
 
-    # Convert raw disk to vhd format
-    "$( dirname "${BASH_SOURCE[0]}" )"/../../bin/convert vpc "$artifacts_dir/$raw_disk" \
-            "$virtual_disk_name" "$vhd_options"
+    # A fixed VHD is the raw disk followed by a footer, so for Azure the raw disk is reflinked
+    # and the footer appended in place. Fall back to qemu-img if that isn't possible.
+    if [[ "$platform" == "azure" ]] && create_fixed_vhd "$artifacts_dir/$raw_disk" \
+            "$virtual_disk_name"; then
+        log_info "Created fixed VHD '$virtual_disk_name' without converting the raw disk."
+    else
+        # Convert raw disk to vhd format
+        "$( dirname "${BASH_SOURCE[0]}" )"/../../bin/convert vpc "$artifacts_dir/$raw_disk" \
+                "$virtual_disk_name" "$vhd_options"
+    fi
 
     # shellcheck disable=SC2181
     if [[ $? -ne 0 ]] ; then
@@ -73,11 +122,13 @@ function prepare_vhd {
 
     log_info "Compressing $virtual_disk_name -- start time: $(date +%T)"
     start_task=$(timer)
-    if [[ "$platform" != "azure" ]]; then
+    if [[ "$virtual_disk_name" == "$bundle_name" ]]; then
+        log_info "Keeping $virtual_disk_name uncompressed."
+    elif [[ "$platform" != "azure" ]]; then
         execute_cmd rm -f "$bundle_name"
-        execute_cmd zip -1 -j "$bundle_name" "$virtual_disk_name"
+        execute_cmd compress_bundle "$bundle_name" "$virtual_disk_name"
     else
-        execute_cmd tar -Sczvf "$bundle_name" -C "$temp_dir" "$(basename "$virtual_disk_name")"
+        execute_cmd create_tar_gz "$bundle_name" "$virtual_disk_name"
     fi
     # shellcheck disable=SC2181
     if [[ $? -ne 0 ]] ; then
@@ -110,11 +161,7 @@ function prepare_vhd {
     print_disk_free_space
 
     log_debug "Content of $bundle_name:"
-    if [[ "$platform" != "azure" ]]; then
-        unzip -l "$bundle_name"
-    else
-        tar -tzvf "$bundle_name"
-    fi
+    list_bundle "$bundle_name"
 
     # shellcheck disable=SC2181
     if [[ $? -ne 0 ]] ; then
@@ -135,6 +182,8 @@ function prepare_vhd {
             --arg virtual_disk_name "$(basename "$virtual_disk_name")" \
             --arg output "$(basename "$bundle_name")" \
             --arg sig_file "$(basename "$sig_file")" \
+            --arg input_fingerprint "$(get_fingerprint "$artifacts_dir/$raw_disk")" \
+            --arg output_fingerprint "$(get_fingerprint "$bundle_name")" \
             --arg output_partial_md5 "$(calculate_partial_md5 "$bundle_name")" \
             --arg output_size "$(get_file_size "$bundle_name")" \
             --arg log_file "$log_file" \
@@ -148,6 +197,8 @@ function prepare_vhd {
             virtual_disk_name: $virtual_disk_name,
             output: $output,
             sig_file: $sig_file,
+            input_fingerprint: $input_fingerprint,
+            output_fingerprint: $output_fingerprint,
             output_partial_md5: $output_partial_md5,
             output_size: $output_size,
             log_file: $log_file,
@@ -0,0 +1,21 @@
+"""disk module"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+# Extend pkgutil search path to include modules from implicit namespace packages with the same name.
+# This allows source and test code to co-exist on the PYTHONPATH when running tests.
+from pkgutil import extend_path
+__path__ = extend_path(__path__, __name__)
@@ -0,0 +1,90 @@
+"""Single pass conversion of a raw disk into several virtual disk formats"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import os
+import time
+from collections import namedtuple
+
+from disk.image_writer import parse_image_options
+from disk.qcow2 import create_qcow2_writer
+from disk.raw_disk_layout import RawDiskLayout
+from disk.vhd import create_vhd_writer
+from disk.vmdk import create_vmdk_writer
+from util.logger import LOGGER
+from util.misc import get_disk_size
+from util.zero_blocks import ZeroBlockScanner
+
+# Keyed by qemu-img format names, so callers can switch between qemu-img and this converter.
+WRITER_FACTORIES = {
+    'qcow2': create_qcow2_writer,
+    'vmdk': create_vmdk_writer,
+    'vpc': create_vhd_writer
+}
+
+# disk_format and options follow qemu-img convert (-O and -o).
+ConversionTarget = namedtuple('ConversionTarget', ['disk_format', 'path', 'options'])
+
+
+def get_layout_data_ranges(raw_disk, empty_lvs=None):
+    """Data ranges of the raw disk according to its partitions and LVM metadata, or None if the
+    layout can't be read, in which case the whole disk has to be scanned."""
+    layout = RawDiskLayout(raw_disk, empty_lvs)
+    try:
+        layout.load()
+    except (RuntimeError, ValueError, KeyError) as exc:
+        LOGGER.warning('Unable to read the layout of %s, converting the whole disk: %s',
+                       raw_disk, exc)
+        return None
+    return layout.get_data_ranges()
+
+
+def convert_raw_disk(raw_disk, targets, ranges=None):
+    """Convert raw_disk into every target with a single read of its non-zero data.
+
+    ranges: optional (offset, length) ranges holding the data to convert, for example from
+    get_layout_data_ranges(). Everything outside of them is converted as zeroes.
+    Returns the number of bytes read from raw_disk."""
+    size = get_disk_size(raw_disk)
+    writers = []
+    start_time = time.monotonic()
+    try:
+        for target in targets:
+            factory = WRITER_FACTORIES.get(target.disk_format)
+            if factory is None:
+                raise ValueError('Unsupported disk format {}'.format(target.disk_format))
+            writers.append(factory(target.path, size, parse_image_options(target.options)))
+
+        scanner = ZeroBlockScanner(raw_disk)
+        for offset, data in scanner.iter_nonzero_chunks(ranges):
+            for writer in writers:
+                writer.write(offset, data)
+        for writer in writers:
+            writer.close()
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+            if os.path.exists(writer.path):
+                os.unlink(writer.path)
+        raise
+
+    LOGGER.info('Converted %s into %s in %.1fs: read %d MiB of data, skipped %d MiB of zeroes '
+                'and %d MiB of holes.', raw_disk,
+                ', '.join('{} ({})'.format(target.path, target.disk_format)
+                          for target in targets),
+                time.monotonic() - start_time, scanner.scanned_bytes >> 20,
+                scanner.zero_bytes >> 20, (size - scanner.scanned_bytes) >> 20)
+    return scanner.scanned_bytes
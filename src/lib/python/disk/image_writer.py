@@ -0,0 +1,142 @@
+"""Base class for writers of virtual disk image formats"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import re
+
+SECTOR_SIZE = 512
+SIZE_SUFFIX_BITS = {'': 0, 'k': 10, 'm': 20}
+
+
+def parse_image_options(options):
+    """Parse qemu-img style comma separated key=value options into a dictionary.
+    Flags without a value (e.g. force_size) map to 'on'."""
+    parsed = {}
+    for option in (options or '').split(','):
+        option = option.strip()
+        if not option:
+            continue
+        key, _, value = option.partition('=')
+        parsed[key.strip()] = value.strip() if value else 'on'
+    return parsed
+
+
+def parse_size_option(value):
+    """Parse a qemu-img style size option in bytes, or with a k or M suffix (e.g. 64k, 2M)."""
+    match = re.fullmatch(r'([0-9]+)([kKmM]?)', value.strip())
+    if not match:
+        raise ValueError('Invalid size {}, expected bytes or a k or M suffix'.format(value))
+    return int(match.group(1)) << SIZE_SUFFIX_BITS[match.group(2).lower()]
+
+
+def round_up(value, alignment):
+    """Round value up to a multiple of alignment."""
+    return -(-value // alignment) * alignment
+
+
+class ImageWriter():
+    """Writes a virtual disk image from the non-zero data of a raw disk.
+
+    Data is passed to write() in ascending offset order, as produced by
+    ZeroBlockScanner.iter_nonzero_chunks. Formats that allocate fixed size units (clusters,
+    grains, blocks) get complete units through _write_unit(); parts of a unit that are never
+    written are zero. Units that are never written stay unallocated in the image.
+
+    Writers that only append can be given an already open image_file, for example an archive
+    member, instead of creating path. path still names the image in its metadata."""
+
+    # Allocation unit of the format in bytes. Subclasses that override write() may leave it 0.
+    unit_size = 0
+
+    def __init__(self, path, size, image_file=None):
+        self.path = path
+        self.size = size
+        self.image_file = open(path, 'wb') if image_file is None else image_file
+        self.end_offset = 0
+        self.pending_index = None
+        self.pending = None
+        self.data_units = 0
+
+    def _write_unit(self, index, data):
+        """Store one complete allocation unit of unit_size bytes."""
+        raise NotImplementedError('_write_unit() unimplemented.')
+
+    def _finish(self):
+        """Write the metadata once all the data has been written."""
+        raise NotImplementedError('_finish() unimplemented.')
+
+    def _flush_pending(self):
+        if self.pending_index is not None:
+            self._write_unit(self.pending_index, self.pending)
+            self.data_units += 1
+            self.pending_index = None
+            self.pending = None
+
+    def write(self, offset, data):
+        """Write non-zero data at the given offset of the virtual disk."""
+        view = memoryview(data).cast('B')
+        if offset + len(view) > self.size:
+            raise ValueError('Write of {} bytes at {} is past the end of the {} byte disk'.format(
+                len(view), offset, self.size))
+        position = 0
+        while position < len(view):
+            index, unit_offset = divmod(offset + position, self.unit_size)
+            remaining = len(view) - position
+            if unit_offset == 0 and remaining >= self.unit_size and index != self.pending_index:
+                # Whole unit: hand it over without copying.
+                self._flush_pending()
+                self._write_unit(index, view[position:position + self.unit_size])
+                self.data_units += 1
+                position += self.unit_size
+                continue
+            if index != self.pending_index:
+                if self.pending_index is not None and index < self.pending_index:
+                    raise ValueError('Writes must be in ascending offset order')
+                self._flush_pending()
+                self.pending_index = index
+                self.pending = bytearray(self.unit_size)
+            length = min(remaining, self.unit_size - unit_offset)
+            self.pending[unit_offset:unit_offset + length] = view[position:position + length]
+            position += length
+
+    def close(self):
+        """Flush the last unit, write the metadata and close the image."""
+        if self.image_file.closed:
+            return
+        try:
+            self._flush_pending()
+            self._finish()
+        finally:
+            self.image_file.close()
+
+    def abort(self):
+        """Close the image without finishing it."""
+        self.image_file.close()
+
+    def _append(self, data):
+        """Append data at the end of the image and return its offset."""
+        offset = self.end_offset
+        if self.image_file.tell() != offset:
+            self.image_file.seek(offset)
+        self.image_file.write(data)
+        self.end_offset += len(data)
+        return offset
+
+    def _write_at(self, offset, data):
+        """Write data at a fixed offset, typically metadata reserved up front."""
+        self.image_file.seek(offset)
+        self.image_file.write(data)
+        self.end_offset = max(self.end_offset, offset + len(data))
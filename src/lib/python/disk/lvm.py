@@ -0,0 +1,189 @@
+"""LVM2 physical volume label and text metadata reader"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import re
+import struct
+
+from util.logger import LOGGER
+
+SECTOR_SIZE = 512
+
+LABEL_ID = b'LABELONE'
+LABEL_TYPE = b'LVM2 001'
+LABEL_SCAN_SECTORS = 4
+MDA_MAGIC = b' LVM2 x[5A%r0N*>'
+MDA_HEADER_SIZE = 512
+
+_TOKEN_RE = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>-?\d+(?:\.\d+)?(?![\w.+-]))
+  | (?P<name>[\w.+-]+)
+  | (?P<symbol>[{}\[\]=,])
+''', re.VERBOSE)
+
+
+def _tokenize(text):
+    """Split LVM text metadata into (kind, value) tokens."""
+    position = 0
+    while position < len(text):
+        match = _TOKEN_RE.match(text, position)
+        if not match:
+            raise RuntimeError('Unexpected character {!r} in LVM metadata at offset {}'.format(
+                text[position], position))
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        value = match.group(kind)
+        if kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        elif kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        yield kind, value
+
+
+def parse_lvm_metadata(text):
+    """Parse LVM2 text format metadata into nested dictionaries.
+
+    Sections become dictionaries, arrays become lists and scalar values keep their string or
+    integer type. Comments are discarded."""
+    tokens = list(_tokenize(text))
+    position = 0
+
+    def expect(symbol):
+        nonlocal position
+        if position >= len(tokens) or tokens[position] != ('symbol', symbol):
+            raise RuntimeError('Malformed LVM metadata: expected {!r} at token {}'.format(
+                symbol, position))
+        position += 1
+
+    def parse_value():
+        nonlocal position
+        kind, value = tokens[position]
+        if (kind, value) == ('symbol', '['):
+            position += 1
+            values = []
+            while tokens[position] != ('symbol', ']'):
+                values.append(parse_value())
+                if tokens[position] == ('symbol', ','):
+                    position += 1
+            position += 1
+            return values
+        if kind not in ('string', 'number'):
+            raise RuntimeError('Malformed LVM metadata: unexpected {!r}'.format(value))
+        position += 1
+        return value
+
+    def parse_section(closing):
+        nonlocal position
+        section = {}
+        while position < len(tokens):
+            kind, key = tokens[position]
+            if closing and (kind, key) == ('symbol', '}'):
+                position += 1
+                return section
+            if kind not in ('name', 'number'):
+                raise RuntimeError('Malformed LVM metadata: unexpected {!r}'.format(key))
+            key = str(key)
+            position += 1
+            if tokens[position] == ('symbol', '{'):
+                position += 1
+                section[key] = parse_section(True)
+            else:
+                expect('=')
+                section[key] = parse_value()
+        if closing:
+            raise RuntimeError('Malformed LVM metadata: unterminated section')
+        return section
+
+    return parse_section(False)
+
+
+class LvmPhysicalVolume():
+    """LVM2 physical volume found at a byte offset of a raw disk image."""
+
+    def __init__(self, disk_file, offset):
+        self.disk_file = disk_file
+        self.offset = offset
+        self.uuid = None
+        self.device_size = 0
+        self.data_areas = []
+        self.metadata_areas = []
+
+    def _read(self, offset, size):
+        """Read size bytes relative to the start of the physical volume."""
+        self.disk_file.seek(self.offset + offset)
+        return self.disk_file.read(size)
+
+    def read_label(self):
+        """Look for the LVM2 label in the first sectors. Returns False if there is none."""
+        for sector in range(LABEL_SCAN_SECTORS):
+            label = self._read(sector * SECTOR_SIZE, SECTOR_SIZE)
+            if len(label) < SECTOR_SIZE:
+                return False
+            if label[0:8] != LABEL_ID or label[24:32] != LABEL_TYPE:
+                continue
+
+            header_offset = struct.unpack_from('<I', label, 20)[0]
+            if header_offset < 32 or header_offset >= SECTOR_SIZE:
+                raise RuntimeError('Invalid LVM label header offset {}'.format(header_offset))
+            header = label[header_offset:]
+            self.uuid = header[0:32].decode('ascii', errors='replace')
+            self.device_size = struct.unpack_from('<Q', header, 32)[0]
+
+            # Two zero-terminated lists of (offset, size) areas follow: data, then metadata.
+            areas = [self.data_areas, self.metadata_areas]
+            position = 40
+            while areas and position + 16 <= len(header):
+                area_offset, area_size = struct.unpack_from('<QQ', header, position)
+                position += 16
+                if area_offset == 0:
+                    areas.pop(0)
+                    continue
+                areas[0].append((area_offset, area_size))
+            return True
+        return False
+
+    def read_metadata_text(self):
+        """Return the most recent text metadata found in the metadata areas."""
+        for mda_offset, _ in self.metadata_areas:
+            header = self._read(mda_offset, MDA_HEADER_SIZE)
+            if header[4:20] != MDA_MAGIC:
+                LOGGER.debug('No metadata area header at PV offset %d', mda_offset)
+                continue
+            mda_size = struct.unpack_from('<Q', header, 32)[0]
+            text_offset, text_size = struct.unpack_from('<QQ', header, 40)
+            if not text_size:
+                continue
+
+            # The metadata area is a circular buffer that wraps past its header.
+            first_size = min(text_size, mda_size - text_offset)
+            text = self._read(mda_offset + text_offset, first_size)
+            if first_size < text_size:
+                text += self._read(mda_offset + MDA_HEADER_SIZE, text_size - first_size)
+            return text.rstrip(b'\0').decode('utf-8', errors='replace')
+        raise RuntimeError('No readable LVM metadata found on PV at offset {}'.format(self.offset))
+
+    def read_volume_group(self):
+        """Parse the text metadata and return (vg_name, vg_dict)."""
+        metadata = parse_lvm_metadata(self.read_metadata_text())
+        for key, value in metadata.items():
+            if isinstance(value, dict) and 'physical_volumes' in value:
+                return key, value
+        raise RuntimeError('LVM metadata on PV at offset {} has no volume group'.format(
+            self.offset))
@@ -0,0 +1,448 @@
+"""OVA packaging that streams the VMDK straight from the raw disk into one or more archives,
+and rewriting of OVAs without extracting them"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import errno
+import hashlib
+import os
+import re
+import tarfile
+import tempfile
+import time
+import zipfile
+from collections import namedtuple
+
+from disk.ovf import fill_ovf_placeholders
+from disk.vmdk import StreamOptimizedVmdkWriter
+from util.logger import LOGGER
+from util.misc import get_disk_size
+from util.reproducible import get_timestamp
+from util.zero_blocks import ZeroBlockScanner
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+# Largest member size of a ustar header. Larger members get a GNU header, which stores the size
+# in base-256 in the same 512 bytes.
+USTAR_MAX_SIZE = 0o77777777777
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# Manifest lines, as written by openssl and ovftool: SHA1(name)= digest
+MANIFEST_LINE = re.compile(r'^(\w+)\((.+)\)\s*=\s*([0-9a-fA-F]+)\s*$')
+# Members of a source OVA that are regenerated instead of copied.
+REGENERATED_EXTENSIONS = ('.mf', '.sig', '.pub', '.cert')
+
+# One archive packaging the same VMDK: its path (a zip archive if it ends in .zip) and a
+# function returning its descriptor from the common one, or None to use that as is.
+OvaVariant = namedtuple('OvaVariant', ['path', 'transform_ovf'])
+
+
+class ArchiveMember():
+    """Write-only file object for one archive member, hashing what is written.
+
+    tell() is relative to the start of the member, so image writers can write into it as if it
+    was a file of their own."""
+
+    def __init__(self, archive, name, fileobj):
+        self.archive = archive
+        self.name = name
+        self.fileobj = fileobj
+        self.size = 0
+        self.sha1 = hashlib.sha1()
+        self.closed = False
+
+    def write(self, data):
+        """Write data at the end of the member."""
+        self.fileobj.write(data)
+        self.sha1.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        """Number of bytes written so far."""
+        return self.size
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Members are written sequentially, only the current position can be sought."""
+        if (offset, whence) not in ((self.size, os.SEEK_SET), (0, os.SEEK_END)):
+            raise OSError('Archive member {} can only be written sequentially'.format(self.name))
+        return self.size
+
+    def close(self):
+        """Complete the member in its archive."""
+        if not self.closed:
+            self.closed = True
+            self.archive.close_member(self)
+
+
+class ArchiveMemberSet(ArchiveMember):
+    """Write-only file object writing the same data to one member of each of several archives,
+    so that it is produced and hashed once."""
+
+    def __init__(self, members):
+        super().__init__(None, members[0].name, None)
+        self.members = members
+
+    def write(self, data):
+        """Write data at the end of every member."""
+        for member in self.members:
+            member.fileobj.write(data)
+            member.size += len(data)
+        self.sha1.update(data)
+        self.size += len(data)
+        return len(data)
+
+    def close(self):
+        """Complete the member in every archive."""
+        if not self.closed:
+            self.closed = True
+            for member in self.members:
+                member.sha1 = self.sha1
+                member.close()
+
+
+class OvaArchive():
+    """Writes an OVA, which is a tar archive, or a zip archive of the same files, with members
+    of unknown size.
+
+    tar headers are written with a zero size and rewritten once the member is complete, zip
+    members use data descriptors. Either way the archive is written in one pass, but must be a
+    regular (seekable) file."""
+
+    def __init__(self, path, mtime=None):
+        self.path = path
+        self.mtime = get_timestamp() if mtime is None else mtime
+        self.is_zip = path.endswith('.zip')
+        self.digests = {}
+        self.member = None
+        if self.is_zip:
+            self.zip_file = zipfile.ZipFile(path, 'w', allowZip64=True)
+            self.tar_file = None
+        else:
+            self.zip_file = None
+            self.tar_file = open(path, 'wb')
+            self.header_offset = None
+
+    def _tar_header(self, name, size):
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.size = size
+        tarinfo.mtime = self.mtime
+        tarinfo.mode = 0o644
+        return tarinfo.tobuf(tarfile.USTAR_FORMAT if size <= USTAR_MAX_SIZE
+                             else tarfile.GNU_FORMAT)
+
+    def open_member(self, name, compress=True):
+        """Start a new member. Only one member can be written at a time.
+        compress only applies to zip archives, for data that doesn't compress any further."""
+        if self.member is not None:
+            raise RuntimeError('Member {} of {} is still open'.format(self.member.name,
+                                                                      self.path))
+        if self.is_zip:
+            zip_info = zipfile.ZipInfo(name, time.gmtime(self.mtime)[:6])
+            zip_info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+            zip_info.external_attr = 0o644 << 16
+            fileobj = self.zip_file.open(zip_info, 'w', force_zip64=True)
+        else:
+            if len(name.encode()) >= tarfile.LENGTH_NAME:
+                raise ValueError('Member name {} is too long for an OVA'.format(name))
+            self.header_offset = self.tar_file.tell()
+            self.tar_file.write(self._tar_header(name, 0))
+            fileobj = self.tar_file
+        self.member = ArchiveMember(self, name, fileobj)
+        return self.member
+
+    def close_member(self, member):
+        """Pad the member and fix its header. Called by ArchiveMember.close()."""
+        if self.is_zip:
+            member.fileobj.close()
+        else:
+            self.tar_file.write(bytes(-member.size % TAR_BLOCK_SIZE))
+            end_offset = self.tar_file.tell()
+            self.tar_file.seek(self.header_offset)
+            self.tar_file.write(self._tar_header(member.name, member.size))
+            self.tar_file.seek(end_offset)
+        self.digests[member.name] = member.sha1.hexdigest()
+        self.member = None
+
+    def rewrite_member(self, member_offset, data):
+        """Overwrite the data of a complete, uncompressed tar member with data of the same
+        length, which must start at member_offset in the archive."""
+        end_offset = self.tar_file.tell()
+        self.tar_file.seek(member_offset)
+        self.tar_file.write(data)
+        self.tar_file.seek(end_offset)
+
+    def _copy_file_range(self, source_file, offset, size):
+        """Copy size bytes at offset of source_file to the end of the tar archive in the
+        kernel. Returns False if the filesystems don't support it."""
+        self.tar_file.flush()
+        destination_offset = self.tar_file.tell()
+        copied = 0
+        try:
+            while copied < size:
+                length = os.copy_file_range(source_file.fileno(), self.tar_file.fileno(),
+                                            min(size - copied, 1 << 30), offset + copied,
+                                            destination_offset + copied)
+                if length == 0:
+                    raise RuntimeError('{} ended before its member data'.format(
+                        source_file.name))
+                copied += length
+        except (AttributeError, OSError) as exc:
+            if copied or getattr(exc, 'errno', errno.ENOSYS) not in (
+                    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+            return False
+        self.tar_file.seek(destination_offset + size)
+        return True
+
+    def copy_range(self, name, source_file, offset, size, sha1):
+        """Add a tar member holding size bytes at offset of source_file, whose SHA1 digest is
+        known, with copy_file_range() and without reading the data in user space.
+        Returns False if that isn't possible, in which case nothing is added."""
+        if self.is_zip:
+            return False
+        header_offset = self.tar_file.tell()
+        self.tar_file.write(self._tar_header(name, size))
+        if not self._copy_file_range(source_file, offset, size):
+            self.tar_file.seek(header_offset)
+            self.tar_file.truncate()
+            return False
+        self.tar_file.write(bytes(-size % TAR_BLOCK_SIZE))
+        self.digests[name] = sha1.lower()
+        return True
+
+    def add_bytes(self, name, data):
+        """Add a member holding data."""
+        member = self.open_member(name)
+        member.write(data)
+        member.close()
+
+    def add_file(self, name, path):
+        """Add a member holding the content of the file at path."""
+        with open(path, 'rb') as source:
+            self.add_bytes(name, source.read())
+
+    def close(self):
+        """Write the end of the archive."""
+        if self.is_zip:
+            self.zip_file.close()
+        else:
+            self.tar_file.write(bytes(2 * TAR_BLOCK_SIZE))
+            self.tar_file.close()
+
+    def abort(self):
+        """Close and remove an incomplete archive."""
+        try:
+            if self.is_zip:
+                self.zip_file.fp.close()
+            else:
+                self.tar_file.close()
+        finally:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def open_members(archives, name, compress=True):
+    """Start the member name in each of the archives. Returns a file object writing to all of
+    them, see ArchiveMemberSet."""
+    return ArchiveMemberSet([archive.open_member(name, compress) for archive in archives])
+
+
+def add_range(archives, name, source_file, offset, size, sha1=None, compress=False):
+    """Add a member holding size bytes at offset of source_file, typically a member of another
+    archive, to each of the archives.
+
+    With a known SHA1 digest, tar archives get the data with copy_file_range(). The data is
+    read at most once for all the others, hashed and, if sha1 is given, verified."""
+    if sha1:
+        archives = [archive for archive in archives
+                    if not archive.copy_range(name, source_file, offset, size, sha1)]
+    if not archives:
+        return
+    member = open_members(archives, name, compress)
+    position = offset
+    while position < offset + size:
+        data = os.pread(source_file.fileno(), min(COPY_CHUNK_SIZE, offset + size - position),
+                        position)
+        if not data:
+            raise RuntimeError('{} ended before its member data'.format(source_file.name))
+        member.write(data)
+        position += len(data)
+    member.close()
+    if sha1 and member.sha1.hexdigest() != sha1.lower():
+        raise RuntimeError('SHA1 digest of {} does not match its manifest'.format(name))
+
+
+def get_manifest(digests):
+    """OVF manifest listing the SHA1 digests of the members, in the format of openssl.
+    vSphere doesn't support stronger digests in manifests."""
+    return ''.join('SHA1({})= {}\n'.format(name, digest) for name, digest in digests.items())
+
+
+def read_manifest(manifest_data):
+    """Digests of a manifest, as {name: (algorithm, digest)}."""
+    digests = {}
+    for line in manifest_data.decode().splitlines():
+        match = MANIFEST_LINE.match(line)
+        if match:
+            digests[match.group(2)] = (match.group(1).upper(), match.group(3).lower())
+    return digests
+
+
+def _add_manifest(archive, digests, manifest_name, sign_manifest):
+    """Add the manifest of digests and its signature files, then close the archive."""
+    with tempfile.TemporaryDirectory() as manifest_dir:
+        manifest_path = os.path.join(manifest_dir, manifest_name)
+        with open(manifest_path, 'w') as manifest_file:
+            manifest_file.write(get_manifest(digests))
+        archive.add_file(manifest_name, manifest_path)
+        for path in sign_manifest(manifest_path) if sign_manifest else []:
+            archive.add_file(os.path.basename(path), path)
+    archive.close()
+
+
+def _abort_archives(archives):
+    """Remove the incomplete archives."""
+    for archive in archives:
+        try:
+            archive.abort()
+        except OSError as exc:
+            LOGGER.warning('Unable to remove the incomplete archive %s: %s', archive.path, exc)
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def create_ova(raw_disk, ovf_path, variants, vmdk_name, ranges=None, adapter_type='lsilogic',
+               hw_version='4', compress_threads=None, sign_manifest=None):
+    """Package the descriptor at ovf_path and a streamOptimized VMDK of raw_disk into the OVA
+    (tar) or zip archive of every variant, with a manifest as last member. The VMDK is
+    produced and hashed once for all of them.
+
+    variants: OvaVariant list. Their descriptors must keep the VMDK size placeholders of
+    build_ovf().
+    ranges: optional data ranges of raw_disk, as for convert_raw_disk().
+    sign_manifest: optional function called with the manifest path, returning the paths of the
+    additional files (signature, public key) to add after it.
+    Returns the digests of the members that are listed in the manifest of each variant."""
+    size = get_disk_size(raw_disk)
+    ovf_name = os.path.basename(ovf_path)
+    base_name = os.path.splitext(ovf_name)[0]
+    with open(ovf_path, 'rb') as ovf_file:
+        ovf_data = ovf_file.read()
+    ovf_variants = [variant.transform_ovf(ovf_data) if variant.transform_ovf else ovf_data
+                    for variant in variants]
+
+    start_time = time.monotonic()
+    archives = []
+    writer = None
+    try:
+        archives = [OvaArchive(variant.path) for variant in variants]
+        # The descriptor must be the first member of an OVA. Its VMDK sizes are only known at
+        # the end, so the tar member is written now and rewritten in place. Order doesn't
+        # matter in zip archives, where the descriptor is simply written after the VMDK.
+        ovf_member_offsets = []
+        for archive, variant_ovf_data in zip(archives, ovf_variants):
+            if archive.is_zip:
+                ovf_member_offsets.append(None)
+            else:
+                ovf_member_offsets.append(archive.tar_file.tell() + TAR_BLOCK_SIZE)
+                archive.add_bytes(ovf_name, variant_ovf_data)
+
+        vmdk_member = open_members(archives, vmdk_name, compress=False)
+        writer = StreamOptimizedVmdkWriter(vmdk_name, size, adapter_type, hw_version,
+                                           compress_threads=compress_threads,
+                                           image_file=vmdk_member)
+        scanner = ZeroBlockScanner(raw_disk)
+        for offset, data in scanner.iter_nonzero_chunks(ranges):
+            writer.write(offset, data)
+        writer.close()
+        vmdk_size = vmdk_member.size
+        vmdk_digest = vmdk_member.sha1.hexdigest()
+
+        all_digests = []
+        for archive, variant_ovf_data, ovf_member_offset in zip(archives, ovf_variants,
+                                                                ovf_member_offsets):
+            del archive.digests[vmdk_name]
+            variant_ovf_data = fill_ovf_placeholders(variant_ovf_data, vmdk_size,
+                                                     writer.data_units * writer.unit_size)
+            if archive.is_zip:
+                archive.add_bytes(ovf_name, variant_ovf_data)
+            else:
+                archive.rewrite_member(ovf_member_offset, variant_ovf_data)
+                archive.digests[ovf_name] = hashlib.sha1(variant_ovf_data).hexdigest()
+            archive.digests[vmdk_name] = vmdk_digest
+            all_digests.append(dict(archive.digests))
+            _add_manifest(archive, all_digests[-1], base_name + '.mf', sign_manifest)
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        _abort_archives(archives)
+        raise
+
+    LOGGER.info('Created %s in %.1fs: %d byte streamOptimized VMDK from %d MiB of data of %s.',
+                ', '.join(variant.path for variant in variants), time.monotonic() - start_time,
+                vmdk_size, scanner.scanned_bytes >> 20, raw_disk)
+    return all_digests
+
+
+def rewrite_ova(source_ova, variants, sign_manifest=None):
+    """Rewrite the OVA source_ova, for example one created by ovftool, into the OVA (tar) or
+    zip archive of every variant without extracting it.
+
+    The descriptor of each variant is transform_ovf(descriptor data), the manifest is
+    regenerated and signed with sign_manifest (see create_ova()), and signatures and
+    certificates of the source are dropped. Every other member, in particular the VMDK, is
+    copied as is and read at most once for all variants: tar archives get it by offset, without
+    reading it, when the source manifest has its SHA1 digest.
+    Returns the digests of the members that are listed in the manifest of each variant."""
+    start_time = time.monotonic()
+    with tarfile.open(source_ova, 'r:') as source:
+        members = [member for member in source.getmembers() if member.isfile()]
+        ovf_members = [member for member in members if member.name.endswith('.ovf')]
+        if len(ovf_members) != 1:
+            raise ValueError('{} has {} OVF descriptors, expected 1'.format(source_ova,
+                                                                           len(ovf_members)))
+        ovf_member = ovf_members[0]
+        ovf_data = source.extractfile(ovf_member).read()
+        ovf_variants = [variant.transform_ovf(ovf_data) if variant.transform_ovf else ovf_data
+                        for variant in variants]
+        source_digests = {}
+        for member in members:
+            if member.name.endswith('.mf'):
+                source_digests.update(read_manifest(source.extractfile(member).read()))
+
+    base_name = os.path.splitext(os.path.basename(ovf_member.name))[0]
+    archives = []
+    try:
+        archives = [OvaArchive(variant.path) for variant in variants]
+        for archive, variant_ovf_data in zip(archives, ovf_variants):
+            archive.add_bytes(ovf_member.name, variant_ovf_data)
+        with open(source_ova, 'rb') as source_file:
+            for member in members:
+                if member is ovf_member or \
+                        os.path.splitext(member.name)[1] in REGENERATED_EXTENSIONS:
+                    continue
+                algorithm, digest = source_digests.get(member.name, (None, None))
+                add_range(archives, member.name, source_file, member.offset_data, member.size,
+                          digest if algorithm == 'SHA1' else None)
+        all_digests = []
+        for archive in archives:
+            all_digests.append(dict(archive.digests))
+            _add_manifest(archive, all_digests[-1], base_name + '.mf', sign_manifest)
+    except BaseException:
+        _abort_archives(archives)
+        raise
+
+    LOGGER.info('Rewrote %s into %s in %.1fs.', source_ova,
+                ', '.join(variant.path for variant in variants), time.monotonic() - start_time)
+    return all_digests
@@ -0,0 +1,444 @@
+"""OVF descriptor generation from a VMX file, equivalent to what ovftool produces, and the
+BIG-IP specific customization of OVF descriptors"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import io
+import re
+import xml.etree.ElementTree as ET
+
+OVF_NAMESPACES = {
+    'xmlns': 'http://schemas.dmtf.org/ovf/envelope/1',
+    'xmlns:cim': 'http://schemas.dmtf.org/wbem/wscim/1/common',
+    'xmlns:ovf': 'http://schemas.dmtf.org/ovf/envelope/1',
+    'xmlns:rasd': 'http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/'
+                  'CIM_ResourceAllocationSettingData',
+    'xmlns:vmw': 'http://www.vmware.com/schema/ovf',
+    'xmlns:vssd': 'http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/'
+                  'CIM_VirtualSystemSettingData',
+    'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance'
+}
+STREAM_OPTIMIZED_FORMAT = \
+    'http://www.vmware.com/interfaces/specifications/vmdk.html#streamOptimized'
+
+# The size of the VMDK is only known once it has been written. The descriptor is generated
+# with these placeholders, which fill_ovf_placeholders() replaces without changing its length.
+VMDK_FILE_SIZE_PLACEHOLDER = '__VMDK_FILE_SIZE__'
+VMDK_POPULATED_SIZE_PLACEHOLDER = '__VMDK_POPULATED_SIZE__'
+
+# CIM resource types
+RESOURCE_TYPE_CPU = '3'
+RESOURCE_TYPE_MEMORY = '4'
+RESOURCE_TYPE_SCSI_CONTROLLER = '6'
+RESOURCE_TYPE_ETHERNET_ADAPTER = '10'
+RESOURCE_TYPE_DISK_DRIVE = '17'
+
+# VMX keys that ovftool turns into vmw:Config elements, with their OVF key.
+VMX_CONFIG_KEYS = {
+    'tools.syncTime': 'tools.syncTimeWithHost',
+    'tools.upgrade.policy': 'tools.toolsUpgradePolicy'
+}
+# VMX keys that are described by OVF sections or items, or are dropped by ovftool. The
+# remaining keys are kept as vmw:ExtraConfig.
+VMX_CONSUMED_KEYS = re.compile(r'^(\.encoding|displayName|memsize|numvcpus|guestOS|'
+                               r'guestOSAltName|virtualHW\.version|config\.version|'
+                               r'floppy0\..*|pciBridge\d+\..*|scsi\d+[.:].*|ethernet\d+\..*|'
+                               r'tools\..*)$')
+VMX_GUEST_OS_TYPES = {
+    'otherlinux-64': ('101', 'otherLinux64Guest'),
+    'other3xlinux-64': ('100', 'other3xLinux64Guest')
+}
+
+VE_PRODUCT_NAME = 'BIG-IP'
+VE_PRODUCT_DESCRIPTION = 'BIG-IP Local Traffic Manager Virtual Edition'
+# Friendlier names of the network adapters, in adapter order.
+NIC_NAMES = {'ethernet0': 'Management', 'ethernet1': 'Internal', 'ethernet2': 'External',
+             'ethernet3': 'HA'}
+# id, number of CPUs, memory in MB and CPU reservation in MHz of the deployment options.
+DEPLOYMENT_OPTIONS = [('singlecpu', 1, 2048, 2000), ('dualcpu', 2, 4096, 4000),
+                      ('quadcpu', 4, 8192, 8000), ('octalcpu', 8, 16384, 16000)]
+DEFAULT_DEPLOYMENT_OPTION = 'dualcpu'
+# Reservations of the CPU (MHz) and memory (MB) items ovftool generated.
+CPU_RESERVATION = '4000'
+MEMORY_RESERVATION = '4096'
+# OVF properties are retrieved with "vmtoolsd --cmd 'info-get guestinfo.ovfEnv'".
+OVF_ENVIRONMENT_TRANSPORT = 'com.vmware.guestInfo'
+OVF_ENVIRONMENT_TOOLS_KEYS = ['tools.afterPowerOn', 'tools.afterResume',
+                              'tools.beforeGuestShutdown', 'tools.beforeGuestStandby']
+# BIG-IP versions [from, to) that don't support OVA network and user properties.
+NET_PROPERTIES_UNSUPPORTED_VERSIONS = [(14010301, 14010401, '14.1.3.1  ->   14.1.4.1'),
+                                       (15010100, 15010300, '15.1.1  ->   15.1.3'),
+                                       (16000100, 16000102, '16.0.1  ->   16.0.2')]
+
+
+def read_vmx(vmx_path):
+    """Read the key = "value" pairs of a VMX file, in file order."""
+    vmx = {}
+    with open(vmx_path, 'r') as vmx_file:
+        for line in vmx_file:
+            line = line.split('#', 1)[0].strip()
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            vmx[key.strip()] = value.strip().strip('"')
+    return vmx
+
+
+def _add_text_element(parent, tag, text):
+    element = ET.SubElement(parent, tag)
+    element.text = text
+    return element
+
+
+def _add_item(hardware, instance_id, fields):
+    """Add a RASD Item. fields are (name, value) pairs, written in the order ovftool uses."""
+    item = ET.SubElement(hardware, 'Item')
+    for name, value in sorted(fields + [('InstanceID', str(instance_id))]):
+        _add_text_element(item, 'rasd:' + name, value)
+    return item
+
+
+def _add_config(parent, tag, key, value):
+    ET.SubElement(parent, tag, {'ovf:required': 'false', 'vmw:key': key, 'vmw:value': value})
+
+
+def _is_true(value):
+    return value.lower() == 'true'
+
+
+def build_ovf(vmx, vmdk_name, capacity, eula_text=None):
+    """Build the OVF descriptor of the virtual machine described by vmx, whose single disk is
+    the streamOptimized VMDK vmdk_name with a capacity of capacity bytes."""
+    # Elements and attributes are named with their prefixes rather than namespace URIs, so the
+    # descriptor keeps ovftool's prefixes and default namespace.
+    envelope = ET.Element('Envelope', OVF_NAMESPACES)
+    references = ET.SubElement(envelope, 'References')
+    ET.SubElement(references, 'File', {'ovf:href': vmdk_name, 'ovf:id': 'file1',
+                                       'ovf:size': VMDK_FILE_SIZE_PLACEHOLDER})
+
+    disk_section = ET.SubElement(envelope, 'DiskSection')
+    _add_text_element(disk_section, 'Info', 'Virtual disk information')
+    ET.SubElement(disk_section, 'Disk', {'ovf:capacity': str(capacity),
+                                         'ovf:capacityAllocationUnits': 'byte',
+                                         'ovf:diskId': 'vmdisk1', 'ovf:fileRef': 'file1',
+                                         'ovf:format': STREAM_OPTIMIZED_FORMAT,
+                                         'ovf:populatedSize': VMDK_POPULATED_SIZE_PLACEHOLDER})
+
+    nics = sorted({key.split('.', 1)[0] for key in vmx if re.match(r'^ethernet\d+\.', key)
+                   and _is_true(vmx.get(key.split('.', 1)[0] + '.present', 'false'))},
+                  key=lambda nic: int(nic[len('ethernet'):]))
+    network_section = ET.SubElement(envelope, 'NetworkSection')
+    _add_text_element(network_section, 'Info', 'The list of logical networks')
+    for network in dict.fromkeys(vmx.get(nic + '.networkName', nic) for nic in nics):
+        network_element = ET.SubElement(network_section, 'Network', {'ovf:name': network})
+        _add_text_element(network_element, 'Description', 'The {} network'.format(network))
+
+    name = vmx.get('displayName', 'vm')
+    virtual_system = ET.SubElement(envelope, 'VirtualSystem', {'ovf:id': name})
+    _add_text_element(virtual_system, 'Info', 'A virtual machine')
+    _add_text_element(virtual_system, 'Name', name)
+    if eula_text is not None:
+        eula_section = ET.SubElement(virtual_system, 'EulaSection')
+        _add_text_element(eula_section, 'Info', 'An end-user license agreement')
+        _add_text_element(eula_section, 'License', eula_text)
+
+    os_id, os_type = VMX_GUEST_OS_TYPES.get(vmx.get('guestOS', '').lower(),
+                                            ('1', 'otherGuest'))
+    os_section = ET.SubElement(virtual_system, 'OperatingSystemSection',
+                               {'ovf:id': os_id, 'vmw:osType': os_type})
+    _add_text_element(os_section, 'Info', 'The kind of installed guest operating system')
+
+    hardware = ET.SubElement(virtual_system, 'VirtualHardwareSection')
+    _add_text_element(hardware, 'Info', 'Virtual hardware requirements')
+    system = ET.SubElement(hardware, 'System')
+    _add_text_element(system, 'vssd:ElementName', 'Virtual Hardware Family')
+    _add_text_element(system, 'vssd:InstanceID', '0')
+    _add_text_element(system, 'vssd:VirtualSystemIdentifier', name)
+    _add_text_element(system, 'vssd:VirtualSystemType',
+                      'vmx-{:02d}'.format(int(vmx.get('virtualHW.version', '10'))))
+
+    cpus = vmx.get('numvcpus', '1')
+    memory = vmx.get('memsize', '256')
+    _add_item(hardware, 1, [('AllocationUnits', 'hertz * 10^6'),
+                            ('Description', 'Number of Virtual CPUs'),
+                            ('ElementName', '{} virtual CPU(s)'.format(cpus)),
+                            ('ResourceType', RESOURCE_TYPE_CPU), ('VirtualQuantity', cpus)])
+    _add_item(hardware, 2, [('AllocationUnits', 'byte * 2^20'), ('Description', 'Memory Size'),
+                            ('ElementName', '{}MB of memory'.format(memory)),
+                            ('ResourceType', RESOURCE_TYPE_MEMORY),
+                            ('VirtualQuantity', memory)])
+    _add_item(hardware, 3, [('Address', '0'), ('Description', 'SCSI Controller'),
+                            ('ElementName', 'SCSI Controller 0'),
+                            ('ResourceSubType', vmx.get('scsi0.virtualDev', 'lsilogic')),
+                            ('ResourceType', RESOURCE_TYPE_SCSI_CONTROLLER)])
+    disk_item = _add_item(hardware, 4, [('AddressOnParent', '0'),
+                                        ('ElementName', 'Hard Disk 1'),
+                                        ('HostResource', 'ovf:/disk/vmdisk1'), ('Parent', '3'),
+                                        ('ResourceType', RESOURCE_TYPE_DISK_DRIVE)])
+    if _is_true(vmx.get('scsi0:0.writeThrough', 'false')):
+        _add_config(disk_item, 'vmw:Config', 'backing.writeThrough', 'true')
+
+    for instance_id, nic in enumerate(nics, start=5):
+        network = vmx.get(nic + '.networkName', nic)
+        adapter = {'vmxnet3': 'VmxNet3', 'e1000': 'E1000'}.get(
+            vmx.get(nic + '.virtualDev', 'e1000').lower(), vmx.get(nic + '.virtualDev'))
+        _add_item(hardware, instance_id, [
+            ('AddressOnParent', str(instance_id + 2)),
+            ('AutomaticAllocation', vmx.get(nic + '.startConnected', 'true').lower()),
+            ('Connection', network),
+            ('Description', '{} ethernet adapter on "{}"'.format(adapter, network)),
+            ('ElementName', nic), ('ResourceSubType', adapter),
+            ('ResourceType', RESOURCE_TYPE_ETHERNET_ADAPTER)])
+
+    for key, value in vmx.items():
+        if key in VMX_CONFIG_KEYS:
+            _add_config(hardware, 'vmw:Config', VMX_CONFIG_KEYS[key], value.lower())
+    for key, value in vmx.items():
+        if not VMX_CONSUMED_KEYS.match(key):
+            _add_config(hardware, 'vmw:ExtraConfig', key, value)
+    return envelope
+
+
+def parse_ovf(ovf_data):
+    """Parse a descriptor into the same form as build_ovf(): tags and attributes named with the
+    prefixes declared in the document, and elements of the default namespace unprefixed."""
+    prefixes = {}
+    declarations = {}
+    for _, (prefix, uri) in ET.iterparse(io.BytesIO(ovf_data), events=('start-ns',)):
+        attribute = 'xmlns:' + prefix if prefix else 'xmlns'
+        if declarations.setdefault(attribute, uri) != uri:
+            raise ValueError('OVF descriptor binds {} to several namespaces'.format(attribute))
+        prefixes.setdefault(uri, set()).add(prefix)
+
+    def prefixed_name(name, is_attribute):
+        if not name.startswith('{'):
+            return name
+        uri, local_name = name[1:].split('}', 1)
+        named_prefixes = sorted(prefix for prefix in prefixes.get(uri, ()) if prefix)
+        if not is_attribute and '' in prefixes.get(uri, ()):
+            return local_name
+        if not named_prefixes:
+            raise ValueError('No prefix is declared for namespace {}'.format(uri))
+        return '{}:{}'.format(named_prefixes[0], local_name)
+
+    envelope = ET.fromstring(ovf_data)
+    for element in envelope.iter():
+        element.tag = prefixed_name(element.tag, False)
+        attributes = {prefixed_name(name, True): value for name, value in element.attrib.items()}
+        element.attrib.clear()
+        element.attrib.update(attributes)
+    envelope.attrib = dict(declarations, **envelope.attrib)
+    return envelope
+
+
+def ovf_to_bytes(envelope):
+    """Serialize the descriptor with one element per line, like ovftool."""
+    ET.indent(envelope, space='  ')
+    return b'<?xml version="1.0" encoding="UTF-8"?>\n' + \
+        ET.tostring(envelope, encoding='utf-8', xml_declaration=False) + b'\n'
+
+
+def write_ovf(envelope, ovf_path):
+    """Write the descriptor to ovf_path."""
+    with open(ovf_path, 'wb') as ovf_file:
+        ovf_file.write(ovf_to_bytes(envelope))
+
+
+def _find_child(parent, tag):
+    child = parent.find(tag)
+    if child is None:
+        raise ValueError('OVF descriptor has no {} in {}'.format(tag, parent.tag))
+    return child
+
+
+def _insert_before(parent, tag, element):
+    parent.insert(list(parent).index(_find_child(parent, tag)), element)
+
+
+def _resource_items(hardware, resource_type):
+    return [item for item in hardware.findall('Item')
+            if item.findtext('rasd:ResourceType') == resource_type]
+
+
+def _set_item_field(item, name, value):
+    """Set a rasd field of an Item, keeping the fields in alphabetical order."""
+    field = item.find('rasd:' + name)
+    if field is None:
+        field = ET.Element('rasd:' + name)
+        fields = [child for child in item if child.tag.startswith('rasd:')]
+        position = sum(1 for child in fields if child.tag < field.tag)
+        item.insert(position, field)
+    field.text = value
+
+
+def _add_property(product_section, key, label, description):
+    ovf_property = ET.SubElement(product_section, 'Property', {
+        'ovf:key': key, 'ovf:type': 'string', 'ovf:value': '', 'ovf:userConfigurable': 'true'})
+    _add_text_element(ovf_property, 'Label', label)
+    _add_text_element(ovf_property, 'Description', description)
+
+
+def _add_net_properties(product_section, version_number):
+    """Properties VMware uses to set the management address and the passwords at deployment."""
+    for first, last, versions in NET_PROPERTIES_UNSUPPORTED_VERSIONS:
+        if first <= version_number < last:
+            raise ValueError('OVA properties are not supported for BIG-IP versions {}'.format(
+                versions))
+    major_version = version_number // 1000000
+    # IPv6 is supported as of 14.1.4.1, 15.1.3 and 16.0.1.2.
+    add_ipv6 = version_number >= 14010401 and (
+        major_version == 14 or (major_version == 15 and version_number >= 15010300) or
+        (major_version == 16 and version_number >= 16000102))
+
+    _add_text_element(product_section, 'Category', 'Network properties')
+    _add_property(product_section, 'net.mgmt.addr', 'mgmt-addr',
+                  'F5 BIG-IP VE\'s management address in the format of "IP/prefix"')
+    if add_ipv6:
+        _add_property(product_section, 'net.mgmt.addr6', 'mgmt-addr6',
+                      'F5 BIG-IP VE\'s management IPv6 address in the format of "IP/prefix"')
+        _add_property(product_section, 'net.mgmt.gw6', 'mgmt-gw6',
+                      'F5 BIG-IP VE\'s management default IPv6 gateway')
+    _add_property(product_section, 'net.mgmt.gw', 'mgmt-gw',
+                  'F5 BIG-IP VE\'s management default gateway')
+    _add_text_element(product_section, 'Category', 'User properties')
+    for user in ('root', 'admin'):
+        _add_property(product_section, 'user.{}.pwd'.format(user), '{}-pwd'.format(user),
+                      'F5 BIG-IP VE\'s SHA-512 shadow or plain-text password for "{}" '
+                      'user'.format(user))
+
+
+def _add_product_sections(virtual_system, product_version, product_build, version_number):
+    annotation_section = ET.Element('AnnotationSection')
+    _add_text_element(annotation_section, 'Info', 'F5 {} Virtual Edition'.format(VE_PRODUCT_NAME))
+    _add_text_element(annotation_section, 'Annotation',
+                      '{}\nCopyright 2009-2022 F5 Inc (http://www.f5.com)\n\n'
+                      'For support please visit http://support.f5.com\n'.format(
+                          VE_PRODUCT_DESCRIPTION))
+    _insert_before(virtual_system, 'OperatingSystemSection', annotation_section)
+
+    product_section = ET.Element('ProductSection')
+    _add_text_element(product_section, 'Info', 'F5 {}'.format(VE_PRODUCT_NAME))
+    _add_text_element(product_section, 'Product', '{} VE {}.{}'.format(
+        VE_PRODUCT_DESCRIPTION, product_version, product_build))
+    _add_text_element(product_section, 'Vendor', 'F5 Networks')
+    _add_text_element(product_section, 'Version', product_version)
+    _add_text_element(product_section, 'FullVersion', '{}-{}'.format(product_version,
+                                                                      product_build))
+    _add_text_element(product_section, 'VendorUrl', 'http://www.f5.com')
+    if version_number is not None:
+        _add_net_properties(product_section, version_number)
+    _insert_before(virtual_system, 'OperatingSystemSection', product_section)
+
+
+def _add_deployment_options(envelope, hardware):
+    """Let users pick 1 to 8 CPUs at deployment, with 2 GB of memory per CPU."""
+    option_section = ET.Element('DeploymentOptionSection')
+    _add_text_element(option_section, 'Info', 'DeploymentOption Info')
+    for option, cpus, memory, _ in DEPLOYMENT_OPTIONS:
+        attributes = {'ovf:id': option}
+        if option == DEFAULT_DEPLOYMENT_OPTION:
+            attributes['ovf:default'] = 'true'
+        configuration = ET.SubElement(option_section, 'Configuration', attributes)
+        cpu_label = '1 CPU' if cpus == 1 else '{} CPUs'.format(cpus)
+        _add_text_element(configuration, 'Label', '{}/{} MB RAM'.format(cpu_label, memory))
+        _add_text_element(configuration, 'Description', '{} and {} MB RAM.{}'.format(
+            cpu_label, memory, '  High-performance configuration.' if cpus == 8 else ''))
+    _insert_before(envelope, 'VirtualSystem', option_section)
+
+    # The items ovftool generated become those of the default option, the items of the other
+    # options follow the CPU item.
+    cpu_item = _resource_items(hardware, RESOURCE_TYPE_CPU)[0]
+    memory_item = _resource_items(hardware, RESOURCE_TYPE_MEMORY)[0]
+    cpu_item.set('ovf:configuration', DEFAULT_DEPLOYMENT_OPTION)
+    memory_item.set('ovf:configuration', DEFAULT_DEPLOYMENT_OPTION)
+    position = list(hardware).index(cpu_item) + 1
+    for option, cpus, memory, cpu_reservation in DEPLOYMENT_OPTIONS:
+        if option == DEFAULT_DEPLOYMENT_OPTION:
+            continue
+        for fields in ([('AllocationUnits', 'hertz * 10^6'),
+                        ('Description', 'Number of Virtual CPUs'),
+                        ('ElementName', '1 virtual CPU' if cpus == 1
+                         else '{} virtual CPU(s)'.format(cpus)),
+                        ('InstanceID', cpu_item.findtext('rasd:InstanceID')),
+                        ('Reservation', str(cpu_reservation)),
+                        ('ResourceType', RESOURCE_TYPE_CPU), ('VirtualQuantity', str(cpus))],
+                       [('AllocationUnits', 'byte * 2^20'), ('Description', 'Memory Size'),
+                        ('ElementName', '{}MB of memory'.format(memory)),
+                        ('InstanceID', memory_item.findtext('rasd:InstanceID')),
+                        ('Reservation', str(memory)), ('ResourceType', RESOURCE_TYPE_MEMORY),
+                        ('VirtualQuantity', str(memory))]):
+            item = ET.Element('Item', {'ovf:configuration': option})
+            for name, value in fields:
+                _add_text_element(item, 'rasd:' + name, value)
+            hardware.insert(position, item)
+            position += 1
+
+
+# pylint: disable=too-many-arguments
+def customize_ovf(envelope, product_version, product_build, net_properties_version=None,
+                  vcloud=False):
+    """Add the BIG-IP product information, deployment options and resource reservations to a
+    descriptor generated by ovftool or build_ovf().
+
+    net_properties_version: BIG-IP version number (e.g. 16010202) to add the network and user
+    properties of OVA_PROP_NET_USER for, None to leave them out.
+    vcloud: leave out the deployment options, guest OS override and OVF environment settings,
+    which vCloud Director cannot handle."""
+    virtual_system = _find_child(envelope, 'VirtualSystem')
+    hardware = _find_child(virtual_system, 'VirtualHardwareSection')
+    _add_product_sections(virtual_system, product_version, product_build,
+                          net_properties_version)
+    for item in _resource_items(hardware, RESOURCE_TYPE_ETHERNET_ADAPTER):
+        element_name = item.find('rasd:ElementName')
+        element_name.text = NIC_NAMES.get(element_name.text, element_name.text)
+
+    # Only the items ovftool generated get these reservations, the deployment options have
+    # their own.
+    _set_item_field(_resource_items(hardware, RESOURCE_TYPE_CPU)[0], 'Reservation',
+                    CPU_RESERVATION)
+    _set_item_field(_resource_items(hardware, RESOURCE_TYPE_MEMORY)[0], 'Reservation',
+                    MEMORY_RESERVATION)
+    if vcloud:
+        return envelope
+
+    # The old ovftool cannot handle this guest OS when it is set in the VMX template.
+    os_id, os_type = VMX_GUEST_OS_TYPES['other3xlinux-64']
+    operating_system = _find_child(virtual_system, 'OperatingSystemSection')
+    operating_system.set('ovf:id', os_id)
+    operating_system.set('vmw:osType', os_type)
+
+    _add_deployment_options(envelope, hardware)
+
+    hardware.set('ovf:transport', OVF_ENVIRONMENT_TRANSPORT)
+    for key in OVF_ENVIRONMENT_TOOLS_KEYS:
+        ET.SubElement(hardware, 'vmw:Config', {'ovf:required': 'true', 'vmw:key': key,
+                                               'vmw:value': 'true'})
+    return envelope
+
+
+def fill_ovf_placeholders(ovf_data, file_size, populated_size):
+    """Replace the VMDK size placeholders of a descriptor, padding the attributes with spaces
+    so that its length doesn't change."""
+    for placeholder, value in ((VMDK_FILE_SIZE_PLACEHOLDER, file_size),
+                               (VMDK_POPULATED_SIZE_PLACEHOLDER, populated_size)):
+        quoted = '"{}"'.format(placeholder).encode()
+        if quoted not in ovf_data:
+            raise ValueError('OVF descriptor has no {} placeholder'.format(placeholder))
+        value = '"{}"'.format(value).encode()
+        if len(value) > len(quoted):
+            raise ValueError('{} does not fit in the {} placeholder'.format(value, placeholder))
+        ovf_data = ovf_data.replace(quoted, value + b' ' * (len(quoted) - len(value)))
+    return ovf_data
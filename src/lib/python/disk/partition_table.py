@@ -0,0 +1,137 @@
+"""MBR and GPT partition table reader for raw disk images"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import struct
+import uuid
+from collections import namedtuple
+
+from util.logger import LOGGER
+
+SECTOR_SIZE = 512
+
+MBR_SIGNATURE = b'\x55\xaa'
+MBR_TYPE_EMPTY = 0x00
+MBR_TYPE_GPT_PROTECTIVE = 0xee
+MBR_TYPES_EXTENDED = (0x05, 0x0f, 0x85)
+MBR_TYPE_LVM = 0x8e
+
+GPT_SIGNATURE = b'EFI PART'
+GPT_TYPE_LVM = uuid.UUID('e6d6d379-f507-44c2-a23c-238f2a3df928')
+
+# Partition offsets and sizes are in bytes. 'type' is the MBR type byte formatted as a hex
+# string (e.g. '0x8e') or the GPT partition type GUID.
+Partition = namedtuple('Partition', ['number', 'offset', 'size', 'type', 'name', 'is_lvm'])
+
+
+def _read_at(disk_file, offset, size):
+    """Read exactly size bytes at offset, padding with zeroes past the end of the file."""
+    disk_file.seek(offset)
+    data = disk_file.read(size)
+    return data.ljust(size, b'\0')
+
+
+def _parse_mbr_entries(sector):
+    """Return the four (type, first_lba, sector_count) tuples of an MBR or EBR sector."""
+    entries = []
+    for index in range(4):
+        entry = sector[446 + index * 16:446 + (index + 1) * 16]
+        part_type = entry[4]
+        first_lba, sector_count = struct.unpack_from('<II', entry, 8)
+        entries.append((part_type, first_lba, sector_count))
+    return entries
+
+
+def _read_logical_partitions(disk_file, extended_lba, first_number):
+    """Follow the EBR chain of an extended partition and return its logical partitions."""
+    partitions = []
+    ebr_lba = extended_lba
+    number = first_number
+    seen = set()
+    while ebr_lba not in seen:
+        seen.add(ebr_lba)
+        sector = _read_at(disk_file, ebr_lba * SECTOR_SIZE, SECTOR_SIZE)
+        if sector[510:512] != MBR_SIGNATURE:
+            LOGGER.warning('Missing EBR signature at LBA %d, ignoring the rest of the chain.',
+                           ebr_lba)
+            break
+        entries = _parse_mbr_entries(sector)
+        part_type, first_lba, sector_count = entries[0]
+        if part_type != MBR_TYPE_EMPTY and sector_count:
+            partitions.append(Partition(number, (ebr_lba + first_lba) * SECTOR_SIZE,
+                                        sector_count * SECTOR_SIZE, '0x{:02x}'.format(part_type),
+                                        '', part_type == MBR_TYPE_LVM))
+            number += 1
+        next_type, next_lba, _ = entries[1]
+        if next_type not in MBR_TYPES_EXTENDED or not next_lba:
+            break
+        ebr_lba = extended_lba + next_lba
+    return partitions
+
+
+def _read_gpt(disk_file):
+    """Read the primary GPT header and its partition entries."""
+    header = _read_at(disk_file, SECTOR_SIZE, SECTOR_SIZE)
+    if header[0:8] != GPT_SIGNATURE:
+        raise RuntimeError('Protective MBR found but the GPT header signature is missing.')
+
+    entries_lba, entry_count, entry_size = struct.unpack_from('<QII', header, 72)
+    if entry_size < 128 or entry_count > 1024:
+        raise RuntimeError('Unexpected GPT entry layout: {} entries of {} bytes.'.format(
+            entry_count, entry_size))
+
+    table = _read_at(disk_file, entries_lba * SECTOR_SIZE, entry_count * entry_size)
+    partitions = []
+    for index in range(entry_count):
+        entry = table[index * entry_size:(index + 1) * entry_size]
+        type_guid = uuid.UUID(bytes_le=entry[0:16])
+        if type_guid.int == 0:
+            continue
+        first_lba, last_lba = struct.unpack_from('<QQ', entry, 32)
+        name = entry[56:128].decode('utf-16-le', errors='replace').rstrip('\0')
+        partitions.append(Partition(index + 1, first_lba * SECTOR_SIZE,
+                                    (last_lba - first_lba + 1) * SECTOR_SIZE, str(type_guid),
+                                    name, type_guid == GPT_TYPE_LVM))
+    return 'gpt', partitions
+
+
+def read_partition_table(disk_file):
+    """Read the partition table of an open raw disk image.
+
+    Returns a (table_type, partitions) tuple where table_type is 'mbr', 'gpt' or None if the
+    disk has no partition table."""
+    sector = _read_at(disk_file, 0, SECTOR_SIZE)
+    if sector[510:512] != MBR_SIGNATURE:
+        LOGGER.debug('No MBR signature found, assuming an unpartitioned disk.')
+        return None, []
+
+    entries = _parse_mbr_entries(sector)
+    if any(part_type == MBR_TYPE_GPT_PROTECTIVE for part_type, _, _ in entries):
+        return _read_gpt(disk_file)
+
+    partitions = []
+    logical_partitions = []
+    for index, (part_type, first_lba, sector_count) in enumerate(entries):
+        if part_type == MBR_TYPE_EMPTY or not sector_count:
+            continue
+        if part_type in MBR_TYPES_EXTENDED:
+            # Logical partitions are numbered from 5 regardless of the extended entry slot.
+            logical_partitions = _read_logical_partitions(disk_file, first_lba, 5)
+            continue
+        partitions.append(Partition(index + 1, first_lba * SECTOR_SIZE,
+                                    sector_count * SECTOR_SIZE, '0x{:02x}'.format(part_type),
+                                    '', part_type == MBR_TYPE_LVM))
+    return 'mbr', partitions + logical_partitions
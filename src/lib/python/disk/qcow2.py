@@ -0,0 +1,119 @@
+"""qcow2 version 2 (compat=0.10) image writer"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import struct
+
+from disk.image_writer import ImageWriter, parse_size_option, round_up
+
+QCOW2_MAGIC = 0x514649fb
+QCOW2_VERSION = 2
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+# Set on L1/L2 entries of clusters with a refcount of exactly one.
+OFLAG_COPIED = 1 << 63
+# Version 2 images always use 16 bit refcounts.
+REFCOUNT_ENTRY_SIZE = 2
+L2_ENTRIES = CLUSTER_SIZE // 8
+REFCOUNTS_PER_BLOCK = CLUSTER_SIZE // REFCOUNT_ENTRY_SIZE
+REFCOUNT_TABLE_ENTRIES_PER_CLUSTER = CLUSTER_SIZE // 8
+
+# magic, version, backing file offset, backing file size, cluster bits, size, crypt method,
+# l1 size, l1 table offset, refcount table offset, refcount table clusters, nb snapshots,
+# snapshots offset
+HEADER_FORMAT = '>IIQIIQIIQQIIQ'
+
+
+class Qcow2Writer(ImageWriter):
+    """Writes a qcow2 v2 image without a backing file.
+
+    Clusters are allocated contiguously in write order: header, L1 table, then data clusters
+    interleaved with the L2 table of each 512 MiB range, and finally the refcount blocks and
+    table. Every cluster of the file is referenced exactly once."""
+
+    unit_size = CLUSTER_SIZE
+
+    def __init__(self, path, size):
+        super().__init__(path, size)
+        self.l1_size = -(-size // (CLUSTER_SIZE * L2_ENTRIES))
+        self.l1_table_offset = CLUSTER_SIZE
+        self.l1_table = [0] * self.l1_size
+        self.l2_index = None
+        self.l2_table = None
+        # Header and L1 table are written last, reserve their clusters now.
+        self._write_at(0, bytes(self.l1_table_offset +
+                                round_up(max(self.l1_size * 8, 1), CLUSTER_SIZE)))
+
+    def _flush_l2_table(self):
+        if self.l2_table is not None:
+            l2_table = struct.pack('>{}Q'.format(L2_ENTRIES), *self.l2_table)
+            self.l1_table[self.l2_index] = self._append(l2_table) | OFLAG_COPIED
+            self.l2_index = None
+            self.l2_table = None
+
+    def _write_unit(self, index, data):
+        l1_index, l2_index = divmod(index, L2_ENTRIES)
+        if l1_index != self.l2_index:
+            self._flush_l2_table()
+            self.l2_index = l1_index
+            self.l2_table = [0] * L2_ENTRIES
+        self.l2_table[l2_index] = self._append(data) | OFLAG_COPIED
+
+    def _finish(self):
+        self._flush_l2_table()
+
+        # The refcount blocks and table cover every cluster, including themselves.
+        data_clusters = self.end_offset // CLUSTER_SIZE
+        refcount_blocks = refcount_table_clusters = 0
+        while True:
+            total_clusters = data_clusters + refcount_blocks + refcount_table_clusters
+            needed_blocks = -(-total_clusters // REFCOUNTS_PER_BLOCK)
+            needed_table_clusters = -(-needed_blocks // REFCOUNT_TABLE_ENTRIES_PER_CLUSTER)
+            if (needed_blocks, needed_table_clusters) == (refcount_blocks,
+                                                          refcount_table_clusters):
+                break
+            refcount_blocks, refcount_table_clusters = needed_blocks, needed_table_clusters
+
+        refcount_table = []
+        for block in range(refcount_blocks):
+            first_cluster = block * REFCOUNTS_PER_BLOCK
+            used = min(total_clusters - first_cluster, REFCOUNTS_PER_BLOCK)
+            refcount_table.append(self._append(
+                struct.pack('>{}H'.format(used), *([1] * used)) +
+                bytes((REFCOUNTS_PER_BLOCK - used) * REFCOUNT_ENTRY_SIZE)))
+        refcount_table_offset = self._append(
+            struct.pack('>{}Q'.format(len(refcount_table)), *refcount_table).ljust(
+                refcount_table_clusters * CLUSTER_SIZE, b'\0'))
+
+        self._write_at(0, struct.pack(HEADER_FORMAT, QCOW2_MAGIC, QCOW2_VERSION, 0, 0,
+                                      CLUSTER_BITS, self.size, 0, self.l1_size,
+                                      self.l1_table_offset, refcount_table_offset,
+                                      refcount_table_clusters, 0, 0))
+        self._write_at(self.l1_table_offset,
+                       struct.pack('>{}Q'.format(self.l1_size), *self.l1_table))
+
+
+def create_qcow2_writer(path, size, options):
+    """qcow2 writer for qemu-img style qcow2 options. Only compat=0.10 images with 64 KiB
+    clusters are written, also when no compat level is given."""
+    compat = options.get('compat', '0.10')
+    if compat not in ('0.10', 'v2'):
+        raise ValueError('Unsupported qcow2 compat level {}'.format(compat))
+    cluster_size = parse_size_option(options.get('cluster_size', str(CLUSTER_SIZE)))
+    if cluster_size != CLUSTER_SIZE:
+        raise ValueError('Unsupported qcow2 cluster size {}: the native writer only writes {} KiB '
+                         'clusters'.format(options['cluster_size'], CLUSTER_SIZE // 1024))
+    return Qcow2Writer(path, size)
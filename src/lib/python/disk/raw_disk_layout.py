@@ -0,0 +1,210 @@
+"""Raw disk layout: maps every byte of a raw disk image to a partition, LV or free extent"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import os
+from collections import namedtuple
+
+from disk.lvm import LvmPhysicalVolume, SECTOR_SIZE
+from disk.partition_table import read_partition_table
+from util.logger import LOGGER
+from util.misc import get_disk_size
+
+# Extent kinds. Only 'free' extents and the extents of LVs listed as empty are safe to skip.
+KIND_UNPARTITIONED = 'unpartitioned'
+KIND_PARTITION = 'partition'
+KIND_LVM_METADATA = 'lvm_metadata'
+KIND_LV = 'lv'
+KIND_FREE = 'free'
+KIND_PV_TAIL = 'pv_tail'
+
+DiskExtent = namedtuple('DiskExtent', ['offset', 'length', 'kind', 'owner'])
+
+
+def merge_ranges(ranges):
+    """Merge sorted or unsorted (offset, length) ranges that touch or overlap."""
+    merged = []
+    for offset, length in sorted(ranges):
+        if length <= 0:
+            continue
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            last_offset, last_length = merged[-1]
+            merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def _pv_uuid(metadata_id):
+    """Strip the dashes LVM inserts into PV UUIDs in its text metadata."""
+    return metadata_id.replace('-', '')
+
+
+class RawDiskLayout():
+    """Reads the partition table and LVM2 metadata of a raw disk image without root privileges
+    or loop devices, and builds a complete extent map of the disk."""
+
+    def __init__(self, disk_path, empty_lvs=None):
+        self.disk_path = disk_path
+        self.empty_lvs = set(empty_lvs or [])
+        self.disk_size = 0
+        self.partition_table = None
+        self.partitions = []
+        self.volume_groups = {}
+        self.logical_volumes = {}
+        self.extents = []
+
+    def load(self):
+        """Read the disk and build the extent map."""
+        if not os.path.exists(self.disk_path):
+            raise RuntimeError('Raw disk {} does not exist.'.format(self.disk_path))
+
+        self.disk_size = get_disk_size(self.disk_path)
+        with open(self.disk_path, 'rb') as disk_file:
+            self.partition_table, self.partitions = read_partition_table(disk_file)
+            LOGGER.info('Found %s partition table with %d partitions on %s.',
+                        self.partition_table or 'no', len(self.partitions), self.disk_path)
+
+            regions = [(part.offset, part.size, 'partition{}'.format(part.number))
+                       for part in self.partitions]
+            if not regions:
+                regions = [(0, self.disk_size, 'disk')]
+
+            extents = []
+            position = 0
+            for offset, size, owner in sorted(regions):
+                if offset > position:
+                    extents.append(DiskExtent(position, offset - position,
+                                              KIND_UNPARTITIONED, None))
+                size = min(size, self.disk_size - offset)
+                extents.extend(self._map_region(disk_file, offset, size, owner))
+                position = max(position, offset + size)
+            if position < self.disk_size:
+                extents.append(DiskExtent(position, self.disk_size - position,
+                                          KIND_UNPARTITIONED, None))
+        self.extents = extents
+
+    def _map_region(self, disk_file, offset, size, owner):
+        """Map a partition (or the whole disk) either as an LVM PV or as opaque data."""
+        physical_volume = LvmPhysicalVolume(disk_file, offset)
+        if not physical_volume.read_label():
+            return [DiskExtent(offset, size, KIND_PARTITION, owner)]
+
+        vg_name, vg_dict = physical_volume.read_volume_group()
+        LOGGER.info('Found LVM PV %s (VG %s) on %s.', physical_volume.uuid, vg_name, owner)
+
+        extent_size = int(vg_dict['extent_size']) * SECTOR_SIZE
+        pv_name, pv_dict = None, None
+        for name, candidate in vg_dict.get('physical_volumes', {}).items():
+            if _pv_uuid(candidate.get('id', '')) == physical_volume.uuid:
+                pv_name, pv_dict = name, candidate
+                break
+        if pv_dict is None:
+            raise RuntimeError('PV {} is not listed in the metadata of VG {}'.format(
+                physical_volume.uuid, vg_name))
+
+        pe_start = int(pv_dict['pe_start']) * SECTOR_SIZE
+        pe_count = int(pv_dict['pe_count'])
+        owners = [None] * pe_count
+        for lv_name, lv_dict in vg_dict.get('logical_volumes', {}).items():
+            lv_info = self.logical_volumes.setdefault(
+                (vg_name, lv_name), {'vg': vg_name, 'name': lv_name, 'extents': 0,
+                                     'size': 0, 'empty': lv_name in self.empty_lvs})
+            for segment in (value for key, value in lv_dict.items()
+                            if key.startswith('segment') and isinstance(value, dict)):
+                stripes = segment.get('stripes', [])
+                stripe_count = max(int(segment.get('stripe_count', 1)), 1)
+                area_length = int(segment.get('extent_count', 0)) // stripe_count
+                for stripe_pv, first_pe in zip(stripes[0::2], stripes[1::2]):
+                    if stripe_pv != pv_name:
+                        continue
+                    for pe_index in range(first_pe, min(first_pe + area_length, pe_count)):
+                        owners[pe_index] = lv_name
+                    lv_info['extents'] += area_length
+                    lv_info['size'] += area_length * extent_size
+
+        free_extents = owners.count(None)
+        vg_info = self.volume_groups.setdefault(
+            vg_name, {'name': vg_name, 'extent_size': extent_size, 'pe_count': 0,
+                      'free_extents': 0, 'physical_volumes': []})
+        vg_info['pe_count'] += pe_count
+        vg_info['free_extents'] += free_extents
+        vg_info['physical_volumes'].append({'name': pv_name, 'uuid': physical_volume.uuid,
+                                            'partition': owner, 'offset': offset,
+                                            'pe_start': pe_start, 'pe_count': pe_count})
+
+        extents = [DiskExtent(offset, min(pe_start, size), KIND_LVM_METADATA, vg_name)]
+        run_start = 0
+        for pe_index in range(1, pe_count + 1):
+            if pe_index < pe_count and owners[pe_index] == owners[run_start]:
+                continue
+            run_owner = owners[run_start]
+            extents.append(DiskExtent(offset + pe_start + run_start * extent_size,
+                                      (pe_index - run_start) * extent_size,
+                                      KIND_FREE if run_owner is None else KIND_LV,
+                                      run_owner))
+            run_start = pe_index
+
+        mapped_size = pe_start + pe_count * extent_size
+        if mapped_size < size:
+            extents.append(DiskExtent(offset + mapped_size, size - mapped_size,
+                                      KIND_PV_TAIL, vg_name))
+        return extents
+
+    def is_skippable(self, extent):
+        """True if the extent content is not needed in the output image."""
+        return extent.kind == KIND_FREE or \
+            (extent.kind == KIND_LV and extent.owner in self.empty_lvs)
+
+    def get_skippable_ranges(self):
+        """Merged (offset, length) ranges of free extents and extents of empty LVs."""
+        return merge_ranges([(extent.offset, extent.length) for extent in self.extents
+                             if self.is_skippable(extent)])
+
+    def get_data_ranges(self):
+        """Merged (offset, length) ranges that have to be preserved in the output image."""
+        return merge_ranges([(extent.offset, extent.length) for extent in self.extents
+                             if not self.is_skippable(extent)])
+
+    def get_report(self):
+        """Per-LV size report plus the full extent map as a JSON-friendly dictionary."""
+        skippable_bytes = sum(length for _, length in self.get_skippable_ranges())
+        return {
+            'disk': os.path.basename(self.disk_path),
+            'disk_size': self.disk_size,
+            'partition_table': self.partition_table,
+            'partitions': [part._asdict() for part in self.partitions],
+            'volume_groups': list(self.volume_groups.values()),
+            'logical_volumes': sorted(self.logical_volumes.values(),
+                                      key=lambda lv: (lv['vg'], lv['name'])),
+            'skippable_bytes': skippable_bytes,
+            'extents': [extent._asdict() for extent in self.extents]
+        }
+
+    def log_report(self):
+        """Log a human readable per-LV size summary."""
+        mib = 1024 * 1024
+        for lv_info in sorted(self.logical_volumes.values(), key=lambda lv: -lv['size']):
+            LOGGER.info('LV %s/%s: %d MiB (%d extents)%s', lv_info['vg'], lv_info['name'],
+                        lv_info['size'] // mib, lv_info['extents'],
+                        ' [empty]' if lv_info['empty'] else '')
+        for vg_info in self.volume_groups.values():
+            LOGGER.info('VG %s: %d of %d extents free (%d MiB).', vg_info['name'],
+                        vg_info['free_extents'], vg_info['pe_count'],
+                        vg_info['free_extents'] * vg_info['extent_size'] // mib)
+        LOGGER.info('%d MiB of %d MiB on %s can be skipped by sparse-aware consumers.',
+                    sum(length for _, length in self.get_skippable_ranges()) // mib,
+                    self.disk_size // mib, os.path.basename(self.disk_path))
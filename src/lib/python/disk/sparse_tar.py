@@ -0,0 +1,180 @@
+"""gzip compressed tar archives of disks, with sparse members as GCE imports them"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import os
+import stat
+import tarfile
+import time
+
+from util.compression import DEFAULT_LEVEL, GzipWriter
+from util.digests import DigestingWriter
+from util.io_policy import POLICY_DEFAULT, drop_cached_range, get_io_policy
+from util.logger import LOGGER
+from util.reproducible import get_file_mtime
+from util.zero_blocks import iter_allocated_ranges
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# Sparse map entries held by the member header and by each extension header of the 'oldgnu'
+# format, as written by "tar --format=oldgnu -S".
+HEADER_SPARSE_ENTRIES = 4
+EXTENSION_SPARSE_ENTRIES = 21
+SPARSE_ENTRY_SIZE = 24
+# Field offsets of the 'oldgnu' header past the ustar ones.
+SPARSE_OFFSET = 386
+IS_EXTENDED_OFFSET = 482
+REAL_SIZE_OFFSET = 483
+EXTENSION_IS_EXTENDED_OFFSET = EXTENSION_SPARSE_ENTRIES * SPARSE_ENTRY_SIZE
+
+
+def get_sparse_map(disk_file, size):
+    """(offset, length) data ranges of disk_file according to its extent map, merged. A file
+    ending in a hole gets an empty last range at its end, like GNU tar records it."""
+    sparse_map = []
+    for offset, length in iter_allocated_ranges(disk_file, 0, size):
+        if sparse_map and sparse_map[-1][0] + sparse_map[-1][1] == offset:
+            sparse_map[-1] = (sparse_map[-1][0], sparse_map[-1][1] + length)
+        else:
+            sparse_map.append((offset, length))
+    if not sparse_map or sum(sparse_map[-1]) < size:
+        sparse_map.append((size, 0))
+    return sparse_map
+
+
+def _number(value, digits):
+    # Octal, or base-256 for the sizes and offsets of disks larger than 8 GiB.
+    return tarfile.itn(value, digits, tarfile.GNU_FORMAT)
+
+
+def _set_sparse_entries(header, offset, entries):
+    for index, (entry_offset, entry_length) in enumerate(entries):
+        position = offset + index * SPARSE_ENTRY_SIZE
+        header[position:position + 12] = _number(entry_offset, 12)
+        header[position + 12:position + 24] = _number(entry_length, 12)
+
+
+def _set_checksum(header):
+    header[148:156] = b' ' * 8
+    header[148:156] = b'%06o\0 ' % sum(header)
+
+
+def sparse_headers(name, size, sparse_map, mtime):
+    """'oldgnu' headers of a sparse member: the member header holding the first sparse map
+    entries, followed by the extension headers holding the other ones."""
+    encoded_name = name.encode()
+    if len(encoded_name) >= tarfile.LENGTH_NAME:
+        raise ValueError('Member name {} is too long for a sparse tar member'.format(name))
+
+    header = bytearray(TAR_BLOCK_SIZE)
+    header[0:len(encoded_name)] = encoded_name
+    header[100:108] = _number(0o644, 8)
+    header[108:116] = _number(0, 8)
+    header[116:124] = _number(0, 8)
+    header[124:136] = _number(sum(length for _, length in sparse_map), 12)
+    header[136:148] = _number(mtime, 12)
+    header[156:157] = tarfile.GNUTYPE_SPARSE
+    header[257:265] = tarfile.GNU_MAGIC
+    _set_sparse_entries(header, SPARSE_OFFSET, sparse_map[:HEADER_SPARSE_ENTRIES])
+    header[REAL_SIZE_OFFSET:REAL_SIZE_OFFSET + 12] = _number(size, 12)
+
+    extensions = []
+    remaining = sparse_map[HEADER_SPARSE_ENTRIES:]
+    while remaining:
+        extension = bytearray(TAR_BLOCK_SIZE)
+        _set_sparse_entries(extension, 0, remaining[:EXTENSION_SPARSE_ENTRIES])
+        remaining = remaining[EXTENSION_SPARSE_ENTRIES:]
+        extensions.append(extension)
+    if extensions:
+        header[IS_EXTENDED_OFFSET] = 1
+        for extension in extensions[:-1]:
+            extension[EXTENSION_IS_EXTENDED_OFFSET] = 1
+    _set_checksum(header)
+    return bytes(header) + b''.join(bytes(extension) for extension in extensions)
+
+
+def _dense_header(name, size, mtime):
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = size
+    tarinfo.mtime = mtime
+    tarinfo.mode = 0o644
+    return tarinfo.tobuf(tarfile.GNU_FORMAT)
+
+
+def create_tar_gz(raw_disk, bundle, name=None, sparse=True, level=DEFAULT_LEVEL, threads=None):
+    """Write raw_disk as the single member name (the base name of raw_disk by default) of the
+    gzip compressed tar archive bundle, like "tar --format=oldgnu -Sczf" does, or like
+    "tar -czf" does if not sparse. The digests of bundle are recorded next to it.
+
+    Sparse members only hold the data ranges of the raw disk extent map, holes are recorded in
+    the sparse map instead of being read and compressed. Returns the number of bytes that were
+    skipped."""
+    start_time = time.monotonic()
+    name = name or os.path.basename(raw_disk)
+    with open(raw_disk, 'rb', buffering=0) as disk_file:
+        disk_stat = os.fstat(disk_file.fileno())
+        if not stat.S_ISREG(disk_stat.st_mode):
+            raise ValueError('{} is not a regular file'.format(raw_disk))
+        size = disk_stat.st_size
+        if sparse:
+            sparse_map = get_sparse_map(disk_file, size)
+            header = sparse_headers(name, size, sparse_map, get_file_mtime(disk_stat))
+        else:
+            sparse_map = [(0, size)]
+            header = _dense_header(name, size, get_file_mtime(disk_stat))
+        data_size = sum(length for _, length in sparse_map)
+        drop_cache = get_io_policy('compress') != POLICY_DEFAULT
+
+        with open(bundle, 'wb') as bundle_file:
+            digesting_file = DigestingWriter(bundle_file, bundle)
+            digesting_file.add_member(name, size)
+            writer = GzipWriter(digesting_file, level=level, threads=threads)
+            try:
+                writer.write(header)
+                buffer = bytearray(COPY_CHUNK_SIZE)
+                view = memoryview(buffer)
+                for offset, length in sparse_map:
+                    end = offset + length
+                    while offset < end:
+                        read_size = os.preadv(disk_file.fileno(),
+                                              [view[:min(COPY_CHUNK_SIZE, end - offset)]],
+                                              offset)
+                        if not read_size:
+                            raise RuntimeError('{} ended at {} while reading its extent '
+                                               'ending at {}'.format(raw_disk, offset, end))
+                        writer.write(view[:read_size])
+                        if drop_cache:
+                            drop_cached_range(disk_file.fileno(), offset, read_size)
+                        offset += read_size
+                # Pad the member, then end the archive with two zero blocks, padded to a
+                # whole record like tar does.
+                archive_size = writer.size + -data_size % TAR_BLOCK_SIZE + 2 * TAR_BLOCK_SIZE
+                writer.write(bytes(-data_size % TAR_BLOCK_SIZE + 2 * TAR_BLOCK_SIZE +
+                                   -archive_size % tarfile.RECORDSIZE))
+                writer.close()
+            except BaseException:
+                writer.abort()
+                bundle_file.close()
+                os.unlink(bundle)
+                raise
+    digesting_file.write_digests()
+
+    skipped = size - data_size
+    LOGGER.info('Archived %d byte %s as %s in %.1fs: %d bytes of data in %d ranges, '
+                '%d bytes of holes skipped, %d compressed bytes.', size, raw_disk, bundle,
+                time.monotonic() - start_time, data_size, len(sparse_map), skipped,
+                writer.compressed_size)
+    return skipped
@@ -0,0 +1,222 @@
+"""VHD (Microsoft Virtual Hard Disk) image writers"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import os
+import struct
+import uuid
+
+from disk.image_writer import ImageWriter, SECTOR_SIZE, round_up
+from util.reproducible import get_timestamp, get_unique_id
+
+FOOTER_COOKIE = b'conectix'
+DYNAMIC_HEADER_COOKIE = b'cxsparse'
+FORMAT_VERSION = 0x00010000
+FEATURES_RESERVED = 0x00000002
+DISK_TYPE_FIXED = 2
+DISK_TYPE_DYNAMIC = 3
+NO_DATA_OFFSET = 0xFFFFFFFFFFFFFFFF
+UNUSED_BAT_ENTRY = 0xFFFFFFFF
+DYNAMIC_BLOCK_SIZE = 2 * 1024 * 1024
+# Fixed VHDs hold the disk as is, data is written in blocks of the zero block scanner's size.
+FIXED_UNIT_SIZE = 64 * 1024
+# Azure requires the virtual size of (fixed) VHDs to be a whole number of MiB.
+AZURE_VHD_ALIGNMENT = 1024 * 1024
+# Same creator fields as qemu-img. 'qem2' tells readers that the size is exact (force_size),
+# 'qemu' that it was rounded to the CHS geometry.
+CREATOR_APP = b'qemu'
+CREATOR_APP_FORCE_SIZE = b'qem2'
+CREATOR_VERSION = 0x00050003
+CREATOR_HOST_OS = b'Wi2k'
+# Seconds between the Unix epoch and the VHD epoch (2000-01-01 00:00:00 UTC).
+VHD_EPOCH = 946684800
+MAX_CHS_SECTORS = 65535 * 16 * 255
+
+# cookie, features, version, data offset, timestamp, creator app, creator version,
+# creator host OS, original size, current size, cylinders, heads, sectors per track,
+# disk type, checksum, unique id, saved state
+FOOTER_FORMAT = '>8sIIQI4sI4sQQHBBII16sB427x'
+# cookie, data offset, table offset, header version, max table entries, block size,
+# checksum, parent unique id, parent timestamp, parent unicode name, parent locators
+DYNAMIC_HEADER_FORMAT = '>8sQQIIII16sI4x512s192s256x'
+
+
+def vhd_checksum(data):
+    """One's complement of the sum of all bytes, computed with the checksum field zeroed."""
+    return ~sum(data) & 0xFFFFFFFF
+
+
+def chs_geometry(total_sectors):
+    """CHS geometry (cylinders, heads, sectors per track) from the VHD specification."""
+    total_sectors = min(total_sectors, MAX_CHS_SECTORS)
+    if total_sectors >= 65535 * 16 * 63:
+        sectors_per_track = 255
+        heads = 16
+        cylinder_times_heads = total_sectors // sectors_per_track
+    else:
+        sectors_per_track = 17
+        cylinder_times_heads = total_sectors // sectors_per_track
+        heads = max((cylinder_times_heads + 1023) // 1024, 4)
+        if cylinder_times_heads >= heads * 1024 or heads > 16:
+            sectors_per_track = 31
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+        if cylinder_times_heads >= heads * 1024:
+            sectors_per_track = 63
+            heads = 16
+            cylinder_times_heads = total_sectors // sectors_per_track
+    return cylinder_times_heads // heads, heads, sectors_per_track
+
+
+def get_vhd_size(size, force_size=False):
+    """Virtual size and CHS geometry of a VHD holding size bytes.
+
+    Without force_size the size is rounded up to the CHS geometry, like qemu-img and Virtual PC
+    do; with force_size (required by Azure) it is kept as is."""
+    total_sectors = -(-size // SECTOR_SIZE)
+    geometry = chs_geometry(total_sectors)
+    index = 0
+    while geometry[0] * geometry[1] * geometry[2] < total_sectors and \
+            geometry[0] * geometry[1] * geometry[2] < MAX_CHS_SECTORS:
+        index += 1
+        geometry = chs_geometry(total_sectors + index)
+    if force_size or geometry[0] * geometry[1] * geometry[2] >= MAX_CHS_SECTORS:
+        return total_sectors * SECTOR_SIZE, geometry
+    return geometry[0] * geometry[1] * geometry[2] * SECTOR_SIZE, geometry
+
+
+def build_footer(size, geometry, disk_type, data_offset, force_size=False, timestamp=None,
+                 unique_id=None):
+    """The 512 byte VHD footer for a disk of the given virtual size and CHS geometry."""
+    cylinders, heads, sectors_per_track = geometry
+    if timestamp is None:
+        timestamp = get_timestamp()
+    unique_id = unique_id or get_unique_id('vhd', size, disk_type)
+    fields = [FOOTER_COOKIE, FEATURES_RESERVED, FORMAT_VERSION, data_offset,
+              max(timestamp - VHD_EPOCH, 0) & 0xFFFFFFFF,
+              CREATOR_APP_FORCE_SIZE if force_size else CREATOR_APP, CREATOR_VERSION,
+              CREATOR_HOST_OS, size, size, cylinders, heads, sectors_per_track, disk_type, 0,
+              unique_id.bytes, 0]
+    checksum = vhd_checksum(struct.pack(FOOTER_FORMAT, *fields))
+    fields[14] = checksum
+    return struct.pack(FOOTER_FORMAT, *fields)
+
+
+def read_footer(vhd_path):
+    """Read and validate the footer of a VHD. Returns a dictionary of its fields."""
+    with open(vhd_path, 'rb') as vhd_file:
+        vhd_file.seek(-SECTOR_SIZE, 2)
+        footer = vhd_file.read(SECTOR_SIZE)
+    fields = struct.unpack(FOOTER_FORMAT, footer)
+    if fields[0] != FOOTER_COOKIE:
+        raise RuntimeError('{} has no VHD footer'.format(vhd_path))
+    if vhd_checksum(footer[:64] + bytes(4) + footer[68:]) != fields[14]:
+        raise RuntimeError('Invalid VHD footer checksum in {}'.format(vhd_path))
+    return {'data_offset': fields[3], 'creator_app': fields[5].decode(errors='replace'),
+            'original_size': fields[8], 'current_size': fields[9],
+            'geometry': fields[10:13], 'disk_type': fields[13],
+            'unique_id': str(uuid.UUID(bytes=fields[15]))}
+
+
+def append_fixed_vhd_footer(vhd_path, alignment=AZURE_VHD_ALIGNMENT):
+    """Turn a raw disk file into a fixed VHD in place: pad it with a hole to a multiple of
+    alignment and append the footer. Returns the virtual size of the VHD."""
+    with open(vhd_path, 'r+b') as vhd_file:
+        size = round_up(vhd_file.seek(0, 2), alignment)
+        _, geometry = get_vhd_size(size, force_size=True)
+        vhd_file.truncate(size)
+        vhd_file.seek(size)
+        vhd_file.write(build_footer(size, geometry, DISK_TYPE_FIXED, NO_DATA_OFFSET,
+                                    force_size=True))
+    return size
+
+
+def build_dynamic_header(table_offset, max_table_entries, block_size=DYNAMIC_BLOCK_SIZE):
+    """The 1024 byte dynamic disk header."""
+    fields = [DYNAMIC_HEADER_COOKIE, NO_DATA_OFFSET, table_offset, FORMAT_VERSION,
+              max_table_entries, block_size, 0, bytes(16), 0, bytes(512), bytes(192)]
+    fields[6] = vhd_checksum(struct.pack(DYNAMIC_HEADER_FORMAT, *fields))
+    return struct.pack(DYNAMIC_HEADER_FORMAT, *fields)
+
+
+class FixedVhdWriter(ImageWriter):
+    """Fixed VHD: the raw disk content followed by a footer. Zero data is left as holes."""
+
+    unit_size = FIXED_UNIT_SIZE
+
+    def __init__(self, path, size, force_size=False, timestamp=None):
+        super().__init__(path, size)
+        self.force_size = force_size
+        self.timestamp = timestamp
+        self.vhd_size, self.geometry = get_vhd_size(size, force_size)
+
+    def _write_unit(self, index, data):
+        offset = index * self.unit_size
+        # The last unit may extend past the end of the disk.
+        self._write_at(offset, data[:self.size - offset])
+
+    def _finish(self):
+        self.image_file.truncate(self.vhd_size)
+        self._write_at(self.vhd_size, build_footer(self.vhd_size, self.geometry, DISK_TYPE_FIXED,
+                                                   NO_DATA_OFFSET, self.force_size,
+                                                   self.timestamp))
+
+
+class DynamicVhdWriter(ImageWriter):
+    """Dynamic VHD with qemu-img's layout: footer copy, dynamic header, block allocation table
+    (BAT), then 2 MiB data blocks, each preceded by a fully set sector bitmap, and the footer."""
+
+    unit_size = DYNAMIC_BLOCK_SIZE
+
+    def __init__(self, path, size, force_size=False, timestamp=None):
+        super().__init__(path, size)
+        self.force_size = force_size
+        self.timestamp = timestamp
+        self.unique_id = get_unique_id('vhd', os.path.basename(path), size)
+        self.vhd_size, self.geometry = get_vhd_size(size, force_size)
+        self.max_table_entries = -(-self.vhd_size // DYNAMIC_BLOCK_SIZE)
+        self.table_offset = 3 * SECTOR_SIZE
+        self.bat = [UNUSED_BAT_ENTRY] * self.max_table_entries
+        self.bitmap = b'\xff' * round_up(DYNAMIC_BLOCK_SIZE // SECTOR_SIZE // 8, SECTOR_SIZE)
+        # Footer copy and dynamic header are written last, the BAT is reserved now.
+        self._write_at(self.table_offset,
+                       b'\xff' * round_up(self.max_table_entries * 4, SECTOR_SIZE))
+
+    def _write_unit(self, index, data):
+        self.bat[index] = self.end_offset // SECTOR_SIZE
+        self._append(self.bitmap)
+        self._append(data)
+
+    def _finish(self):
+        footer = build_footer(self.vhd_size, self.geometry, DISK_TYPE_DYNAMIC, SECTOR_SIZE,
+                              self.force_size, self.timestamp, self.unique_id)
+        self._append(footer)
+        self._write_at(0, footer)
+        self._write_at(SECTOR_SIZE,
+                       build_dynamic_header(self.table_offset, self.max_table_entries))
+        self._write_at(self.table_offset,
+                       struct.pack('>{}I'.format(self.max_table_entries), *self.bat))
+
+
+def create_vhd_writer(path, size, options):
+    """VHD writer for qemu-img style vpc options (subformat=fixed|dynamic, force_size)."""
+    subformat = options.get('subformat', 'dynamic')
+    force_size = options.get('force_size', 'off') in ('on', 'true', 'yes')
+    if subformat == 'fixed':
+        return FixedVhdWriter(path, size, force_size)
+    if subformat == 'dynamic':
+        return DynamicVhdWriter(path, size, force_size)
+    raise ValueError('Unsupported VHD subformat {}'.format(subformat))
@@ -0,0 +1,300 @@
+"""VMDK sparse extent image writers (monolithicSparse and streamOptimized) and a
+streamOptimized reader"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from disk.image_writer import ImageWriter, SECTOR_SIZE, round_up
+from util.reproducible import get_unique_bytes
+
+SPARSE_MAGIC = b'KDMV'
+FLAG_VALID_NEW_LINE_DETECTION = 1 << 0
+FLAG_REDUNDANT_GRAIN_TABLE = 1 << 1
+FLAG_COMPRESSED_GRAINS = 1 << 16
+FLAG_MARKERS = 1 << 17
+COMPRESSION_NONE = 0
+COMPRESSION_DEFLATE = 1
+GD_AT_END = 0xFFFFFFFFFFFFFFFF
+
+GRAIN_SIZE = 64 * 1024
+GRAIN_SECTORS = GRAIN_SIZE // SECTOR_SIZE
+GT_ENTRIES = 512
+GT_SECTORS = GT_ENTRIES * 4 // SECTOR_SIZE
+DESCRIPTOR_OFFSET = 1
+DESCRIPTOR_SECTORS = 20
+# streamOptimized data starts at 64 KiB, like in images written by VMware tools.
+STREAM_OVERHEAD_SECTORS = 128
+
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+# magic, version, flags, capacity, grain size, descriptor offset, descriptor size,
+# GT entries per GT, redundant GD offset, GD offset, overhead, unclean shutdown,
+# new line detection characters, compression algorithm
+HEADER_FORMAT = '<4sIIQQQQIQQQB4sH433x'
+# value, size, type
+MARKER_FORMAT = '<QII496x'
+# LBA and compressed size preceding every compressed grain
+GRAIN_MARKER_FORMAT = '<QI'
+
+DESCRIPTOR_TEMPLATE = '''# Disk DescriptorFile
+version=1
+CID={cid:08x}
+parentCID=ffffffff
+createType="{create_type}"
+
+# Extent description
+RW {sectors} SPARSE "{extent_name}"
+
+# The Disk Data Base
+#DDB
+
+ddb.virtualHWVersion = "{hw_version}"
+ddb.geometry.cylinders = "{cylinders}"
+ddb.geometry.heads = "{heads}"
+ddb.geometry.sectors = "63"
+ddb.adapterType = "{adapter_type}"
+'''
+
+
+def build_header(version, flags, capacity, overhead, gd_offset, rgd_offset=0,
+                 compression=COMPRESSION_NONE):
+    """The 512 byte sparse extent header."""
+    return struct.pack(HEADER_FORMAT, SPARSE_MAGIC, version, flags, capacity, GRAIN_SECTORS,
+                       DESCRIPTOR_OFFSET, DESCRIPTOR_SECTORS, GT_ENTRIES, rgd_offset, gd_offset,
+                       overhead, 0, b'\n \r\n', compression)
+
+
+def build_descriptor(create_type, size, extent_name, adapter_type='lsilogic', hw_version='4',
+                     cid=None):
+    """The embedded text descriptor, padded to its reserved sectors."""
+    sectors = size // SECTOR_SIZE
+    heads = 16 if adapter_type == 'ide' else 255
+    if cid is None:
+        cid = int.from_bytes(get_unique_bytes(4, 'vmdk', extent_name, size), 'big')
+    descriptor = DESCRIPTOR_TEMPLATE.format(
+        cid=cid, create_type=create_type,
+        sectors=sectors, extent_name=extent_name, hw_version=hw_version,
+        cylinders=min(-(-sectors // (heads * 63)), 16383), heads=heads,
+        adapter_type=adapter_type).encode()
+    if len(descriptor) > DESCRIPTOR_SECTORS * SECTOR_SIZE:
+        raise ValueError('VMDK descriptor does not fit in {} sectors'.format(DESCRIPTOR_SECTORS))
+    return descriptor.ljust(DESCRIPTOR_SECTORS * SECTOR_SIZE, b'\0')
+
+
+def build_marker(value, marker_type):
+    """A metadata marker sector of a streamOptimized extent."""
+    return struct.pack(MARKER_FORMAT, value, 0, marker_type)
+
+
+class MonolithicSparseVmdkWriter(ImageWriter):
+    """monolithicSparse VMDK with qemu-img's layout: header, descriptor, redundant and primary
+    grain directories each followed by all their grain tables, then the grains."""
+
+    unit_size = GRAIN_SIZE
+
+    def __init__(self, path, size, adapter_type='lsilogic', hw_version='4'):
+        super().__init__(path, size)
+        self.capacity = -(-size // SECTOR_SIZE)
+        self.gt_count = -(-self.capacity // (GT_ENTRIES * GRAIN_SECTORS))
+        self.gd_sectors = -(-self.gt_count * 4 // SECTOR_SIZE)
+        self.rgd_offset = DESCRIPTOR_OFFSET + DESCRIPTOR_SECTORS
+        self.gd_offset = self.rgd_offset + self.gd_sectors + self.gt_count * GT_SECTORS
+        self.overhead = round_up(self.gd_offset + self.gd_sectors + self.gt_count * GT_SECTORS,
+                                 GRAIN_SECTORS)
+        self.grain_table = [0] * (self.gt_count * GT_ENTRIES)
+        self._write_at(0, build_header(1, FLAG_VALID_NEW_LINE_DETECTION |
+                                       FLAG_REDUNDANT_GRAIN_TABLE, self.capacity,
+                                       self.overhead, self.gd_offset, self.rgd_offset))
+        self._write_at(DESCRIPTOR_OFFSET * SECTOR_SIZE, build_descriptor(
+            'monolithicSparse', self.capacity * SECTOR_SIZE, os.path.basename(path),
+            adapter_type, hw_version))
+        # Grain directories and tables are written last, reserve them now.
+        self._write_at(self.rgd_offset * SECTOR_SIZE,
+                       bytes((self.overhead - self.rgd_offset) * SECTOR_SIZE))
+
+    def _write_unit(self, index, data):
+        self.grain_table[index] = self._append(data) // SECTOR_SIZE
+
+    def _finish(self):
+        grain_tables = struct.pack('<{}I'.format(len(self.grain_table)), *self.grain_table)
+        for directory_offset in (self.rgd_offset, self.gd_offset):
+            first_table = directory_offset + self.gd_sectors
+            directory = struct.pack('<{}I'.format(self.gt_count),
+                                    *range(first_table, first_table + self.gt_count * GT_SECTORS,
+                                           GT_SECTORS))
+            self._write_at(directory_offset * SECTOR_SIZE, directory)
+            self._write_at(first_table * SECTOR_SIZE, grain_tables)
+
+
+class StreamOptimizedVmdkWriter(ImageWriter):
+    """streamOptimized VMDK: deflate compressed grains preceded by their LBA, each grain table
+    after the grains it covers, then the grain directory, a footer and the end-of-stream marker.
+
+    The image is written strictly sequentially, so it can be produced on the fly into a
+    pipe or an archive member (image_file). Grains are deflated by compress_threads threads,
+    zlib releases the GIL, and appended in order as their compression completes."""
+
+    unit_size = GRAIN_SIZE
+
+    def __init__(self, path, size, adapter_type='lsilogic', hw_version='4', compress_level=6,
+                 compress_threads=None, image_file=None):
+        super().__init__(path, size, image_file)
+        self.compress_level = compress_level
+        compress_threads = compress_threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(compress_threads) if compress_threads > 1 else None
+        # Bounds the memory held by grains queued for compression.
+        self.max_queued_grains = 4 * compress_threads
+        self.queued_grains = deque()
+        self.capacity = -(-size // SECTOR_SIZE)
+        self.gt_count = -(-self.capacity // (GT_ENTRIES * GRAIN_SECTORS))
+        self.grain_directory = [0] * self.gt_count
+        self.gt_index = None
+        self.grain_table = None
+        self.flags = FLAG_VALID_NEW_LINE_DETECTION | FLAG_COMPRESSED_GRAINS | FLAG_MARKERS
+        self._append(build_header(3, self.flags, self.capacity, STREAM_OVERHEAD_SECTORS,
+                                  GD_AT_END, compression=COMPRESSION_DEFLATE))
+        self._append(build_descriptor('streamOptimized', self.capacity * SECTOR_SIZE,
+                                      os.path.basename(path), adapter_type, hw_version))
+        self._append(bytes(STREAM_OVERHEAD_SECTORS * SECTOR_SIZE - self.end_offset))
+
+    def _flush_grain_table(self):
+        if self.grain_table is not None:
+            self._append(build_marker(GT_SECTORS, MARKER_GT))
+            self.grain_directory[self.gt_index] = self.end_offset // SECTOR_SIZE
+            self._append(struct.pack('<{}I'.format(GT_ENTRIES), *self.grain_table))
+            self.gt_index = None
+            self.grain_table = None
+
+    def _append_grain(self, index, compressed):
+        """Append an already compressed grain and reference it in its grain table."""
+        gt_index, gt_entry = divmod(index, GT_ENTRIES)
+        if gt_index != self.gt_index:
+            self._flush_grain_table()
+            self.gt_index = gt_index
+            self.grain_table = [0] * GT_ENTRIES
+        self.grain_table[gt_entry] = self.end_offset // SECTOR_SIZE
+        header = struct.pack(GRAIN_MARKER_FORMAT, index * GRAIN_SECTORS, len(compressed))
+        padding = -(len(header) + len(compressed)) % SECTOR_SIZE
+        self._append(header)
+        self._append(compressed)
+        self._append(bytes(padding))
+
+    def _append_queued_grain(self):
+        index, future = self.queued_grains.popleft()
+        self._append_grain(index, future.result())
+
+    def _write_unit(self, index, data):
+        if self.executor is None:
+            self._append_grain(index, zlib.compress(data, self.compress_level))
+            return
+        # data can be a view of the reader's buffer, which is reused once write() returns.
+        self.queued_grains.append((index, self.executor.submit(zlib.compress, bytes(data),
+                                                               self.compress_level)))
+        while len(self.queued_grains) > self.max_queued_grains:
+            self._append_queued_grain()
+
+    def _shutdown_executor(self):
+        if self.executor is not None:
+            for _, future in self.queued_grains:
+                future.cancel()
+            self.executor.shutdown()
+            self.executor = None
+
+    def _finish(self):
+        try:
+            while self.queued_grains:
+                self._append_queued_grain()
+        finally:
+            self._shutdown_executor()
+        self._flush_grain_table()
+        gd_sectors = -(-self.gt_count * 4 // SECTOR_SIZE)
+        self._append(build_marker(gd_sectors, MARKER_GD))
+        gd_offset = self.end_offset // SECTOR_SIZE
+        self._append(struct.pack('<{}I'.format(self.gt_count), *self.grain_directory).ljust(
+            gd_sectors * SECTOR_SIZE, b'\0'))
+        self._append(build_marker(1, MARKER_FOOTER))
+        self._append(build_header(3, self.flags, self.capacity, STREAM_OVERHEAD_SECTORS,
+                                  gd_offset, compression=COMPRESSION_DEFLATE))
+        self._append(build_marker(0, MARKER_EOS))
+
+    def abort(self):
+        self._shutdown_executor()
+        self.queued_grains.clear()
+        super().abort()
+
+
+def create_vmdk_writer(path, size, options):
+    """VMDK writer for qemu-img style vmdk options (subformat, adapter_type, hwversion).
+    streamOptimized grains are compressed on all CPUs."""
+    subformat = options.get('subformat', 'monolithicSparse')
+    adapter_type = options.get('adapter_type', 'ide')
+    hw_version = options.get('hwversion', '4')
+    if subformat == 'monolithicSparse':
+        return MonolithicSparseVmdkWriter(path, size, adapter_type, hw_version)
+    if subformat == 'streamOptimized':
+        return StreamOptimizedVmdkWriter(path, size, adapter_type, hw_version)
+    raise ValueError('Unsupported VMDK subformat {}'.format(subformat))
+
+
+
+class StreamOptimizedVmdkReader():
+    """Sequential reader of the grains of a streamOptimized VMDK, as written by
+    StreamOptimizedVmdkWriter or VMware tools, from a file object that only needs read()."""
+
+    def __init__(self, vmdk_file):
+        self.vmdk_file = vmdk_file
+        header = struct.unpack(HEADER_FORMAT, self._read(SECTOR_SIZE))
+        magic, _, flags, capacity, grain_sectors = header[:5]
+        if magic != SPARSE_MAGIC or not flags & FLAG_MARKERS or \
+                not flags & FLAG_COMPRESSED_GRAINS or grain_sectors != GRAIN_SECTORS:
+            raise ValueError('Not a streamOptimized VMDK with {} byte grains'.format(GRAIN_SIZE))
+        # Virtual disk size in bytes.
+        self.capacity = capacity * SECTOR_SIZE
+        self.overhead = header[10]
+
+    def _read(self, size):
+        data = self.vmdk_file.read(size)
+        if len(data) != size:
+            raise ValueError('Truncated streamOptimized VMDK')
+        return data
+
+    def iter_grains(self):
+        """Yield (offset, data) for the grains in the order they are stored. Grains that aren't
+        stored are zero. The last grain is clipped to the capacity."""
+        self._read((self.overhead - 1) * SECTOR_SIZE)
+        grain_marker_size = struct.calcsize(GRAIN_MARKER_FORMAT)
+        while True:
+            lba, size = struct.unpack(GRAIN_MARKER_FORMAT, self._read(grain_marker_size))
+            if size:
+                compressed = self._read(size)
+                self._read(-(grain_marker_size + size) % SECTOR_SIZE)
+                offset = lba * SECTOR_SIZE
+                yield offset, zlib.decompress(compressed)[:self.capacity - offset]
+                continue
+            # Metadata marker: the sectors of metadata that follow, a zero size and the type.
+            marker_type = struct.unpack('<I', self._read(4))[0]
+            self._read(SECTOR_SIZE - grain_marker_size - 4)
+            if marker_type == MARKER_EOS:
+                return
+            self._read(lba * SECTOR_SIZE)
@@ -124,6 +124,16 @@ class AlibabaClient():
             request.set_ImageName(image_name)
         return self.__send_request(request)
 
+    def describe_tagged_images(self, key, value):
+        """ Send request to get details of the available images of this account
+            Filter by tag
+            Return Alibaba response """
+        request = DescribeImagesRequest()
+        request.set_ImageOwnerAlias('self')
+        request.set_Status('Available')
+        request.set_Tags([{'Key': key, 'Value': value}])
+        return self.__send_request(request)
+
     def import_image(self, oss_bucket, oss_object, image_name):
         """ Form and send request to to import image
             Return Alibaba response """
@@ -27,6 +27,8 @@ from util.config import get_config_value
 from util.logger import LOGGER
 from util.retrier import Retrier
 
+OSS_META_PREFIX = 'x-oss-meta-'
+
 class AlibabaDisk(BaseDisk):
     """Class for handling Alibaba disk related actions"""
 
@@ -46,6 +48,8 @@ class AlibabaDisk(BaseDisk):
                                      "was (or had to be) uploaded: {}".format(self.disk_to_upload)
             LOGGER.debug(failed_delete_file_msg)
 
+        if self.is_uploaded_disk_kept():
+            return
         LOGGER.debug("Cleaning up the uploaded disk from Alibaba storage")
         self.upload_cleanup()
 
@@ -73,7 +77,8 @@ class AlibabaDisk(BaseDisk):
             try:
                 resumable_store = oss2.resumable.ResumableStore(root=self.working_dir)
                 oss2.resumable_upload(self.bucket, self.uploaded_disk_name, self.disk_to_upload,
-                                      store=resumable_store, num_threads=number_of_threads)
+                                      store=resumable_store, headers=self.get_upload_headers(),
+                                      num_threads=number_of_threads)
                 result = True
             except FileNotFoundError as exc:
                 LOGGER.exception(exc)
@@ -99,6 +104,29 @@ class AlibabaDisk(BaseDisk):
             raise RuntimeError('Exhausted all {} retries for file {} to upload.'.
                                format(retrier.tries, self.uploaded_disk_name))
 
+    def get_upload_headers(self):
+        """OSS user metadata headers of the upload. OSS metadata names can't hold underscores."""
+        return {OSS_META_PREFIX + key.replace('_', '-'): value
+                for key, value in self.get_upload_metadata().items()}
+
+    def reuse_uploaded_disk(self, disk_name):
+        """Use disk_name, an object uploaded earlier to ALIBABA_BUCKET, after checking its size
+           and metadata"""
+        self.set_bucket()
+        try:
+            result = self.bucket.head_object(disk_name)
+        except oss2.exceptions.NotFound as exc:
+            LOGGER.exception(exc)
+            raise RuntimeError('Uploaded disk {} was not found in the bucket'.format(disk_name)) \
+                from exc
+        metadata = {key[len(OSS_META_PREFIX):].replace('-', '_'): value
+                    for key, value in result.headers.items()
+                    if key.lower().startswith(OSS_META_PREFIX)}
+        self.check_uploaded_disk(disk_name, result.content_length, metadata)
+        self.uploaded_disk_name = disk_name
+        self.reused_uploaded_disk = True
+        LOGGER.info('Reusing %s from the bucket', disk_name)
+
     @staticmethod
     def set_number_of_threads():
         """number of threads should not be higher than oss2.defaults.connection_pool_size"""
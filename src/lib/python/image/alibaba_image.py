@@ -38,6 +38,15 @@ class AlibabaImage(BaseImage):
         self.prev_progress = None
         self.image_id = None
 
+    @staticmethod
+    def find_tagged_image(key, value):
+        """ Id of an available image of this account tagged with key=value, None if there is
+            none """
+        images_json = AlibabaClient().describe_tagged_images(key, value)
+        if int(images_json['TotalCount']) == 0:
+            return None
+        return images_json['Images']['Image'][0]['ImageId']
+
     def clean_up(self):
         """ Clean-up cloud objects created by this class and its members """
         LOGGER.info('Cleaning-up AlibabaImage artifacts.')
@@ -14,12 +14,61 @@
 # the License.
 
 
+import base64
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
 from image.base_disk import BaseDisk
 from util.config import get_config_value
+from util.io_policy import open_with_io_policy
 from util.logger import LOGGER
+from util.retrier import Retrier
+
+MIB = 1024 * 1024
+# S3 multipart upload limits.
+MIN_PART_SIZE = 5 * MIB
+MAX_PARTS = 10000
+# Multipart upload state in ARTIFACTS_DIR: the upload id and the parts completed so far, from
+# which a retried upload, or a re-run with REUSE, resumes.
+UPLOAD_CHECKPOINT_FILE = 'aws_upload_checkpoint.json'
+# Progress is logged whenever this fraction of the disk has been uploaded.
+PROGRESS_STEP = 0.1
+
+
+class UploadProgress():
+    """Logs the progress and throughput of an upload at every PROGRESS_STEP of the disk"""
+    def __init__(self, total_bytes):
+        self.total_bytes = total_bytes
+        self.start_time = time.time()
+        # Bytes of the disk uploaded, by this upload (sent) or an earlier attempt.
+        self.done_bytes = 0
+        self.sent_bytes = 0
+        self.next_step = PROGRESS_STEP
+
+    def get_elapsed(self):
+        """Seconds since the upload started"""
+        return time.time() - self.start_time
+
+    def get_throughput(self):
+        """MiB/s sent by this upload"""
+        return self.sent_bytes / MIB / max(self.get_elapsed(), 1e-9)
+
+    def add(self, size, sent):
+        """Account for a part of size bytes, sent by this upload or not"""
+        self.done_bytes += size
+        if sent:
+            self.sent_bytes += size
+        if self.total_bytes and self.done_bytes >= self.next_step * self.total_bytes:
+            LOGGER.info("Uploaded %d of %d MiB (%d%%) at %.1f MiB/s.", self.done_bytes // MIB,
+                        self.total_bytes // MIB, 100 * self.done_bytes // self.total_bytes,
+                        self.get_throughput())
+            while self.next_step * self.total_bytes <= self.done_bytes:
+                self.next_step += PROGRESS_STEP
 
 
 class AWSDisk(BaseDisk):
@@ -41,8 +90,15 @@ class AWSDisk(BaseDisk):
         if not self.bucket_name:
             raise RuntimeError("AWS_BUCKET is missing.")
 
+        # Duration (seconds) and throughput (MiB/s) of the upload, resumed parts excluded.
+        self.upload_time = None
+        self.upload_throughput = None
+
     def clean_up(self):
         """Clean-up."""
+        self.clean_up_checkpoint()
+        if self.is_uploaded_disk_kept():
+            return
         try:
             if self.bucket_name is not None and self.uploaded_disk_name is not None:
                 LOGGER.debug("Deleting '%s' from the bucket '%s'.",
@@ -52,6 +108,18 @@ class AWSDisk(BaseDisk):
             # Log the exception without propagating it further.
             LOGGER.exception(client_error)
 
+    def clean_up_checkpoint(self):
+        """Abort an unfinished multipart upload that no later run can resume: without REUSE,
+        the next run starts from a new artifacts directory."""
+        if get_config_value('REUSE') or not os.path.exists(self.get_checkpoint_path()):
+            return
+        try:
+            with open(self.get_checkpoint_path()) as checkpoint_file:
+                self.abort_upload(json.load(checkpoint_file))
+            self.remove_checkpoint()
+        except (OSError, ValueError) as exc:
+            LOGGER.warning("Failed to clean up the multipart upload checkpoint: %s", exc)
+
     def extract(self):
         """Extract the vmdk disk out of zip."""
         LOGGER.debug("Extracting '.vmdk' disk file from [%s].", self.input_disk_path)
@@ -119,19 +187,200 @@ class AWSDisk(BaseDisk):
         return bucket
 
     def upload(self):
-        """Upload the disk to the s3 bucket represented by AWS_BUCKET"""
+        """Upload the disk to the s3 bucket represented by AWS_BUCKET, resuming the multipart
+        upload of an earlier attempt if there is one."""
         try:
             if self.is_bucket_exist() is False:
                 LOGGER.debug("Creating '%s' bucket as it doesn't exist.", self.bucket_name)
                 self.create_bucket()
+        except ClientError as client_error:
+            LOGGER.exception(client_error)
+            raise RuntimeError("AWS upload disk operation failed.") from client_error
+
+        def _upload():
+            try:
+                self.multipart_upload()
+                return True
+            except (BotoCoreError, ClientError) as botocore_exception:
+                # The completed parts are kept for the next attempt.
+                LOGGER.exception(botocore_exception)
+            return False
+
+        retrier = Retrier(_upload)
+        retrier.tries = int(get_config_value('AWS_S3_UPLOAD_RETRY_COUNT'))
+        retrier.delay = int(get_config_value('AWS_S3_UPLOAD_RETRY_DELAY'))
+        if not retrier.execute():
+            raise RuntimeError("AWS upload disk operation failed after {} tries.".format(
+                retrier.tries))
+        LOGGER.info("Successfully uploaded '%s'.", self.uploaded_disk_name)
+
+    @staticmethod
+    def get_part_size(disk_size):
+        """Size of the parts to upload a disk of disk_size bytes in: AWS_S3_MULTIPART_CHUNK_MB
+        MiB, within the S3 limits on part size and number of parts."""
+        part_size = max(int(get_config_value('AWS_S3_MULTIPART_CHUNK_MB')) * MIB, MIN_PART_SIZE)
+        min_part_size = -(-disk_size // MAX_PARTS)
+        if part_size < min_part_size:
+            part_size = -(-min_part_size // MIB) * MIB
+            LOGGER.info("Uploading in %d MiB parts to stay within %d parts.", part_size // MIB,
+                        MAX_PARTS)
+        return part_size
+
+    def get_checkpoint_path(self):
+        """Path of the multipart upload checkpoint file"""
+        return os.path.join(get_config_value('ARTIFACTS_DIR'), UPLOAD_CHECKPOINT_FILE)
+
+    def save_checkpoint(self, checkpoint):
+        """Atomically replace the multipart upload checkpoint file"""
+        checkpoint_path = self.get_checkpoint_path()
+        with open(checkpoint_path + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=4, sort_keys=True)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
 
-            self.uploaded_disk_name = BaseDisk.decorate_disk_name(self.disk_to_upload)
+    def remove_checkpoint(self):
+        """Remove the multipart upload checkpoint file, if any"""
+        checkpoint_path = self.get_checkpoint_path()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
-            LOGGER.info("Uploading '%s' to the bucket '%s'.", self.uploaded_disk_name,
-                        self.bucket_name)
-            self.s3_client.upload_file(self.disk_to_upload, self.bucket_name,
-                                       self.uploaded_disk_name)
-            LOGGER.info("Successfully uploaded '%s'.", self.uploaded_disk_name)
+    def abort_upload(self, checkpoint):
+        """Abort the multipart upload of a checkpoint, deleting its parts. Errors are logged."""
+        LOGGER.info("Aborting the multipart upload of '%s'.", checkpoint['key'])
+        try:
+            self.s3_client.abort_multipart_upload(Bucket=checkpoint['bucket'],
+                                                  Key=checkpoint['key'],
+                                                  UploadId=checkpoint['upload_id'])
+        except ClientError as client_error:
+            LOGGER.warning("Failed to abort the multipart upload of '%s': %s",
+                           checkpoint['key'], client_error)
+
+    def list_uploaded_parts(self, checkpoint):
+        """ETags of the parts S3 holds for the multipart upload of a checkpoint, by part
+        number, None if the upload doesn't exist anymore."""
+        etags = {}
+        kwargs = {'Bucket': checkpoint['bucket'], 'Key': checkpoint['key'],
+                  'UploadId': checkpoint['upload_id']}
+        try:
+            while True:
+                response = self.s3_client.list_parts(**kwargs)
+                for part in response.get('Parts', []):
+                    etags[str(part['PartNumber'])] = part['ETag']
+                if not response.get('IsTruncated'):
+                    return etags
+                kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
+        except ClientError as client_error:
+            if client_error.response['Error']['Code'] == 'NoSuchUpload':
+                return None
+            raise
+
+    def load_checkpoint(self, upload_metadata, part_size):
+        """The multipart upload checkpoint of an earlier attempt to upload this disk, with
+        only the parts S3 still holds, None if there is none to resume."""
+        checkpoint_path = self.get_checkpoint_path()
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint.get('bucket') != self.bucket_name or \
+                checkpoint.get('metadata') != upload_metadata or \
+                checkpoint.get('part_size') != part_size:
+            LOGGER.info("The multipart upload checkpoint is for another disk or part size.")
+            self.abort_upload(checkpoint)
+            self.remove_checkpoint()
+            return None
+        uploaded_etags = self.list_uploaded_parts(checkpoint)
+        if uploaded_etags is None:
+            LOGGER.info("The multipart upload of '%s' doesn't exist anymore.", checkpoint['key'])
+            self.remove_checkpoint()
+            return None
+        checkpoint['parts'] = {number: part for number, part in checkpoint['parts'].items()
+                               if uploaded_etags.get(number) == part['etag']}
+        LOGGER.info("Resuming the multipart upload of '%s' with %d uploaded parts.",
+                    checkpoint['key'], len(checkpoint['parts']))
+        return checkpoint
+
+    def upload_part(self, checkpoint, number, data, md5):
+        """Upload part number of a multipart upload, returning its ETag"""
+        response = self.s3_client.upload_part(Bucket=checkpoint['bucket'], Key=checkpoint['key'],
+                                              UploadId=checkpoint['upload_id'],
+                                              PartNumber=int(number), Body=data,
+                                              ContentMD5=base64.b64encode(md5).decode())
+        return response['ETag']
+
+    def multipart_upload(self):
+        """Upload the disk in AWS_S3_MULTIPART_CHUNK_MB MiB parts, AWS_S3_MAX_CONCURRENCY at a
+        time, checkpointing every completed part. Parts of an earlier attempt that S3 still
+        holds are checked against the disk and not uploaded again."""
+        disk_size = os.path.getsize(self.disk_to_upload)
+        part_size = self.get_part_size(disk_size)
+        concurrency = max(int(get_config_value('AWS_S3_MAX_CONCURRENCY')), 1)
+        upload_metadata = self.get_upload_metadata()
+
+        checkpoint = self.load_checkpoint(upload_metadata, part_size)
+        if checkpoint is None:
+            key = BaseDisk.decorate_disk_name(self.disk_to_upload)
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket_name, Key=key,
+                                                              Metadata=upload_metadata)
+            checkpoint = {'bucket': self.bucket_name, 'key': key,
+                          'upload_id': response['UploadId'], 'metadata': upload_metadata,
+                          'part_size': part_size, 'parts': {}}
+            self.save_checkpoint(checkpoint)
+        self.uploaded_disk_name = checkpoint['key']
+        LOGGER.info("Uploading '%s' (%d MiB) to the bucket '%s' in %d MiB parts, %d at a time.",
+                    self.uploaded_disk_name, disk_size // MIB, self.bucket_name,
+                    part_size // MIB, concurrency)
+
+        progress = UploadProgress(disk_size)
+        with open_with_io_policy(self.disk_to_upload, 'upload') as disk_file, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = {}
+
+            def _complete_parts(return_when):
+                completed, _ = wait(pending, return_when=return_when)
+                for future in completed:
+                    number, md5, size = pending.pop(future)
+                    checkpoint['parts'][number] = {'etag': future.result(), 'md5': md5,
+                                                   'size': size}
+                    self.save_checkpoint(checkpoint)
+                    progress.add(size, sent=True)
+
+            for number, data in enumerate(iter(lambda: disk_file.read(part_size), b''), 1):
+                md5 = hashlib.md5(data)
+                part = checkpoint['parts'].get(str(number))
+                if part is not None and part['md5'] == md5.hexdigest():
+                    progress.add(len(data), sent=False)
+                    continue
+                # Bound the parts held in memory to the parts in flight.
+                if len(pending) >= concurrency:
+                    _complete_parts(FIRST_COMPLETED)
+                future = executor.submit(self.upload_part, checkpoint, str(number), data,
+                                         md5.digest())
+                pending[future] = (str(number), md5.hexdigest(), len(data))
+            while pending:
+                _complete_parts(ALL_COMPLETED)
+
+        parts = [{'PartNumber': int(number), 'ETag': part['etag']}
+                 for number, part in checkpoint['parts'].items()]
+        self.s3_client.complete_multipart_upload(
+            Bucket=checkpoint['bucket'], Key=checkpoint['key'], UploadId=checkpoint['upload_id'],
+            MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])})
+        self.remove_checkpoint()
+        self.upload_time = progress.get_elapsed()
+        self.upload_throughput = progress.get_throughput()
+        LOGGER.info("Uploaded %d MiB in %.1f seconds at %.1f MiB/s, %d MiB resumed.",
+                    disk_size // MIB, self.upload_time, self.upload_throughput,
+                    (disk_size - progress.sent_bytes) // MIB)
+
+    def reuse_uploaded_disk(self, disk_name):
+        """Use disk_name, an object uploaded earlier to the AWS_BUCKET bucket, after checking
+        its size and metadata."""
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key=disk_name)
         except ClientError as client_error:
             LOGGER.exception(client_error)
-            raise RuntimeError("AWS upload disk operation failed.") from client_error
+            raise RuntimeError("Uploaded disk '{}' wasn't found in the bucket '{}'."
+                               .format(disk_name, self.bucket_name)) from client_error
+        self.check_uploaded_disk(disk_name, response['ContentLength'], response.get('Metadata'))
+        self.uploaded_disk_name = disk_name
+        self.reused_uploaded_disk = True
+        LOGGER.info("Reusing '%s' from the bucket '%s'.", disk_name, self.bucket_name)
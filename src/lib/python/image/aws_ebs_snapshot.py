@@ -0,0 +1,356 @@
+"""AWS snapshot written with the EBS direct APIs"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import base64
+import datetime
+import hashlib
+import json
+import os
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from disk.vmdk import StreamOptimizedVmdkReader
+from image.aws_disk import MIB, UploadProgress
+from image.aws_snapshot import AWSSnapshot
+from util.config import get_config_value
+from util.io_policy import open_with_io_policy
+from util.logger import LOGGER
+from util.retrier import Retrier
+
+# Block size of EBS snapshots, the unit of PutSnapshotBlock.
+EBS_BLOCK_SIZE = 512 * 1024
+GIB = 1024 * 1024 * 1024
+ZERO_BLOCK = bytes(EBS_BLOCK_SIZE)
+
+
+def _base64_digest(data):
+    return base64.b64encode(data).decode()
+
+
+def get_block_manifest_dir():
+    """Directory caching the block manifests of the snapshots written by this host:
+    AWS_EBS_MANIFEST_DIR, else ebs-block-manifests in IMAGE_DIR. None if neither is set."""
+    manifest_dir = get_config_value('AWS_EBS_MANIFEST_DIR')
+    if not manifest_dir and get_config_value('IMAGE_DIR'):
+        manifest_dir = os.path.join(get_config_value('IMAGE_DIR'), 'ebs-block-manifests')
+    return manifest_dir or None
+
+
+def _get_block_manifest_path(snapshot_id):
+    manifest_dir = get_block_manifest_dir()
+    return os.path.join(manifest_dir, snapshot_id + '.json') if manifest_dir else None
+
+
+def load_block_manifest(snapshot_id):
+    """The cached block manifest of a snapshot, None if there is none."""
+    manifest_path = _get_block_manifest_path(snapshot_id)
+    if manifest_path is None or not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as exc:
+        LOGGER.warning("Ignoring the block manifest '%s': %s", manifest_path, exc)
+        return None
+    if manifest.get('snapshot_id') != snapshot_id or \
+            manifest.get('block_size') != EBS_BLOCK_SIZE or \
+            'volume_size' not in manifest or 'blocks' not in manifest:
+        LOGGER.warning("Ignoring the block manifest '%s' of another snapshot or block size.",
+                       manifest_path)
+        return None
+    manifest['blocks'] = {int(index): checksum for index, checksum in manifest['blocks'].items()}
+    return manifest
+
+
+def save_block_manifest(snapshot_id, volume_size, blocks, parent_snapshot_id=None):
+    """Cache the block manifest of a completed snapshot."""
+    manifest_path = _get_block_manifest_path(snapshot_id)
+    if manifest_path is None:
+        LOGGER.info('Neither AWS_EBS_MANIFEST_DIR nor IMAGE_DIR is set, the block manifest of '
+                    "'%s' isn't cached.", snapshot_id)
+        return
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    manifest = {'snapshot_id': snapshot_id, 'parent_snapshot_id': parent_snapshot_id,
+                'volume_size': volume_size, 'block_size': EBS_BLOCK_SIZE,
+                'blocks': {str(index): blocks[index] for index in sorted(blocks)}}
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    LOGGER.info("Cached the block manifest of '%s' in '%s'.", snapshot_id, manifest_path)
+
+
+def remove_block_manifest(snapshot_id):
+    """Remove the cached block manifest of a deleted snapshot, if any."""
+    manifest_path = _get_block_manifest_path(snapshot_id)
+    if manifest_path is not None and os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+
+class EbsSnapshotWriter():
+    """Writes the non-zero 512 KiB blocks of a disk to a new EBS snapshot with StartSnapshot,
+    PutSnapshotBlock and CompleteSnapshot, concurrency blocks at a time.
+
+    Every block is sent with its SHA256 checksum, and the snapshot is completed with the
+    linear aggregate of the block checksums, so that EBS checks what it stored. ebs_client is
+    a boto3 'ebs' client, or an EbsDirectStub for tests and benchmarks.
+
+    Given a parent snapshot and its block manifest, the new snapshot starts as a copy of the
+    parent, and only the blocks whose checksum differs from the manifest are written: changed
+    and new blocks, and zeroes over the parent blocks that are now zero."""
+
+    def __init__(self, ebs_client, concurrency):
+        self.ebs_client = ebs_client
+        self.concurrency = max(concurrency, 1)
+        self.snapshot_id = None
+        # Block manifest of the snapshot: SHA256 (hex) of every non-zero block by index.
+        self.blocks = {}
+        # SHA256 of the blocks written to the snapshot by index, zeroed blocks included.
+        self.block_checksums = {}
+        # Bytes sent, duration (seconds) and throughput (MiB/s) of the write.
+        self.sent_bytes = 0
+        self.elapsed = None
+        self.throughput = None
+
+    def _put_block(self, index, block):
+        checksum = hashlib.sha256(block).digest()
+        self.ebs_client.put_snapshot_block(SnapshotId=self.snapshot_id, BlockIndex=index,
+                                           BlockData=bytes(block), DataLength=EBS_BLOCK_SIZE,
+                                           Checksum=_base64_digest(checksum),
+                                           ChecksumAlgorithm='SHA256')
+        return checksum
+
+    def _write_block(self, index, block, parent_blocks):
+        """Put a block unless the parent snapshot already holds it. Returns its checksum and
+        whether it was sent."""
+        if index in parent_blocks and \
+                parent_blocks[index] == hashlib.sha256(block).hexdigest():
+            return bytes.fromhex(parent_blocks[index]), False
+        return self._put_block(index, block), True
+
+    def write(self, size, chunks, description, parent_snapshot_id=None, parent_blocks=None):
+        """Write a disk of size bytes to a new snapshot, complete it and return its id.
+
+        chunks yields (offset, data) for the disk data in ascending offset order, typically
+        the non-zero grains of a VMDK. Data that isn't yielded is zero.
+        parent_snapshot_id: optional completed snapshot of the same volume size to start from,
+        with parent_blocks, its block manifest."""
+        # pylint: disable=too-many-locals,too-many-statements
+        parent_blocks = parent_blocks or {}
+        volume_size = -(-size // GIB)
+        block_count = -(-size // EBS_BLOCK_SIZE)
+        kwargs = {'VolumeSize': volume_size, 'Description': description}
+        if parent_snapshot_id:
+            kwargs['ParentSnapshotId'] = parent_snapshot_id
+        response = self.ebs_client.start_snapshot(**kwargs)
+        self.snapshot_id = response['SnapshotId']
+        if response.get('BlockSize', EBS_BLOCK_SIZE) != EBS_BLOCK_SIZE:
+            raise RuntimeError('Unexpected EBS block size {}'.format(response['BlockSize']))
+        LOGGER.info("Writing %d MiB to the %d GiB snapshot '%s'%s, %d blocks at a time.",
+                    size // MIB, volume_size, self.snapshot_id,
+                    " over '{}'".format(parent_snapshot_id) if parent_snapshot_id else '',
+                    self.concurrency)
+
+        progress = UploadProgress(block_count * EBS_BLOCK_SIZE)
+        self.blocks = {}
+        self.block_checksums = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            pending = {}
+
+            def _complete_blocks(return_when):
+                completed, _ = wait(pending, return_when=return_when)
+                for future in completed:
+                    index, is_zero = pending.pop(future)
+                    checksum, sent = future.result()
+                    if sent:
+                        self.block_checksums[index] = checksum
+                    if not is_zero:
+                        self.blocks[index] = checksum.hex()
+                        progress.add(EBS_BLOCK_SIZE, sent)
+
+            def _submit(index, block, is_zero=False):
+                # Bound the blocks held in memory to twice the blocks in flight.
+                if len(pending) >= 2 * self.concurrency:
+                    _complete_blocks(FIRST_COMPLETED)
+                future = executor.submit(self._write_block, index, block,
+                                         {} if is_zero else parent_blocks)
+                pending[future] = (index, is_zero)
+
+            def _flush(index, block):
+                if block == ZERO_BLOCK:
+                    progress.add(EBS_BLOCK_SIZE, sent=False)
+                else:
+                    _submit(index, block)
+
+            next_index = 0
+            block_index = None
+            block = None
+            for offset, data in chunks:
+                view = memoryview(data).cast('B')
+                position = 0
+                while position < len(view):
+                    index, block_offset = divmod(offset + position, EBS_BLOCK_SIZE)
+                    if index != block_index:
+                        if block_index is not None:
+                            if index < block_index:
+                                raise RuntimeError('Disk data must be in ascending offset order')
+                            _flush(block_index, block)
+                        # Blocks skipped over are zero.
+                        progress.add((index - next_index) * EBS_BLOCK_SIZE, sent=False)
+                        block_index = index
+                        next_index = index + 1
+                        block = bytearray(EBS_BLOCK_SIZE)
+                    length = min(len(view) - position, EBS_BLOCK_SIZE - block_offset)
+                    block[block_offset:block_offset + length] = view[position:position + length]
+                    position += length
+            if block_index is not None:
+                _flush(block_index, block)
+            progress.add((block_count - next_index) * EBS_BLOCK_SIZE, sent=False)
+            while pending:
+                _complete_blocks(ALL_COMPLETED)
+
+            # Parent blocks that the disk doesn't hold anymore must be zeroed.
+            zeroed_blocks = sorted(set(parent_blocks) - set(self.blocks))
+            for index in zeroed_blocks:
+                _submit(index, ZERO_BLOCK, is_zero=True)
+            while pending:
+                _complete_blocks(ALL_COMPLETED)
+
+        aggregate = hashlib.sha256(b''.join(self.block_checksums[index]
+                                            for index in sorted(self.block_checksums)))
+        response = self.ebs_client.complete_snapshot(
+            SnapshotId=self.snapshot_id, ChangedBlocksCount=len(self.block_checksums),
+            Checksum=_base64_digest(aggregate.digest()), ChecksumAlgorithm='SHA256',
+            ChecksumAggregationMethod='LINEAR')
+        self.sent_bytes = progress.sent_bytes + len(zeroed_blocks) * EBS_BLOCK_SIZE
+        self.elapsed = progress.get_elapsed()
+        self.throughput = self.sent_bytes / MIB / max(self.elapsed, 1e-9)
+        LOGGER.info("Wrote %d of %d blocks (%d MiB, %d zeroed) to '%s' in %.1f seconds at "
+                    "%.1f MiB/s, snapshot status '%s'.", len(self.block_checksums), block_count,
+                    self.sent_bytes // MIB, len(zeroed_blocks), self.snapshot_id, self.elapsed,
+                    self.throughput, response['Status'])
+        return self.snapshot_id
+
+
+class AWSEbsSnapshot(AWSSnapshot):
+    """Class that writes the extracted VMDK disk straight into an AWS snapshot with the EBS
+    direct APIs, instead of uploading it to S3 and importing it with import_snapshot(). Nothing
+    is imported from S3, so the S3 bucket and key of AWSSnapshot are None and import_task_id stays
+    None; clean-up, tagging and deletion are inherited."""
+    def __init__(self, ec2_client, ebs_client, vmdk_disk):
+        super().__init__(ec2_client, None, None)
+        # Local path of the streamOptimized VMDK written to the snapshot.
+        self.vmdk_disk = vmdk_disk
+        self.writer = EbsSnapshotWriter(ebs_client,
+                                        int(get_config_value('AWS_EBS_MAX_CONCURRENCY')))
+        self.parent_snapshot_id = None
+
+    def find_parent_snapshot(self, volume_size):
+        """The id and block manifest of the snapshot given by AWS_EBS_PARENT_SNAPSHOT: a
+        snapshot id, the build fingerprint of the build that created it, or 'auto' for the
+        latest snapshot of a build of the same platform, modules and boot locations. Only
+        completed snapshots of this account, of volume_size GiB and with a cached block manifest
+        can be parents. (None, None) if there is none."""
+        parent = get_config_value('AWS_EBS_PARENT_SNAPSHOT')
+        if not parent:
+            return None, None
+        if parent.startswith('snap-'):
+            filters = [{'Name': 'snapshot-id', 'Values': [parent]}]
+        elif parent == 'auto':
+            tags = self.get_snapshot_tag_metadata()
+            filters = [{'Name': 'tag-key', 'Values': ['build_fingerprint']}]
+            filters += [{'Name': 'tag:' + key, 'Values': [tags[key]]}
+                        for key in ('platform', 'modules', 'boot_locations') if key in tags]
+        else:
+            filters = [{'Name': 'tag:build_fingerprint', 'Values': [parent]}]
+        filters.append({'Name': 'status', 'Values': ['completed']})
+        try:
+            snapshots = [snapshot for page in
+                         self.ec2_client.get_paginator('describe_snapshots').paginate(
+                             OwnerIds=['self'], Filters=filters)
+                         for snapshot in page['Snapshots']]
+        except ClientError as client_error:
+            LOGGER.exception(client_error)
+            raise RuntimeError("describe_snapshots() failed for the parent snapshot '{}'!"
+                               .format(parent)) from client_error
+
+        for snapshot in sorted(snapshots, key=lambda snapshot: snapshot['StartTime'],
+                               reverse=True):
+            manifest = load_block_manifest(snapshot['SnapshotId'])
+            if manifest is None:
+                LOGGER.info("Snapshot '%s' has no cached block manifest.", snapshot['SnapshotId'])
+            elif manifest['volume_size'] != volume_size:
+                LOGGER.info("Snapshot '%s' is %d GiB instead of %d GiB.", snapshot['SnapshotId'],
+                            manifest['volume_size'], volume_size)
+            else:
+                return snapshot['SnapshotId'], manifest['blocks']
+        LOGGER.warning("No parent snapshot found for AWS_EBS_PARENT_SNAPSHOT '%s', writing the "
+                       "whole disk.", parent)
+        return None, None
+
+    def create_snapshot(self):
+        """Writes the non-zero blocks of the disk, or the blocks that differ from the parent
+        snapshot, to a new snapshot and waits for it to complete."""
+        description = datetime.datetime.now().strftime('%Y%m%d%H%M%S') + '--BIGIP-Volume-From-'
+        description += os.path.basename(self.vmdk_disk)
+        try:
+            with open_with_io_policy(self.vmdk_disk, 'upload') as vmdk_file:
+                reader = StreamOptimizedVmdkReader(vmdk_file)
+                volume_size = -(-reader.capacity // GIB)
+                self.parent_snapshot_id, parent_blocks = self.find_parent_snapshot(volume_size)
+                self.writer.write(reader.capacity, reader.iter_grains(), description,
+                                  self.parent_snapshot_id, parent_blocks)
+        except (BotoCoreError, ClientError, ValueError) as exception:
+            LOGGER.exception(exception)
+            raise RuntimeError("Writing '{}' to an EBS snapshot failed.".format(
+                self.vmdk_disk)) from exception
+        finally:
+            # Set even if writing failed, so that clean-up deletes the snapshot.
+            self.snapshot_id = self.writer.snapshot_id
+
+        if not self.is_snapshot_completed():
+            raise RuntimeError("Snapshot '{}' didn't complete.".format(self.snapshot_id))
+        self.create_tags()
+        save_block_manifest(self.snapshot_id, volume_size, self.writer.blocks,
+                            self.parent_snapshot_id)
+
+    def delete_snapshot(self):
+        """Delete the AWS snapshot created by this object and its cached block manifest."""
+        if self.snapshot_id is not None:
+            remove_block_manifest(self.snapshot_id)
+        super().delete_snapshot()
+
+    def is_snapshot_completed(self):
+        """Waits for EBS to finish processing the written snapshot."""
+        def _is_snapshot_completed():
+            try:
+                response = self.ec2_client.describe_snapshots(SnapshotIds=[self.snapshot_id])
+            except ClientError as client_error:
+                LOGGER.exception(client_error)
+                raise RuntimeError("describe_snapshots() failed for [{}]!".format(
+                    self.snapshot_id)) from client_error
+            state = response['Snapshots'][0]['State']
+            if state == 'error':
+                raise RuntimeError("Snapshot [{}] in unrecoverable 'error' state.".format(
+                    self.snapshot_id))
+            return state == 'completed'
+
+        retrier = Retrier(_is_snapshot_completed)
+        retrier.tries = int(get_config_value('AWS_EBS_SNAPSHOT_RETRY_COUNT'))
+        retrier.delay = int(get_config_value('AWS_EBS_SNAPSHOT_RETRY_DELAY'))
+        LOGGER.info("Waiting for the snapshot [%s] to complete.", self.snapshot_id)
+        return retrier.execute()
@@ -0,0 +1,123 @@
+"""Local stand-in for the EBS direct APIs used by EbsSnapshotWriter"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import base64
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from image.aws_ebs_snapshot import EBS_BLOCK_SIZE, GIB
+
+
+class EbsDirectStub():
+    """Implements start_snapshot, put_snapshot_block and complete_snapshot with the arguments
+    and validation of the boto3 'ebs' client, without any AWS account.
+
+    Blocks are checked against their checksums, and the snapshot against the aggregate
+    checksum, then kept in memory only as checksums, unless image_dir is given: every snapshot
+    is then written there as a raw disk, <snapshot id>.raw, to compare with the source.
+    Snapshots started from a parent begin as a copy of it. latency (seconds) is added to every
+    call to mimic the round trip to the EBS endpoint in benchmarks."""
+
+    def __init__(self, image_dir=None, latency=0.0):
+        self.image_dir = image_dir
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.snapshots = {}
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _get_snapshot(self, snapshot_id, status='pending'):
+        snapshot = self.snapshots.get(snapshot_id)
+        if snapshot is None:
+            raise ValueError('ResourceNotFoundException: snapshot {}'.format(snapshot_id))
+        if snapshot['status'] != status:
+            raise ValueError('ValidationException: snapshot {} is {}'.format(
+                snapshot_id, snapshot['status']))
+        return snapshot
+
+    def get_image_path(self, snapshot_id):
+        """Path of the raw disk a snapshot is written to, None without image_dir."""
+        return os.path.join(self.image_dir, snapshot_id + '.raw') if self.image_dir else None
+
+    def start_snapshot(self, VolumeSize, ParentSnapshotId=None, **_):
+        """StartSnapshot: a new pending snapshot of VolumeSize GiB, optionally starting from a
+        completed parent snapshot that isn't larger."""
+        # pylint: disable=invalid-name
+        self._wait()
+        if ParentSnapshotId is not None:
+            parent = self._get_snapshot(ParentSnapshotId, 'completed')
+            if parent['size'] > VolumeSize * GIB:
+                raise ValueError('ValidationException: volume smaller than the parent snapshot')
+        with self.lock:
+            snapshot_id = 'snap-{:017x}'.format(len(self.snapshots) + 1)
+            self.snapshots[snapshot_id] = {'status': 'pending', 'size': VolumeSize * GIB,
+                                           'checksums': {}}
+        image_path = self.get_image_path(snapshot_id)
+        if image_path:
+            if ParentSnapshotId is not None:
+                shutil.copyfile(self.get_image_path(ParentSnapshotId), image_path)
+            with open(image_path, 'ab') as image_file:
+                image_file.truncate(VolumeSize * GIB)
+        return {'SnapshotId': snapshot_id, 'BlockSize': EBS_BLOCK_SIZE, 'Status': 'pending',
+                'VolumeSize': VolumeSize}
+
+    def put_snapshot_block(self, SnapshotId, BlockIndex, BlockData, DataLength, Checksum,
+                           ChecksumAlgorithm):
+        """PutSnapshotBlock: store a 512 KiB block whose SHA256 checksum matches."""
+        # pylint: disable=invalid-name,too-many-arguments
+        self._wait()
+        snapshot = self._get_snapshot(SnapshotId)
+        if ChecksumAlgorithm != 'SHA256' or DataLength != EBS_BLOCK_SIZE or \
+                len(BlockData) != DataLength:
+            raise ValueError('ValidationException: block {} of {} bytes'.format(
+                BlockIndex, len(BlockData)))
+        if not 0 <= BlockIndex < snapshot['size'] // EBS_BLOCK_SIZE:
+            raise ValueError('ValidationException: block index {} out of range'.format(
+                BlockIndex))
+        if base64.b64encode(hashlib.sha256(BlockData).digest()).decode() != Checksum:
+            raise ValueError('ValidationException: checksum mismatch for block {}'.format(
+                BlockIndex))
+        if self.image_dir:
+            with open(self.get_image_path(SnapshotId), 'r+b') as image_file:
+                image_file.seek(BlockIndex * EBS_BLOCK_SIZE)
+                image_file.write(BlockData)
+        with self.lock:
+            snapshot['checksums'][BlockIndex] = base64.b64decode(Checksum)
+        return {'Checksum': Checksum, 'ChecksumAlgorithm': ChecksumAlgorithm}
+
+    def complete_snapshot(self, SnapshotId, ChangedBlocksCount, Checksum=None,
+                          ChecksumAlgorithm=None, ChecksumAggregationMethod=None):
+        """CompleteSnapshot: check the block count and the linear aggregate checksum."""
+        # pylint: disable=invalid-name,too-many-arguments
+        self._wait()
+        snapshot = self._get_snapshot(SnapshotId)
+        checksums = snapshot['checksums']
+        if ChangedBlocksCount != len(checksums):
+            raise ValueError('ValidationException: {} blocks changed, {} written'.format(
+                ChangedBlocksCount, len(checksums)))
+        if Checksum is not None:
+            aggregate = hashlib.sha256(b''.join(checksums[index] for index in sorted(checksums)))
+            if ChecksumAlgorithm != 'SHA256' or ChecksumAggregationMethod != 'LINEAR' or \
+                    base64.b64encode(aggregate.digest()).decode() != Checksum:
+                raise ValueError('ValidationException: aggregate checksum mismatch')
+        snapshot['status'] = 'completed'
+        return {'Status': 'completed'}
@@ -21,6 +21,7 @@ from botocore.exceptions import ClientError, ParamValidationError
 
 from image.base_image import BaseImage
 from image.aws_disk import AWSDisk
+from image.aws_ebs_snapshot import AWSEbsSnapshot
 from image.aws_snapshot import AWSSnapshot
 from metadata.cloud_metadata import CloudImageMetadata
 from metadata.cloud_tag import CloudImageTags
@@ -37,12 +38,7 @@ class AWSImage(BaseImage):
 
     def __init__(self, working_dir, input_disk_path):
         super().__init__(working_dir, input_disk_path)
-        self.session = Session(
-            aws_access_key_id=get_config_value('AWS_ACCESS_KEY_ID'),
-            aws_secret_access_key=get_config_value('AWS_SECRET_ACCESS_KEY'),
-            aws_session_token=get_config_value('AWS_SESSION_TOKEN'),
-            region_name=get_config_value('AWS_REGION')
-        )
+        self.session = AWSImage.create_session()
 
         self.disk = AWSDisk(input_disk_path, working_dir, self.session)
 
@@ -54,6 +50,38 @@ class AWSImage(BaseImage):
         self.metadata.set(self.__class__.__name__, 'location', self.session.region_name)
         self.snapshot = None
         self.image_id = None
+        # 'import': upload the disk to S3 and import it as a snapshot with import_snapshot().
+        # 'ebs-direct': write the disk straight into a snapshot with the EBS direct APIs.
+        self.snapshot_backend = get_config_value('AWS_SNAPSHOT_BACKEND')
+
+    @staticmethod
+    def create_session():
+        """Create an AWS session from the configured credentials and region"""
+        return Session(
+            aws_access_key_id=get_config_value('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=get_config_value('AWS_SECRET_ACCESS_KEY'),
+            aws_session_token=get_config_value('AWS_SESSION_TOKEN'),
+            region_name=get_config_value('AWS_REGION')
+        )
+
+    @staticmethod
+    def find_tagged_image(key, value):
+        """Id of an available image of this account tagged with key=value, None if there is
+           none."""
+        ec2_client = AWSImage.create_session().client('ec2')
+        try:
+            response = ec2_client.describe_images(
+                Owners=['self'],
+                Filters=[{'Name': 'tag:{}'.format(key), 'Values': [value]},
+                         {'Name': 'state', 'Values': ['available']}])
+        except (ClientError, ParamValidationError) as botocore_exception:
+            LOGGER.exception(botocore_exception)
+            raise RuntimeError('describe_images failed for tag \'{}={}\' !'.format(key, value)) \
+                from botocore_exception
+        LOGGER.trace('describe_images response for tag %s=%s: %s', key, value, response)
+        if not response['Images']:
+            return None
+        return response['Images'][0]['ImageId']
 
     def clean_up(self):
         """Clean-up cloud objects created by this class and its members."""
@@ -234,9 +262,40 @@ class AWSImage(BaseImage):
                 from botocore_exception
         LOGGER.trace('create_tags response for image %s: %s', self.image_id, response)
 
+    def is_ebs_direct(self):
+        """Whether the snapshot is written with the EBS direct APIs. A disk reused from S3
+        can only be imported."""
+        return self.snapshot_backend == 'ebs-direct' and not self.disk.reused_uploaded_disk
+
+    def upload_disk(self):
+        """Upload the disk to S3, recording the upload time and throughput."""
+        if self.is_ebs_direct():
+            LOGGER.info("Skipping the S3 upload, the disk is written to the snapshot directly.")
+            return
+        super().upload_disk()
+        self.metadata.set(self.__class__.__name__, 'upload_time',
+                          str(datetime.timedelta(seconds=round(self.disk.upload_time))))
+        self.metadata.set(self.__class__.__name__, 'upload_throughput',
+                          '{:.1f} MiB/s'.format(self.disk.upload_throughput))
+
     def prep_disk(self):
         """Performs the leg work to convert the S3 Disk represented by self.disk into
         a snapshot from which an AWSImage can be created."""
+        if self.is_ebs_direct():
+            LOGGER.info("Write the disk to a snapshot with the EBS direct APIs.")
+            self.snapshot = AWSEbsSnapshot(self.ec2_client, self.session.client('ebs'),
+                                           self.disk.disk_to_upload)
+            self.snapshot.create_snapshot()
+            self.metadata.set(self.__class__.__name__, 'upload_time',
+                              str(datetime.timedelta(seconds=round(self.snapshot.writer.elapsed))))
+            self.metadata.set(self.__class__.__name__, 'upload_throughput',
+                              '{:.1f} MiB/s'.format(self.snapshot.writer.throughput))
+            if self.snapshot.parent_snapshot_id:
+                self.metadata.set(self.__class__.__name__, 'parent_snapshot',
+                                  self.snapshot.parent_snapshot_id)
+            LOGGER.info("AWS Disk preparation is complete for image creation.")
+            return
+
         LOGGER.info("Prepare the uploaded s3 disk for image generation.")
 
         # Convert the s3Disk into an AWS Snapshot.
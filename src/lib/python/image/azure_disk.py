@@ -18,14 +18,17 @@ import json
 from multiprocessing import Process
 import os
 from time import time, sleep
+from urllib.parse import unquote, urlparse
 
 from azure.common import AzureException, AzureMissingResourceHttpError
+from azure.core.exceptions import AzureError
 
-from azure.storage.blob import BlobClient
+from azure.storage.blob import BlobClient, BlobType
 from image.base_disk import BaseDisk
 from metadata.cloud_metadata import CloudImageMetadata
 from metadata.cloud_tag import CloudImageTags
 from util.config import get_config_value
+from util.io_policy import open_with_io_policy
 from util.logger import LOGGER
 from util.retrier import Retrier
 
@@ -78,15 +81,56 @@ class AzureDisk(BaseDisk):
             byte_total //= (1<<20)
             LOGGER.info('Uploaded %d MB of total %d MB', byte_up, byte_total)
 
+    def record_uploaded_disk_url(self):
+        """ Record the url of the uploaded disk in vhd_url.json and in the metadata """
+        self.uploaded_disk_url = self.blob.url
+        # save uploaded disk in artifacts dir json file
+        vhd_url_json = {"vhd_url": self.uploaded_disk_url}
+        artifacts_dir = get_config_value("ARTIFACTS_DIR")
+        with open(artifacts_dir + "/vhd_url.json", "w") as vhd_url_json_file:
+            json.dump(vhd_url_json, vhd_url_json_file)
+
+        # insert file with vhd url
+        self.metadata.set(self.__class__.__name__, 'vhd_url', self.uploaded_disk_url)
+        self.metadata.set(self.__class__.__name__, 'image_id', self.uploaded_disk_name)
+        LOGGER.info('Uploaded disk url is: %s', self.uploaded_disk_url)
+
+    def reuse_uploaded_disk(self, disk_name):
+        """ Use disk_name, the url of a page blob uploaded earlier (or its name in
+            AZURE_STORAGE_CONTAINER_NAME), after checking its size and metadata """
+        container_name = self.container_name
+        blob_name = disk_name
+        if '://' in disk_name:
+            container_name, _, blob_name = unquote(urlparse(disk_name).path).lstrip('/') \
+                .partition('/')
+        try:
+            self.blob = BlobClient.from_connection_string(
+                conn_str=self.connection_string,
+                container_name=container_name,
+                blob_name=blob_name
+                )
+            properties = self.blob.get_blob_properties()
+        except (AzureError, AzureException) as exc:
+            LOGGER.exception(exc)
+            raise RuntimeError("Uploaded disk '{}' wasn't found.".format(disk_name)) from exc
+        if properties.blob_type != BlobType.PAGEBLOB:
+            raise RuntimeError("Uploaded disk '{}' is a {}, not a page blob.".format(
+                disk_name, properties.blob_type))
+        self.check_uploaded_disk(disk_name, properties.size, properties.metadata)
+        self.uploaded_disk_name = blob_name
+        self.reused_uploaded_disk = True
+        self.record_uploaded_disk_url()
+
     def upload(self):
         """ Upload a F5 BIG-IP VE image to provided container """
 
         def upload_azure():
-            with open(self.disk_to_upload,'rb') as vhd_file:
+            with open_with_io_policy(self.disk_to_upload, 'upload') as vhd_file:
                 self.blob.upload_blob(
                     vhd_file,
+                    length=os.path.getsize(self.disk_to_upload),
                     blob_type="PageBlob",
-                    metadata=self._get_tags()
+                    metadata={**self._get_tags(), **self.get_upload_metadata()}
                     )
 
         def _upload_impl():
@@ -136,17 +180,7 @@ class AzureDisk(BaseDisk):
                 LOGGER.error("Timeout while uploading")
                 return False
 
-            self.uploaded_disk_url = self.blob.url
-            # save uploaded disk in artifacts dir json file
-            vhd_url_json = {"vhd_url": self.uploaded_disk_url}
-            artifacts_dir = get_config_value("ARTIFACTS_DIR")
-            with open(artifacts_dir + "/vhd_url.json", "w") as vhd_url_json_file:
-                json.dump(vhd_url_json, vhd_url_json_file)
-
-            # insert file with vhd url
-            self.metadata.set(self.__class__.__name__, 'vhd_url', self.uploaded_disk_url)
-            self.metadata.set(self.__class__.__name__, 'image_id', self.uploaded_disk_name)
-            LOGGER.info('Uploaded disk url is: %s', self.uploaded_disk_url)
+            self.record_uploaded_disk_url()
             return True
 
         retrier = Retrier(_upload_impl)
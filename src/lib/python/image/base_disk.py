@@ -16,12 +16,24 @@
 
 
 import datetime
+import lzma
 import os
+import subprocess
 import tarfile
 import zipfile
 from pathlib import Path
 
+from util.config import get_config_value
+from util.fingerprint import get_fingerprint
+from util.io_policy import copy_stream, open_with_io_policy
 from util.logger import LOGGER
+from util.reproducible import get_source_date_epoch
+
+# User metadata recorded on uploaded disk objects: the fingerprint of the bundle the disk comes
+# from and the size of the disk, to check that an object can be reused to create an image of the
+# same bundle, and that it was completely uploaded.
+BUNDLE_FINGERPRINT_KEY = 'f5_bundle_fingerprint'
+DISK_SIZE_KEY = 'f5_disk_size'
 
 
 class BaseDisk:
@@ -49,6 +61,9 @@ class BaseDisk:
         LOGGER.debug("BaseDisk.input_disk_path is '%s'.", self.input_disk_path)
         self.disk_to_upload = None
         self.uploaded_disk_name = None
+        # Disk objects uploaded earlier are reused as they are, and never deleted on clean-up.
+        self.reused_uploaded_disk = False
+        self.keep_uploaded_disk = bool(get_config_value('KEEP_UPLOADED_DISK'))
 
     def clean_up(self):
         """
@@ -69,6 +84,73 @@ class BaseDisk:
     def set_uploaded_disk_name(self, disk_name):
         """Set the uploaded disk name"""
 
+    def is_uploaded_disk_kept(self):
+        """Whether clean-up must leave the uploaded disk object in the cloud storage"""
+        if self.uploaded_disk_name is not None and \
+                (self.reused_uploaded_disk or self.keep_uploaded_disk):
+            LOGGER.info("Keeping the uploaded disk '%s', which can be reused to create images "
+                        "with UPLOADED_DISK.", self.uploaded_disk_name)
+            return True
+        return False
+
+    def get_upload_metadata(self):
+        """User metadata to record on the uploaded disk object"""
+        return {BUNDLE_FINGERPRINT_KEY: get_fingerprint(self.input_disk_path) or '',
+                DISK_SIZE_KEY: str(os.path.getsize(self.disk_to_upload))}
+
+    def check_uploaded_disk(self, disk_name, size, metadata):
+        """Check that an uploaded disk object, of the given size and user metadata, holds the
+        complete disk of the input bundle, raising RuntimeError if it doesn't."""
+        metadata = {key.lower(): value for key, value in (metadata or {}).items()}
+        if BUNDLE_FINGERPRINT_KEY not in metadata or DISK_SIZE_KEY not in metadata:
+            raise RuntimeError("Uploaded disk '{}' has no {} and {} metadata to check it against "
+                               "'{}'.".format(disk_name, BUNDLE_FINGERPRINT_KEY, DISK_SIZE_KEY,
+                                             self.input_disk_path))
+        if metadata[BUNDLE_FINGERPRINT_KEY] != get_fingerprint(self.input_disk_path):
+            raise RuntimeError("Uploaded disk '{}' doesn't come from '{}'.".format(
+                disk_name, self.input_disk_path))
+        if str(size) != metadata[DISK_SIZE_KEY]:
+            raise RuntimeError("Uploaded disk '{}' is {} bytes long instead of {}.".format(
+                disk_name, size, metadata[DISK_SIZE_KEY]))
+        LOGGER.info("Uploaded disk '%s' holds the %s bytes disk of '%s'.", disk_name, size,
+                    self.input_disk_path)
+
+    def reuse_uploaded_disk(self, disk_name):
+        """Use disk_name, a disk object uploaded earlier from the same bundle, instead of
+        uploading the disk. Real work to be done by the derived class implementations"""
+        raise NotImplementedError("reuse_uploaded_disk() unimplemented.")
+
+    @staticmethod
+    def _extract_member(member_file, member_name, output_dir):
+        """Stream an archive member to output_dir with the 'extract' I/O policy. Zero chunks
+        are not written, so the extracted disk stays sparse."""
+        out_file = os.path.join(output_dir, os.path.normpath(member_name).lstrip(os.sep))
+        if not os.path.abspath(out_file).startswith(os.path.abspath(output_dir) + os.sep):
+            raise RuntimeError("Archive member {} is outside of {}".format(member_name,
+                                                                          output_dir))
+        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        with open_with_io_policy(out_file, 'extract', 'wb') as output_file:
+            copy_stream(member_file, output_file)
+        return out_file
+
+    @staticmethod
+    def _extract_compressed(input_disk, member_name, output_dir):
+        """Decompress an xz or zstd compressed disk to member_name in output_dir. zstd disks
+        are read through the zstd tool, which decodes them on several threads."""
+        if input_disk.endswith(".xz"):
+            with open_with_io_policy(input_disk, 'extract') as input_file, \
+                    lzma.open(input_file) as member_file:
+                return BaseDisk._extract_member(member_file, member_name, output_dir)
+
+        with subprocess.Popen(["zstd", "-d", "-c", "-q", "--long=31", input_disk],
+                              stdout=subprocess.PIPE) as zstd:
+            out_file = BaseDisk._extract_member(zstd.stdout, member_name, output_dir)
+            zstd.stdout.close()
+        if zstd.returncode != 0:
+            raise RuntimeError("zstd failed to decompress {} with exit code {}"
+                               .format(input_disk, zstd.returncode))
+        return out_file
+
     @staticmethod
     def decompress(input_disk, output_file_ext, output_dir):
         """Extracts the file with output_file_ext from the given input disk and
@@ -78,24 +160,32 @@ class BaseDisk:
         out_file = None
         try:
             if str.endswith(input_disk, (".tar.gz", ".tgz")):
-                with tarfile.open(input_disk, "r:gz") as tar_file:
-                    for file_name in tar_file.getnames():
-                        if file_name.endswith(output_file_ext):
-                            tar_file.extract(member=file_name, path=output_dir)
-                            out_file = os.path.join(output_dir, file_name)
+                with open_with_io_policy(input_disk, 'extract') as input_file, \
+                        tarfile.open(fileobj=input_file, mode="r|gz") as tar_file:
+                    for member in tar_file:
+                        if member.isfile() and member.name.endswith(output_file_ext):
+                            out_file = BaseDisk._extract_member(
+                                tar_file.extractfile(member), member.name, output_dir)
                             break
             elif str.endswith(input_disk, ".zip"):
+                # Zip archives need random access to the central directory.
                 with zipfile.ZipFile(input_disk, "r") as zip_file:
                     for file_name in zip_file.namelist():
                         if file_name.endswith(output_file_ext):
-                            zip_file.extract(member=file_name, path=output_dir)
-                            out_file = os.path.join(output_dir, file_name)
+                            with zip_file.open(file_name) as member_file:
+                                out_file = BaseDisk._extract_member(member_file, file_name,
+                                                                    output_dir)
                             break
+            elif str.endswith(input_disk, (".xz", ".zst")):
+                # Compressed disks hold a single file named after the disk itself.
+                member_name = os.path.basename(os.path.splitext(input_disk)[0])
+                if member_name.endswith(output_file_ext):
+                    out_file = BaseDisk._extract_compressed(input_disk, member_name, output_dir)
             else:
                 input_file_ext = "".join(Path(input_disk).suffixes)
                 raise NotImplementedError("Extension {} is not supported.  Unable to extract "
                                           "compressed disk {}!".format(input_file_ext, input_disk))
-        except (tarfile.ReadError, zipfile.BadZipFile) as read_error:
+        except (tarfile.ReadError, zipfile.BadZipFile, lzma.LZMAError) as read_error:
             LOGGER.exception(read_error)
             raise RuntimeError("Failed to read {} file".format(input_disk)) from read_error
         except RuntimeError as runtime_error:
@@ -112,9 +202,13 @@ class BaseDisk:
     @staticmethod
     def decorate_disk_name(disk_path):
         """Appends the timestamp as a prefix to the given disk_path to generate
-        a unique disk-name."""
+        a unique disk-name. Reproducible builds use SOURCE_DATE_EPOCH, so that a rebuild gets
+        the name of the disk it would upload again."""
         if disk_path:
-            result = datetime.datetime.now().strftime('%Y%m%d--%H%M%S')
+            epoch = get_source_date_epoch()
+            moment = datetime.datetime.now() if epoch is None else \
+                datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc)
+            result = moment.strftime('%Y%m%d--%H%M%S')
             result += "--" + os.path.basename(disk_path)
         else:
             raise RuntimeError("decorate_disk_name() received an empty disk_path argument.")
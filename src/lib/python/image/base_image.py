@@ -49,6 +49,10 @@ class BaseImage():
         """Upload the disk to cloud"""
         self.disk.upload()
 
+    def reuse_uploaded_disk(self, uploaded_disk_name):
+        """Use a disk uploaded to the cloud earlier instead of uploading the disk"""
+        self.disk.reuse_uploaded_disk(uploaded_disk_name)
+
     def prep_disk(self):
         """Perform any processing needed for disk"""
 
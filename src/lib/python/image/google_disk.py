@@ -41,6 +41,8 @@ class GoogleDisk(BaseDisk):
     def clean_up(self):
         """Clean-up the uploaded disk after image generation."""
         # Delete the uploaded disk as it no longer needs to be retained.
+        if self.is_uploaded_disk_kept():
+            return
         try:
             if self.bucket and self.uploaded_disk_name:
                 self.delete_blob()
@@ -166,6 +168,8 @@ class GoogleDisk(BaseDisk):
                 raise RuntimeError("Factory constructor for blob '{}' failed."
                                    .format(self.uploaded_disk_name))
 
+            blob.metadata = self.get_upload_metadata()
+
             # upload blob
             LOGGER.info("Started to upload '%s' at '%s'.", self.uploaded_disk_name,
                         datetime.datetime.now().strftime('%H:%M:%S'))
@@ -177,3 +181,21 @@ class GoogleDisk(BaseDisk):
         except RuntimeError as exception:
             LOGGER.exception(exception)
             raise exception
+
+    def reuse_uploaded_disk(self, disk_name):
+        """
+        Use disk_name, a blob uploaded earlier to GCE_BUCKET, after checking its size and
+        metadata.
+        """
+        # Populate the bucket if not already.
+        if self.bucket is None:
+            self.init_bucket()
+
+        blob = self.get_blob(disk_name)
+        if blob is None:
+            raise RuntimeError("Uploaded disk '{}' wasn't found in the bucket '{}'."
+                               .format(disk_name, self.bucket.name))
+        self.check_uploaded_disk(disk_name, blob.size, blob.metadata)
+        self.uploaded_disk_name = disk_name
+        self.reused_uploaded_disk = True
+        LOGGER.info("Reusing blob '%s'.", disk_name)
@@ -54,6 +54,28 @@ class GoogleImage(BaseImage):
         self.gce_credentials = service_account.Credentials.from_service_account_info(creds_dict)
         self.gce_service = discovery.build('compute', 'v1', credentials=self.gce_credentials)
 
+    @staticmethod
+    def find_tagged_image(key, value):
+        """Name of a ready image of the project labeled with key=value, None if there is
+           none."""
+        creds_dict = get_dict_from_config_json("GOOGLE_APPLICATION_CREDENTIALS")
+        gce_project_id = ensure_value_from_dict(creds_dict, "project_id")
+        gce_credentials = service_account.Credentials.from_service_account_info(creds_dict)
+        gce_service = discovery.build('compute', 'v1', credentials=gce_credentials)
+        try:
+            # pylint: disable=no-member
+            request = gce_service.images().list(
+                project=gce_project_id,
+                filter='(labels.{}={}) AND (status=READY)'.format(key, value))
+            result = request.execute()
+        except HttpError as exp:
+            LOGGER.exception(exp)
+            raise RuntimeError('Listing images labeled {}={} failed'.format(key, value)) from exp
+        images = result.get('items', [])
+        if not images:
+            return None
+        return images[0]['name']
+
     def clean_up(self):
         """Clean-up cloud objects created by this class and its members."""
         LOGGER.info("Cleaning-up GoogleImage artifacts.")
@@ -113,6 +113,26 @@ class ImageController(): # pylint: disable=too-many-instance-attributes
         raise ValueError('Unexpected cloud type: {}'.format(cloud_type))
         # pylint: enable=import-outside-toplevel
 
+    @staticmethod
+    def find_tagged_image(cloud_type, key, value):
+        """Identifier of an existing cloud image tagged with key=value, None if there is none"""
+        # pylint: disable=import-outside-toplevel
+        if cloud_type == 'alibaba':
+            from image.alibaba_image import AlibabaImage
+            return AlibabaImage.find_tagged_image(key, value)
+        if cloud_type == 'aws':
+            from image.aws_image import AWSImage
+            return AWSImage.find_tagged_image(key, value)
+        if cloud_type == 'azure':
+            # Azure images aren't tagged, see AzureImage.create_image().
+            LOGGER.info('Looking up Azure images by tag is not supported.')
+            return None
+        if cloud_type == 'gce':
+            from image.google_image import GoogleImage
+            return GoogleImage.find_tagged_image(key, value)
+        raise ValueError('Unexpected cloud type: {}'.format(cloud_type))
+        # pylint: enable=import-outside-toplevel
+
     @staticmethod
     def check_valid_name(cloud_type, user_image_name):
         """Check if user-supplied image name is valid"""
@@ -147,8 +167,9 @@ class ImageController(): # pylint: disable=too-many-instance-attributes
         # License model is currently hardwired
         self.metadata.set(self.__class__.__name__, 'license_model', 'byol')
 
-    def prepare(self, seed_image_name='', user_image_name=''):
-        """Main controller"""
+    def prepare(self, seed_image_name='', user_image_name='', uploaded_disk_name=''):
+        """Main controller. With uploaded_disk_name, the disk uploaded to the cloud earlier
+        under that name is checked against the input disk and used instead of uploading it."""
         try:
             self.set_image_name(seed_image_name, user_image_name)
             LOGGER.info("Starting prepare cloud image '%s'.", self.image_name)
@@ -157,8 +178,11 @@ class ImageController(): # pylint: disable=too-many-instance-attributes
             pipeline_build = os.getenv('CI') is not None
             self.initialize_image_metadata(self.artifacts_dir, pipeline_build)
 
-            self.cloud_image.extract_disk()
-            self.cloud_image.upload_disk()
+            if uploaded_disk_name:
+                self.cloud_image.reuse_uploaded_disk(uploaded_disk_name)
+            else:
+                self.cloud_image.extract_disk()
+                self.cloud_image.upload_disk()
             self.cloud_image.prep_disk()
 
             self.metadata.set(self.__class__.__name__, 'build_operation', 'create')
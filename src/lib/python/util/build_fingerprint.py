@@ -0,0 +1,126 @@
+"""Build fingerprints: identify what a build produces from its inputs and the generator version"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import hashlib
+import json
+import os
+
+from util.config import get_config_value, get_list_from_config_yaml
+from util.fingerprint import get_fingerprint
+from util.logger import LOGGER
+
+# 32 hex digits, which fit in GCE label values along with the other cloud image tags.
+DIGEST_SIZE = 16
+PERSON = b'f5-build'
+# Each published bundle has a <bundle>.build.json record of the build that produced it:
+# {
+#   "build_fingerprint": "9f3ad3b0c5a2e16e0f1d2c3b4a5968ff",
+#   "bundle_fingerprint": "0b6562f0612e942cf046fc21762769d9221a362dd66cebf52e4b9f39e50639e7",
+#   "inputs": {...}
+# }
+BUILD_SUFFIX = '.build.json'
+# Configuration, besides the ISOs and the platform, modules and boot locations, that changes
+# the bundles or the cloud images of a build.
+BUILD_CONFIG_KEYS = ['ADD_OVA_EULA', 'BUNDLE_COMPRESSION', 'CLOUD_IMAGE_NAME', 'CONSOLE_DEVICES',
+                     'DISABLE_SPLASH', 'HYPERVISOR_IMAGE_NAME', 'IMAGE_SIG_ENCRYPTION_TYPE',
+                     'IMAGE_SIG_PRIVATE_KEY', 'IMAGE_TAGS', 'IMAGE_TAGS_EXCLUDE', 'OVA_BUILDER',
+                     'OVA_PROP_NET_USER', 'OVA_VARIANTS', 'QCOW2_CLUSTER_SIZE', 'QCOW2_COMPAT',
+                     'QCOW2_COMPRESS', 'SOURCE_DATE_EPOCH', 'UPDATE_IMAGE_FILES',
+                     'UPDATE_ISO_RPMS', 'UPDATE_LV_SIZES']
+
+
+def _get_source_fingerprints(source):
+    """Fingerprints of a local file, or of the files of a local directory, by path."""
+    if os.path.isfile(source):
+        return {source: get_fingerprint(source)}
+    fingerprints = {}
+    if os.path.isdir(source):
+        for directory, subdirectories, files in os.walk(source):
+            subdirectories.sort()
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path):
+                    fingerprints[path] = get_fingerprint(path)
+    return fingerprints
+
+
+def get_build_inputs(platform, modules, boot_locations, iso, ehf_iso=''):
+    """Everything that determines the output of a build. Files are represented by their
+    fingerprints, URLs by themselves, as their content can't be checked without downloading.
+    iso is the original ISO: the files UPDATE_ISO_RPMS updates it with are fingerprinted here,
+    since the updated ISO doesn't exist yet."""
+    config = {key: get_config_value(key) or '' for key in BUILD_CONFIG_KEYS}
+    files = {}
+    for key in ('ADD_OVA_EULA', 'IMAGE_SIG_PRIVATE_KEY'):
+        if config[key]:
+            files.update(_get_source_fingerprints(config[key]))
+    # These lists may be given as YAML files, whose content matters rather than their path.
+    for key in ('UPDATE_IMAGE_FILES', 'UPDATE_ISO_RPMS'):
+        config[key] = get_list_from_config_yaml(key)
+        for update in config[key]:
+            files.update(_get_source_fingerprints(str(update.get('source', ''))))
+
+    return {
+        'version': get_config_value('VERSION_NUMBER'),
+        'platform': platform,
+        'modules': modules,
+        'boot_locations': boot_locations,
+        'iso': get_fingerprint(iso),
+        'ehf_iso': get_fingerprint(ehf_iso) if ehf_iso else '',
+        'config': config,
+        'files': files
+    }
+
+
+def compute_build_fingerprint(inputs):
+    """BLAKE2b hash of the build inputs."""
+    build_hash = hashlib.blake2b(digest_size=DIGEST_SIZE, person=PERSON)
+    build_hash.update(json.dumps(inputs, sort_keys=True).encode())
+    return build_hash.hexdigest()
+
+
+def write_build_record(bundle_path, build_fingerprint, inputs):
+    """Record next to a bundle the fingerprint of the build that produced it."""
+    record = {
+        'build_fingerprint': build_fingerprint,
+        'bundle_fingerprint': get_fingerprint(bundle_path),
+        'inputs': inputs
+    }
+    with open(bundle_path + BUILD_SUFFIX, 'w') as record_file:
+        json.dump(record, record_file, indent=4, sort_keys=True)
+    return record
+
+
+def is_built_bundle(bundle_path, build_fingerprint):
+    """Whether the bundle at bundle_path was produced by a build with this fingerprint, and
+    hasn't changed since."""
+    try:
+        with open(bundle_path + BUILD_SUFFIX) as record_file:
+            record = json.load(record_file)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError) as exc:
+        LOGGER.warning('Ignoring the build record of %s: %s', bundle_path, exc)
+        return False
+    if record.get('build_fingerprint') != build_fingerprint:
+        LOGGER.info('%s was built from different inputs.', bundle_path)
+        return False
+    if not os.path.isfile(bundle_path) or \
+            record.get('bundle_fingerprint') != get_fingerprint(bundle_path):
+        LOGGER.warning('%s changed since it was built.', bundle_path)
+        return False
+    return True
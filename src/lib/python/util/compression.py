@@ -0,0 +1,375 @@
+"""Parallel deflate compression producing standard gzip and zip files"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from util.config import get_config_value
+from util.digests import DigestingWriter
+from util.io_policy import IO_CHUNK_SIZE, copy_stream, open_with_io_policy
+from util.logger import LOGGER
+from util.reproducible import get_file_mtime, get_source_date_epoch, get_timestamp
+
+# Blocks are deflated independently. Each one is primed with the last 32 KiB (the deflate
+# window) of the previous block, so the ratio is within a fraction of a percent of gzip's.
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+DICTIONARY_SIZE = 32 * 1024
+DEFAULT_LEVEL = 6
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_FLAG_NAME = 0x08
+GZIP_OS_UNIX = 3
+
+ZIP_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_END_LOCATOR = struct.Struct('<IIQI')
+ZIP_END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_EXTRA_ID = 0x0001
+ZIP_DEFLATED = 8
+# The CRC and sizes follow the data in a data descriptor, so archives are written in one pass.
+ZIP_FLAG_DATA_DESCRIPTOR = 0x08
+ZIP_DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+# Version 2.0 supports deflate, 4.5 is required for ZIP64.
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+ZIP_MADE_BY_UNIX = 3 << 8
+ZIP_MAX_32 = 0xFFFFFFFF
+ZIP_MAX_ENTRIES = 0xFFFF
+
+
+def get_compression_threads():
+    """Number of compression threads: COMPRESSION_THREADS, or all CPUs."""
+    threads = get_config_value('COMPRESSION_THREADS')
+    return int(threads) if threads else os.cpu_count() or 1
+
+
+def _deflate_block(data, dictionary, level, last):
+    """Raw deflate data of one block. Blocks but the last end on a byte boundary (sync flush)
+    without the final bit, so that the compressed blocks can be concatenated."""
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last
+                                                        else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelDeflate():
+    """Raw deflate stream of the data written to it, compressed in blocks on a thread pool
+    like pigz does, and written in order to output.
+
+    The CRC-32 and size of the uncompressed data are available once closed, for the gzip or
+    zip container around the stream."""
+
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, output, level=DEFAULT_LEVEL, threads=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.output = output
+        self.level = level
+        self.threads = threads or get_compression_threads()
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(self.threads) if self.threads > 1 else None
+        # Compressed blocks waiting to be written in order, bounded to limit memory use.
+        self.queued_blocks = deque()
+        self.max_queued_blocks = 2 * self.threads
+        self.pending = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.closed = False
+
+    def _submit(self, data, last):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.executor is None:
+            self._write_output(_deflate_block(data, self.dictionary, self.level, last))
+        else:
+            if len(self.queued_blocks) >= self.max_queued_blocks:
+                self._write_output(self.queued_blocks.popleft().result())
+            self.queued_blocks.append(self.executor.submit(_deflate_block, data,
+                                                           self.dictionary, self.level, last))
+        self.dictionary = data[-DICTIONARY_SIZE:]
+
+    def _write_output(self, compressed):
+        self.output.write(compressed)
+        self.compressed_size += len(compressed)
+
+    def write(self, data):
+        """Compress data, which follows the data written so far."""
+        self.pending += data
+        if len(self.pending) > self.block_size:
+            view = memoryview(self.pending)
+            # Keep the last block pending: it could be the last one.
+            blocks_end = (len(self.pending) - 1) // self.block_size * self.block_size
+            for offset in range(0, blocks_end, self.block_size):
+                self._submit(bytes(view[offset:offset + self.block_size]), False)
+            view.release()
+            del self.pending[:blocks_end]
+        return len(data)
+
+    def close(self):
+        """Compress the pending data as final block and write all compressed blocks."""
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(bytes(self.pending), True)
+            self.pending = bytearray()
+            while self.queued_blocks:
+                self._write_output(self.queued_blocks.popleft().result())
+        finally:
+            self.abort()
+
+    def abort(self):
+        """Stop the compression threads, dropping the blocks that were not written."""
+        self.closed = True
+        for future in self.queued_blocks:
+            future.cancel()
+        self.queued_blocks.clear()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def _gzip_header(name, mtime, level):
+    flags = GZIP_FLAG_NAME if name else 0
+    # Extra flags: 2 for the slowest compression, 4 for the fastest, as gzip sets them.
+    extra_flags = 2 if level == 9 else 4 if level == 1 else 0
+    header = GZIP_MAGIC + struct.pack('<BBIBB', zlib.DEFLATED, flags, mtime & 0xFFFFFFFF,
+                                      extra_flags, GZIP_OS_UNIX)
+    if name:
+        header += os.path.basename(name).encode('latin-1', 'replace') + b'\0'
+    return header
+
+
+class GzipWriter():
+    """Single gzip member of the data written to it, deflated on a thread pool. output_file
+    doesn't have to be seekable."""
+
+    def __init__(self, output_file, name=None, mtime=None, level=DEFAULT_LEVEL, threads=None):
+        self.output_file = output_file
+        header = _gzip_header(name, get_timestamp() if mtime is None else mtime, level)
+        output_file.write(header)
+        self.deflate = ParallelDeflate(output_file, level, threads)
+        self.compressed_size = len(header)
+
+    @property
+    def size(self):
+        """Number of bytes written so far."""
+        return self.deflate.size + len(self.deflate.pending)
+
+    def write(self, data):
+        """Compress data, which follows the data written so far."""
+        return self.deflate.write(data)
+
+    def close(self):
+        """Write the remaining compressed data and the gzip trailer."""
+        if self.deflate.closed:
+            return
+        self.deflate.close()
+        self.output_file.write(struct.pack('<II', self.deflate.crc,
+                                           self.deflate.size & 0xFFFFFFFF))
+        self.compressed_size += self.deflate.compressed_size + 8
+
+    def abort(self):
+        """Stop the compression threads. The gzip member is left incomplete."""
+        self.deflate.abort()
+
+
+def gzip_stream(input_file, output_file, name=None, mtime=None, level=DEFAULT_LEVEL,
+                threads=None):
+    """Compress everything read from input_file into a single gzip member written to
+    output_file, which doesn't have to be seekable. Returns (input size, output size)."""
+    writer = GzipWriter(output_file, name, mtime, level, threads)
+    try:
+        copy_stream(input_file, writer, IO_CHUNK_SIZE)
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.size, writer.compressed_size
+
+
+def gzip_file(input_path, output_path, level=DEFAULT_LEVEL, threads=None):
+    """Compress the file at input_path into the gzip file output_path, recording its name and
+    modification time like gzip does. input_path '-' reads stdin, output_path '-' writes to
+    stdout."""
+    start_time = time.monotonic()
+    if input_path == '-':
+        input_file = open(0, 'rb', closefd=False)
+        # Like gzip, no name nor time for data read from stdin.
+        name, mtime = None, 0
+    else:
+        input_file = open_with_io_policy(input_path, 'compress')
+        name, mtime = input_path, get_file_mtime(os.stat(input_path))
+    try:
+        output_file = open(1, 'wb', closefd=False) if output_path == '-' \
+            else open(output_path, 'wb')
+        try:
+            size, compressed_size = gzip_stream(input_file, output_file, name, mtime, level,
+                                                threads)
+        finally:
+            output_file.close()
+    finally:
+        input_file.close()
+    LOGGER.info('Compressed %d bytes into %d bytes of %s in %.1fs.', size, compressed_size,
+                output_path, time.monotonic() - start_time)
+
+
+def _dos_date_time(timestamp):
+    # Local time like zip, but UTC in reproducible builds, which must not depend on the host.
+    moment = time.localtime(timestamp) if get_source_date_epoch() is None \
+        else time.gmtime(timestamp)
+    return ((max(moment.tm_year, 1980) - 1980) << 9 | moment.tm_mon << 5 | moment.tm_mday,
+            moment.tm_hour << 11 | moment.tm_min << 5 | moment.tm_sec // 2)
+
+
+def _zip_flags(level):
+    # Bits 1 and 2 of the general purpose flags record the deflate level.
+    if level >= 8:
+        return 0x2
+    if level == 2:
+        return 0x4
+    if level == 1:
+        return 0x6
+    return 0
+
+
+class ZipEntry():
+    """Metadata of one deflated member of a zip archive."""
+
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    def __init__(self, name, mtime, level, header_offset):
+        self.name = name.encode()
+        self.date, self.time = _dos_date_time(mtime)
+        self.flags = _zip_flags(level) | ZIP_FLAG_DATA_DESCRIPTOR
+        self.header_offset = header_offset
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.zip64 = False
+
+    def local_header(self):
+        """Local file header, written before the data: the CRC and sizes are in the data
+        descriptor. ZIP64 entries have a ZIP64 extra field."""
+        extra = b''
+        sizes = (self.compressed_size, self.size)
+        if self.zip64:
+            extra = struct.pack('<HHQQ', ZIP64_EXTRA_ID, 16, self.size, self.compressed_size)
+            sizes = (ZIP_MAX_32, ZIP_MAX_32)
+        return ZIP_LOCAL_HEADER.pack(
+            0x04034b50, ZIP64_VERSION if self.zip64 else ZIP_VERSION, self.flags, ZIP_DEFLATED,
+            self.time, self.date, self.crc, sizes[0], sizes[1], len(self.name),
+            len(extra)) + self.name + extra
+
+    def data_descriptor(self):
+        """Data descriptor following the data, with 64-bit sizes for ZIP64 entries."""
+        if self.zip64:
+            return struct.pack('<IIQQ', ZIP_DATA_DESCRIPTOR_SIGNATURE, self.crc,
+                               self.compressed_size, self.size)
+        return struct.pack('<IIII', ZIP_DATA_DESCRIPTOR_SIGNATURE, self.crc,
+                           self.compressed_size, self.size)
+
+    def central_header(self):
+        """Central directory header, with a ZIP64 extra field for the values too large for
+        their 32-bit fields."""
+        extra_values = []
+        fields = []
+        for value in (self.size, self.compressed_size, self.header_offset):
+            if value >= ZIP_MAX_32:
+                extra_values.append(value)
+                fields.append(ZIP_MAX_32)
+            else:
+                fields.append(value)
+        extra = b''
+        if extra_values:
+            extra = struct.pack('<HH{}Q'.format(len(extra_values)), ZIP64_EXTRA_ID,
+                                8 * len(extra_values), *extra_values)
+        version = ZIP64_VERSION if extra_values else ZIP_VERSION
+        return ZIP_CENTRAL_HEADER.pack(
+            0x02014b50, ZIP_MADE_BY_UNIX | version, version, self.flags, ZIP_DEFLATED,
+            self.time, self.date, self.crc, fields[1], fields[0], len(self.name), len(extra),
+            0, 0, 0, 0o100644 << 16, fields[2]) + self.name + extra
+
+
+def _write_zip_end(zip_file, entries, directory_offset, directory_size):
+    """Write the end of central directory record, preceded by the ZIP64 ones if needed."""
+    if len(entries) >= ZIP_MAX_ENTRIES or directory_offset >= ZIP_MAX_32 or \
+            directory_size >= ZIP_MAX_32:
+        zip64_end_offset = directory_offset + directory_size
+        zip_file.write(ZIP64_END_RECORD.pack(
+            0x06064b50, ZIP64_END_RECORD.size - 12, ZIP_MADE_BY_UNIX | ZIP64_VERSION,
+            ZIP64_VERSION, 0, 0, len(entries), len(entries), directory_size, directory_offset))
+        zip_file.write(ZIP64_END_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1))
+    zip_file.write(ZIP_END_RECORD.pack(
+        0x06054b50, 0, 0, min(len(entries), ZIP_MAX_ENTRIES), min(len(entries), ZIP_MAX_ENTRIES),
+        min(directory_size, ZIP_MAX_32), min(directory_offset, ZIP_MAX_32), 0))
+
+
+def zip_files(zip_path, input_paths, level=DEFAULT_LEVEL, threads=None):
+    """Create the zip archive zip_path holding the deflated files input_paths under their base
+    names, like zip -j. Files of 4 GiB or more get ZIP64 entries.
+
+    The archive is written sequentially, its digests are recorded next to it."""
+    start_time = time.monotonic()
+    entries = []
+    with open(zip_path, 'wb') as output_file:
+        zip_file = DigestingWriter(output_file, zip_path)
+        try:
+            for input_path in input_paths:
+                stat = os.stat(input_path)
+                entry = ZipEntry(os.path.basename(input_path), get_file_mtime(stat), level,
+                                 zip_file.tell())
+                # Incompressible data grows a little, the deflate output of a file just below
+                # 4 GiB could need ZIP64 too.
+                entry.zip64 = stat.st_size >= ZIP_MAX_32 - (ZIP_MAX_32 >> 8)
+                zip_file.write(entry.local_header())
+                deflate = ParallelDeflate(zip_file, level, threads)
+                try:
+                    with open_with_io_policy(input_path, 'compress') as input_file:
+                        copy_stream(input_file, deflate, IO_CHUNK_SIZE)
+                    deflate.close()
+                except BaseException:
+                    deflate.abort()
+                    raise
+                entry.crc, entry.size = deflate.crc, deflate.size
+                entry.compressed_size = deflate.compressed_size
+                if not entry.zip64 and max(entry.size, entry.compressed_size) >= ZIP_MAX_32:
+                    raise RuntimeError('{} grew to 4 GiB while being compressed'.format(
+                        input_path))
+                zip_file.write(entry.data_descriptor())
+                zip_file.add_member(os.path.basename(input_path), entry.size)
+                entries.append(entry)
+                LOGGER.info('Deflated %s: %d bytes into %d bytes.', input_path, entry.size,
+                            entry.compressed_size)
+
+            directory_offset = zip_file.tell()
+            for entry in entries:
+                zip_file.write(entry.central_header())
+            _write_zip_end(zip_file, entries, directory_offset,
+                           zip_file.tell() - directory_offset)
+        except BaseException:
+            output_file.close()
+            os.unlink(zip_path)
+            raise
+    zip_file.write_digests()
+    LOGGER.info('Created %s in %.1fs.', zip_path, time.monotonic() - start_time)
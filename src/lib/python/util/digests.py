@@ -0,0 +1,162 @@
+"""Digests of bundles computed while they are written, recorded next to them"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import hashlib
+import json
+import os
+
+from util.config import get_config_value
+from util.fingerprint import TreeHasher, store_fingerprint
+from util.io_policy import (
+    IO_CHUNK_SIZE, POLICY_DEFAULT, copy_stream, drop_cached_range, get_io_policy
+)
+from util.logger import LOGGER
+from util.manifest import write_manifest
+
+# Digests of a bundle are recorded in <bundle>.digests.json. They are only valid while the size
+# and modification time of the bundle match the recorded ones.
+DIGESTS_SUFFIX = '.digests.json'
+# calculate_partial_md5 hashes the first 1024 blocks of 512 bytes (dd count=1024).
+PARTIAL_MD5_SIZE = 1024 * 512
+
+
+def get_signature_algorithm():
+    """openssl name of the IMAGE_SIG_ENCRYPTION_TYPE digest (for example sha3-512) when bundles
+    are signed, else None."""
+    if not get_config_value('IMAGE_SIG_PRIVATE_KEY'):
+        return None
+    return get_config_value('IMAGE_SIG_ENCRYPTION_TYPE')
+
+
+def _new_hash(algorithm):
+    # openssl names (sha3-512) to hashlib names (sha3_512).
+    return hashlib.new(algorithm.replace('-', '_'))
+
+
+class DigestingWriter():
+    """Writes sequentially to a file object while computing the md5, partial md5, signature
+    digest and fingerprint of everything written. Once the file is closed, write_digests()
+    records them with the members of the bundle next to it, caches the fingerprint and writes
+    the chunk manifest of the bundle."""
+
+    def __init__(self, fileobj, path, algorithms=None):
+        self.fileobj = fileobj
+        self.path = path
+        if algorithms is None:
+            algorithms = [get_signature_algorithm()]
+        self.hashes = {'md5': hashlib.md5()}
+        for algorithm in algorithms:
+            if algorithm and algorithm not in self.hashes:
+                self.hashes[algorithm] = _new_hash(algorithm)
+        self.partial_md5 = hashlib.md5()
+        self.tree = TreeHasher()
+        self.size = 0
+        self.members = []
+
+    def write(self, data):
+        """Write and hash data."""
+        if self.size < PARTIAL_MD5_SIZE:
+            self.partial_md5.update(memoryview(data)[:PARTIAL_MD5_SIZE - self.size])
+        for digest in self.hashes.values():
+            digest.update(data)
+        self.tree.update(data)
+        written = self.fileobj.write(data)
+        self.size += len(data)
+        return written
+
+    def tell(self):
+        """Number of bytes written so far."""
+        return self.size
+
+    def flush(self):
+        """Flush the underlying file object."""
+        self.fileobj.flush()
+
+    def add_member(self, name, size):
+        """Record a member of the bundle for its listing."""
+        self.members.append({'name': name, 'size': size})
+
+    def write_digests(self):
+        """Record the digests in the digests file of the closed bundle and return them."""
+        stat = os.stat(self.path)
+        if stat.st_size != self.size:
+            raise RuntimeError('{} is {} bytes long, {} bytes were written'.format(
+                self.path, stat.st_size, self.size))
+        digests = {
+            'size': stat.st_size,
+            'mtime': int(stat.st_mtime),
+            'partial_md5': self.partial_md5.hexdigest(),
+            'digests': {algorithm: digest.hexdigest()
+                        for algorithm, digest in self.hashes.items()},
+            'fingerprint': self.tree.hexdigest(),
+            'members': self.members
+        }
+        with open(self.path + DIGESTS_SUFFIX, 'w') as digests_file:
+            json.dump(digests, digests_file, indent=4)
+        store_fingerprint(self.path, digests['fingerprint'])
+        write_manifest(self.path, self.size, self.tree.leaves(), digests['fingerprint'])
+        LOGGER.debug('Recorded the %s digests of %s.', ', '.join(self.hashes), self.path)
+        return digests
+
+
+def store_file(path, member_path=None):
+    """Write stdin to path and record its digests. member_path names the file whose compressed
+    content is written, for the listing of the bundle."""
+    with open(0, 'rb', closefd=False) as input_file, open(path, 'wb') as output_file:
+        writer = DigestingWriter(output_file, path)
+        try:
+            copy_stream(input_file, writer, IO_CHUNK_SIZE)
+        except BaseException:
+            output_file.close()
+            os.unlink(path)
+            raise
+    if member_path:
+        writer.add_member(os.path.basename(member_path), os.path.getsize(member_path))
+    return writer.write_digests()
+
+
+def record_digests(path):
+    """Read the file at path once to record its digests and manifest, for bundles written by
+    other tools (qemu-img, ovftool)."""
+    drop_cache = get_io_policy('hash') != POLICY_DEFAULT
+    with open(path, 'rb', buffering=0) as input_file, open(os.devnull, 'wb') as null_file:
+        writer = DigestingWriter(null_file, path)
+        buffer = bytearray(IO_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            length = input_file.readinto(view)
+            if not length:
+                break
+            writer.write(view[:length])
+            if drop_cache:
+                drop_cached_range(input_file.fileno(), writer.size - length, length)
+    return writer.write_digests()
+
+
+def read_digests(path):
+    """Digests recorded for the bundle at path, or None if there are none or the bundle changed
+    since they were recorded."""
+    try:
+        with open(path + DIGESTS_SUFFIX) as digests_file:
+            digests = json.load(digests_file)
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if digests.get('size') != stat.st_size or digests.get('mtime') != int(stat.st_mtime):
+        LOGGER.debug('Ignoring the digests of %s, which changed since they were recorded.', path)
+        return None
+    return digests
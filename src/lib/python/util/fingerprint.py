@@ -0,0 +1,196 @@
+"""Fingerprints of build artifacts: BLAKE2b tree hashes cached with the file identity"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import errno
+import hashlib
+import json
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from util.io_policy import POLICY_DEFAULT, drop_cached_range, get_io_policy
+from util.logger import LOGGER
+from util.misc import get_disk_size
+from util.zero_blocks import iter_allocated_ranges
+
+# Files are split into leaves hashed independently (in parallel), the fingerprint is the hash of
+# the leaf digests and the file size. Leaves in holes aren't read: they hash like zero leaves.
+LEAF_SIZE = 16 * 1024 * 1024
+DIGEST_SIZE = 32
+ALGORITHM = 'blake2b-tree-{}m'.format(LEAF_SIZE >> 20)
+LEAF_PERSON = b'f5-leaf'
+ROOT_PERSON = b'f5-root'
+# Fingerprints are cached in an extended attribute of the file, or in a sidecar file where the
+# filesystem doesn't support user extended attributes. Either way they are only trusted while
+# the inode, size and modification time of the file match the cached ones.
+XATTR_NAME = 'user.f5_image_generator.fingerprint'
+SIDECAR_SUFFIX = '.fingerprint.json'
+
+
+def _leaf_hash():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE, person=LEAF_PERSON)
+
+
+def _root_digest(leaf_digests, size):
+    root = hashlib.blake2b(digest_size=DIGEST_SIZE, person=ROOT_PERSON)
+    for leaf_digest in leaf_digests:
+        root.update(leaf_digest)
+    root.update(size.to_bytes(8, 'little'))
+    return root.hexdigest()
+
+
+class TreeHasher():
+    """Fingerprint of data written sequentially, for example by an archive writer. Gives the
+    same fingerprint as compute_fingerprint() on the resulting file."""
+
+    def __init__(self):
+        self.leaf_digests = []
+        self.leaf = _leaf_hash()
+        self.leaf_length = 0
+        self.size = 0
+
+    def update(self, data):
+        """Hash data, which follows the data hashed so far."""
+        view = memoryview(data).cast('B')
+        while view:
+            length = min(len(view), LEAF_SIZE - self.leaf_length)
+            self.leaf.update(view[:length])
+            self.leaf_length += length
+            self.size += length
+            view = view[length:]
+            if self.leaf_length == LEAF_SIZE:
+                self.leaf_digests.append(self.leaf.digest())
+                self.leaf = _leaf_hash()
+                self.leaf_length = 0
+
+    def leaves(self):
+        """Digests of the leaves of the data hashed so far, the last one possibly partial."""
+        if self.leaf_length:
+            return self.leaf_digests + [self.leaf.digest()]
+        return list(self.leaf_digests)
+
+    def hexdigest(self):
+        """Fingerprint of the data hashed so far."""
+        return _root_digest(self.leaves(), self.size)
+
+
+def _hash_leaf(input_file, offset, length, drop_cache):
+    """Digest of one leaf, reading only its allocated ranges. Reads are positioned, so threads
+    can share input_file."""
+    fileno = input_file.fileno()
+    leaf = _leaf_hash()
+    position = offset
+    for data_offset, data_length in iter_allocated_ranges(input_file, offset, length):
+        if data_offset > position:
+            leaf.update(bytes(data_offset - position))
+        data = os.pread(fileno, data_length, data_offset)
+        if len(data) != data_length:
+            raise RuntimeError('Short read of {} bytes at {}'.format(data_length, data_offset))
+        leaf.update(data)
+        if drop_cache:
+            drop_cached_range(fileno, data_offset, data_length)
+        position = data_offset + data_length
+    if offset + length > position:
+        leaf.update(bytes(offset + length - position))
+    return leaf.digest()
+
+
+def compute_leaf_digests(path, threads=None):
+    """Read the file at path and return its size and the digests of its leaves. Leaves are
+    hashed on threads (all CPUs by default), BLAKE2b releases the GIL while hashing."""
+    drop_cache = get_io_policy('hash') != POLICY_DEFAULT
+    size = get_disk_size(path)
+    with open(path, 'rb', buffering=0) as input_file:
+        leaves = [(offset, min(LEAF_SIZE, size - offset))
+                  for offset in range(0, size, LEAF_SIZE)]
+        with ThreadPoolExecutor(threads or os.cpu_count() or 1) as executor:
+            leaf_digests = list(executor.map(
+                lambda leaf: _hash_leaf(input_file, leaf[0], leaf[1], drop_cache),
+                leaves))
+    return size, leaf_digests
+
+
+def compute_fingerprint(path, threads=None):
+    """Read the file at path and return its fingerprint."""
+    start_time = time.monotonic()
+    size, leaf_digests = compute_leaf_digests(path, threads)
+    fingerprint = _root_digest(leaf_digests, size)
+    LOGGER.info('Computed the fingerprint of %s (%d bytes) in %.1fs.', path, size,
+                time.monotonic() - start_time)
+    return fingerprint
+
+
+def _identity(file_stat):
+    return {'inode': file_stat.st_ino, 'size': file_stat.st_size,
+            'mtime_ns': file_stat.st_mtime_ns}
+
+
+def _read_cache(path, file_stat):
+    try:
+        cached = os.getxattr(path, XATTR_NAME)
+    except OSError:
+        try:
+            with open(path + SIDECAR_SUFFIX, 'rb') as sidecar:
+                cached = sidecar.read()
+        except OSError:
+            return None
+    try:
+        record = json.loads(cached)
+    except ValueError:
+        return None
+    if record.get('algorithm') != ALGORITHM or \
+            any(record.get(key) != value for key, value in _identity(file_stat).items()):
+        return None
+    return record.get('fingerprint')
+
+
+def store_fingerprint(path, fingerprint):
+    """Cache the fingerprint of the file at path, which must not change anymore."""
+    record = dict(_identity(os.stat(path)), algorithm=ALGORITHM, fingerprint=fingerprint)
+    encoded = json.dumps(record).encode()
+    try:
+        os.setxattr(path, XATTR_NAME, encoded)
+        return
+    except OSError as exc:
+        if exc.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES, errno.EROFS):
+            raise
+    try:
+        with open(path + SIDECAR_SUFFIX, 'wb') as sidecar:
+            sidecar.write(encoded)
+    except OSError as exc:
+        LOGGER.debug('Unable to cache the fingerprint of %s: %s', path, exc)
+
+
+def get_fingerprint(path, refresh=False):
+    """Fingerprint of the file at path, from its cache unless refresh is set or the file changed
+    since it was cached. The block devices of the lvm-thin backend are always read, as their
+    identity doesn't change with their content. Returns None for other kinds of files."""
+    file_stat = os.stat(path)
+    if stat.S_ISBLK(file_stat.st_mode):
+        return compute_fingerprint(path)
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+    if not refresh:
+        fingerprint = _read_cache(path, file_stat)
+        if fingerprint:
+            return fingerprint
+    fingerprint = compute_fingerprint(path)
+    if os.stat(path).st_mtime_ns != file_stat.st_mtime_ns:
+        raise RuntimeError('{} changed while its fingerprint was computed'.format(path))
+    store_fingerprint(path, fingerprint)
+    return fingerprint
@@ -16,13 +16,14 @@
 
 from os.path import basename, isdir, isfile, abspath, realpath, expanduser
 from pathlib import Path
-from shutil import copy2, copytree
+from shutil import copystat, copytree
 import re
 import requests
 
 from telemetry.build_info_inject import BuildInfoInject
 from util.config import get_config_value, get_list_from_config_yaml
 from util.logger import LOGGER
+from util.materialize import materialize_file
 
 
 def extract_single_worded_key(dictionary, key):
@@ -88,7 +89,8 @@ def read_injected_files(top_call_dir, overall_dest_dir):
         Path(file_holder).mkdir(parents=True, exist_ok=True)
         if isfile(src):
             LOGGER.info('Treating \'%s\' as a file for file injection', src)
-            copy2(src, source_holder)
+            materialize_file(src, source_holder)
+            copystat(src, source_holder)
         elif isdir(src):
             LOGGER.info('Treating \'%s\' as a directory for file injection', src)
             copytree(src, source_holder)
@@ -0,0 +1,253 @@
+"""Page cache policy for large sequential file I/O"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import errno
+import io
+import mmap
+import os
+
+from util.config import get_config_value, get_dict_from_config_json
+from util.logger import LOGGER
+
+# default: plain buffered I/O.
+# fadvise: buffered I/O, dropping the pages of each chunk from the page cache once processed.
+# direct:  O_DIRECT reads into aligned buffers, falling back to fadvise where unsupported.
+POLICY_DEFAULT = 'default'
+POLICY_FADVISE = 'fadvise'
+POLICY_DIRECT = 'direct'
+POLICIES = (POLICY_DEFAULT, POLICY_FADVISE, POLICY_DIRECT)
+
+# Stages that stream multi-GB files and can be configured independently in IO_POLICY_STAGES.
+STAGES = ('compress', 'convert', 'copy', 'extract', 'hash', 'scan', 'upload')
+
+DIRECT_ALIGNMENT = 4096
+IO_CHUNK_SIZE = 8 * 1024 * 1024
+# Granularity at which writers leave zero blocks as holes.
+SPARSE_BLOCK_SIZE = 64 * 1024
+# Dirty pages can't be dropped, so writers flush this often before advising the kernel.
+WRITE_FLUSH_SIZE = 64 * 1024 * 1024
+
+
+def get_io_policy(stage):
+    """Return the I/O policy for a stage: IO_POLICY_STAGES[stage], else IO_POLICY."""
+    if stage not in STAGES:
+        raise ValueError('Unknown I/O stage {}, expected one of {}'.format(stage, STAGES))
+    policy = None
+    if get_config_value('IO_POLICY_STAGES'):
+        policy = get_dict_from_config_json('IO_POLICY_STAGES').get(stage)
+    policy = policy or get_config_value('IO_POLICY') or POLICY_DEFAULT
+    if policy not in POLICIES:
+        raise ValueError('Unknown I/O policy {} for stage {}, expected one of {}'.format(
+            policy, stage, POLICIES))
+    return policy
+
+
+def drop_cached_range(fileno, offset, length):
+    """Ask the kernel to drop clean cached pages of a file range. Errors are not fatal."""
+    try:
+        os.posix_fadvise(fileno, offset, length, os.POSIX_FADV_DONTNEED)
+    except OSError as exc:
+        LOGGER.trace('posix_fadvise failed: %s', exc)
+
+
+class PolicyReader(io.RawIOBase):
+    """Sequential, read-only raw file honoring an I/O policy.
+
+    Reads go through an aligned buffer with O_DIRECT under the 'direct' policy, and the pages of
+    every chunk are dropped from the page cache under the 'fadvise' policy. Only sequential
+    reading is supported, which is what the copy, hash, upload and extract paths do."""
+
+    def __init__(self, path, policy, chunk_size=IO_CHUNK_SIZE):
+        super().__init__()
+        self.path = path
+        self.policy = policy
+        self.position = 0
+        self.buffer = None
+        self.buffer_start = 0
+        self.buffer_length = 0
+        self.fd = None
+
+        if policy == POLICY_DIRECT:
+            try:
+                self.fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+                # Anonymous mmaps are page aligned, as O_DIRECT requires.
+                self.chunk_size = -(-chunk_size // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT
+                self.buffer = mmap.mmap(-1, self.chunk_size)
+            except OSError as exc:
+                if exc.errno != errno.EINVAL:
+                    raise
+                LOGGER.debug('O_DIRECT is not supported for %s, using fadvise.', path)
+                self.policy = POLICY_FADVISE
+        if self.fd is None:
+            self.fd = os.open(path, os.O_RDONLY)
+            self.chunk_size = chunk_size
+            if self.policy != POLICY_DEFAULT:
+                os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self.fd
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def _readinto_direct(self, view):
+        """Serve reads from the aligned O_DIRECT buffer, refilling it chunk by chunk."""
+        if self.position >= self.buffer_start + self.buffer_length:
+            self.buffer_start = self.position
+            self.buffer_length = os.preadv(self.fd, [self.buffer], self.buffer_start)
+            if not self.buffer_length:
+                return 0
+        start = self.position - self.buffer_start
+        length = min(len(view), self.buffer_length - start)
+        view[:length] = self.buffer[start:start + length]
+        return length
+
+    def _fall_back_to_fadvise(self):
+        """Some filesystems accept O_DIRECT at open time but reject the reads."""
+        LOGGER.debug('O_DIRECT reads are not supported for %s, using fadvise.', self.path)
+        os.close(self.fd)
+        self.buffer.close()
+        self.buffer = None
+        self.fd = os.open(self.path, os.O_RDONLY)
+        self.policy = POLICY_FADVISE
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast('B')
+        if self.policy == POLICY_DIRECT:
+            try:
+                length = self._readinto_direct(view)
+            except OSError as exc:
+                if exc.errno != errno.EINVAL or self.buffer_start != self.position:
+                    raise
+                self._fall_back_to_fadvise()
+        if self.policy != POLICY_DIRECT:
+            length = os.preadv(self.fd, [view[:self.chunk_size]], self.position)
+            if length and self.policy == POLICY_FADVISE:
+                drop_cached_range(self.fd, self.position, length)
+        self.position += length
+        return length
+
+    def close(self):
+        if not self.closed:
+            if self.buffer is not None:
+                self.buffer.close()
+            os.close(self.fd)
+        super().close()
+
+
+class PolicyWriter(io.RawIOBase):
+    """Sequential, write-only raw file honoring an I/O policy.
+
+    All-zero blocks are skipped to keep the output sparse. Under the 'fadvise' and 'direct'
+    policies the written data is flushed and dropped from the page cache periodically; O_DIRECT
+    writes would need aligned sizes, so 'direct' behaves like 'fadvise' for writes."""
+
+    def __init__(self, path, policy):
+        super().__init__()
+        self.path = path
+        self.policy = policy
+        self.position = 0
+        self.flushed_position = 0
+        self.zero_chunk = b''
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def writable(self):
+        return True
+
+    def fileno(self):
+        return self.fd
+
+    def _is_zero(self, view):
+        """True if the block only holds zeroes. Checks the edges first to avoid copying data."""
+        if not view or view[0] or view[-1]:
+            return not view
+        if len(self.zero_chunk) < len(view):
+            self.zero_chunk = bytes(len(view))
+        return self.zero_chunk.startswith(view.tobytes())
+
+    def tell(self):
+        return self.position
+
+    def _write_at(self, view, position):
+        written = 0
+        while written < len(view):
+            written += os.pwrite(self.fd, view[written:], position + written)
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        length = len(view)
+        # Write runs of non-zero blocks, leaving holes for the zero blocks.
+        run_start = None
+        for block_start in range(0, length, SPARSE_BLOCK_SIZE):
+            if self._is_zero(view[block_start:block_start + SPARSE_BLOCK_SIZE]):
+                if run_start is not None:
+                    self._write_at(view[run_start:block_start], self.position + run_start)
+                    run_start = None
+            elif run_start is None:
+                run_start = block_start
+        if run_start is not None:
+            self._write_at(view[run_start:], self.position + run_start)
+        self.position += length
+
+        if self.policy != POLICY_DEFAULT and \
+                self.position - self.flushed_position >= WRITE_FLUSH_SIZE:
+            os.fdatasync(self.fd)
+            drop_cached_range(self.fd, self.flushed_position,
+                              self.position - self.flushed_position)
+            self.flushed_position = self.position
+        return length
+
+    def close(self):
+        if not self.closed:
+            os.ftruncate(self.fd, self.position)
+            if self.policy != POLICY_DEFAULT:
+                os.fdatasync(self.fd)
+                drop_cached_range(self.fd, 0, 0)
+            os.close(self.fd)
+        super().close()
+
+
+def open_with_io_policy(path, stage, mode='rb'):
+    """Open a file for sequential reading ('rb') or writing ('wb') with the policy of a stage.
+
+    The returned object is buffered like the result of open()."""
+    policy = get_io_policy(stage)
+    LOGGER.debug('Opening %s for %s with the %s I/O policy.', path, stage, policy)
+    if mode == 'rb':
+        return io.BufferedReader(PolicyReader(path, policy), IO_CHUNK_SIZE)
+    if mode == 'wb':
+        return io.BufferedWriter(PolicyWriter(path, policy), IO_CHUNK_SIZE)
+    raise ValueError('Unsupported mode {}'.format(mode))
+
+
+def copy_stream(src_file, dest_file, chunk_size=IO_CHUNK_SIZE):
+    """Copy everything from src_file to dest_file in chunks. Returns the bytes copied."""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    copied = 0
+    while True:
+        length = src_file.readinto(view)
+        if not length:
+            return copied
+        dest_file.write(view[:length])
+        copied += length
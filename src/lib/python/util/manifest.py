@@ -0,0 +1,108 @@
+"""Chunk manifests of bundles, to verify them in parallel and resume interrupted copies"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import json
+import os
+import time
+
+from util.fingerprint import ALGORITHM, LEAF_SIZE, compute_leaf_digests, get_fingerprint
+from util.logger import LOGGER
+
+# The manifest of a bundle is published next to it as <bundle>.manifest.json. Its chunks are
+# the leaves of the bundle fingerprint, so it is written along with the fingerprint while the
+# bundle is written, and the fingerprint of a copy can be checked chunk by chunk:
+# {
+#   "algorithm": "blake2b-tree-16m",
+#   "chunk_size": 16777216,
+#   "size": 2192284,
+#   "fingerprint": "0b6562f0612e942cf046fc21762769d9221a362dd66cebf52e4b9f39e50639e7",
+#   "chunks": ["5d0e4c6e3bd2bd1d7c33f8c9a46d1ad8ba1e5b27dcd2f93c85c2f9fd6d3a8c1e"]
+# }
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def write_manifest(path, size, leaf_digests, fingerprint):
+    """Write the manifest of the file at path from the digests of its leaves."""
+    manifest = {
+        'algorithm': ALGORITHM,
+        'chunk_size': LEAF_SIZE,
+        'size': size,
+        'fingerprint': fingerprint,
+        'chunks': [leaf_digest.hex() for leaf_digest in leaf_digests]
+    }
+    with open(path + MANIFEST_SUFFIX, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    return manifest
+
+
+def read_manifest(manifest_path):
+    """Load a manifest, raising ValueError if it isn't one this version can check."""
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('algorithm') != ALGORITHM or manifest.get('chunk_size') != LEAF_SIZE:
+        raise ValueError('{} is a {} manifest of {} byte chunks, expected {} of {}'.format(
+            manifest_path, manifest.get('algorithm'), manifest.get('chunk_size'), ALGORITHM,
+            LEAF_SIZE))
+    size = manifest.get('size')
+    if not isinstance(size, int) or len(manifest.get('chunks', [])) != -(-size // LEAF_SIZE):
+        raise ValueError('{} lists {} chunks for {} bytes'.format(
+            manifest_path, len(manifest.get('chunks', [])), size))
+    return manifest
+
+
+def get_source_manifest(path):
+    """Manifest of the file at path if it still describes it, else None."""
+    try:
+        manifest = read_manifest(path + MANIFEST_SUFFIX)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        LOGGER.warning('Ignoring the manifest of %s: %s', path, exc)
+        return None
+    if manifest['size'] != os.path.getsize(path) or \
+            manifest['fingerprint'] != get_fingerprint(path):
+        LOGGER.warning('Ignoring the manifest of %s, which changed since it was written.', path)
+        return None
+    return manifest
+
+
+def get_matching_chunks(path, manifest, threads=None):
+    """Indexes of the manifest chunks whose content in the file at path matches, hashing the
+    chunks of the file in parallel."""
+    if not os.path.exists(path):
+        return set()
+    leaf_digests = compute_leaf_digests(path, threads)[1]
+    return {index for index, (leaf_digest, chunk) in
+            enumerate(zip(leaf_digests, manifest['chunks'])) if leaf_digest.hex() == chunk}
+
+
+def verify_file(path, manifest_path=None, threads=None):
+    """Check the file at path against its manifest (<path>.manifest.json by default). Returns
+    the indexes of the mismatching chunks, an empty list when the file is intact."""
+    start_time = time.monotonic()
+    manifest = read_manifest(manifest_path or path + MANIFEST_SUFFIX)
+    matching = get_matching_chunks(path, manifest, threads)
+    mismatching = [index for index in range(len(manifest['chunks'])) if index not in matching]
+    size = os.path.getsize(path)
+    if size != manifest['size']:
+        LOGGER.warning('%s is %d bytes long, its manifest lists %d bytes.', path, size,
+                       manifest['size'])
+        if not mismatching:
+            mismatching.append(len(manifest['chunks']))
+    LOGGER.info('Verified %d chunks of %s in %.1fs, %d mismatching.', len(manifest['chunks']),
+                path, time.monotonic() - start_time, len(mismatching))
+    return mismatching
@@ -0,0 +1,258 @@
+"""Materialize large files at a new path with the cheapest strategy the filesystem offers"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import errno
+import fcntl
+import json
+import os
+import shutil
+import time
+from collections import namedtuple
+
+from util.config import get_config_value
+from util.io_policy import POLICY_DEFAULT, drop_cached_range, get_io_policy
+from util.logger import LOGGER
+from util.manifest import get_matching_chunks, get_source_manifest
+from util.zero_blocks import iter_allocated_ranges
+
+# ioctl request number of FICLONE (_IOW(0x94, 9, int)), supported by XFS, btrfs and others.
+FICLONE = 0x40049409
+
+STRATEGY_RENAME = 'rename'
+STRATEGY_REFLINK = 'reflink'
+STRATEGY_HARDLINK = 'hardlink'
+STRATEGY_COPY_FILE_RANGE = 'copy_file_range'
+STRATEGY_COPY = 'copy'
+STRATEGY_RESUME = 'resume'
+
+MATERIALIZE_LOG = 'materialize.json'
+# Resumable copies are written to <dest>.partial, which outlives interruptions.
+PARTIAL_SUFFIX = '.partial'
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Errors meaning "this strategy is not available here", as opposed to real I/O failures.
+_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                       errno.EPERM, errno.EMLINK, errno.EBADF)
+
+MaterializeResult = namedtuple('MaterializeResult', ['strategy', 'size', 'bytes_copied'])
+
+
+def _reflink(src, tmp_dest):
+    """Share all extents of src with tmp_dest (copy-on-write)."""
+    with open(src, 'rb') as src_file, open(tmp_dest, 'wb') as dest_file:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copymode(src, tmp_dest)
+    return 0
+
+
+def _hardlink(src, tmp_dest):
+    """Link tmp_dest to the inode of src. Only valid when nobody modifies src in place."""
+    os.link(src, tmp_dest)
+    return 0
+
+
+def _copy_ranges(src, tmp_dest, copy_range):
+    """Copy only the allocated ranges of src, leaving holes in tmp_dest. Returns bytes copied."""
+    size = os.path.getsize(src)
+    drop_cache = get_io_policy('copy') != POLICY_DEFAULT
+    copied = 0
+    with open(src, 'rb') as src_file, open(tmp_dest, 'wb') as dest_file:
+        for offset, length in iter_allocated_ranges(src_file, 0, size):
+            copied += copy_range(src_file, dest_file, offset, length)
+            if drop_cache:
+                dest_file.flush()
+                os.fdatasync(dest_file.fileno())
+                drop_cached_range(src_file.fileno(), offset, length)
+                drop_cached_range(dest_file.fileno(), offset, length)
+        dest_file.truncate(size)
+    shutil.copymode(src, tmp_dest)
+    return copied
+
+
+def _copy_file_range(src_file, dest_file, offset, length):
+    """Kernel side copy of one range, which may also be offloaded to the filesystem."""
+    remaining = length
+    while remaining:
+        copied = os.copy_file_range(src_file.fileno(), dest_file.fileno(), remaining,
+                                    offset + length - remaining, offset + length - remaining)
+        if not copied:
+            raise OSError(errno.EIO, 'copy_file_range stopped before the end of the range')
+        remaining -= copied
+    return length
+
+
+def _read_write(src_file, dest_file, offset, length):
+    """User space copy of one range."""
+    src_file.seek(offset)
+    dest_file.seek(offset)
+    remaining = length
+    while remaining:
+        chunk = src_file.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        dest_file.write(chunk)
+        remaining -= len(chunk)
+    return length - remaining
+
+
+def _copy_chunk(src_file, dest_file, offset, length):
+    """Copy one chunk, in the kernel if possible."""
+    try:
+        return _copy_file_range(src_file, dest_file, offset, length)
+    except OSError as exc:
+        if exc.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+    if _read_write(src_file, dest_file, offset, length) != length:
+        raise OSError(errno.EIO, 'Short read of {} bytes at {}'.format(length, offset))
+    return length
+
+
+def _resume_copy(src, dest, tmp_dest, manifest):
+    """Copy src to tmp_dest through dest.partial, only copying from src the chunks of its
+    manifest that an interrupted copy (dest.partial) or an earlier one (dest) doesn't already
+    hold. dest is left in place until the copy is complete, so a failed copy never loses it:
+    dest.partial starts as a reflink of it where possible, else its matching chunks are copied
+    locally. Returns bytes copied from src."""
+    partial = dest + PARTIAL_SUFFIX
+    earlier = dest if os.path.isfile(dest) and not os.path.islink(dest) else None
+    if earlier and not os.path.lexists(partial):
+        try:
+            _reflink(dest, partial)
+            earlier = None
+        except OSError as exc:
+            if os.path.lexists(partial):
+                os.unlink(partial)
+            if exc.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+    matching = get_matching_chunks(partial, manifest)
+    earlier_matching = get_matching_chunks(earlier, manifest) - matching if earlier else set()
+    copied = 0
+    with open(src, 'rb') as src_file, \
+            open(os.open(partial, os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as dest_file:
+        dest_file.truncate(manifest['size'])
+        earlier_file = open(earlier, 'rb') if earlier_matching else None
+        try:
+            for index in range(len(manifest['chunks'])):
+                if index in matching:
+                    continue
+                offset = index * manifest['chunk_size']
+                length = min(manifest['chunk_size'], manifest['size'] - offset)
+                if index in earlier_matching:
+                    _copy_chunk(earlier_file, dest_file, offset, length)
+                else:
+                    copied += _copy_chunk(src_file, dest_file, offset, length)
+        finally:
+            if earlier_file:
+                earlier_file.close()
+        dest_file.flush()
+        os.fsync(dest_file.fileno())
+    shutil.copymode(src, partial)
+    os.replace(partial, tmp_dest)
+    LOGGER.info('Resumed the copy of %s: %d of %d chunks were already copied.', src,
+                len(matching | earlier_matching), len(manifest['chunks']))
+    return copied
+
+
+def _record(src, dest, result, elapsed):
+    """Log the outcome and append it to the materialize log of the artifacts directory."""
+    saved = result.size - result.bytes_copied
+    LOGGER.info('Materialized %s as %s using %s in %.1fs (%d of %d bytes copied, %d saved).',
+                src, dest, result.strategy, elapsed, result.bytes_copied, result.size, saved)
+
+    artifacts_dir = get_config_value('ARTIFACTS_DIR')
+    if not artifacts_dir or not os.path.isdir(artifacts_dir):
+        return
+    log_path = os.path.join(artifacts_dir, MATERIALIZE_LOG)
+    records = []
+    if os.path.isfile(log_path):
+        try:
+            with open(log_path) as log_file:
+                records = json.load(log_file)
+        except ValueError:
+            LOGGER.warning('Ignoring unreadable %s', log_path)
+    records.append({'source': src, 'destination': dest, 'strategy': result.strategy,
+                    'size': result.size, 'bytes_copied': result.bytes_copied,
+                    'bytes_saved': saved, 'elapsed_seconds': round(elapsed, 3)})
+    with open(log_path, 'w') as log_file:
+        json.dump(records, log_file, indent=4)
+
+
+def materialize_file(src, dest, immutable=False, move=False, resume=False):
+    """Make the content of src available at dest as cheaply as possible.
+
+    The strategies are tried in order: rename (move only), FICLONE reflink, hardlink (only when
+    the caller guarantees src is immutable from now on), copy_file_range of the allocated ranges,
+    and finally a plain sparse copy. With resume, and a manifest of src, copies are made chunk by
+    chunk instead, keeping the chunks of an interrupted or earlier copy that match the manifest.
+    dest may be a directory. The destination is replaced atomically, so dest may safely be an
+    earlier link to src. Returns a MaterializeResult."""
+    if not os.path.isfile(src):
+        raise RuntimeError('Cannot materialize {}: not a file'.format(src))
+    if os.path.isdir(dest):
+        dest = os.path.join(dest, os.path.basename(src))
+    if os.path.exists(dest) and os.path.samefile(src, dest) and not move:
+        LOGGER.info('%s is already materialized as %s', src, dest)
+        return MaterializeResult(STRATEGY_HARDLINK, os.path.getsize(src), 0)
+
+    start_time = time.monotonic()
+    size = os.path.getsize(src)
+
+    if move:
+        try:
+            os.replace(src, dest)
+            result = MaterializeResult(STRATEGY_RENAME, size, 0)
+            _record(src, dest, result, time.monotonic() - start_time)
+            return result
+        except OSError as exc:
+            if exc.errno != errno.EXDEV:
+                raise RuntimeError('Failed to move {} to {}'.format(src, dest)) from exc
+
+    strategies = [(STRATEGY_REFLINK, _reflink)]
+    if immutable or move:
+        strategies.append((STRATEGY_HARDLINK, _hardlink))
+    manifest = get_source_manifest(src) if resume else None
+    if manifest:
+        strategies.append((STRATEGY_RESUME,
+                           lambda src, tmp_dest: _resume_copy(src, dest, tmp_dest, manifest)))
+    else:
+        strategies.append((STRATEGY_COPY_FILE_RANGE,
+                           lambda src, tmp_dest: _copy_ranges(src, tmp_dest, _copy_file_range)))
+        strategies.append((STRATEGY_COPY,
+                           lambda src, tmp_dest: _copy_ranges(src, tmp_dest, _read_write)))
+
+    tmp_dest = '{}.tmp.{}'.format(dest, os.getpid())
+    result = None
+    for strategy, function in strategies:
+        try:
+            if os.path.lexists(tmp_dest):
+                os.unlink(tmp_dest)
+            bytes_copied = function(src, tmp_dest)
+            result = MaterializeResult(strategy, size, bytes_copied)
+            break
+        except OSError as exc:
+            if strategy == strategies[-1][0] or exc.errno not in _UNSUPPORTED_ERRNOS:
+                if os.path.lexists(tmp_dest):
+                    os.unlink(tmp_dest)
+                raise RuntimeError('Failed to materialize {} as {} using {}'.format(
+                    src, dest, strategy)) from exc
+            LOGGER.debug('%s is not available for %s: %s', strategy, dest, exc)
+
+    os.replace(tmp_dest, dest)
+    if move:
+        os.unlink(src)
+    _record(src, dest, result, time.monotonic() - start_time)
+    return result
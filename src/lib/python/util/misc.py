@@ -46,6 +46,12 @@ def ensure_value_from_dict(value_dict, key):
         raise ValueError(error_message)
     return value
 
+def get_disk_size(disk_path):
+    """Size in bytes of a disk file or of a block device holding a disk."""
+    with open(disk_path, 'rb') as disk_file:
+        return disk_file.seek(0, os.SEEK_END)
+
+
 def save_image_id(image_id):
     """Takes in an image_id and saves it to artifacts_id/image_id.json."""
     image_id_json = {"image_id": image_id}
@@ -0,0 +1,64 @@
+"""Reproducible builds: timestamps and identifiers fixed by SOURCE_DATE_EPOCH"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import hashlib
+import os
+import time
+import uuid
+
+from util.config import get_config_value
+
+
+def get_source_date_epoch():
+    """SOURCE_DATE_EPOCH as an int when building reproducibly, else None."""
+    value = get_config_value('SOURCE_DATE_EPOCH')
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError as exc:
+        raise ValueError('SOURCE_DATE_EPOCH must be a number of seconds, not {}'.format(
+            value)) from exc
+
+
+def get_timestamp():
+    """Timestamp to record in images and archives: SOURCE_DATE_EPOCH, or the current time."""
+    epoch = get_source_date_epoch()
+    return int(time.time()) if epoch is None else epoch
+
+
+def get_file_mtime(file_stat):
+    """Modification time to record for a file in archives: SOURCE_DATE_EPOCH, or its own."""
+    epoch = get_source_date_epoch()
+    return int(file_stat.st_mtime) if epoch is None else epoch
+
+
+def get_unique_bytes(length, *parts):
+    """length random bytes, or when building reproducibly, bytes derived from
+    SOURCE_DATE_EPOCH and parts, which identify what they are used for."""
+    epoch = get_source_date_epoch()
+    if epoch is None:
+        return os.urandom(length)
+    derived = hashlib.blake2b(digest_size=length, person=b'f5-reproducible')
+    for part in (epoch,) + parts:
+        derived.update(str(part).encode() + b'\0')
+    return derived.digest()
+
+
+def get_unique_id(*parts):
+    """Random UUID, derived from SOURCE_DATE_EPOCH and parts when building reproducibly."""
+    return uuid.UUID(bytes=get_unique_bytes(16, *parts), version=4)
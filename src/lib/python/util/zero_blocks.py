@@ -0,0 +1,172 @@
+"""Zero block detection for disk images"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import errno
+import os
+
+from util.config import get_config_value
+from util.io_policy import POLICY_DEFAULT, drop_cached_range, get_io_policy
+from util.logger import LOGGER
+from util.misc import get_disk_size
+
+MIN_BLOCK_SIZE = 4 * 1024
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+DEFAULT_BLOCK_SIZE = 64 * 1024
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def get_zero_block_size(block_size=None):
+    """Validate the block size, defaulting to ZERO_BLOCK_SIZE_KB from the config."""
+    if block_size is None:
+        configured_kb = get_config_value('ZERO_BLOCK_SIZE_KB')
+        block_size = int(configured_kb) * 1024 if configured_kb else DEFAULT_BLOCK_SIZE
+    if block_size < MIN_BLOCK_SIZE or block_size > MAX_BLOCK_SIZE or \
+            block_size & (block_size - 1):
+        raise ValueError('Zero block size must be a power of two between {} and {} bytes, '
+                         'got {}'.format(MIN_BLOCK_SIZE, MAX_BLOCK_SIZE, block_size))
+    return block_size
+
+
+def iter_allocated_ranges(disk_file, offset, length):
+    """Yield (offset, length) ranges of the file that are backed by data, skipping holes.
+
+    Falls back to the whole range when the filesystem doesn't support SEEK_DATA/SEEK_HOLE."""
+    end = offset + length
+    fileno = disk_file.fileno()
+    position = offset
+    while position < end:
+        try:
+            data_start = os.lseek(fileno, position, os.SEEK_DATA)
+        except OSError as exc:
+            if exc.errno == errno.ENXIO:
+                # No more data past this position.
+                return
+            if exc.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield position, end - position
+                return
+            raise
+        if data_start >= end:
+            return
+        data_end = min(os.lseek(fileno, data_start, os.SEEK_HOLE), end)
+        yield data_start, data_end - data_start
+        position = data_end
+
+
+class ZeroBlockScanner():
+    """Classifies fixed size blocks of a file as zero or non-zero.
+
+    Blocks are aligned to absolute file offsets so consumers with block oriented targets (EBS
+    snapshot blocks, page blobs, sparse tar maps) can use the ranges as is. Holes are skipped
+    without being read, and allocated data is compared in large chunks against a zero buffer,
+    which runs at memcmp speed."""
+
+    def __init__(self, file_path, block_size=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.file_path = file_path
+        self.block_size = get_zero_block_size(block_size)
+        # Chunks are a whole number of blocks.
+        self.chunk_size = max(chunk_size - chunk_size % self.block_size, self.block_size)
+        self.file_size = get_disk_size(file_path)
+        self.scanned_bytes = 0
+        self.hole_bytes = 0
+        self.zero_bytes = 0
+
+    def _align_ranges(self, ranges):
+        """Expand ranges to block boundaries, clip them to the file and merge them."""
+        aligned = []
+        for offset, length in sorted(ranges):
+            start = offset - offset % self.block_size
+            end = min(-(-(offset + length) // self.block_size) * self.block_size, self.file_size)
+            if start >= end:
+                continue
+            if aligned and start <= aligned[-1][1]:
+                aligned[-1][1] = max(aligned[-1][1], end)
+            else:
+                aligned.append([start, end])
+        return [(start, end - start) for start, end in aligned]
+
+    def iter_nonzero_chunks(self, ranges=None):
+        """Yield (offset, data) for runs of non-zero blocks, in ascending offset order.
+
+        ranges: optional (offset, length) ranges to restrict the scan to, for example the data
+        ranges of a RawDiskLayout. Defaults to the whole file.
+        data is a memoryview into a reused buffer: it is only valid until the next iteration.
+        Runs never span read chunks, so adjacent runs may be yielded separately."""
+        if ranges is None:
+            ranges = [(0, self.file_size)]
+        self.scanned_bytes = self.hole_bytes = self.zero_bytes = 0
+
+        drop_cache = get_io_policy('scan') != POLICY_DEFAULT
+        zero_block = bytes(self.block_size)
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+
+        with open(self.file_path, 'rb', buffering=0) as disk_file:
+            for range_offset, range_length in self._align_ranges(ranges):
+                allocated = self._align_ranges(
+                    iter_allocated_ranges(disk_file, range_offset, range_length))
+                self.hole_bytes += range_length - sum(length for _, length in allocated)
+
+                for data_offset, data_length in allocated:
+                    disk_file.seek(data_offset)
+                    position = data_offset
+                    data_end = data_offset + data_length
+                    while position < data_end:
+                        read_size = disk_file.readinto(view[:min(self.chunk_size,
+                                                                 data_end - position)])
+                        if not read_size:
+                            break
+                        self.scanned_bytes += read_size
+                        run_start = None
+                        for block_start in range(0, read_size, self.block_size):
+                            block_length = min(self.block_size, read_size - block_start)
+                            if block_length == self.block_size:
+                                is_zero = buffer.startswith(zero_block, block_start)
+                            else:
+                                is_zero = buffer.startswith(zero_block[:block_length],
+                                                            block_start)
+                            if not is_zero:
+                                if run_start is None:
+                                    run_start = block_start
+                                continue
+                            self.zero_bytes += block_length
+                            if run_start is not None:
+                                yield position + run_start, view[run_start:block_start]
+                                run_start = None
+                        if run_start is not None:
+                            yield position + run_start, view[run_start:read_size]
+                        if drop_cache:
+                            drop_cached_range(disk_file.fileno(), position, read_size)
+                        position += read_size
+
+        LOGGER.debug('Scanned %d bytes of %s: %d bytes in holes, %d bytes in zero blocks.',
+                     self.scanned_bytes, self.file_path, self.hole_bytes, self.zero_bytes)
+
+    def iter_nonzero_ranges(self, ranges=None):
+        """Yield merged (offset, length) ranges of non-zero blocks.
+
+        ranges: optional (offset, length) ranges to restrict the scan to, for example the data
+        ranges of a RawDiskLayout. Defaults to the whole file."""
+        run_start = run_end = None
+        for offset, data in self.iter_nonzero_chunks(ranges):
+            if run_end == offset:
+                run_end += len(data)
+                continue
+            if run_start is not None:
+                yield run_start, run_end - run_start
+            run_start, run_end = offset, offset + len(data)
+        if run_start is not None:
+            yield run_start, run_end - run_start
@@ -0,0 +1,376 @@
+"""Tests of EbsSnapshotWriter and AWSEbsSnapshot against the local EbsDirectStub"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import base64
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from disk.vmdk import StreamOptimizedVmdkWriter
+from image.aws_ebs_snapshot import AWSEbsSnapshot, EBS_BLOCK_SIZE, EbsSnapshotWriter, \
+    ZERO_BLOCK, load_block_manifest, remove_block_manifest
+from image.aws_ebs_stub import EbsDirectStub
+from util.config import set_config_value, set_config_variable_prefix
+
+GRAIN_SIZE = 64 * 1024
+
+
+def _block(seed):
+    """A non-zero EBS block whose content depends on seed."""
+    return hashlib.sha256(str(seed).encode()).digest() * (EBS_BLOCK_SIZE // 32)
+
+
+class FailingStub(EbsDirectStub):
+    """EbsDirectStub whose PutSnapshotBlock fails for one block index."""
+
+    def __init__(self, failing_index, image_dir=None):
+        super().__init__(image_dir)
+        self.failing_index = failing_index
+
+    def put_snapshot_block(self, **kwargs):
+        # pylint: disable=arguments-differ
+        if kwargs['BlockIndex'] == self.failing_index:
+            raise ValueError('InternalServerException: block {}'.format(self.failing_index))
+        return super().put_snapshot_block(**kwargs)
+
+
+class RecordingStub(EbsDirectStub):
+    """EbsDirectStub recording the arguments of StartSnapshot and CompleteSnapshot."""
+
+    def __init__(self, image_dir=None):
+        super().__init__(image_dir)
+        self.started = []
+        self.completed = []
+
+    def start_snapshot(self, **kwargs):
+        # pylint: disable=arguments-differ
+        self.started.append(kwargs)
+        return super().start_snapshot(**kwargs)
+
+    def complete_snapshot(self, **kwargs):
+        # pylint: disable=arguments-differ
+        self.completed.append(kwargs)
+        return super().complete_snapshot(**kwargs)
+
+
+class FakeEc2Client():
+    """The EC2 calls AWSEbsSnapshot makes, over the snapshots of an EbsDirectStub."""
+
+    def __init__(self, stub):
+        self.stub = stub
+        self.tags = {}
+        self.deleted = []
+
+    def describe_snapshots(self, SnapshotIds):
+        # pylint: disable=invalid-name
+        return {'Snapshots': [{'SnapshotId': snapshot_id,
+                               'State': self.stub.snapshots[snapshot_id]['status']}
+                              for snapshot_id in SnapshotIds]}
+
+    def create_tags(self, Resources, Tags):
+        # pylint: disable=invalid-name
+        for resource in Resources:
+            self.tags[resource] = {tag['Key']: tag['Value'] for tag in Tags}
+
+    def delete_snapshot(self, SnapshotId):
+        # pylint: disable=invalid-name
+        self.deleted.append(SnapshotId)
+
+    def get_paginator(self, _):
+        """describe_snapshots paginator filtering by snapshot id and status."""
+        stub = self.stub
+
+        class _Paginator():
+            @staticmethod
+            def paginate(OwnerIds, Filters):
+                # pylint: disable=invalid-name,unused-argument
+                values = {snapshot_filter['Name']: snapshot_filter['Values']
+                          for snapshot_filter in Filters}
+                return [{'Snapshots': [
+                    {'SnapshotId': snapshot_id, 'StartTime': datetime.datetime(2022, 1, 1)}
+                    for snapshot_id, snapshot in stub.snapshots.items()
+                    if snapshot_id in values.get('snapshot-id', [snapshot_id]) and
+                    snapshot['status'] in values.get('status', [snapshot['status']])]}]
+
+        return _Paginator()
+
+
+class EbsSnapshotTest(unittest.TestCase):
+    """Base class setting up the configuration and a working directory."""
+
+    def setUp(self):
+        set_config_variable_prefix()
+        self.work_dir = tempfile.mkdtemp()
+        for key, value in (('AWS_EBS_MAX_CONCURRENCY', '4'),
+                           ('AWS_EBS_MANIFEST_DIR', os.path.join(self.work_dir, 'manifests')),
+                           ('AWS_EBS_PARENT_SNAPSHOT', None),
+                           ('AWS_EBS_SNAPSHOT_RETRY_COUNT', '2'),
+                           ('AWS_EBS_SNAPSHOT_RETRY_DELAY', '0')):
+            set_config_value(key, value)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_raw(self, name, blocks, size):
+        """Write a raw disk of size bytes holding the given blocks by index."""
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'wb') as raw_file:
+            raw_file.truncate(size)
+            for index, block in blocks.items():
+                raw_file.seek(index * EBS_BLOCK_SIZE)
+                raw_file.write(block[:size - index * EBS_BLOCK_SIZE])
+        return path
+
+    def write_vmdk(self, name, raw_path):
+        """Convert a raw disk into a streamOptimized VMDK of its non-zero grains."""
+        path = os.path.join(self.work_dir, name)
+        size = os.path.getsize(raw_path)
+        writer = StreamOptimizedVmdkWriter(path, size)
+        with open(raw_path, 'rb') as raw_file:
+            for offset in range(0, size, GRAIN_SIZE):
+                data = raw_file.read(GRAIN_SIZE)
+                if data.count(0) != len(data):
+                    writer.write(offset, data)
+        writer.close()
+        return path
+
+    def assert_snapshot_equals(self, stub, snapshot_id, raw_path):
+        """The snapshot holds the raw disk, followed by zeroes up to its volume size."""
+        with open(stub.get_image_path(snapshot_id), 'rb') as image_file, \
+                open(raw_path, 'rb') as raw_file:
+            raw = raw_file.read()
+            self.assertEqual(image_file.read(len(raw)), raw)
+            rest = image_file.read()
+            self.assertEqual(rest.count(0), len(rest))
+
+
+class EbsSnapshotWriterTest(EbsSnapshotTest):
+    """EbsSnapshotWriter writing disks to new snapshots."""
+
+    def test_zero_blocks_are_skipped(self):
+        stub = EbsDirectStub(self.work_dir)
+        writer = EbsSnapshotWriter(stub, 4)
+        size = 8 * EBS_BLOCK_SIZE
+        # Block 0 is yielded as zeroes, blocks 1, 2, 4, 5 and 7 aren't yielded at all.
+        chunks = [(0, bytes(EBS_BLOCK_SIZE)), (3 * EBS_BLOCK_SIZE, _block(3)),
+                  (6 * EBS_BLOCK_SIZE, _block(6))]
+        snapshot_id = writer.write(size, iter(chunks), 'test')
+
+        self.assertEqual(sorted(stub.snapshots[snapshot_id]['checksums']), [3, 6])
+        self.assertEqual(sorted(writer.blocks), [3, 6])
+        self.assertEqual(writer.sent_bytes, 2 * EBS_BLOCK_SIZE)
+        self.assertEqual(stub.snapshots[snapshot_id]['status'], 'completed')
+
+    def test_grains_are_gathered_into_blocks(self):
+        stub = EbsDirectStub(self.work_dir)
+        writer = EbsSnapshotWriter(stub, 4)
+        raw_path = self.write_raw('disk.raw', {1: _block(1), 2: _block(2)}, 4 * EBS_BLOCK_SIZE)
+        with open(raw_path, 'rb') as raw_file:
+            raw = raw_file.read()
+        # Grains of a block arrive separately and straddle blocks; the first one only
+        # holds the zeroes at the end of block 0.
+        chunks = [(offset, raw[offset:offset + 3 * GRAIN_SIZE])
+                  for offset in range(EBS_BLOCK_SIZE - GRAIN_SIZE, 3 * EBS_BLOCK_SIZE,
+                                      3 * GRAIN_SIZE)]
+        snapshot_id = writer.write(len(raw), iter(chunks), 'test')
+
+        self.assertEqual(sorted(stub.snapshots[snapshot_id]['checksums']), [1, 2])
+        self.assert_snapshot_equals(stub, snapshot_id, raw_path)
+
+    def test_linear_aggregate_checksum(self):
+        stub = RecordingStub()
+        writer = EbsSnapshotWriter(stub, 3)
+        blocks = {index: _block(index) for index in (9, 2, 5, 0)}
+        writer.write(16 * EBS_BLOCK_SIZE,
+                     iter(sorted((index * EBS_BLOCK_SIZE, block)
+                                 for index, block in blocks.items())), 'test')
+
+        # The SHA256 of the concatenated block checksums, in block index order.
+        aggregate = hashlib.sha256(b''.join(hashlib.sha256(blocks[index]).digest()
+                                            for index in sorted(blocks)))
+        self.assertEqual(stub.completed, [{
+            'SnapshotId': writer.snapshot_id, 'ChangedBlocksCount': 4,
+            'Checksum': base64.b64encode(aggregate.digest()).decode(),
+            'ChecksumAlgorithm': 'SHA256', 'ChecksumAggregationMethod': 'LINEAR'}])
+
+    def test_size_not_a_multiple_of_the_block_size(self):
+        stub = RecordingStub(self.work_dir)
+        writer = EbsSnapshotWriter(stub, 2)
+        size = 3 * EBS_BLOCK_SIZE + 12345
+        raw_path = self.write_raw('disk.raw', {0: _block(0), 3: _block(3)}, size)
+        with open(raw_path, 'rb') as raw_file:
+            raw = raw_file.read()
+        snapshot_id = writer.write(size, iter([(0, raw[:EBS_BLOCK_SIZE]),
+                                               (3 * EBS_BLOCK_SIZE, raw[3 * EBS_BLOCK_SIZE:])]),
+                                   'test')
+
+        # The last, partial block is padded with zeroes, the volume rounded up to a GiB.
+        self.assertEqual(stub.started[0]['VolumeSize'], 1)
+        self.assertEqual(sorted(stub.snapshots[snapshot_id]['checksums']), [0, 3])
+        self.assert_snapshot_equals(stub, snapshot_id, raw_path)
+
+    def test_failed_block_leaves_the_snapshot_for_clean_up(self):
+        stub = FailingStub(failing_index=5)
+        writer = EbsSnapshotWriter(stub, 2)
+        chunks = [(index * EBS_BLOCK_SIZE, _block(index)) for index in range(8)]
+        with self.assertRaises(ValueError):
+            writer.write(8 * EBS_BLOCK_SIZE, iter(chunks), 'test')
+
+        # The snapshot is known, so that it can be deleted, and was never completed.
+        self.assertIn(writer.snapshot_id, stub.snapshots)
+        self.assertEqual(stub.snapshots[writer.snapshot_id]['status'], 'pending')
+
+
+class EbsSnapshotWriterParentTest(EbsSnapshotTest):
+    """EbsSnapshotWriter writing only the blocks that differ from a parent snapshot."""
+
+    def setUp(self):
+        super().setUp()
+        self.stub = RecordingStub(self.work_dir)
+        self.size = 8 * EBS_BLOCK_SIZE
+        # Blocks 1 and 4 to 6 are zero.
+        self.parent_raw = self.write_raw('parent.raw', {0: _block(0), 2: _block(2), 3: _block(3),
+                                                        7: _block(7)}, self.size)
+        parent_writer = EbsSnapshotWriter(self.stub, 4)
+        self.parent_id = self.write_disk(parent_writer, self.parent_raw)
+        self.parent_blocks = parent_writer.blocks
+
+    def write_disk(self, writer, raw_path, parent_snapshot_id=None, parent_blocks=None):
+        """Write the non-zero grains of a raw disk with writer."""
+        with open(raw_path, 'rb') as raw_file:
+            raw = raw_file.read()
+        chunks = [(offset, raw[offset:offset + GRAIN_SIZE])
+                  for offset in range(0, len(raw), GRAIN_SIZE)
+                  if raw[offset:offset + GRAIN_SIZE].count(0) != GRAIN_SIZE]
+        return writer.write(len(raw), iter(chunks), 'test', parent_snapshot_id, parent_blocks)
+
+    def test_no_parent(self):
+        writer = EbsSnapshotWriter(self.stub, 4)
+        snapshot_id = self.write_disk(writer, self.parent_raw)
+
+        self.assertNotIn('ParentSnapshotId', self.stub.started[-1])
+        self.assertEqual(sorted(self.stub.snapshots[snapshot_id]['checksums']), [0, 2, 3, 7])
+        self.assertEqual(writer.blocks, self.parent_blocks)
+        self.assert_snapshot_equals(self.stub, snapshot_id, self.parent_raw)
+
+    def test_unchanged_disk(self):
+        writer = EbsSnapshotWriter(self.stub, 4)
+        snapshot_id = self.write_disk(writer, self.parent_raw, self.parent_id, self.parent_blocks)
+
+        self.assertEqual(self.stub.started[-1]['ParentSnapshotId'], self.parent_id)
+        self.assertEqual(self.stub.snapshots[snapshot_id]['checksums'], {})
+        self.assertEqual(self.stub.completed[-1]['ChangedBlocksCount'], 0)
+        self.assertEqual(writer.sent_bytes, 0)
+        # The manifest of the child lists every block it holds, not only the changed ones.
+        self.assertEqual(writer.blocks, self.parent_blocks)
+        self.assert_snapshot_equals(self.stub, snapshot_id, self.parent_raw)
+
+    def test_changed_new_and_parent_only_blocks(self):
+        # Block 0 is unchanged, 2 changed, 3 and 7 only in the parent (3 now zero, 7 no longer
+        # yielded at all), 5 new.
+        raw_path = self.write_raw('disk.raw', {0: _block(0), 2: _block(20), 5: _block(5)},
+                                  self.size)
+        writer = EbsSnapshotWriter(self.stub, 4)
+        snapshot_id = self.write_disk(writer, raw_path, self.parent_id, self.parent_blocks)
+
+        checksums = self.stub.snapshots[snapshot_id]['checksums']
+        self.assertEqual(sorted(checksums), [2, 3, 5, 7])
+        zero_checksum = hashlib.sha256(ZERO_BLOCK).digest()
+        self.assertEqual(checksums[3], zero_checksum)
+        self.assertEqual(checksums[7], zero_checksum)
+        self.assertEqual(checksums[2], hashlib.sha256(_block(20)).digest())
+        self.assertEqual(self.stub.completed[-1]['ChangedBlocksCount'], 4)
+        self.assertEqual(writer.sent_bytes, 4 * EBS_BLOCK_SIZE)
+        # Zeroed blocks are sent, but the child's manifest only holds its non-zero blocks.
+        self.assertEqual(sorted(writer.blocks), [0, 2, 5])
+        self.assertEqual(writer.blocks[0], self.parent_blocks[0])
+        self.assert_snapshot_equals(self.stub, snapshot_id, raw_path)
+        self.assertEqual(self.stub.snapshots[snapshot_id]['status'], 'completed')
+
+
+class AWSEbsSnapshotTest(EbsSnapshotTest):
+    """AWSEbsSnapshot writing a streamOptimized VMDK to a snapshot."""
+
+    def test_create_snapshot(self):
+        stub = EbsDirectStub(self.work_dir)
+        ec2_client = FakeEc2Client(stub)
+        raw_path = self.write_raw('disk.raw', {0: _block(0), 7: _block(7)}, 9 * EBS_BLOCK_SIZE)
+        snapshot = AWSEbsSnapshot(ec2_client, stub, self.write_vmdk('disk.vmdk', raw_path))
+        snapshot.get_snapshot_tag_metadata = lambda: {'platform': 'aws'}
+        snapshot.create_snapshot()
+
+        self.assertEqual(sorted(stub.snapshots[snapshot.snapshot_id]['checksums']), [0, 7])
+        self.assert_snapshot_equals(stub, snapshot.snapshot_id, raw_path)
+        self.assertEqual(ec2_client.tags[snapshot.snapshot_id], {'platform': 'aws'})
+        self.assertIsNone(snapshot.s3_disk)
+
+    def test_failed_snapshot_is_cleaned_up(self):
+        stub = FailingStub(failing_index=7)
+        ec2_client = FakeEc2Client(stub)
+        raw_path = self.write_raw('disk.raw', {0: _block(0), 7: _block(7)}, 9 * EBS_BLOCK_SIZE)
+        snapshot = AWSEbsSnapshot(ec2_client, stub, self.write_vmdk('disk.vmdk', raw_path))
+        with self.assertRaises(RuntimeError):
+            snapshot.create_snapshot()
+
+        snapshot_id = snapshot.snapshot_id
+        self.assertIsNotNone(snapshot_id)
+        snapshot.clean_up()
+        self.assertEqual(ec2_client.deleted, [snapshot_id])
+
+    def create_snapshots(self, remove_parent_manifest=False):
+        """Write a parent disk, then a disk differing in blocks 2 and 3 with the parent given
+        by AWS_EBS_PARENT_SNAPSHOT. Returns the stub, the two snapshots and the second disk."""
+        stub = EbsDirectStub(self.work_dir)
+        ec2_client = FakeEc2Client(stub)
+        size = 6 * EBS_BLOCK_SIZE
+        parent_raw = self.write_raw('parent.raw', {0: _block(0), 2: _block(2)}, size)
+        parent = AWSEbsSnapshot(ec2_client, stub, self.write_vmdk('parent.vmdk', parent_raw))
+        parent.get_snapshot_tag_metadata = lambda: {}
+        parent.create_snapshot()
+        if remove_parent_manifest:
+            remove_block_manifest(parent.snapshot_id)
+
+        raw_path = self.write_raw('disk.raw', {0: _block(0), 3: _block(3)}, size)
+        set_config_value('AWS_EBS_PARENT_SNAPSHOT', parent.snapshot_id)
+        snapshot = AWSEbsSnapshot(ec2_client, stub, self.write_vmdk('disk.vmdk', raw_path))
+        snapshot.get_snapshot_tag_metadata = lambda: {}
+        snapshot.create_snapshot()
+        self.assert_snapshot_equals(stub, snapshot.snapshot_id, raw_path)
+        return stub, parent, snapshot
+
+    def test_create_snapshot_from_parent(self):
+        stub, parent, snapshot = self.create_snapshots()
+
+        self.assertEqual(snapshot.parent_snapshot_id, parent.snapshot_id)
+        self.assertEqual(sorted(stub.snapshots[snapshot.snapshot_id]['checksums']), [2, 3])
+        manifest = load_block_manifest(snapshot.snapshot_id)
+        self.assertEqual(manifest['parent_snapshot_id'], parent.snapshot_id)
+        self.assertEqual(sorted(manifest['blocks']), [0, 3])
+
+    def test_parent_without_manifest(self):
+        stub, _, snapshot = self.create_snapshots(remove_parent_manifest=True)
+
+        # Without the parent's block manifest, the whole disk is written to a new snapshot.
+        self.assertIsNone(snapshot.parent_snapshot_id)
+        self.assertEqual(sorted(stub.snapshots[snapshot.snapshot_id]['checksums']), [0, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
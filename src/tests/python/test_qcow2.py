@@ -0,0 +1,140 @@
+"""Tests of the native qcow2 writer with the options the build passes to it"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from disk.image_writer import parse_image_options, parse_size_option
+from disk.qcow2 import CLUSTER_SIZE, HEADER_FORMAT, L2_ENTRIES, QCOW2_MAGIC, create_qcow2_writer
+from util.config import set_config_value, set_config_variable_prefix
+
+SRC_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+# Clear the flags (OFLAG_COPIED, compressed) of L1 and L2 entries.
+OFFSET_MASK = (1 << 62) - 1 & ~0x1ff
+
+
+def get_qcow2_disk_options(**config):
+    """The qcow2 options get_qcow2_disk_options of common.sh emits for the given config."""
+    env = {key: value for key, value in os.environ.items()
+           if key not in ('F5_QCOW2_COMPAT', 'F5_QCOW2_CLUSTER_SIZE')}
+    env.update({'F5_' + key: value for key, value in config.items()})
+    # Settings are read straight from the environment, without the slow config initialization.
+    env.update({'ENVIRONMENT_VARIABLE_PREFIX': 'F5_', 'CONFIG_SYSTEM_INITIALIZED': '1'})
+    return subprocess.run(['bash', '-c', 'source "$1"; get_qcow2_disk_options', 'bash',
+                           os.path.join(SRC_DIR, 'lib', 'bash', 'common.sh')],
+                          env=env, check=True, stdout=subprocess.PIPE,
+                          universal_newlines=True).stdout.strip()
+
+
+def read_qcow2(path):
+    """The virtual size and the content of a qcow2 v2 image without a backing file."""
+    with open(path, 'rb') as image_file:
+        header = struct.unpack(HEADER_FORMAT, image_file.read(struct.calcsize(HEADER_FORMAT)))
+        magic, version, _, _, cluster_bits, size, _, l1_size, l1_table_offset = header[:9]
+        if magic != QCOW2_MAGIC or version != 2 or cluster_bits != 16:
+            raise ValueError('Unexpected qcow2 header {}'.format(header))
+        image_file.seek(l1_table_offset)
+        l1_table = struct.unpack('>{}Q'.format(l1_size), image_file.read(l1_size * 8))
+        data = bytearray(size)
+        for l1_index, l1_entry in enumerate(l1_table):
+            if not l1_entry & OFFSET_MASK:
+                continue
+            image_file.seek(l1_entry & OFFSET_MASK)
+            l2_table = struct.unpack('>{}Q'.format(L2_ENTRIES), image_file.read(CLUSTER_SIZE))
+            for l2_index, l2_entry in enumerate(l2_table):
+                if not l2_entry & OFFSET_MASK:
+                    continue
+                offset = (l1_index * L2_ENTRIES + l2_index) * CLUSTER_SIZE
+                image_file.seek(l2_entry & OFFSET_MASK)
+                data[offset:offset + CLUSTER_SIZE] = \
+                    image_file.read(min(CLUSTER_SIZE, size - offset))
+    return size, bytes(data)
+
+
+class Qcow2OptionsTest(unittest.TestCase):
+    """Parsing the qcow2 options of qemu-img and QCOW2_CLUSTER_SIZE."""
+
+    def test_parse_size_option(self):
+        for value, size in (('65536', 65536), ('64k', 65536), ('64K', 65536), ('2M', 2 << 20),
+                            ('1m', 1 << 20)):
+            self.assertEqual(parse_size_option(value), size)
+        for value in ('', '64KiB', '1G', '-1', '0x10000'):
+            with self.assertRaises(ValueError):
+                parse_size_option(value)
+
+    def test_default_options(self):
+        self.assertEqual(parse_image_options(get_qcow2_disk_options()),
+                         {'compat': '0.10', 'cluster_size': '64k'})
+
+    def test_unsupported_cluster_size(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir)
+        options = parse_image_options(get_qcow2_disk_options(QCOW2_CLUSTER_SIZE='2M'))
+        with self.assertRaisesRegex(ValueError, 'cluster size 2M: the native writer only '
+                                                'writes 64 KiB clusters'):
+            create_qcow2_writer(os.path.join(work_dir, 'disk.qcow2'), 1 << 20, options)
+
+
+class ConvertRawDiskQcow2Test(unittest.TestCase):
+    """convert_raw_disk.py writing qcow2 images the way convert.sh runs it."""
+
+    def setUp(self):
+        set_config_variable_prefix()
+        self.work_dir = tempfile.mkdtemp()
+        set_config_value('LOG_FILE', os.path.join(self.work_dir, 'convert.log'))
+        set_config_value('LOG_LEVEL', 'INFO')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_convert_with_default_options(self):
+        raw_path = os.path.join(self.work_dir, 'disk.raw')
+        size = 3 * 1024 * 1024 + 4096
+        with open(raw_path, 'wb') as raw_file:
+            raw_file.truncate(size)
+            for offset in (0, 1024 * 1024 + 100, size - 10):
+                raw_file.seek(offset)
+                raw_file.write(os.urandom(10))
+        with open(raw_path, 'rb') as raw_file:
+            raw = raw_file.read()
+
+        qcow2_path = os.path.join(self.work_dir, 'disk.qcow2')
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [os.path.join(SRC_DIR, 'lib', 'python'), os.environ.get('PYTHONPATH', '')]))
+        subprocess.run([sys.executable, os.path.join(SRC_DIR, 'bin', 'convert_raw_disk.py'),
+                        '--target', 'qcow2', qcow2_path, get_qcow2_disk_options(), raw_path],
+                       env=env, check=True)
+
+        self.assertEqual(read_qcow2(qcow2_path), (size, raw))
+        if shutil.which('qemu-img'):
+            info = json.loads(subprocess.run(
+                ['qemu-img', 'info', '--output', 'json', '-f', 'qcow2', qcow2_path],
+                check=True, stdout=subprocess.PIPE).stdout)
+            self.assertEqual(info['virtual-size'], size)
+            self.assertEqual(info['cluster-size'], CLUSTER_SIZE)
+            subprocess.run(['qemu-img', 'check', '-f', 'qcow2', qcow2_path], check=True,
+                           stdout=subprocess.DEVNULL)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Tests of fixed VHDs, written by FixedVhdWriter or created in place by
+append_fixed_vhd_footer"""
+# Copyright (C) 2019-2022 F5 Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from disk.image_writer import SECTOR_SIZE
+from disk.vhd import AZURE_VHD_ALIGNMENT, DISK_TYPE_FIXED, FIXED_UNIT_SIZE, NO_DATA_OFFSET, \
+    FixedVhdWriter, append_fixed_vhd_footer, read_footer
+
+MIB = 1024 * 1024
+
+
+class FixedVhdFooterTest(unittest.TestCase):
+    """append_fixed_vhd_footer and read_footer."""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'disk.vhd')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_raw(self, size):
+        """Write a raw disk of size bytes with data at its start and end, return its content."""
+        with open(self.path, 'wb') as raw_file:
+            raw_file.truncate(size)
+            raw_file.write(os.urandom(4096))
+            raw_file.seek(size - 100)
+            raw_file.write(os.urandom(100))
+        with open(self.path, 'rb') as raw_file:
+            return raw_file.read()
+
+    def test_size_is_padded_with_a_hole(self):
+        raw_size = 3 * MIB + 12345
+        raw = self.write_raw(raw_size)
+        size = append_fixed_vhd_footer(self.path)
+
+        self.assertEqual(size, 4 * MIB)
+        self.assertEqual(os.path.getsize(self.path), size + SECTOR_SIZE)
+        with open(self.path, 'rb') as vhd_file:
+            self.assertEqual(vhd_file.read(raw_size), raw)
+            padding = vhd_file.read(size - raw_size)
+        self.assertEqual(padding.count(0), len(padding))
+        if hasattr(os, 'SEEK_DATA'):
+            # Nothing is allocated between the filesystem block holding the end of the raw disk
+            # and the footer.
+            block_size = os.statvfs(self.work_dir).f_bsize
+            with open(self.path, 'rb') as vhd_file:
+                hole = -(-raw_size // block_size) * block_size
+                self.assertEqual(os.lseek(vhd_file.fileno(), hole, os.SEEK_DATA), size)
+
+    def test_aligned_size_is_kept(self):
+        self.write_raw(2 * MIB)
+        self.assertEqual(append_fixed_vhd_footer(self.path), 2 * MIB)
+        self.assertEqual(os.path.getsize(self.path), 2 * MIB + SECTOR_SIZE)
+
+    def test_footer(self):
+        self.write_raw(5 * MIB + 1)
+        size = append_fixed_vhd_footer(self.path)
+        footer = read_footer(self.path)
+
+        self.assertEqual(size % AZURE_VHD_ALIGNMENT, 0)
+        self.assertEqual(footer['creator_app'], 'qem2')
+        self.assertEqual(footer['disk_type'], DISK_TYPE_FIXED)
+        self.assertEqual(footer['data_offset'], NO_DATA_OFFSET)
+        self.assertEqual(footer['original_size'], size)
+        self.assertEqual(footer['current_size'], size)
+
+    def test_invalid_checksum(self):
+        self.write_raw(MIB)
+        size = append_fixed_vhd_footer(self.path)
+        with open(self.path, 'r+b') as vhd_file:
+            # Flip a byte of the creator host OS.
+            vhd_file.seek(size + 36)
+            byte = vhd_file.read(1)
+            vhd_file.seek(size + 36)
+            vhd_file.write(bytes([byte[0] ^ 1]))
+        with self.assertRaisesRegex(RuntimeError, 'Invalid VHD footer checksum'):
+            read_footer(self.path)
+
+    @unittest.skipIf(shutil.which('qemu-img') is None, 'qemu-img is not installed')
+    def test_qemu_img_info(self):
+        self.write_raw(7 * MIB + 512)
+        size = append_fixed_vhd_footer(self.path)
+        info = json.loads(subprocess.run(
+            ['qemu-img', 'info', '--output', 'json', '-f', 'vpc', self.path],
+            check=True, stdout=subprocess.PIPE).stdout)
+
+        self.assertEqual(info['format'], 'vpc')
+        self.assertEqual(info['virtual-size'], size)
+
+
+class FixedVhdWriterTest(unittest.TestCase):
+    """FixedVhdWriter writing the non-zero data of a disk."""
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, 'disk.vhd')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_write(self):
+        size = 2 * MIB + 1000
+        raw = bytearray(size)
+        # Chunks across unit boundaries, in one unit, and up to the end of the disk.
+        chunks = [(FIXED_UNIT_SIZE - 100, os.urandom(300)), (MIB + 10, os.urandom(20)),
+                  (MIB + 4096, os.urandom(FIXED_UNIT_SIZE)), (size - 500, os.urandom(500))]
+        writer = FixedVhdWriter(self.path, size, force_size=True)
+        for offset, data in chunks:
+            writer.write(offset, data)
+            raw[offset:offset + len(data)] = data
+        writer.close()
+
+        # Units 0, 1, 16, 17 and 32.
+        self.assertEqual(writer.data_units, 5)
+        # force_size only rounds the virtual size up to a whole sector.
+        vhd_size = 2 * MIB + 1024
+        self.assertEqual(os.path.getsize(self.path), vhd_size + SECTOR_SIZE)
+        with open(self.path, 'rb') as vhd_file:
+            self.assertEqual(vhd_file.read(vhd_size), raw + bytes(vhd_size - size))
+        footer = read_footer(self.path)
+        self.assertEqual(footer['current_size'], vhd_size)
+        self.assertEqual(footer['disk_type'], DISK_TYPE_FIXED)
+
+    def test_write_past_the_end(self):
+        writer = FixedVhdWriter(self.path, MIB)
+        with self.assertRaises(ValueError):
+            writer.write(MIB - 10, bytes(20))
+        writer.abort()
+
+
+if __name__ == '__main__':
+    unittest.main()